@@ -0,0 +1,327 @@
+"""
+POS 連鎖店系統 v2.0 - 銷售分析匯出
+將 sales / sale_items 以 cursor.fetchmany 分批串流匯出為欄式檔案（Parquet 或 Arrow IPC），
+依月份、分店分區，報表指標以 pyarrow.compute 向量化計算，涵蓋全部歷史資料。
+
+目錄結構（hive 分區）：
+    <匯出目錄>/sales/month=2026-10/store_id=1/part-0.parquet
+    <匯出目錄>/sale_items/month=2026-10/store_id=1/part-0.parquet
+
+每次匯出在 <匯出目錄>/_export.json 記錄匯出時間與當時最大的 sales.id；讀取指標時，
+之後新增的銷售（id 較大）直接以 SQL 統計後合併，報表不會停在上次匯出。
+
+需要選用套件 pyarrow；未安裝時各函數回傳 {'success': False, 'message': ...}。
+"""
+import json
+import os
+import shutil
+from datetime import datetime
+
+import database
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+CHUNK_SIZE = 50000
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+PARTITION_FIELDS = (('month', 'string'), ('store_id', 'int64'))
+MANIFEST = '_export.json'
+
+# 匯出資料表 -> (SELECT（{where} 代入篩選條件）, 欄位與型別)
+# 依 created_at 順序串流（走 idx_sales_created，不需排序），同一月份的分區連續出現，寫完即可關閉
+EXPORT_TABLES = {
+    'sales': (
+        '''SELECT strftime('%Y-%m', created_at) AS month, store_id, id, member_id,
+            subtotal, discount, promo_discount, member_discount, total, payment_method, created_at
+        FROM sales {where} ORDER BY created_at''',
+        [('id', 'int64'), ('member_id', 'int64'), ('subtotal', 'float64'), ('discount', 'float64'),
+         ('promo_discount', 'float64'), ('member_discount', 'float64'), ('total', 'float64'),
+         ('payment_method', 'string'), ('created_at', 'string')]),
+    'sale_items': (
+        '''SELECT strftime('%Y-%m', s.created_at) AS month, s.store_id, si.id, si.sale_id, si.product_id,
+            si.product_name, si.quantity, si.unit_price, si.discount, si.subtotal, s.created_at
+        FROM sales s JOIN sale_items si ON si.sale_id = s.id {where} ORDER BY s.created_at''',
+        [('id', 'int64'), ('sale_id', 'int64'), ('product_id', 'int64'), ('product_name', 'string'),
+         ('quantity', 'int64'), ('unit_price', 'float64'), ('discount', 'float64'),
+         ('subtotal', 'float64'), ('created_at', 'string')]),
+}
+
+MISSING_PYARROW = {'success': False, 'message': '需要安裝 pyarrow（pip install pyarrow）'}
+
+
+def available():
+    """是否已安裝 pyarrow"""
+    return pa is not None
+
+
+def default_path():
+    """預設匯出目錄：資料庫旁的 analytics/（可用環境變數 POS_ANALYTICS_DIR 指定）"""
+    return os.environ.get('POS_ANALYTICS_DIR') or os.path.join(
+        os.path.dirname(os.path.abspath(database.DB_PATH)), 'analytics')
+
+
+def has_export(path=None):
+    """匯出目錄中是否已有銷售資料"""
+    return os.path.isdir(os.path.join(path or default_path(), 'sales'))
+
+
+def export_info(path=None):
+    """最近一次匯出的紀錄 {'exported_at', 'last_sale_id', 'format'}；沒有紀錄時回傳 None"""
+    try:
+        with open(os.path.join(path or default_path(), MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# ===== 匯出 =====
+
+class _PartitionWriter:
+    """單一分區的檔案寫入器（分批附加 record batch）"""
+
+    def __init__(self, path, schema, fmt):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if fmt == 'parquet':
+            self._writer = pq.ParquetWriter(path, schema)
+        else:
+            self._sink = pa.OSFile(path, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, schema)
+        self.schema = schema
+
+    def write(self, columns):
+        self._writer.write_batch(pa.record_batch(columns, schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+        if hasattr(self, '_sink'):
+            self._sink.close()
+
+
+def _export_table(conn, table, root, fmt, where, params, chunk_size):
+    """串流匯出一張表到 root/<table>/month=.../store_id=.../，回傳 (筆數, 檔案數)"""
+    select, fields = EXPORT_TABLES[table]
+    schema = pa.schema([(name, getattr(pa, type_)()) for name, type_ in fields])
+    writers = {}
+    buffers = {}
+    buffered = 0
+    rows = 0
+
+    files = 0
+
+    def flush(before_month=None):
+        """寫出緩衝資料；before_month 指定時關閉更早月份的分區"""
+        nonlocal files
+        for key, buffer in buffers.items():
+            if key not in writers:
+                month, store_id = key
+                path = os.path.join(root, table, f"month={month}", f"store_id={store_id}", f"part-0{FORMATS[fmt]}")
+                writers[key] = _PartitionWriter(path, schema, fmt)
+                files += 1
+            writers[key].write([pa.array(column, type=field.type) for column, field in zip(zip(*buffer), schema)])
+        buffers.clear()
+        if before_month:
+            for key in [key for key in writers if key[0] < before_month]:
+                writers.pop(key).close()
+
+    cursor = conn.cursor()
+    cursor.execute(select.format(where=where), params)
+    try:
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            if not chunk:
+                break
+            for row in chunk:
+                buffers.setdefault((row[0], row[1]), []).append(row[2:])
+            buffered += len(chunk)
+            rows += len(chunk)
+            # 各分區累積的筆數合計達 chunk_size 時寫出，記憶體用量與 chunk_size 成正比
+            if buffered >= chunk_size:
+                flush(before_month=chunk[-1][0])
+                buffered = 0
+        flush()
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return rows, files
+
+
+def export_sales(path=None, since=None, fmt='parquet', chunk_size=CHUNK_SIZE):
+    """匯出 sales / sale_items 為欄式檔案
+
+    since 為 'YYYY-MM'：只重新匯出該月（含）之後的分區，其他月份保留。
+    fmt 為 'parquet' 或 'arrow'（Arrow IPC）。
+    回傳 {'success': True, 'path', 'rows': {表: 筆數}, 'files': 檔案數}
+    """
+    if not available():
+        return dict(MISSING_PYARROW)
+    if fmt not in FORMATS:
+        return {'success': False, 'message': f'不支援的格式: {fmt}'}
+
+    path = path or default_path()
+    staging = os.path.join(path, '.staging')
+    shutil.rmtree(staging, ignore_errors=True)
+    where = {'sales': ("WHERE created_at >= ?" if since else ""),
+             'sale_items': ("WHERE s.created_at >= ?" if since else "")}
+    params = (f"{since}-01",) if since else ()
+
+    rows, files = {}, 0
+    with database.db_connection() as conn:
+        # 兩張表在同一個讀取交易內匯出，明細與主檔一致
+        conn.execute("BEGIN")
+        try:
+            last_sale_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM sales").fetchone()[0]
+            for table in EXPORT_TABLES:
+                rows[table], count = _export_table(conn, table, staging, fmt, where[table], params, chunk_size)
+                files += count
+        finally:
+            conn.rollback()
+
+    # 以暫存目錄取代舊分區（全量匯出取代整張表；since 只取代該月之後）
+    for table in EXPORT_TABLES:
+        target = os.path.join(path, table)
+        if since:
+            if os.path.isdir(target):
+                for name in os.listdir(target):
+                    if name.startswith('month=') and name[len('month='):] >= since:
+                        shutil.rmtree(os.path.join(target, name))
+        else:
+            shutil.rmtree(target, ignore_errors=True)
+        source = os.path.join(staging, table)
+        if os.path.isdir(source):
+            os.makedirs(target, exist_ok=True)
+            for name in os.listdir(source):
+                os.replace(os.path.join(source, name), os.path.join(target, name))
+    shutil.rmtree(staging, ignore_errors=True)
+
+    info = {'exported_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'last_sale_id': last_sale_id, 'format': fmt}
+    with open(os.path.join(path, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+    return {'success': True, 'path': path, 'rows': rows, 'files': files, 'exported_at': info['exported_at']}
+
+
+# ===== 向量化指標 =====
+
+def _dataset(path, table):
+    """讀取匯出的分區；每個檔案依副檔名選擇讀取器（增量匯出可能混用 Parquet 與 Arrow IPC）"""
+    partition_fields = [(name, getattr(pa, type_)()) for name, type_ in PARTITION_FIELDS]
+    schema = pa.schema([(name, getattr(pa, type_)()) for name, type_ in EXPORT_TABLES[table][1]] + partition_fields)
+    partitioning = ds.partitioning(pa.schema(partition_fields), flavor='hive')
+    root = os.path.join(path or default_path(), table)
+    files = {fmt: [] for fmt in FORMATS}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            for fmt, ext in FORMATS.items():
+                if name.endswith(ext):
+                    files[fmt].append(os.path.join(directory, name))
+    children = [ds.dataset(paths, format='ipc' if fmt == 'arrow' else fmt, schema=schema,
+                           partitioning=partitioning, partition_base_dir=root)
+                for fmt, paths in files.items() if paths]
+    if len(children) == 1:
+        return children[0]
+    return ds.dataset(children) if children else ds.dataset([], schema=schema)
+
+
+def _since_export(path, select, store_id=None, start_month=None, end_month=None, group_by=''):
+    """上次匯出之後新增的銷售（sales.id 大於匯出紀錄）直接以 SQL 統計；select 中 sales 的別名為 s"""
+    info = export_info(path)
+    if not info:
+        return []
+    conditions, params = ["s.id > ?"], [info['last_sale_id']]
+    if store_id:
+        conditions.append("s.store_id = ?")
+        params.append(store_id)
+    if start_month:
+        conditions.append("strftime('%Y-%m', s.created_at) >= ?")
+        params.append(start_month)
+    if end_month:
+        conditions.append("strftime('%Y-%m', s.created_at) <= ?")
+        params.append(end_month)
+    with database.db_connection() as conn:
+        return conn.execute(f"{select} WHERE {' AND '.join(conditions)} {group_by}", params).fetchall()
+
+
+def _filter(store_id=None, start_month=None, end_month=None):
+    """分區篩選條件（只讀取符合的月份 / 分店目錄）"""
+    expr = None
+    for condition in (
+        ds.field('store_id') == store_id if store_id else None,
+        ds.field('month') >= start_month if start_month else None,
+        ds.field('month') <= end_month if end_month else None,
+    ):
+        if condition is not None:
+            expr = condition if expr is None else expr & condition
+    return expr
+
+
+def sales_metrics(path=None, store_id=None, start_month=None, end_month=None):
+    """銷售指標：{'success', 'orders', 'revenue', 'discount', 'average', 'exported_at', 'pending'}
+
+    月份為 'YYYY-MM'（含）；exported_at 為上次匯出時間，pending 為之後由資料庫即時統計的訂單數。
+    """
+    if not available():
+        return dict(MISSING_PYARROW)
+    if not has_export(path):
+        return {'success': False, 'message': '尚未匯出分析資料'}
+    table = _dataset(path, 'sales').to_table(
+        columns=['total', 'discount'], filter=_filter(store_id, start_month, end_month))
+    [(pending, pending_revenue, pending_discount)] = _since_export(
+        path, "SELECT COUNT(*), COALESCE(SUM(s.total), 0), COALESCE(SUM(s.discount), 0) FROM sales s",
+        store_id, start_month, end_month) or [(0, 0, 0)]
+    orders = table.num_rows + pending
+    revenue = (pc.sum(table['total']).as_py() or 0) + pending_revenue
+    return {
+        'success': True,
+        'orders': orders,
+        'revenue': revenue,
+        'discount': (pc.sum(table['discount']).as_py() or 0) + pending_discount,
+        'average': revenue / orders if orders else 0,
+        'exported_at': (export_info(path) or {}).get('exported_at'),
+        'pending': pending,
+    }
+
+
+def monthly_revenue(path=None, store_id=None, start_month=None, end_month=None):
+    """每月每店營收：[{'month', 'store_id', 'orders', 'revenue'}]，依月份、分店排序（含上次匯出之後的銷售）"""
+    if not available() or not has_export(path):
+        return []
+    table = _dataset(path, 'sales').to_table(
+        columns=['month', 'store_id', 'total'], filter=_filter(store_id, start_month, end_month))
+    grouped = table.group_by(['month', 'store_id']).aggregate([('total', 'count'), ('total', 'sum')])
+    totals = {(row['month'], row['store_id']): [row['total_count'], row['total_sum']] for row in grouped.to_pylist()}
+    for month, sid, orders, revenue in _since_export(
+            path, "SELECT strftime('%Y-%m', s.created_at), s.store_id, COUNT(*), SUM(s.total) FROM sales s",
+            store_id, start_month, end_month, "GROUP BY 1, 2"):
+        total = totals.setdefault((month, sid), [0, 0])
+        total[0] += orders
+        total[1] += revenue
+    return [{'month': month, 'store_id': sid, 'orders': orders, 'revenue': revenue}
+            for (month, sid), (orders, revenue) in sorted(totals.items())]
+
+
+def product_sales(path=None, store_id=None, start_month=None, end_month=None, limit=10):
+    """商品銷售排行（依銷售額）：[{'product_id', 'product_name', 'total_qty', 'total_sales'}]（含上次匯出之後的銷售）"""
+    if not available() or not has_export(path):
+        return []
+    table = _dataset(path, 'sale_items').to_table(
+        columns=['product_id', 'product_name', 'quantity', 'subtotal'],
+        filter=_filter(store_id, start_month, end_month))
+    grouped = table.group_by('product_id').aggregate(
+        [('product_name', 'max'), ('quantity', 'sum'), ('subtotal', 'sum')])
+    products = {row['product_id']: {'product_id': row['product_id'], 'product_name': row['product_name_max'],
+                                    'total_qty': row['quantity_sum'], 'total_sales': row['subtotal_sum']}
+                for row in grouped.to_pylist()}
+    for product_id, name, qty, amount in _since_export(
+            path, "SELECT si.product_id, MAX(si.product_name), SUM(si.quantity), SUM(si.subtotal) "
+                  "FROM sales s JOIN sale_items si ON si.sale_id = s.id",
+            store_id, start_month, end_month, "GROUP BY si.product_id"):
+        product = products.setdefault(product_id, {'product_id': product_id, 'product_name': name,
+                                                   'total_qty': 0, 'total_sales': 0})
+        product['total_qty'] += qty
+        product['total_sales'] += amount
+    return sorted(products.values(), key=lambda p: p['total_sales'], reverse=True)[:limit]
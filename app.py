@@ -2,20 +2,27 @@
 POS 連鎖店系統 v2.0 - 主程式
 支援：總部+分店架構、統一會員、庫存調度、權限管理
 """
+import os
+import tempfile
 import streamlit as st
 import pandas as pd
-from database import init_db, get_stores, get_store_by_id, verify_login, get_user_by_id, get_connection
-from database import get_products, add_product, add_store_product, get_store_product, update_store_stock
-from database import get_members, add_member, get_member_by_phone, get_member_by_id
-from database import get_member_levels, add_member_level
-from database import get_promotions, add_promotion, calculate_promotion
-from database import create_sale, get_sales, get_daily_sales, get_store_revenue
-from database import get_transfers, create_transfer, approve_transfer
-from database import get_low_stock_products, get_top_products, get_hourly_sales
-from database import check_stock_available, check_cart_stock, check_birthday_discount
-from database import get_birthday_coupon, add_birthday_coupon
+from datetime import date, timedelta
+import analytics
+import catalog_import
+from database import init_db, cached_stores, get_store_by_id, verify_login, get_user_by_id, get_connection
+from database import cached_products, cached_pos_catalog, add_product, add_store_product, get_store_product, update_store_stock
+from database import calculate_price_inc_tax
+from database import get_members, count_members, page_cursor, add_member, get_member_by_phone, get_member_by_id
+from database import cached_member_levels, add_member_level, recalculate_member_levels, grant_birthday_bonus
+from database import get_promotions, add_promotion, price_cart
+from database import checkout, get_sales, get_daily_sales, get_store_revenue
+from database import get_transfers, create_transfer_order, approve_transfers
+from database import get_low_stock_products, get_top_products, get_today_top_products
+from database import get_hourly_sales, get_sales_heatmap
+from database import check_cart_stock
+from database import cached_birthday_coupon, add_birthday_coupon
 from database import get_holiday_templates, add_holiday_template, apply_holiday_template
-from database import generate_invoice_number, create_invoice, get_invoices, get_invoice_by_number
+from database import generate_invoice_number, get_invoices, get_invoice_by_number
 from database import void_invoice, get_invoice_statistics, print_invoice
 from database import create_einvoice, get_einvoice, get_einvoice_details, get_einvoice_amount, void_einvoice
 from database import get_einvoice_statistics, generate_mig_xml, add_track_number, get_available_track
@@ -24,14 +31,7 @@ from database import get_einvoice_statistics, generate_mig_xml, add_track_number
 init_db()
 st.set_page_config(page_title="POS 連鎖店系統", page_icon="🏪", layout="wide")
 
-
-def calculate_price_inc_tax(price_ex_tax):
-    if not price_ex_tax:
-        return 0.0
-    try:
-        return round(float(price_ex_tax) * 1.05, 1)
-    except:
-        return 0.0
+PAGE_SIZE = 100
 
 
 # ===== 登入頁面 =====
@@ -112,12 +112,12 @@ def dashboard_page():
     col1.metric("今日總營收", f"${total_revenue:,.0f}")
     col2.metric("今日總訂單", total_orders)
     
-    stores = get_stores(is_active=1)
+    stores = cached_stores(is_active=1)
     hq_count = len([s for s in stores if s['is_hq']])
     store_count = len([s for s in stores if not s['is_hq']])
     
     col3.metric("分店數", store_count)
-    col4.metric("會員數", len(get_members()))
+    col4.metric("會員數", count_members())
     
     # 各分店營收
     st.subheader("📈 各分店營收（近30天）")
@@ -135,6 +135,24 @@ def dashboard_page():
         revenues = [h['revenue'] for h in hourly]
         chart_data = pd.DataFrame({'小時': hours, '營收': revenues})
         st.bar_chart(chart_data.set_index('小時'))
+    
+    # 時段熱度圖（日期 x 小時）
+    st.subheader("🔥 時段熱度圖")
+    col1, col2, col3 = st.columns(3)
+    start_date = col1.date_input("開始日期", value=date.today() - timedelta(days=6), key="heatmap_start")
+    end_date = col2.date_input("結束日期", value=date.today(), key="heatmap_end")
+    store_names = {s['name']: s['id'] for s in stores}
+    selected = col3.multiselect("分店（不選為全部）", list(store_names), key="heatmap_stores")
+    heatmap = get_sales_heatmap(start_date.isoformat(), end_date.isoformat(),
+                                [store_names[name] for name in selected] or None)
+    if heatmap:
+        df = pd.DataFrame([dict(h) for h in heatmap])
+        pivot = df.pivot_table(index='day', columns='hour', values='revenue', fill_value=0)
+        pivot.index.name = '日期'
+        pivot.columns = [f"{h:02d}" for h in pivot.columns]
+        st.dataframe(pivot)
+    else:
+        st.info("此期間無銷售資料")
 
 
 # ===== 收銀前台 =====
@@ -154,23 +172,22 @@ def pos_page():
     
     with col1:
         search = st.text_input("🔍 搜尋商品", placeholder="輸入商品名稱或條碼...")
-        products = get_products(search, store_id)
+        # 商品、分店價、庫存與最佳促銷一次取得（資料未異動時使用快取）
+        products = cached_pos_catalog(store_id, search)
         
         if products:
             cols = st.columns(4)
             for i, p in enumerate(products):
-                p = dict(p)
                 stock = p.get('stock', 0) or 0
                 promo_text = ""
                 
-                # 檢查促銷
-                promos = get_promotions(p['id'])
-                if promos:
-                    promo = dict(promos[0])
-                    if promo['type'] == 'percent':
-                        promo_text = f" 🔥 {int(promo['value'])}%OFF"
+                # 促銷標示
+                if p['promo_type'] == 'percent':
+                    promo_text = f" 🔥 {int(p['promo_value'])}%OFF"
+                elif p['promo_discount'] > 0:
+                    promo_text = f" 🔥 -${p['promo_discount']:g}"
                 
-                price = p.get('store_price_inc', p['price_inc_tax'])
+                price = p['price']
                 
                 # 庫存不足標記
                 stock_status = "✅" if stock > 0 else "❌"
@@ -191,9 +208,10 @@ def pos_page():
                         remaining = stock - in_cart
                         if remaining > 0:
                             if st.button(f"加入", key=f"add_{p['id']}"):
-                                # 庫存再次檢查
-                                check = check_stock_available(store_id, p['id'], 1)
-                                if check['available']:
+                                # 庫存再次檢查（含購物車已選數量）
+                                check = check_cart_stock(store_id, [
+                                    {'product_id': p['id'], 'name': p['name'], 'quantity': in_cart + 1}])
+                                if check['all_available']:
                                     found = False
                                     for item in st.session_state.cart:
                                         if item['product_id'] == p['id']:
@@ -215,7 +233,7 @@ def pos_page():
                                         })
                                     st.rerun()
                                 else:
-                                    st.error(check['message'])
+                                    st.error(check['items'][0]['message'])
                         else:
                             st.caption("❌ 庫存不足")
                     else:
@@ -235,7 +253,7 @@ def pos_page():
             if member:
                 st.session_state.selected_member = member
                 # 檢查生日優惠
-                birthday_coupon = get_birthday_coupon()
+                birthday_coupon = cached_birthday_coupon()
                 if birthday_coupon:
                     st.success(f"✅ {member['name']} | 積分: {member['points']} | 🎂 生日優惠可適用")
                 else:
@@ -266,30 +284,14 @@ def pos_page():
         if st.session_state.cart:
             st.markdown("---")
             subtotal = sum(item['subtotal'] for item in st.session_state.cart)
-            
-            # 會員折扣
-            member_discount = 0
-            birthday_discount = 0
-            if st.session_state.selected_member:
-                member = dict(st.session_state.selected_member)
-                levels = get_member_levels()
-                for lv in levels:
-                    if lv['name'] == member['level']:
-                        member_discount = subtotal * (lv['discount_percent'] / 100)
-                        break
-                
-                # 生日優惠檢查
-                birthday_discount = check_birthday_discount(member['id'], subtotal)
-            
-            # 促銷折扣
-            promo_discount = 0
-            for item in st.session_state.cart:
-                promos = get_promotions(item['product_id'])
-                if promos:
-                    promo_discount += calculate_promotion(item, promos)
-            
             discount = st.number_input("折扣", 0, int(subtotal), 0)
-            total = int(subtotal - discount - promo_discount - member_discount - birthday_discount + 0.5)
+            
+            # 促銷、會員折扣、生日優惠一次計價（使用記憶體規則表）
+            pricing = price_cart(store_id, st.session_state.selected_member, st.session_state.cart, discount)
+            promo_discount = pricing['promo_discount']
+            member_discount = pricing['member_discount']
+            birthday_discount = pricing['birthday_discount']
+            total = pricing['total']
             
             if member_discount > 0:
                 st.success(f"👤 會員折扣: -${member_discount:.1f}")
@@ -313,41 +315,24 @@ def pos_page():
             
             # 結帳按鈕（庫存不足時禁用）
             if st.button("💰 結帳", type="primary", disabled=not stock_check['all_available']):
-                member_id = st.session_state.selected_member['id'] if st.session_state.selected_member else None
-                member_phone = st.session_state.selected_member['phone'] if st.session_state.selected_member else ""
-                member_email = st.session_state.selected_member['email'] if st.session_state.selected_member else ""
-                
-                # 建立銷售記錄
-                sale_id = create_sale(
-                    store_id=store_id,
-                    member_id=member_id,
-                    subtotal=subtotal,
-                    discount=discount,
-                    promo_discount=promo_discount,
-                    member_discount=member_discount + birthday_discount,
-                    total=total,
-                    cash=cash,
-                    change_amount=change,
-                    payment_method='cash',
-                    created_by=st.session_state.user_id,
-                    items=st.session_state.cart
+                # 銷售、扣庫存、積分、等級、發票同一筆交易完成
+                result = checkout(
+                    store_id,
+                    st.session_state.cart,
+                    member=st.session_state.selected_member,
+                    payment={'method': 'cash', 'cash': cash, 'discount': discount},
+                    created_by=st.session_state.user_id
                 )
                 
-                # 建立電子發票
-                invoice_id, invoice_number = create_invoice(
-                    store_id=store_id,
-                    sale_id=sale_id,
-                    member_id=member_id,
-                    total_amount=total,
-                    items=st.session_state.cart,
-                    member_phone=member_phone,
-                    member_email=member_email
-                )
-                
-                st.session_state.cart = []
-                st.session_state.selected_member = None
-                st.success(f"✅ 交易完成！\n\n找零 ${change}\n\n🧾 發票號碼: {invoice_number}")
-                st.rerun()
+                if result['success']:
+                    st.session_state.cart = []
+                    st.session_state.selected_member = None
+                    st.success(f"✅ 交易完成！\n\n找零 ${result['change']}\n\n🧾 發票號碼: {result['invoice_number']}")
+                    st.rerun()
+                else:
+                    st.error(f"❌ {result['message']}")
+                    for item in result.get('items', []):
+                        st.write(f"- {item['name']}: {item['message']}")
         
         if st.button("🗑️ 清空"):
             st.session_state.cart = []
@@ -377,7 +362,7 @@ def stores_page():
                 st.success("✅ 分店已新增")
                 st.rerun()
     
-    stores = get_stores()
+    stores = cached_stores()
     if stores:
         df = pd.DataFrame([{
             'ID': s['id'],
@@ -412,9 +397,33 @@ def products_page():
                     pid = add_product(name, price_ex, price_inc, cost, barcode, category)
                     st.success(f"✅ 商品已新增 (ID: {pid})")
                     st.rerun()
+
+        with st.expander("📥 批次匯入商品 / 分店價格"):
+            st.caption("CSV 或 JSONL，欄位：barcode、name、price_ex_tax、price_inc_tax、cost、category、store_code、stock、low_stock_alert")
+            upload = st.file_uploader("匯入檔案", type=["csv", "jsonl"])
+            dry_run = st.checkbox("只驗證（試算，不寫入）", value=True)
+            if upload and st.button("開始匯入"):
+                suffix = os.path.splitext(upload.name)[1]
+                with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+                    f.write(upload.getvalue())
+                progress = st.empty()
+                try:
+                    result = catalog_import.import_catalog(
+                        f.name, dry_run=dry_run, progress=lambda stage, rows: progress.text(f"{stage} {rows:,} 筆"))
+                finally:
+                    os.unlink(f.name)
+                if not result['success']:
+                    st.error(result['message'])
+                else:
+                    st.success(f"✅ {'試算' if dry_run else '匯入'}完成：商品新增 {result['products_created']:,}、"
+                               f"更新 {result['products_updated']:,}；分店商品新增 {result['store_products_created']:,}、"
+                               f"更新 {result['store_products_updated']:,}")
+                    if result['errors']:
+                        st.warning(f"⚠️ {result['error_count']:,} 列有錯誤已略過")
+                        st.dataframe(pd.DataFrame(result['errors']))
     
     # 商品列表
-    products = get_products(store_id=store_id if not is_admin else None)
+    products = cached_products(store_id=store_id if not is_admin else None)
     
     if products:
         df = pd.DataFrame([{
@@ -450,7 +459,7 @@ def members_page():
     # 會員等級設定（總部）
     if st.session_state.user_role == 'admin':
         with st.expander("🏆 會員等級"):
-            levels = get_member_levels()
+            levels = cached_member_levels()
             if levels:
                 st.dataframe(pd.DataFrame(levels))
             
@@ -464,10 +473,14 @@ def members_page():
                     add_member_level(name, min_points, min_spent, discount)
                     st.success("✅ 等級已新增")
                     st.rerun()
+            
+            if st.button("🔄 依門檻重新判定所有會員等級"):
+                changed = recalculate_member_levels()
+                st.success(f"✅ {changed:,} 位會員等級已更新")
         
         # 生日優惠設定
         with st.expander("🎂 生日優惠"):
-            birthday_coupon = get_birthday_coupon()
+            birthday_coupon = cached_birthday_coupon()
             if birthday_coupon:
                 st.write("### 當前生日優惠")
                 st.json(dict(birthday_coupon))
@@ -485,9 +498,24 @@ def members_page():
                     st.rerun()
             
             st.caption("💡 會員生日當月及前後一個月可使用此優惠")
-    
-    # 會員列表
-    members = get_members()
+            
+            if st.button("🎁 發放本月生日積分"):
+                granted = grant_birthday_bonus()
+                st.success(f"✅ 已發放 {granted:,} 位會員生日積分（依等級設定，同月不重複）")
+    
+    # 會員列表（keyset 分頁，每頁 PAGE_SIZE 筆；pages 保存每頁起點游標）
+    if 'member_pages' not in st.session_state:
+        st.session_state.member_pages = [None]
+    pages = st.session_state.member_pages
+    members = get_members(limit=PAGE_SIZE, before=pages[-1])
+    st.caption(f"共 {count_members():,} 位會員，第 {len(pages)} 頁")
+    col1, col2 = st.columns(2)
+    if col1.button("⬅️ 上一頁", disabled=len(pages) == 1):
+        pages.pop()
+        st.rerun()
+    if col2.button("下一頁 ➡️", disabled=len(members) < PAGE_SIZE):
+        pages.append(page_cursor(members[-1]))
+        st.rerun()
     if members:
         df = pd.DataFrame([{
             'ID': m['id'],
@@ -582,34 +610,51 @@ def promotions_page():
 # ===== 庫存調度 =====
 def inventory_page():
     st.title("📦 庫存調度")
-    
+
     is_admin = st.session_state.user_role == 'admin'
     store_id = st.session_state.user_store_id
-    
-    # 調货申請
+
+    # 調货申請（一張調貨單可包含多項商品）
     with st.expander("📝 申請調貨"):
-        stores = get_stores(is_active=1)
+        stores = cached_stores(is_active=1)
         stores_options = {s['name']: s['id'] for s in stores if s['id'] != store_id}
-        
-        products = get_products(store_id=store_id)
-        
+
+        products = cached_products(store_id=store_id)
+        product_ids = {p['name']: p['id'] for p in products}
+        selected = st.multiselect("商品", list(product_ids), key="transfer_products")
+
         with st.form("transfer"):
             to_store = st.selectbox("調至分店", list(stores_options.keys()))
-            product = st.selectbox("商品", [p['name'] for p in products])
-            quantity = st.number_input("數量", min_value=1, value=1)
+            quantities = {name: st.number_input(f"{name} 數量", min_value=1, value=1, key=f"transfer_qty_{name}")
+                          for name in selected}
             notes = st.text_input("備註")
-            
+
             if st.form_submit_button("申請"):
-                product_id = products[[p['name'] for p in products].index(product)]['id']
-                create_transfer(store_id, stores_options[to_store], product_id, quantity, notes)
-                st.success("✅ 調貨申請已提交")
-                st.rerun()
-    
+                result = create_transfer_order(
+                    store_id, stores_options[to_store],
+                    [(product_ids[name], int(qty)) for name, qty in quantities.items()],
+                    notes, st.session_state.user_id)
+                if result['success']:
+                    st.success(f"✅ 調貨申請已提交（{len(result['transfer_ids'])} 項）")
+                    st.rerun()
+                else:
+                    st.error(result['message'])
+
+    # 上次整批核准未通過的明細
+    rejected = st.session_state.pop('transfer_rejected', None)
+    if rejected:
+        st.warning(f"⚠️ {len(rejected)} 項未核准（維持待審核）")
+        st.dataframe(pd.DataFrame([{
+            'ID': r['transfer_id'], '商品ID': r['product_id'], '數量': r['quantity'],
+            '可調庫存': r['available'], '原因': r['message']
+        } for r in rejected]))
+
     # 調貨記錄
     transfers = get_transfers(store_id if not is_admin else None)
     if transfers:
         df = pd.DataFrame([{
             'ID': t['id'],
+            '調貨單': t['order_id'],
             '調出': t['from_store'],
             '調入': t['to_store'],
             '商品': t['product_name'],
@@ -618,18 +663,26 @@ def inventory_page():
             '日期': t['created_at']
         } for t in transfers])
         st.dataframe(df)
-        
-        # 審核（總部）
-        if is_admin:
-            pending = [t for t in transfers if t['status'] == 'pending']
-            if pending:
-                st.subheader("✅ 待審核")
-                for t in pending:
-                    col1, col2 = st.columns([3, 1])
-                    col1.write(f"{t['from_store']} → {t['to_store']}: {t['product_name']} x{t['quantity']}")
-                    if col2.button("核准", key=f"approve_{t['id']}"):
-                        approve_transfer(t['id'], st.session_state.user_id)
-                        st.rerun()
+
+    # 審核（總部）：勾選後一次核准，庫存不足的項目不核准並列出
+    if is_admin:
+        pending = get_transfers(status='pending', limit=PAGE_SIZE * 5)
+        if pending:
+            st.subheader("✅ 待審核")
+            editor = st.data_editor(pd.DataFrame([{
+                '核准': False,
+                'ID': t['id'],
+                '調貨單': t['order_id'],
+                '調出': t['from_store'],
+                '調入': t['to_store'],
+                '商品': t['product_name'],
+                '數量': t['quantity']
+            } for t in pending]), disabled=['ID', '調貨單', '調出', '調入', '商品', '數量'], key="pending_transfers")
+            if st.button("核准勾選項目"):
+                result = approve_transfers(editor.loc[editor['核准'], 'ID'].tolist(), st.session_state.user_id)
+                st.session_state.transfer_rejected = result['rejected']
+                st.success(f"✅ 已核准 {len(result['approved'])} 項")
+                st.rerun()
 
 
 # ===== 銷售報表 =====
@@ -653,14 +706,43 @@ def reports_page():
         } for s in sales])
         st.dataframe(df)
         
+        # 全部歷史指標（由欄式分析檔向量化計算；未匯出時只統計上表最近 500 筆）
+        metrics = analytics.sales_metrics(store_id=store_id)
         col1, col2, col3 = st.columns(3)
-        col1.metric("總營收", f"${df['總額'].sum():,.0f}")
-        col2.metric("訂單數", len(df))
-        col3.metric("平均訂單", f"${df['總額'].mean():,.0f}")
+        if metrics['success']:
+            col1.metric("總營收", f"${metrics['revenue']:,.0f}")
+            col2.metric("訂單數", f"{metrics['orders']:,}")
+            col3.metric("平均訂單", f"${metrics['average']:,.0f}")
+            if metrics['exported_at']:
+                st.caption(f"分析資料匯出於 {metrics['exported_at']}，之後的 {metrics['pending']:,} 筆訂單由資料庫即時統計")
+        else:
+            col1.metric("總營收", f"${df['總額'].sum():,.0f}")
+            col2.metric("訂單數", len(df))
+            col3.metric("平均訂單", f"${df['總額'].mean():,.0f}")
+            st.caption(f"僅統計最近 {len(df)} 筆（{metrics['message']}）")
+        
+        if st.session_state.user_role == 'admin' and st.button("📦 匯出分析資料"):
+            with st.spinner("匯出中..."):
+                result = analytics.export_sales()
+            if result['success']:
+                st.success(f"已匯出 {result['rows']['sales']:,} 筆銷售、{result['rows']['sale_items']:,} 筆明細")
+                st.rerun()
+            else:
+                st.error(result['message'])
+        
+        monthly = analytics.monthly_revenue(store_id=store_id)
+        if monthly:
+            st.subheader("📅 每月營收")
+            monthly_df = pd.DataFrame(monthly).pivot_table(
+                index='month', columns='store_id', values='revenue', aggfunc='sum', fill_value=0)
+            st.bar_chart(monthly_df)
         
         # 熱銷商品
         st.subheader("🔥 熱銷商品")
-        top = get_top_products(store_id)
+        col1, col2 = st.columns(2)
+        top_start = col1.date_input("開始日期", value=date.today() - timedelta(days=29), key="top_start")
+        top_end = col2.date_input("結束日期", value=date.today(), key="top_end")
+        top = get_top_products(store_id, start_date=top_start.isoformat(), end_date=top_end.isoformat())
         if top:
             st.dataframe(pd.DataFrame([{
                 '商品': t['product_name'],
@@ -668,6 +750,16 @@ def reports_page():
                 '銷售額': t['total_sales']
             } for t in top]))
         
+        if store_id:
+            st.subheader("⚡ 今日熱銷")
+            today_top = get_today_top_products(store_id)
+            if today_top:
+                st.dataframe(pd.DataFrame([{
+                    '商品': t['product_name'],
+                    '銷售數量': t['total_qty'],
+                    '銷售額': t['total_sales']
+                } for t in today_top]))
+        
         # 低庫存警示
         if store_id:
             st.subheader("⚠️ 低庫存警示")
@@ -833,13 +925,15 @@ def invoices_page():
     
     # 取得發票列表
     conn = get_connection()
-    cursor = conn.cursor()
-    if seller_id:
-        cursor.execute("SELECT * FROM einvoice_main WHERE seller_identifier = ? ORDER BY created_at DESC LIMIT 50", (seller_id,))
-    else:
-        cursor.execute("SELECT * FROM einvoice_main ORDER BY created_at DESC LIMIT 50")
-    invoices = cursor.fetchall()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        if seller_id:
+            cursor.execute("SELECT * FROM einvoice_main WHERE seller_identifier = ? ORDER BY created_at DESC LIMIT 50", (seller_id,))
+        else:
+            cursor.execute("SELECT * FROM einvoice_main ORDER BY created_at DESC LIMIT 50")
+        invoices = cursor.fetchall()
+    finally:
+        conn.close()
     
     if invoices:
         df = pd.DataFrame([{
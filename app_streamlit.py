@@ -8,8 +8,8 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from database import (
     init_db, get_connection,
-    get_stores, create_store, get_store_by_id,
-    get_products, create_product, get_product_by_id,
+    cached_stores, create_store, get_store_by_id,
+    cached_products, create_product, get_product_by_id,
     create_einvoice, generate_mig_xml, get_einvoice, get_einvoice_details, get_einvoice_amount,
     get_members, create_member, add_points, use_points,
     get_promotions, create_promotion,
@@ -75,7 +75,7 @@ elif page == "門市管理":
     tab1, tab2 = st.tabs(["門市列表", "新增門市"])
     
     with tab1:
-        stores = get_stores()
+        stores = cached_stores()
         for store in stores:
             with st.expander(f"{store['name']} ({store['code']})"):
                 st.write(f"**地址:** {store.get('address', 'N/A')}")
@@ -102,7 +102,7 @@ elif page == "商品管理":
     tab1, tab2 = st.tabs(["商品列表", "新增商品"])
     
     with tab1:
-        products = get_products()
+        products = cached_products()
         for p in products:
             with st.expander(f"{p['name']} - NT${p.get('price_inc_tax', 0)}"):
                 st.write(f"**條碼:** {p.get('barcode', 'N/A')}")
@@ -131,7 +131,7 @@ elif page == "銷售 POS":
     
     with col1:
         st.subheader("選擇商品")
-        products = get_products()
+        products = cached_products()
         
         if 'cart' not in st.session_state:
             st.session_state.cart = []
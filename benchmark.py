@@ -0,0 +1,1134 @@
+#!/usr/bin/env python3
+"""
+POS 連鎖店系統 v2.0 - 效能基準測試
+用法：python benchmark.py [項目 ...]（不指定則全部執行）
+每個項目都在暫存資料庫上執行，不會動到 pos_chain.db
+"""
+
+import sys
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """註冊基準測試項目"""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def fresh_db():
+    """建立暫存資料庫並切換 DB_PATH"""
+    workdir = tempfile.mkdtemp(prefix="pos_bench_")
+    database.close_pools()
+    database.DB_PATH = os.path.join(workdir, "bench.db")
+    database.init_db()
+    return workdir
+
+
+def drop_db(workdir):
+    database.close_pools()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def timed(func, repeat=1):
+    """回傳平均每次耗時（秒）"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def report(label, seconds, count=None):
+    if count:
+        print(f"  {label:<36} {seconds * 1000:10.2f} ms  ({count / seconds:,.0f} /s)")
+    else:
+        print(f"  {label:<36} {seconds * 1000:10.2f} ms")
+
+
+# ===== 連線池 =====
+
+@benchmark('pool')
+def bench_pool(calls=5000):
+    """每次查詢都重新連線 vs 連線池借用"""
+    workdir = fresh_db()
+    try:
+        def raw_connect():
+            conn = sqlite3.connect(database.DB_PATH, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("SELECT * FROM stores WHERE id = ?", (1,)).fetchone()
+            conn.close()
+
+        def pooled():
+            database.get_store_by_id(1)
+
+        report(f"sqlite3.connect x{calls}", timed(raw_connect, calls) * calls, calls)
+        report(f"pooled get_store_by_id x{calls}", timed(pooled, calls) * calls, calls)
+        print(f"  pool stats: {database.get_pool_stats()}")
+    finally:
+        drop_db(workdir)
+
+
+# ===== WAL / PRAGMA 設定檔 =====
+
+def seed_stores(count=4, products=None):
+    """建立分店與分店商品（每店每商品庫存充足）"""
+    conn = database.get_connection()
+    cursor = conn.cursor()
+    store_ids = []
+    for i in range(count):
+        cursor.execute("INSERT INTO stores (name, code) VALUES (?, ?)", (f"分店{i + 1}", f"S{i + 1:03d}"))
+        store_ids.append(cursor.lastrowid)
+    product_ids = products or [row[0] for row in cursor.execute("SELECT id FROM products")]
+    cursor.executemany('''INSERT INTO store_products (store_id, product_id, price_ex_tax, price_inc_tax, stock)
+        VALUES (?, ?, 100, 105, 1000000000)''', [(s, p) for s in store_ids for p in product_ids])
+    conn.commit()
+    conn.close()
+    return store_ids, product_ids
+
+
+def seed_sales_history(store_ids, product_ids, sales=20000, items_per_sale=3, days=30, batch=5000):
+    """直接批次寫入歷史銷售資料（不經過結帳流程）"""
+    conn = database.get_connection()
+    cursor = conn.cursor()
+    rng = random.Random(42)
+    for start in range(0, sales, batch):
+        size = min(batch, sales - start)
+        first_id = cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM sales").fetchone()[0]
+        cursor.executemany('''INSERT INTO sales (id, store_id, subtotal, total, created_at)
+            VALUES (?, ?, 300, 300, datetime('now', ? || ' minutes'))''',
+            [(first_id + i, rng.choice(store_ids), -rng.randrange(days * 24 * 60)) for i in range(size)])
+        cursor.executemany('''INSERT INTO sale_items (sale_id, product_id, product_name, quantity, unit_price, subtotal)
+            VALUES (?, ?, ?, 1, 100, 100)''',
+            [(sale_id, pid, f"商品{pid}")
+             for sale_id in range(first_id, first_id + size)
+             for pid in rng.sample(product_ids, min(items_per_sale, len(product_ids)))])
+    conn.commit()
+    conn.close()
+    database.rebuild_sales_rollup()
+
+
+def run_concurrently(workers, duration):
+    """同時執行多個工作函數 duration 秒，回傳各函數完成次數"""
+    stop = threading.Event()
+    counts = [0] * len(workers)
+    errors = []
+
+    def loop(index, func):
+        try:
+            while not stop.is_set():
+                func()
+                counts[index] += 1
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=loop, args=(i, f)) for i, f in enumerate(workers)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return counts
+
+
+@benchmark('wal')
+def bench_wal(writers=4, readers=4, duration=3.0):
+    """結帳吞吐量（同時有報表查詢）：legacy rollback journal vs WAL"""
+    for profile in ('legacy', 'default'):
+        database.configure_pool(pool_size=writers + readers + 1, profile=profile)
+        workdir = fresh_db()
+        try:
+            store_ids, product_ids = seed_stores(writers)
+            seed_sales_history(store_ids, product_ids)
+
+            def make_writer(store_id):
+                items = [{'product_id': pid, 'name': f"商品{pid}", 'quantity': 1,
+                          'price': 105, 'subtotal': 105} for pid in product_ids[:3]]
+
+                def checkout():
+                    database.create_sale(store_id, None, 315, 0, 0, 0, 315, 315, 0, items=items)
+                return checkout
+
+            def report_queries():
+                database.get_store_revenue(days=30)
+                database.get_hourly_sales()
+                database.get_sales(limit=500)
+
+            workers = [make_writer(s) for s in store_ids] + [report_queries] * readers
+            counts = run_concurrently(workers, duration)
+            checkouts = sum(counts[:writers])
+            reports = sum(counts[writers:])
+            print(f"  [{profile:<7}] 結帳 {checkouts / duration:8,.0f} /s   報表 {reports / duration:6,.1f} /s")
+        finally:
+            drop_db(workdir)
+    database.configure_pool(profile='default')
+
+
+# ===== 啟動 / init_db =====
+
+def legacy_init_db():
+    """舊版 init_db()：每次都執行全部 DDL、欄位探測與預設資料檢查"""
+    conn = database.get_connection()
+    cursor = conn.cursor()
+    for _, migrate in database.MIGRATIONS:
+        migrate(cursor)
+    conn.commit()
+    conn.close()
+
+
+@benchmark('startup')
+def bench_startup(reruns=200):
+    """init_db() 冷啟動與 Streamlit 重跑成本：舊版全量 DDL vs 版本遷移"""
+    workdir = tempfile.mkdtemp(prefix="pos_bench_")
+    try:
+        for label, init in (("舊版（每次全量 DDL）", legacy_init_db), ("版本遷移", database.init_db)):
+            database.close_pools()
+            database.DB_PATH = os.path.join(workdir, f"startup_{len(os.listdir(workdir))}.db")
+            cold = timed(init)
+            warm = timed(init, reruns)
+            print(f"  [{label}]")
+            report("冷啟動（新資料庫）", cold)
+            report(f"重跑 x{reruns}（平均）", warm)
+    finally:
+        database.close_pools()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# ===== 收銀前台商品清單 =====
+
+def seed_catalog(skus=10000, promotions=500, promo_products=2000):
+    """批次建立大量商品與促銷，回傳商品 id 清單"""
+    conn = database.get_connection()
+    cursor = conn.cursor()
+    rng = random.Random(7)
+    cursor.executemany('''INSERT INTO products (name, price_ex_tax, price_inc_tax, cost, barcode, category)
+        VALUES (?, ?, ?, ?, ?, ?)''',
+        [(f"商品{i:06d}", 100, 105, 50, f"471{i:010d}", "其他") for i in range(skus)])
+    product_ids = [row[0] for row in cursor.execute("SELECT id FROM products")]
+    cursor.executemany('''INSERT INTO promotions (name, type, value, start_date, end_date)
+        VALUES (?, ?, ?, date('now', '-1 day'), date('now', '+30 days'))''',
+        [(f"促銷{i}", rng.choice(['percent', 'fixed', 'bogo']), rng.randint(1, 30)) for i in range(promotions)])
+    promo_ids = [row[0] for row in cursor.execute("SELECT id FROM promotions")]
+    cursor.executemany("INSERT INTO promotion_products (promotion_id, product_id) VALUES (?, ?)",
+        [(rng.choice(promo_ids), rng.choice(product_ids)) for _ in range(promo_products)])
+    conn.commit()
+    conn.close()
+    return product_ids
+
+
+@benchmark('catalog')
+def bench_catalog(skus=10000):
+    """收銀前台重跑：get_products + 逐筆 get_promotions vs get_pos_catalog"""
+    workdir = fresh_db()
+    try:
+        product_ids = seed_catalog(skus)
+        store_ids, _ = seed_stores(1, product_ids)
+        store_id = store_ids[0]
+
+        def legacy():
+            for p in database.get_products("", store_id):
+                database.get_promotions(p['id'])
+
+        def catalog():
+            database.get_pos_catalog(store_id, "")
+
+        report(f"舊版 {skus:,} SKU（{skus + 1:,} 次查詢）", timed(legacy))
+        report(f"get_pos_catalog {skus:,} SKU", timed(catalog, 5))
+        report("get_pos_catalog 搜尋 '商品0001'", timed(lambda: database.get_pos_catalog(store_id, "商品0001"), 20))
+    finally:
+        drop_db(workdir)
+
+
+# ===== 促銷索引 =====
+
+@benchmark('promotions')
+def bench_promotions(skus=10000, lookups=20000):
+    """商品促銷查詢：get_promotions (SQL) vs 記憶體促銷索引"""
+    workdir = fresh_db()
+    try:
+        product_ids = seed_catalog(skus)
+        rng = random.Random(3)
+        sample = [rng.choice(product_ids) for _ in range(lookups)]
+
+        mismatches = sum(1 for pid in sample[:500]
+                         if database.get_promotions(pid) != database.get_active_promotions(pid))
+        print(f"  結果比對（500 筆）: {'✓ 一致' if not mismatches else f'✗ {mismatches} 筆不一致'}")
+
+        sql = timed(lambda: [database.get_promotions(pid) for pid in sample[:2000]])
+        report("get_promotions x2,000", sql, 2000)
+
+        database.add_promotion("失效測試", "fixed", 1)
+        load = timed(lambda: database.get_active_promotions(sample[0]))
+        report("索引重載（失效後首次查詢）", load)
+        indexed = timed(lambda: [database.get_active_promotions(pid) for pid in sample])
+        report(f"get_active_promotions x{lookups:,}", indexed, lookups)
+        print(f"  每次查詢 {indexed / lookups * 1e6:.2f} µs")
+    finally:
+        drop_db(workdir)
+
+
+# ===== 購物車計價 =====
+
+def seed_member_rules():
+    """建立會員等級、生日優惠券與生日會員，回傳會員 dict"""
+    database.add_member_level("normal", 0, 0, 0, 0)
+    database.add_member_level("gold", 100, 1000, 5, 50)
+    database.add_birthday_coupon("生日優惠", 10, 0, 100)
+    birthday = time.strftime('%Y-%m-%d')
+    member_id = database.add_member("王小明", "0912345678", birthday=birthday)
+    conn = database.get_connection()
+    conn.execute("UPDATE members SET level = 'gold' WHERE id = ?", (member_id,))
+    conn.commit()
+    conn.close()
+    return database.get_member_by_id(member_id)
+
+
+@benchmark('pricing')
+def bench_pricing(lines=50, repeat=200):
+    """50 行購物車計價：逐行 SQL + calculate_promotion vs price_cart"""
+    workdir = fresh_db()
+    try:
+        product_ids = seed_catalog(2000, promotions=200, promo_products=4000)
+        member = seed_member_rules()
+        rng = random.Random(5)
+        cart = [{'product_id': pid, 'name': f"商品{pid}", 'quantity': rng.randint(1, 3), 'price': 105}
+                for pid in rng.sample(product_ids, lines)]
+        for item in cart:
+            item['subtotal'] = item['quantity'] * item['price']
+
+        def legacy():
+            subtotal = sum(item['subtotal'] for item in cart)
+            member_discount = 0
+            for lv in database.get_member_levels():
+                if lv['name'] == member['level']:
+                    member_discount = subtotal * (lv['discount_percent'] / 100)
+                    break
+            birthday_discount = database.check_birthday_discount(member['id'], subtotal)
+            promo_discount = 0
+            for item in cart:
+                promos = database.get_promotions(item['product_id'])
+                if promos:
+                    promo_discount += database.calculate_promotion(item, promos)
+            return int(subtotal - promo_discount - member_discount - birthday_discount + 0.5)
+
+        def engine():
+            return database.price_cart(1, member, cart)['total']
+
+        print(f"  總額比對: 舊版 {legacy()} / price_cart {engine()}")
+        report(f"舊版 {lines} 行 x{repeat}", timed(legacy, repeat) * repeat, repeat)
+        report(f"price_cart {lines} 行 x{repeat}", timed(engine, repeat) * repeat, repeat)
+    finally:
+        drop_db(workdir)
+
+
+# ===== 會員快取 =====
+
+@benchmark('member')
+def bench_member_cache(members=100000, lookups=20000):
+    """收銀前台重跑：電話查會員 + 生日優惠 + 會員計價（查資料庫 vs 會員快取）"""
+    workdir = fresh_db()
+    try:
+        seed_member_rules()
+        with database.transaction() as conn:
+            conn.executemany("INSERT INTO members (phone, name, level, birthday) VALUES (?, ?, 'gold', '2000-01-01')",
+                             [(f"08{i:08d}", f"會員{i}") for i in range(members)])
+        rng = random.Random(19)
+        phones = [f"08{rng.randrange(members):08d}" for _ in range(200)]
+        cart = [{'product_id': 1, 'name': '商品', 'quantity': 1, 'price': 100, 'subtotal': 100}]
+        conn = database.get_connection()
+
+        def legacy():
+            for phone in phones:
+                member = dict(conn.execute("SELECT * FROM members WHERE phone = ? AND is_active = 1",
+                                           (phone,)).fetchone())
+                dict(conn.execute("SELECT * FROM members WHERE id = ?", (member['id'],)).fetchone())
+                database.get_member_levels()
+                database.price_cart(1, member, cart)
+
+        def cached():
+            for phone in phones:
+                member = database.get_member_by_phone(phone)
+                database.check_birthday_discount(member['id'], 100)
+                database.price_cart(1, member, cart)
+
+        repeat = lookups // len(phones)
+        report(f"查資料庫 x{lookups:,}", timed(legacy, repeat) * repeat, lookups)
+        database.member_cache.clear()
+        report(f"會員快取 x{lookups:,}", timed(cached, repeat) * repeat, lookups)
+        print(f"  快取統計: {database.get_member_cache_stats()}")
+        conn.close()
+    finally:
+        drop_db(workdir)
+
+
+# ===== 會員等級 =====
+
+def legacy_update_member_level(cursor, member_id):
+    """舊版：每次積分異動查會員與 member_levels 並寫回等級"""
+    cursor.execute("SELECT points, total_spent FROM members WHERE id = ?", (member_id,))
+    points, total_spent = cursor.fetchone()
+    cursor.execute("SELECT name FROM member_levels WHERE is_active = 1 AND (min_points <= ? OR min_spent <= ?) "
+                   "ORDER BY min_points DESC, min_spent DESC LIMIT 1", (points, total_spent))
+    new_level = cursor.fetchone()
+    if new_level:
+        cursor.execute("UPDATE members SET level = ? WHERE id = ?", (new_level[0], member_id))
+
+
+def legacy_post_member_points(cursor, member_id, points_change, reason="", store_id=None):
+    """舊版積分異動：更新、查餘額、寫記錄，再以 SQL 判定等級"""
+    cursor.execute("UPDATE members SET points = points + ? WHERE id = ?", (points_change, member_id))
+    cursor.execute("SELECT points FROM members WHERE id = ?", (member_id,))
+    new_balance = cursor.fetchone()[0]
+    cursor.execute('''INSERT INTO member_points_log (member_id, points_change, points_balance, reason, store_id)
+        VALUES (?, ?, ?, ?, ?)''', (member_id, points_change, new_balance, reason, store_id))
+    legacy_update_member_level(cursor, member_id)
+
+
+@benchmark('levels')
+def bench_member_levels(members=int(os.environ.get('POS_BENCH_MEMBERS', 1000000)), updates=20000, sample=20000):
+    """會員等級：結帳內逐筆判定（SQL vs 記憶體等級表）、門檻變更後全體重算（逐筆 vs 單一 UPDATE CASE）
+    （POS_BENCH_MEMBERS 可調整會員數）"""
+    workdir = fresh_db()
+    try:
+        for name, points, spent, percent in (("normal", 0, 0, 0), ("silver", 500, 5000, 2),
+                                             ("gold", 2000, 20000, 5), ("platinum", 5000, 50000, 8)):
+            database.add_member_level(name, points, spent, percent, 0)
+        rng = random.Random(23)
+        with database.transaction() as conn:
+            for start in range(0, members, 100000):
+                conn.executemany("INSERT INTO members (phone, name, points, total_spent) VALUES (?, ?, ?, ?)",
+                                 [(f"09{i:08d}", f"會員{i}", rng.randrange(6000), rng.randrange(60000))
+                                  for i in range(start, min(start + 100000, members))])
+        database.recalculate_member_levels()
+        ids = [rng.randrange(1, members + 1) for _ in range(updates)]
+
+        def per_sale(post):
+            with database.transaction() as conn:
+                cursor = conn.cursor()
+                for member_id in ids:
+                    post(cursor, member_id, 10, "消費積分", 1)
+                conn.rollback()
+
+        report(f"結帳積分 + SQL 判定等級 x{updates:,}", timed(lambda: per_sale(legacy_post_member_points)), updates)
+        report(f"結帳積分 + 記憶體判定 x{updates:,}", timed(lambda: per_sale(database._post_member_points)), updates)
+
+        database.add_member_level("diamond", 5800, 58000, 10, 0)
+        with database.transaction() as conn:
+            cursor = conn.cursor()
+            seconds = timed(lambda: [legacy_update_member_level(cursor, member_id) for member_id in range(1, sample + 1)])
+            conn.rollback()
+        report(f"逐筆重算（推估 {members:,} 位）", seconds * members / sample)
+        changed = []
+        report(f"recalculate_member_levels {members:,} 位",
+               timed(lambda: changed.append(database.recalculate_member_levels())), members)
+        print(f"  等級變動: {changed[0]:,} 位")
+    finally:
+        drop_db(workdir)
+
+
+# ===== 積分帳本 =====
+
+@benchmark('points')
+def bench_points(members=100000, entries=int(os.environ.get('POS_BENCH_LEDGER_ROWS', 1000000)), sample=20000):
+    """批次發放積分：逐筆 update_member_points vs bulk_earn_points（executemany），帳本加總 vs 物化餘額讀取
+    （POS_BENCH_LEDGER_ROWS 可調整帳本筆數）"""
+    workdir = fresh_db()
+    try:
+        database.add_member_level("normal", 0, 0, 0, 0)
+        database.add_member_level("gold", 2000, 20000, 5, 0)
+        with database.transaction() as conn:
+            conn.executemany("INSERT INTO members (phone, name) VALUES (?, ?)",
+                             [(f"09{i:08d}", f"會員{i}") for i in range(members)])
+        rng = random.Random(29)
+        grants = [(rng.randrange(1, members + 1), rng.randrange(1, 50)) for _ in range(entries)]
+
+        def legacy():
+            for member_id, points in grants[:sample]:
+                with database.transaction() as conn:
+                    legacy_post_member_points(conn.cursor(), member_id, points, "活動加贈")
+
+        seconds = timed(legacy)
+        report(f"逐筆交易 x{sample:,}（推估 {entries:,} 筆）", seconds * entries / sample, entries)
+        batch = 100000
+        seconds = timed(lambda: [database.bulk_earn_points(grants[i:i + batch], "活動加贈")
+                                 for i in range(0, entries, batch)])
+        report(f"bulk_earn_points {entries:,} 筆", seconds, entries)
+        print(f"  帳本一致: {database.check_member_points() == []}")
+
+        ids = [rng.randrange(1, members + 1) for _ in range(2000)]
+        with database.db_connection() as conn:
+            full_sum = timed(lambda: [conn.execute("SELECT SUM(points_change) FROM member_points_log WHERE member_id = ?",
+                                                   (member_id,)).fetchone() for member_id in ids])
+            materialized = timed(lambda: [conn.execute("SELECT points FROM members WHERE id = ?",
+                                                       (member_id,)).fetchone() for member_id in ids])
+        report("全帳本加總 x2,000", full_sum, len(ids))
+        report("members.points x2,000", materialized, len(ids))
+    finally:
+        drop_db(workdir)
+
+
+# ===== 商品批次匯入 =====
+
+@benchmark('import')
+def bench_import(rows=int(os.environ.get('POS_BENCH_IMPORT_ROWS', 100000)), sample=2000):
+    """商品主檔 + 分店價格匯入：逐筆 add_product / add_store_product vs catalog_import（暫存表 + 整批 upsert）
+    （POS_BENCH_IMPORT_ROWS 可調整列數，一半主檔、一半分店價格）"""
+    import catalog_import
+    workdir = fresh_db()
+    try:
+        database.add_store("匯入門市", "S001")
+        store_id = database.get_stores()[0]['id']
+        skus = rows // 2
+        path = os.path.join(workdir, "catalog.csv")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("barcode,name,price_ex_tax,cost,category,store_code,stock\n")
+            for i in range(skus):
+                f.write(f"89{i:011d},匯入商品{i},{10 + i % 500},{5 + i % 300},類別{i % 50},,\n")
+            for i in range(skus):
+                f.write(f"89{i:011d},,{12 + i % 500},,,S001,{i % 100}\n")
+
+        def legacy():
+            for i in range(sample):
+                price = 10 + i % 500
+                product_id = database.add_product(f"逐筆商品{i}", price, database.calculate_price_inc_tax(price),
+                                                  5, f"77{i:011d}", "類別")
+                database.add_store_product(store_id, product_id, price + 2, database.calculate_price_inc_tax(price + 2),
+                                           i % 100)
+
+        seconds = timed(legacy)
+        report(f"逐筆新增 x{sample:,}（推估 {rows:,} 列）", seconds * skus / sample, rows)
+        result = {}
+        seconds = timed(lambda: result.update(catalog_import.import_catalog(path)))
+        report(f"import_catalog 新增 {rows:,} 列", seconds, rows)
+        print(f"  商品新增 {result['products_created']:,}、分店商品新增 {result['store_products_created']:,}、"
+              f"錯誤 {result['error_count']:,}")
+        seconds = timed(lambda: result.update(catalog_import.import_catalog(path)))
+        report(f"import_catalog 更新 {rows:,} 列", seconds, rows)
+    finally:
+        drop_db(workdir)
+
+
+# ===== 單一交易結帳 =====
+
+@benchmark('checkout')
+def bench_checkout(stores=4, duration=3.0, lines=5):
+    """會員結帳吞吐量（每店一台收銀機）：create_sale + create_invoice 分開 vs checkout 單一交易"""
+    database.configure_pool(pool_size=stores + 1)
+    workdir = fresh_db()
+    try:
+        store_ids, product_ids = seed_stores(stores)
+        member = seed_member_rules()
+        cart = [{'product_id': pid, 'name': f"商品{pid}", 'quantity': 1, 'price': 105, 'subtotal': 105}
+                for pid in product_ids[:lines]]
+
+        def make_split(store_id):
+            def run():
+                pricing = database.price_cart(store_id, member, cart)
+                sale_id = database.create_sale(
+                    store_id, member['id'], pricing['subtotal'], 0, pricing['promo_discount'],
+                    pricing['member_discount'] + pricing['birthday_discount'], pricing['total'],
+                    pricing['total'], 0, items=cart)
+                database.create_invoice(store_id, sale_id, member['id'], pricing['total'], cart)
+            return run
+
+        def make_single(store_id):
+            def run():
+                database.checkout(store_id, cart, member, {'method': 'cash'})
+            return run
+
+        for label, make in (("create_sale + create_invoice", make_split), ("checkout", make_single)):
+            counts = run_concurrently([make(s) for s in store_ids], duration)
+            per_store = ", ".join(f"{c / duration:,.0f}" for c in counts)
+            print(f"  {label:<30} 合計 {sum(counts) / duration:8,.0f} /s   每店 [{per_store}]")
+    finally:
+        drop_db(workdir)
+    database.configure_pool()
+
+
+# ===== 字軌號碼配號 =====
+
+def legacy_consume_track_number():
+    """舊版配號：先讀 current_number，再用另一條連線遞增"""
+    track = database.get_available_track()
+    if not track:
+        return None
+    conn = database.get_connection()
+    conn.execute("UPDATE einvoice_track_numbers SET current_number = current_number + 1 WHERE id = ?",
+                 (track['id'],))
+    conn.commit()
+    conn.close()
+    return f"{track['track_code1']}{track['track_code2']}{track['current_number']:08d}"
+
+
+@benchmark('allocator')
+def bench_allocator(workers=8, duration=2.0):
+    """多收銀機同時配發字軌號碼：舊版逐號讀寫 vs 預留區段配號器（含重號數）"""
+    for label, consume in (("舊版逐號", legacy_consume_track_number),
+                           ("配號器", database.consume_track_number)):
+        database.configure_pool(pool_size=workers + 1)
+        workdir = fresh_db()
+        try:
+            database.add_track_number('ZZ', '99', 1, 99999999, '2000-01-01')
+            issued = [[] for _ in range(workers)]
+            counts = run_concurrently([(lambda i=i: issued[i].append(consume()))
+                                       for i in range(workers)], duration)
+            numbers = [n for chunk in issued for n in chunk]
+            duplicates = len(numbers) - len(set(numbers))
+            print(f"  {label:<8} {sum(counts) / duration:10,.0f} 號/秒   重號 {duplicates:,}")
+            database.release_invoice_numbers()
+        finally:
+            drop_db(workdir)
+    database.configure_pool()
+
+
+# ===== MIG 4.1 F0401 XML =====
+
+def legacy_generate_mig_xml(invoice_number):
+    """舊版：三次查詢 + 字串串接"""
+    invoice = database.get_einvoice(invoice_number)
+    if not invoice:
+        return None
+    
+    # 轉換 Row 為 dict
+    invoice = dict(invoice)
+    details = [dict(d) for d in database.get_einvoice_details(invoice['id'])]
+    amount = dict(database.get_einvoice_amount(invoice['id'])) if database.get_einvoice_amount(invoice['id']) else None
+    
+    # 產生F0401 XML
+    xml = f'''<?xml version="1.0" encoding="utf-8"?>
+<Invoice xsi:schemaLocation="urn:GEINV:eInvoiceMessage:F0401:4.1 F0401.xsd" xmlns="urn:GEINV:eInvoiceMessage:F0401:4.1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <Main>
+    <InvoiceNumber>{invoice['invoice_number']}</InvoiceNumber>
+    <InvoiceDate>{invoice['invoice_date']}</InvoiceDate>
+    <InvoiceTime>{invoice['invoice_time']}</InvoiceTime>
+    <InvoiceType>{invoice.get('invoice_type', '07')}</InvoiceType>
+    <RandomNumber>{invoice.get('random_number', '')}</RandomNumber>
+    <GroupMark>{invoice.get('group_mark', '')}</GroupMark>
+    <DonateMark>{invoice.get('donate_mark', '0')}</DonateMark>
+    <Seller>
+      <Identifier>{invoice['seller_identifier']}</Identifier>
+      <Name><![CDATA[{invoice['seller_name']}]]></Name>
+      <Address>{invoice.get('seller_address', '')}</Address>
+      <PersonInCharge>{invoice.get('seller_person_in_charge', '')}</PersonInCharge>
+      <TelephoneNumber>{invoice.get('seller_phone', '')}</TelephoneNumber>
+      <FacsimileNumber>{invoice.get('seller_fax_number', '')}</FacsimileNumber>
+      <EmailAddress>{invoice.get('seller_email', '')}</EmailAddress>
+      <CustomerNumber>{invoice.get('seller_customer_number', '')}</CustomerNumber>
+      <RoleRemark>{invoice.get('seller_role_remark', '')}</RoleRemark>
+      <BankCode>{invoice.get('seller_bank_code', '')}</BankCode>
+      <BankAccount>{invoice.get('seller_bank_account', '')}</BankAccount>
+    </Seller>
+    <Buyer>
+      <Identifier>{invoice.get('buyer_identifier', '')}</Identifier>
+      <Name><![CDATA[{invoice.get('buyer_name', '')}]]></Name>
+      <Address>{invoice.get('buyer_address', '')}</Address>
+      <PersonInCharge>{invoice.get('buyer_person_in_charge', '')}</PersonInCharge>
+      <TelephoneNumber>{invoice.get('buyer_phone', '')}</TelephoneNumber>
+      <FacsimileNumber>{invoice.get('buyer_fax_number', '')}</FacsimileNumber>
+      <EmailAddress>{invoice.get('buyer_email', '')}</EmailAddress>
+      <CustomerNumber>{invoice.get('buyer_customer_number', '')}</CustomerNumber>
+      <RoleRemark>{invoice.get('buyer_role_remark', '')}</RoleRemark>
+    </Buyer>
+    <BuyerRemark>{invoice.get('buyer_remark', '')}</BuyerRemark>
+    <MainRemark>{invoice.get('main_remark', '')}</MainRemark>
+    <CustomsClearanceMark>{invoice.get('customs_clearance_method', '')}</CustomsClearanceMark>
+    <Category>{invoice.get('category', '')}</Category>
+    <RelateNumber>{invoice.get('relate_number', '')}</RelateNumber>
+    <CarrierType>{invoice.get('carrier_type', '')}</CarrierType>
+    <CarrierId1>{invoice.get('carrier_id1', '')}</CarrierId1>
+    <CarrierId2>{invoice.get('carrier_id2', '')}</CarrierId2>
+    <PrintMark>{invoice.get('print_mark', 'N')}</PrintMark>
+    <NPOBAN>{invoice.get('npoaban', '')}</NPOBAN>
+    <BondedAreaConfirm>{invoice.get('bonded_area_confirm', '')}</BondedAreaConfirm>
+    <ZeroTaxRateReason>{invoice.get('zero_tax_rate_reason', '')}</ZeroTaxRateReason>
+  </Main>
+  <Details>
+'''
+    
+    for item in details:
+        xml += f'''    <ProductItem>
+      <SequenceNumber>{item['sequence_number']:03d}</SequenceNumber>
+      <Description><![CDATA[{item['product_name']}]]></Description>
+      <Quantity>{item['quantity']}</Quantity>
+      <Unit>{item.get('unit', '件')}</Unit>
+      <UnitPrice>{item['unit_price']}</UnitPrice>
+      <TaxType>{item['tax_type']}</TaxType>
+      <Amount>{item['amount']}</Amount>
+      <Remark>{item.get('remark', '')}</Remark>
+      <RelateNumber>{item.get('relate_number', '')}</RelateNumber>
+    </ProductItem>
+'''
+    
+    # Amount (Summary)
+    if amount:
+        xml += f'''  </Details>
+  <Amount>
+    <SalesAmount>{amount['sales_amount']}</SalesAmount>
+    <FreeTaxSalesAmount>{amount.get('free_tax_sales_amount', 0)}</FreeTaxSalesAmount>
+    <ZeroTaxSalesAmount>{amount.get('zero_tax_sales_amount', 0)}</ZeroTaxSalesAmount>
+    <TaxAmount>{amount['tax_amount']}</TaxAmount>
+    <TaxType>{amount['tax_type']}</TaxType>
+    <TaxRate>{amount['tax_rate']}</TaxRate>
+    <TotalAmount>{amount['total_amount']}</TotalAmount>
+    <DiscountAmount>{amount.get('discount_amount', 0)}</DiscountAmount>
+    <OriginalCurrencyAmount>{amount.get('original_currency_amount', '')}</OriginalCurrencyAmount>
+    <ExchangeRate>{amount.get('exchange_rate', '')}</ExchangeRate>
+    <Currency>{amount.get('currency', '')}</Currency>
+  </Amount>
+</Invoice>'''
+    
+    return xml
+
+
+
+def seed_einvoice(lines):
+    """建立一張 lines 筆明細的電子發票，回傳發票號碼"""
+    store = {'code': '12345678', 'name': '測試商行 & 分店'}
+    items = [{'product_id': i, 'name': f"商品<{i}>", 'quantity': 1, 'unit_price': 100, 'amount': 100}
+             for i in range(1, lines + 1)]
+    _, invoice_number = database.create_einvoice(store, {'name': '消費者'}, items)
+    return invoice_number
+
+
+@benchmark('mig_xml')
+def bench_mig_xml(sizes=(1, 100, 1000), repeat=200):
+    """F0401 XML 產生：舊版串接 vs 單次查詢編譯範本"""
+    workdir = fresh_db()
+    try:
+        for lines in sizes:
+            invoice_number = seed_einvoice(lines)
+            count = max(1, repeat // max(1, lines // 50))
+            report(f"舊版 {lines} 行 x{count}",
+                   timed(lambda: legacy_generate_mig_xml(invoice_number), count) * count, count)
+            report(f"generate_mig_xml {lines} 行 x{count}",
+                   timed(lambda: database.generate_mig_xml(invoice_number), count) * count, count)
+            report(f"iter_mig_xml {lines} 行 x{count}",
+                   timed(lambda: sum(1 for _ in database.iter_mig_xml(invoice_number)), count) * count, count)
+    finally:
+        drop_db(workdir)
+
+
+# ===== 商品搜尋 =====
+
+SEARCH_WORDS = ['拿鐵', '美式', '咖啡', '紅茶', '綠茶', '奶茶', '抹茶', '烏龍', '蛋糕', '餅乾',
+                '三明治', '可頌', '果汁', '檸檬', '焦糖', '香草', 'Latte', 'Mocha', 'Espresso', 'Tea']
+SEARCH_SIZES = ['小杯', '中杯', '大杯', '禮盒', '家庭號']
+
+
+def seed_search_catalog(skus=100000):
+    """建立 skus 筆中英混合名稱的商品，回傳 (分店 id, 條碼清單)"""
+    rng = random.Random(11)
+    conn = database.get_connection()
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO stores (name, code) VALUES ('搜尋分店', 'SRCH')")
+    store_id = cursor.lastrowid
+    barcodes = [f"471{i:010d}" for i in range(skus)]
+    names = [f"{rng.choice(SEARCH_WORDS)}{rng.choice(SEARCH_WORDS)} {rng.choice(SEARCH_SIZES)} {i}" for i in range(skus)]
+    cursor.executemany('''INSERT INTO products (name, price_ex_tax, price_inc_tax, cost, barcode, category, search_tokens)
+        VALUES (?, 100, 105, 50, ?, '其他', ?)''',
+        [(name, barcode, database.search_tokens(name, barcode)) for name, barcode in zip(names, barcodes)])
+    cursor.execute('''INSERT INTO store_products (store_id, product_id, price_ex_tax, price_inc_tax, stock)
+        SELECT ?, id, 100, 105, 10 FROM products''', (store_id,))
+    conn.commit()
+    conn.close()
+    return store_id, barcodes
+
+
+def legacy_search(store_id, search):
+    """舊版 get_products：name / barcode 雙邊 LIKE"""
+    conn = database.get_connection()
+    rows = conn.execute('''
+        SELECT p.*, sp.price_ex_tax as store_price, sp.price_inc_tax as store_price_inc,
+               sp.stock, sp.low_stock_alert
+        FROM products p
+        LEFT JOIN store_products sp ON p.id = sp.product_id AND sp.store_id = ?
+        WHERE p.is_active = 1 AND (p.name LIKE ? OR p.barcode LIKE ?)
+        ORDER BY p.name
+    ''', (store_id, f"%{search}%", f"%{search}%")).fetchall()
+    conn.close()
+    return rows
+
+
+@benchmark('search')
+def bench_search(skus=100000, repeat=20):
+    """商品搜尋延遲：LIKE 全表掃描 vs 條碼索引 + FTS5"""
+    workdir = fresh_db()
+    try:
+        start = time.perf_counter()
+        store_id, barcodes = seed_search_catalog(skus)
+        print(f"  建立 {skus:,} 筆商品（含 FTS 觸發器）: {time.perf_counter() - start:.1f} 秒")
+        barcode = barcodes[skus // 2]
+        rng = random.Random(3)
+        print(f"  條碼查詢 ({barcode})")
+        report("舊版 LIKE", timed(lambda: legacy_search(store_id, barcode), repeat))
+        report("find_product_by_barcode", timed(lambda: database.find_product_by_barcode(barcode, store_id), repeat * 50))
+        report("get_pos_catalog", timed(lambda: database.get_pos_catalog(store_id, barcode), repeat))
+        for term in ('抹茶', '抹茶拿鐵', 'latte', rng.choice(SEARCH_SIZES)):
+            hits = len(database.get_products(term, store_id))
+            print(f"  名稱搜尋 '{term}'（{hits:,} 筆）")
+            report("舊版 LIKE", timed(lambda: legacy_search(store_id, term), repeat))
+            report("get_products", timed(lambda: database.get_products(term, store_id), repeat))
+    finally:
+        drop_db(workdir)
+
+
+# ===== 購物車庫存檢查 =====
+
+@benchmark('stock')
+def bench_stock(skus=2000, lines=50, repeat=200):
+    """50 行購物車庫存檢查：逐行 check_stock_available vs 整車一次查詢"""
+    workdir = fresh_db()
+    try:
+        product_ids = seed_catalog(skus, promotions=0, promo_products=0)
+        store_ids, _ = seed_stores(1, product_ids)
+        rng = random.Random(13)
+        cart = [{'product_id': pid, 'name': f"商品{pid}", 'quantity': 1}
+                for pid in rng.sample(product_ids, lines)]
+
+        def legacy():
+            return [database.check_stock_available(store_ids[0], item['product_id'], item['quantity'])
+                    for item in cart]
+
+        report(f"逐行查詢 {lines} 行 x{repeat}", timed(legacy, repeat) * repeat, repeat)
+        report(f"check_cart_stock {lines} 行 x{repeat}",
+               timed(lambda: database.check_cart_stock(store_ids[0], cart), repeat) * repeat, repeat)
+    finally:
+        drop_db(workdir)
+
+
+@benchmark('stocktake')
+def bench_stocktake(lines=20000, sample=2000):
+    """20,000 行盤點單：逐行 update_store_stock（每行一次提交）vs apply_stock_document（單一交易）"""
+    workdir = fresh_db()
+    try:
+        product_ids = seed_catalog(lines, promotions=0, promo_products=0)
+        store_ids, _ = seed_stores(1, product_ids)
+        store_id = store_ids[0]
+        stock = database.get_stock_levels(store_id, product_ids)
+        rng = random.Random(17)
+        counts = [(pid, max(0, stock[pid] - rng.randrange(0, 3))) for pid in product_ids]
+
+        def legacy():
+            for pid, counted in counts[:sample]:
+                current = database.get_store_product(store_id, pid)['stock']
+                database.update_store_stock(store_id, pid, counted - current)
+
+        seconds = timed(legacy)
+        report(f"逐行調整 x{sample:,}（推估 {lines:,} 行）", seconds * lines / sample, lines)
+        result = {}
+        seconds = timed(lambda: result.update(database.apply_stock_document(store_id, 'count', counts, "ST-BENCH")))
+        report(f"apply_stock_document {lines:,} 行", seconds, lines)
+        print(f"  有差異 {result['changed']:,} 行、退回 {len(result['rejected'])} 行")
+    finally:
+        drop_db(workdir)
+
+
+# ===== 調貨單核准 =====
+
+def legacy_approve_transfer(transfer_id, approved_by):
+    """舊版：逐筆兩次 UPDATE 後提交，不檢查調出庫存"""
+    conn = database.get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM inventory_transfers WHERE id = ?", (transfer_id,))
+    transfer = cursor.fetchone()
+    cursor.execute("UPDATE store_products SET stock = stock - ? WHERE store_id = ? AND product_id = ?",
+                   (transfer['quantity'], transfer['from_store_id'], transfer['product_id']))
+    cursor.execute("UPDATE store_products SET stock = stock + ? WHERE store_id = ? AND product_id = ?",
+                   (transfer['quantity'], transfer['to_store_id'], transfer['product_id']))
+    cursor.execute('''UPDATE inventory_transfers SET status = 'approved', approved_by = ?, approved_at = CURRENT_TIMESTAMP
+        WHERE id = ?''', (approved_by, transfer_id))
+    conn.commit()
+    conn.close()
+
+
+@benchmark('transfers')
+def bench_transfers(skus=2000, lines=500, repeat=5):
+    """500 行調貨單核准：逐筆 approve（舊版，每筆一次提交）vs approve_transfers 整批（含庫存檢查）"""
+    workdir = fresh_db()
+    try:
+        product_ids = seed_catalog(skus, promotions=0, promo_products=0)
+        (source, target), _ = seed_stores(2, product_ids)
+        rng = random.Random(23)
+
+        def new_order():
+            lines_ = [(pid, rng.randrange(1, 5)) for pid in rng.sample(product_ids, lines)]
+            return database.create_transfer_order(source, target, lines_)['transfer_ids']
+
+        orders = [new_order() for _ in range(repeat * 2)]
+        legacy = timed(lambda: [legacy_approve_transfer(t, 1) for t in orders.pop()], repeat)
+        report(f"逐筆核准 {lines} 行 x{repeat}", legacy * repeat, lines * repeat)
+        bulk = timed(lambda: database.approve_transfers(orders.pop(), 1), repeat)
+        report(f"approve_transfers {lines} 行 x{repeat}", bulk * repeat, lines * repeat)
+    finally:
+        drop_db(workdir)
+
+
+# ===== 歷史庫存 =====
+
+def legacy_inventory_as_of(store_id, as_of):
+    """不使用快照：重播分店全部異動至 as_of"""
+    with database.db_connection() as conn:
+        rows = conn.execute('''SELECT product_id, SUM(quantity_change) FROM stock_movements
+            WHERE store_id = ? AND created_at <= ? GROUP BY product_id''', (store_id, as_of)).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+@benchmark('asof')
+def bench_asof(skus=2000, days=90, lines=1000, repeat=20):
+    """90 天、每天 1,000 筆異動的分店歷史庫存：重播全部異動 vs 每日快照 + 當日異動"""
+    workdir = fresh_db()
+    try:
+        product_ids = seed_catalog(skus, promotions=0, promo_products=0)
+        store_ids, _ = seed_stores(1, product_ids)
+        store_id = store_ids[0]
+        database.check_stock_movements(repair=True)
+        rng = random.Random(29)
+        start = datetime(2000, 1, 1)
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        conn = database.get_connection()
+        for day in range(days):
+            database.apply_stock_document(store_id, 'adjust',
+                                          [(pid, rng.randrange(-5, 6) or 1) for pid in rng.sample(product_ids, lines)])
+            database.snapshot_store_stock(store_id)
+            # 把這一天的異動與快照改到對應日期，模擬每日排程
+            stamp = (start + timedelta(days=day)).strftime('%Y-%m-%d')
+            conn.execute("UPDATE stock_movements SET created_at = ? || ' 12:00:00' WHERE created_at >= ?", (stamp, today))
+            conn.execute("UPDATE stock_snapshots SET created_at = ? || ' 23:59:59' WHERE created_at >= ?", (stamp, today))
+            conn.commit()
+        conn.close()
+        as_of = (start + timedelta(days=days - 1)).strftime('%Y-%m-%d 18:00:00')
+        assert legacy_inventory_as_of(store_id, as_of) == database.get_inventory_as_of(store_id, as_of)
+
+        report(f"重播 {days * lines:,} 筆異動 x{repeat}",
+               timed(lambda: legacy_inventory_as_of(store_id, as_of), repeat) * repeat, repeat)
+        report(f"get_inventory_as_of x{repeat}",
+               timed(lambda: database.get_inventory_as_of(store_id, as_of), repeat) * repeat, repeat)
+    finally:
+        drop_db(workdir)
+
+
+# ===== 每日銷售彙總 =====
+
+@benchmark('rollup')
+def bench_rollup(stores=10, sales=200000, days=90, repeat=50):
+    """儀表板報表（今日營收、30 天分店營收、7 天時段）：掃描 sales vs 彙總表"""
+    workdir = fresh_db()
+    try:
+        store_ids, product_ids = seed_stores(stores, [1, 2, 3])
+        seed_sales_history(store_ids, product_ids, sales=sales, items_per_sale=1, days=days)
+        conn = database.get_connection()
+
+        def legacy():
+            conn.execute("SELECT COUNT(*), SUM(total), SUM(discount) FROM sales "
+                         "WHERE store_id = ? AND date(created_at) = date('now')", (store_ids[0],)).fetchone()
+            conn.execute('''SELECT store_id, st.name as store_name, SUM(total) as revenue, COUNT(*) as orders
+                FROM sales s JOIN stores st ON s.store_id = st.id
+                WHERE s.created_at >= date('now', '-30 days')
+                GROUP BY store_id ORDER BY revenue DESC''').fetchall()
+            conn.execute('''SELECT strftime('%H', created_at) as hour, COUNT(*) as orders, SUM(total) as revenue
+                FROM sales WHERE created_at >= date('now', '-7 days')
+                GROUP BY hour ORDER BY hour''').fetchall()
+
+        def rollup():
+            database.get_daily_sales(store_ids[0])
+            database.get_store_revenue(days=30)
+            database.get_hourly_sales()
+
+        report(f"掃描 sales ({sales:,} 筆) x{repeat}", timed(legacy, repeat) * repeat, repeat)
+        report(f"彙總表 x{repeat}", timed(rollup, repeat) * repeat, repeat)
+        heatmap = timed(lambda: database.get_sales_heatmap(store_ids=store_ids[:3]), repeat)
+        report(f"get_sales_heatmap 3 店 7 天 x{repeat}", heatmap * repeat, repeat)
+        conn.close()
+        report("rebuild_sales_rollup()", timed(database.rebuild_sales_rollup))
+        report("check_sales_rollup()", timed(database.check_sales_rollup))
+    finally:
+        drop_db(workdir)
+
+
+# ===== 熱銷商品排行 =====
+
+@benchmark('top')
+def bench_top_products(sale_items=int(os.environ.get('POS_BENCH_SALE_ITEMS', 1000000)),
+                       stores=10, skus=2000, days=365, repeat=5):
+    """熱銷商品前 10 名：sale_items 全表 GROUP BY vs sales_product_daily vs 今日記憶體排行
+    （POS_BENCH_SALE_ITEMS=10000000 可測 1,000 萬筆明細）"""
+    workdir = fresh_db()
+    try:
+        product_ids = seed_catalog(skus, promotions=0, promo_products=0)
+        store_ids, _ = seed_stores(stores, product_ids)
+        start = time.perf_counter()
+        seed_sales_history(store_ids, product_ids, sales=sale_items // 3, items_per_sale=3, days=days)
+        print(f"  建立 {sale_items:,} 筆明細（含彙總重建）: {time.perf_counter() - start:.1f} 秒")
+        conn = database.get_connection()
+
+        def legacy():
+            return conn.execute('''SELECT product_name, SUM(si.quantity) as total_qty, SUM(si.subtotal) as total_sales
+                FROM sale_items si
+                JOIN sales s ON si.sale_id = s.id
+                WHERE s.store_id = ?
+                GROUP BY product_id ORDER BY total_sales DESC LIMIT 10''', (store_ids[0],)).fetchall()
+
+        month = time.strftime('%Y-%m-%d', time.gmtime(time.time() - 30 * 86400))
+        report(f"sale_items GROUP BY（單店全期） x{repeat}", timed(legacy, repeat) * repeat, repeat)
+        report(f"彙總表（單店全期） x{repeat}",
+               timed(lambda: database.get_top_products(store_ids[0]), repeat) * repeat, repeat)
+        report(f"彙總表（單店近 30 天） x{repeat}",
+               timed(lambda: database.get_top_products(store_ids[0], start_date=month), repeat) * repeat, repeat)
+        report(f"彙總表（全部分店近 30 天） x{repeat}",
+               timed(lambda: database.get_top_products(start_date=month), repeat) * repeat, repeat)
+        database.today_leaderboard.reset()
+        report("今日排行首次載入", timed(lambda: database.get_today_top_products(store_ids[0])))
+        report("今日排行 x1000", timed(lambda: database.get_today_top_products(store_ids[0]), 1000) * 1000, 1000)
+        conn.close()
+    finally:
+        drop_db(workdir)
+
+
+# ===== 欄式分析匯出 =====
+
+@benchmark('analytics')
+def bench_analytics(sales=500000, stores=10, days=365, repeat=5):
+    """報表全期指標：SQL 全表彙總 vs Parquet 分區向量化計算（需要 pyarrow）"""
+    import analytics
+    if not analytics.available():
+        print("  未安裝 pyarrow，略過")
+        return
+    workdir = fresh_db()
+    try:
+        store_ids, product_ids = seed_stores(stores, seed_catalog(500, promotions=0, promo_products=0))
+        seed_sales_history(store_ids, product_ids, sales=sales, items_per_sale=3, days=days)
+        out = os.path.join(workdir, "analytics")
+        result = {}
+        seconds = timed(lambda: result.update(analytics.export_sales(out)))
+        report(f"export_sales（{result['rows']['sales'] + result['rows']['sale_items']:,} 筆）", seconds,
+               result['rows']['sales'] + result['rows']['sale_items'])
+        conn = database.get_connection()
+
+        def legacy():
+            conn.execute("SELECT COUNT(*), SUM(total), SUM(discount), AVG(total) FROM sales").fetchone()
+            conn.execute('''SELECT strftime('%Y-%m', created_at) as month, store_id, COUNT(*), SUM(total)
+                FROM sales GROUP BY month, store_id''').fetchall()
+
+        def columnar():
+            analytics.sales_metrics(out)
+            analytics.monthly_revenue(out)
+
+        report(f"SQL 全表彙總 x{repeat}", timed(legacy, repeat) * repeat, repeat)
+        report(f"Parquet 向量化 x{repeat}", timed(columnar, repeat) * repeat, repeat)
+        report(f"Parquet 單店 x{repeat}",
+               timed(lambda: analytics.sales_metrics(out, store_id=store_ids[0]), repeat) * repeat, repeat)
+        report(f"Parquet 商品排行 x{repeat}", timed(lambda: analytics.product_sales(out), repeat) * repeat, repeat)
+        conn.close()
+    finally:
+        drop_db(workdir)
+
+
+# ===== 分頁列表 =====
+
+def peak_memory(func):
+    """回傳 (耗時秒數, 峰值記憶體 bytes)"""
+    tracemalloc.start()
+    try:
+        seconds = timed(func)
+        return seconds, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@benchmark('pagination')
+def bench_pagination(members=int(os.environ.get('POS_BENCH_MEMBERS', 1000000)), page=100, depth=5000):
+    """會員列表：一次載入全部 vs keyset 分頁（深頁延遲、逐頁讀完的峰值記憶體）
+    （POS_BENCH_MEMBERS 可調整會員數）"""
+    workdir = fresh_db()
+    try:
+        with database.transaction() as conn:
+            for start in range(0, members, 100000):
+                conn.executemany('''INSERT INTO members (phone, name, created_at)
+                    VALUES (?, ?, datetime('now', ? || ' seconds'))''',
+                    [(f"09{i:08d}", f"會員{i}", -(i // 3)) for i in range(start, min(start + 100000, members))])
+        conn = database.get_connection()
+        offset = min(page * depth, members - page)
+        cursor = tuple(conn.execute('''SELECT created_at, id FROM members WHERE is_active = 1
+            ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?''', (offset - 1,)).fetchone())
+
+        def offset_page():
+            return conn.execute('''SELECT * FROM members WHERE is_active = 1
+                ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?''', (page, offset)).fetchall()
+
+        report(f"OFFSET 第 {offset // page:,} 頁 x20", timed(offset_page, 20) * 20, 20)
+        report(f"keyset 第 {offset // page:,} 頁 x20",
+               timed(lambda: database.get_members(limit=page, before=cursor), 20) * 20, 20)
+        report("count_members() x20", timed(database.count_members, 20) * 20, 20)
+        conn.close()
+
+        for label, func in ((f"get_members() 全部 {members:,} 筆", lambda: len(database.get_members())),
+                            ("iter_members() 逐頁讀完", lambda: sum(1 for _ in database.iter_members()))):
+            seconds, peak = peak_memory(func)
+            print(f"  {label:<36} {seconds * 1000:10.2f} ms  峰值記憶體 {peak / 2 ** 20:,.1f} MB")
+    finally:
+        drop_db(workdir)
+
+
+# ===== Streamlit 重跑快取 =====
+
+@benchmark('snapshot')
+def bench_snapshot(skus=2000, reruns=500):
+    """收銀頁面每次重跑的目錄讀取：每次查詢 vs 快照快取"""
+    workdir = fresh_db()
+    try:
+        product_ids = seed_catalog(skus, promotions=100, promo_products=500)
+        store_ids, _ = seed_stores(1, product_ids)
+        seed_member_rules()
+        store_id = store_ids[0]
+
+        def uncached():
+            database.get_stores(is_active=1)
+            database.get_pos_catalog(store_id, "")
+            database.get_member_levels()
+            database.get_birthday_coupon()
+
+        def cached():
+            database.cached_stores(is_active=1)
+            database.cached_pos_catalog(store_id, "")
+            database.cached_member_levels()
+            database.cached_birthday_coupon()
+
+        report(f"每次查詢 x{reruns}", timed(uncached, reruns) * reruns, reruns)
+        report(f"快照快取 x{reruns}", timed(cached, reruns) * reruns, reruns)
+        stats = database.get_snapshot_stats()
+        print(f"  快取命中 {stats['hits']:,} / 未命中 {stats['misses']:,}")
+    finally:
+        drop_db(workdir)
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"✗ 未知項目: {name}（可用: {', '.join(BENCHMARKS)}）")
+            continue
+        print("\n" + "=" * 60)
+        print(f"  {name}: {BENCHMARKS[name].__doc__}")
+        print("=" * 60)
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
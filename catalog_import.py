@@ -0,0 +1,235 @@
+"""
+POS 連鎖店系統 v2.0 - 商品 / 分店價格批次匯入
+CSV 或 JSONL 分批串流寫入暫存表，以 SQL 整批驗證後，在單一交易內 upsert 至 products / store_products
+（讀檔與驗證期間不持有寫入鎖，不影響前台結帳）。
+
+欄位（CSV 標題列或 JSONL 的鍵，未提供的欄位保留原值）：
+    barcode          條碼（必填，商品比對鍵）
+    name             商品名稱（新商品必填）
+    price_ex_tax     未稅價
+    price_inc_tax    含稅價（未提供時由 price_ex_tax 計算，與 calculate_price_inc_tax() 相同）
+    cost、category   成本、類別
+    store_code       分店代碼：有值時價格寫入該分店（store_products），商品主檔只更新名稱 / 成本 / 類別
+    stock、low_stock_alert  分店庫存、低庫存警示
+
+有錯誤的列略過並列在回傳的 errors，其他列照常匯入；dry_run=True 只驗證與試算筆數，不寫入。
+"""
+import csv
+import json
+import os
+
+import database
+
+CHUNK_SIZE = 5000
+FORMATS = ('csv', 'jsonl')
+TEXT_FIELDS = ('barcode', 'name', 'category', 'store_code')
+NUMERIC_FIELDS = ('price_ex_tax', 'price_inc_tax', 'cost', 'stock', 'low_stock_alert')
+FIELDS = TEXT_FIELDS + NUMERIC_FIELDS
+MAX_ERRORS = 1000
+
+# 驗證規則：(錯誤訊息, 條件)，依序套用，每列只記錄第一個錯誤
+VALIDATIONS = [
+    ('缺少條碼', "barcode IS NULL"),
+    *[(f'{field} 不是數字', f"typeof({field}) NOT IN ('integer', 'real', 'null')") for field in NUMERIC_FIELDS],
+    ('價格或成本不可為負', "price_ex_tax < 0 OR price_inc_tax < 0 OR cost < 0"),
+    ('分店代碼不存在', "store_code IS NOT NULL AND store_id IS NULL"),
+    # 同一分店（或主檔）同一條碼出現多次時以最後一列為準
+    ('檔案內條碼重複（以最後一列為準）', '''EXISTS (SELECT 1 FROM import_staging d
+        WHERE d.barcode = import_staging.barcode AND d.store_code IS import_staging.store_code
+        AND d.line > import_staging.line)'''),
+    # 新商品只要檔案內任一有效列提供名稱即可（例如主檔列有名稱、分店價格列沒有）
+    ('新商品缺少名稱', '''product_id IS NULL AND NOT EXISTS (SELECT 1 FROM import_staging d
+        WHERE d.barcode = import_staging.barcode AND d.name IS NOT NULL AND d.error IS NULL)'''),
+]
+
+
+def read_rows(path, fmt=None):
+    """逐列讀取 CSV / JSONL，產生 (行號, 欄位 dict)"""
+    fmt = fmt or ('jsonl' if os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson', '.json') else 'csv')
+    if fmt not in FORMATS:
+        raise ValueError(f"不支援的格式: {fmt}")
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line_num, line in enumerate(f, 1):
+                if line.strip():
+                    yield line_num, json.loads(line)
+
+
+def _clean(value):
+    """空字串視為未提供"""
+    if isinstance(value, str):
+        value = value.strip()
+        return value or None
+    return value
+
+
+def _stage(cursor, rows, store_code, chunk_size, progress):
+    """分批寫入暫存表，回傳筆數"""
+    cursor.execute('''CREATE TEMP TABLE import_staging (
+        line INTEGER PRIMARY KEY,
+        barcode TEXT, name TEXT, category TEXT, store_code TEXT,
+        price_ex_tax REAL, price_inc_tax REAL, cost REAL, stock INTEGER, low_stock_alert INTEGER,
+        store_id INTEGER, product_id INTEGER, store_product_id INTEGER, latest INTEGER DEFAULT 0, error TEXT
+    )''')
+    insert = f'''INSERT INTO import_staging (line, {', '.join(FIELDS)})
+        VALUES (?, {', '.join('?' * len(FIELDS))})'''
+    total = 0
+    chunk = []
+    for line, row in rows:
+        values = [_clean(row.get(field)) for field in FIELDS]
+        if store_code and values[3] is None:
+            values[3] = store_code
+        chunk.append([line] + [str(v) if v is not None and i < len(TEXT_FIELDS) else v
+                               for i, v in enumerate(values)])
+        if len(chunk) >= chunk_size:
+            cursor.executemany(insert, chunk)
+            total += len(chunk)
+            chunk = []
+            if progress:
+                progress('讀取', total)
+    if chunk:
+        cursor.executemany(insert, chunk)
+        total += len(chunk)
+    if progress:
+        progress('讀取', total)
+    cursor.execute("CREATE INDEX temp.idx_import_staging_barcode ON import_staging (barcode, line)")
+    return total
+
+
+def _resolve(cursor):
+    """以分店代碼 / 條碼比對 store_id / product_id"""
+    cursor.execute('''UPDATE import_staging SET store_id = (SELECT id FROM stores WHERE code = import_staging.store_code)
+        WHERE store_code IS NOT NULL''')
+    cursor.execute('''UPDATE import_staging SET product_id = (
+        SELECT id FROM products WHERE barcode = import_staging.barcode ORDER BY id LIMIT 1)''')
+
+
+def _validate(cursor):
+    """比對分店 / 商品並整批驗證，回傳錯誤清單（最多 MAX_ERRORS 筆）與錯誤總數"""
+    _resolve(cursor)
+    for message, condition in VALIDATIONS:
+        cursor.execute(f"UPDATE import_staging SET error = ? WHERE error IS NULL AND ({condition})", (message,))
+    # 未提供含稅價者整批由未稅價換算（與前台 calculate_price_inc_tax() 同一函數）
+    cursor.execute('''UPDATE import_staging SET price_inc_tax = pos_price_inc_tax(price_ex_tax)
+        WHERE error IS NULL AND price_inc_tax IS NULL AND price_ex_tax IS NOT NULL''')
+    # 商品主檔以每個條碼最後一筆有效列為準（優先取無分店代碼的主檔列）
+    cursor.execute('''UPDATE import_staging SET latest = 1 WHERE error IS NULL AND line = (
+        SELECT line FROM import_staging d WHERE d.barcode = import_staging.barcode AND d.error IS NULL
+        ORDER BY d.store_code IS NULL DESC, d.line DESC LIMIT 1)''')
+    cursor.execute("SELECT COUNT(*) FROM import_staging WHERE error IS NOT NULL")
+    count = cursor.fetchone()[0]
+    cursor.execute("SELECT line, barcode, error FROM import_staging WHERE error IS NOT NULL ORDER BY line LIMIT ?",
+                   (MAX_ERRORS,))
+    errors = [{'line': row[0], 'barcode': row[1], 'message': row[2]} for row in cursor.fetchall()]
+    return errors, count
+
+
+def _upsert(cursor, reference):
+    """以暫存表整批更新 / 新增 products 與 store_products（庫存變動寫入 stock_movements），回傳各項筆數"""
+    counts = {}
+    # 既有商品：名稱只在有變動時寫入（避免觸發全文索引重建）
+    cursor.execute('''UPDATE products SET
+            category = COALESCE(s.category, products.category),
+            cost = COALESCE(s.cost, products.cost),
+            price_ex_tax = CASE WHEN s.store_code IS NULL THEN COALESCE(s.price_ex_tax, products.price_ex_tax)
+                                ELSE products.price_ex_tax END,
+            price_inc_tax = CASE WHEN s.store_code IS NULL THEN COALESCE(s.price_inc_tax, products.price_inc_tax)
+                                 ELSE products.price_inc_tax END
+        FROM import_staging s
+        WHERE s.latest = 1 AND products.id = s.product_id''')
+    counts['products_updated'] = cursor.rowcount
+    cursor.execute('''UPDATE products SET name = s.name
+        FROM import_staging s
+        WHERE s.latest = 1 AND products.id = s.product_id AND s.name IS NOT NULL AND s.name != products.name''')
+
+    cursor.execute('''INSERT INTO products (name, price_ex_tax, price_inc_tax, cost, barcode, category)
+        SELECT COALESCE(name, (SELECT d.name FROM import_staging d WHERE d.barcode = s.barcode
+                               AND d.name IS NOT NULL AND d.error IS NULL ORDER BY d.line DESC LIMIT 1)),
+               COALESCE(price_ex_tax, 0), COALESCE(price_inc_tax, 0),
+               COALESCE(cost, 0), barcode, category
+        FROM import_staging s WHERE latest = 1 AND product_id IS NULL ORDER BY line''')
+    counts['products_created'] = cursor.rowcount
+    if counts['products_created']:
+        cursor.execute('''UPDATE import_staging SET product_id = (
+            SELECT id FROM products WHERE barcode = import_staging.barcode ORDER BY id LIMIT 1)
+            WHERE error IS NULL AND product_id IS NULL''')
+    # 新增 / 改名的商品由觸發器先以整段名稱建索引，這裡補上斷詞（只寫入有變動的商品）
+    cursor.execute("SELECT product_id FROM import_staging WHERE latest = 1 AND product_id IS NOT NULL")
+    database.refresh_product_search(cursor, [row[0] for row in cursor.fetchall()])
+
+    # 分店價格 / 庫存：先比對既有列再分別更新、新增（每店每商品一列）
+    cursor.execute('''UPDATE import_staging SET store_product_id = (
+        SELECT id FROM store_products
+        WHERE store_id = import_staging.store_id AND product_id = import_staging.product_id ORDER BY id LIMIT 1)
+        WHERE error IS NULL AND store_id IS NOT NULL''')
+    cursor.execute('''INSERT INTO stock_movements (store_id, product_id, quantity_change, stock_after, movement_type, reference)
+        SELECT sp.store_id, sp.product_id, s.stock - COALESCE(sp.stock, 0), s.stock, 'import', ?
+        FROM import_staging s JOIN store_products sp ON sp.id = s.store_product_id
+        WHERE s.stock IS NOT NULL AND s.stock IS NOT sp.stock ORDER BY s.line''', (reference,))
+    cursor.execute('''UPDATE store_products SET
+            price_ex_tax = COALESCE(s.price_ex_tax, store_products.price_ex_tax),
+            price_inc_tax = COALESCE(s.price_inc_tax, store_products.price_inc_tax),
+            stock = COALESCE(s.stock, store_products.stock),
+            low_stock_alert = COALESCE(s.low_stock_alert, store_products.low_stock_alert),
+            updated_at = CURRENT_TIMESTAMP
+        FROM import_staging s
+        WHERE store_products.id = s.store_product_id''')
+    counts['store_products_updated'] = cursor.rowcount
+    cursor.execute('''INSERT INTO store_products (store_id, product_id, price_ex_tax, price_inc_tax, stock, low_stock_alert)
+        SELECT s.store_id, s.product_id, COALESCE(s.price_ex_tax, p.price_ex_tax),
+               COALESCE(s.price_inc_tax, p.price_inc_tax),
+               COALESCE(s.stock, 0), COALESCE(s.low_stock_alert, 5)
+        FROM import_staging s JOIN products p ON p.id = s.product_id
+        WHERE s.error IS NULL AND s.store_id IS NOT NULL AND s.store_product_id IS NULL''')
+    counts['store_products_created'] = cursor.rowcount
+    cursor.execute('''INSERT INTO stock_movements (store_id, product_id, quantity_change, stock_after, movement_type, reference)
+        SELECT store_id, product_id, stock, stock, 'import', ? FROM import_staging
+        WHERE error IS NULL AND store_id IS NOT NULL AND store_product_id IS NULL AND stock != 0 ORDER BY line''',
+        (reference,))
+    return counts
+
+
+def import_catalog(path, fmt=None, store_code=None, dry_run=False, progress=None, chunk_size=CHUNK_SIZE):
+    """匯入商品主檔 / 分店價格檔
+
+    store_code：檔案未提供 store_code 欄位時套用的分店代碼。
+    progress(階段, 筆數)：讀取進度回報（每 chunk_size 筆一次）。
+    回傳 {'success': True, 'rows', 'imported', 'products_created', 'products_updated',
+          'store_products_created', 'store_products_updated', 'error_count', 'errors': [{'line', 'barcode', 'message'}]}
+    """
+    if not os.path.exists(path):
+        return {'success': False, 'message': f'找不到檔案: {path}'}
+    try:
+        rows = read_rows(path, fmt)
+        # 讀檔、解析與驗證只寫入本連線的暫存表，不持有資料庫寫入鎖；只有最後的 upsert 在 BEGIN IMMEDIATE 交易內
+        with database.db_connection() as conn:
+            nested = conn.in_transaction
+            cursor = conn.cursor()
+            try:
+                total = _stage(cursor, rows, store_code, chunk_size, progress)
+                errors, error_count = _validate(cursor)
+                if not nested:
+                    conn.commit()
+                if progress:
+                    progress('驗證', total)
+                with database.transaction():
+                    # 驗證期間其他連線可能新增了商品 / 分店，取得寫入鎖後重新比對
+                    _resolve(cursor)
+                    # 試算以 savepoint 還原，呼叫端已在交易中時不影響外層交易
+                    cursor.execute("SAVEPOINT catalog_import")
+                    counts = _upsert(cursor, os.path.basename(path))
+                    if dry_run:
+                        cursor.execute("ROLLBACK TO catalog_import")
+                    cursor.execute("RELEASE catalog_import")
+                if progress:
+                    progress('寫入', total - error_count)
+            finally:
+                cursor.execute("DROP TABLE IF EXISTS temp.import_staging")
+    except (ValueError, csv.Error) as e:
+        return {'success': False, 'message': f'檔案格式錯誤: {e}'}
+    return dict(counts, success=True, rows=total, imported=0 if dry_run else total - error_count,
+                error_count=error_count, errors=errors)
@@ -0,0 +1,48 @@
+"""
+測試共用設定
+每個測試使用獨立的暫存資料庫（已 init_db()），結束後關閉連線池並還原 DB_PATH。
+以 pytest 執行時由 pos_db fixture 自動套用；測試檔以腳本執行時，main() 以 temp_db() 包住每個測試。
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+
+
+def _close_db():
+    database.release_invoice_numbers()
+    database.close_pools()
+
+
+@pytest.fixture(autouse=True)
+def pos_db(tmp_path, monkeypatch):
+    """切換到 tmp_path 下的新資料庫，回傳資料庫路徑"""
+    database.close_pools()
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "pos.db"))
+    database.init_db()
+    yield database.DB_PATH
+    _close_db()
+
+
+@contextmanager
+def temp_db():
+    """腳本執行時等同 pos_db 的暫存資料庫"""
+    workdir = tempfile.mkdtemp(prefix="pos_test_")
+    previous = database.DB_PATH
+    database.close_pools()
+    database.DB_PATH = os.path.join(workdir, "pos.db")
+    try:
+        database.init_db()
+        yield database.DB_PATH
+    finally:
+        _close_db()
+        database.DB_PATH = previous
+        shutil.rmtree(workdir, ignore_errors=True)
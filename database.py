@@ -2,24 +2,621 @@
 POS 連鎖店系統 v2.0 - 資料庫模組
 支援：總部+分店架構、統一會員、庫存調度
 """
+import atexit
+import functools
+import heapq
+import io
+import json
+import os
+import random
+import re
+import socket
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from xml.sax.saxutils import escape as xml_escape
 
 DB_PATH = "pos_chain.db"
 
+# 連線池大小（每個資料庫檔案），可用環境變數 POS_DB_POOL_SIZE 調整
+POOL_SIZE = int(os.environ.get("POS_DB_POOL_SIZE", "8"))
+CONNECT_TIMEOUT = 30
+
+# 連線參數設定檔：WAL 讓報表查詢與結帳寫入互不阻塞
+PRAGMA_PROFILES = {
+    'default': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,     # 256MB
+        'cache_size': -65536,       # 64MB（負值單位為 KiB）
+        'temp_store': 'MEMORY',
+        'busy_timeout': 30000,
+    },
+    'low_memory': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 0,
+        'cache_size': -8192,
+        'temp_store': 'DEFAULT',
+        'busy_timeout': 30000,
+    },
+    # 舊版行為：rollback journal + SQLite 預設值
+    'legacy': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'busy_timeout': 30000,
+    },
+}
+# 各部署可用 POS_DB_PROFILE 選設定檔，POS_DB_PRAGMAS 覆寫個別值（如 "cache_size=-20000,mmap_size=0"）
+DB_PROFILE = os.environ.get("POS_DB_PROFILE", "default")
+PRAGMA_OVERRIDES = dict(
+    item.split("=", 1) for item in os.environ.get("POS_DB_PRAGMAS", "").split(",") if "=" in item
+)
+
+# SQLITE_BUSY 重試：最多重試次數與起始退避秒數（指數退避 + 抖動）
+BUSY_RETRIES = 5
+BUSY_BACKOFF = 0.05
+
+
+def get_pragmas(profile=None):
+    """取得目前連線使用的 PRAGMA 設定"""
+    pragmas = dict(PRAGMA_PROFILES[profile or DB_PROFILE])
+    pragmas.update(PRAGMA_OVERRIDES)
+    return pragmas
+
+
+# ===== 商品搜尋斷詞 =====
+# 中日文字以單字 + 相鄰兩字建索引（查詢 1~2 字直接比對，3 字以上拆成兩字詞全部比對；整段另做前綴比對），
+# 英數字以整個字詞建索引（查詢時做前綴比對），條碼整串另外收錄。
+# 寫入商品時以 Python 算好存入 products.search_tokens，由純 SQL 觸發器同步 products_fts；
+# 其他程式直接以 SQL 寫入的商品先以整段名稱 / 條碼建索引，refresh_product_search() 補齊。
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_SEARCH_TOKEN = re.compile(f'[{_CJK}]+|[^\\W_{_CJK}]+')
+_CJK_RUN = re.compile(f'[{_CJK}]')
+
+
+def search_tokens(name, barcode=None):
+    """商品名稱 / 條碼轉成 FTS 索引用的詞（以空白分隔）"""
+    tokens = []
+    for run in _SEARCH_TOKEN.findall((name or '').lower()):
+        if _CJK_RUN.match(run):
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    if barcode:
+        tokens.append(str(barcode).lower())
+    return ' '.join(tokens)
+
+
+def search_match_query(search):
+    """搜尋字串轉成 FTS5 MATCH 語法，沒有可搜尋的字詞時回傳 None"""
+    terms = []
+    for run in _SEARCH_TOKEN.findall((search or '').lower()):
+        if _CJK_RUN.match(run):
+            # 整段另做前綴比對：直接以 SQL 寫入、尚未斷詞的商品以整段名稱為詞
+            if len(run) <= 2:
+                terms.append(f'"{run}"*')
+            else:
+                bigrams = ' '.join(f'"{run[i:i + 2]}"' for i in range(len(run) - 1))
+                terms.append(f'({bigrams} OR "{run}"*)')
+        else:
+            terms.append(f'"{run}"*')
+    return ' '.join(terms) or None
+
+
+# ===== 連線池 =====
+
+class _Hold:
+    """某個執行緒借用中的連線（巢狀深度與交易回滾時要執行的 callback）"""
+
+    __slots__ = ('conn', 'depth', 'rollback_hooks')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.depth = 1
+        self.rollback_hooks = []
+
+
+class ConnectionPool:
+    """SQLite 連線池
+
+    同一執行緒巢狀取得連線時直接重用（不會自己鎖住自己），
+    歸還後的連線放回閒置清單供其他執行緒使用，最多建立 pool_size 條。
+    借用紀錄以執行緒 id 為鍵，其他執行緒也能代為歸還。
+    """
+
+    def __init__(self, db_path, pool_size=None, timeout=CONNECT_TIMEOUT, pragmas=None):
+        self.db_path = db_path
+        self.pool_size = pool_size or POOL_SIZE
+        self.timeout = timeout
+        self.pragmas = get_pragmas() if pragmas is None else pragmas
+        self._idle = []
+        self._all = []
+        self._cond = threading.Condition()
+        self._held = {}           # 執行緒 id -> _Hold
+        self._closed = False
+        self._stats = {'hits': 0, 'misses': 0, 'nested': 0, 'waits': 0, 'wait_time': 0.0}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.create_function('pos_ngrams', 2, search_tokens, deterministic=True)
+        conn.create_function('pos_price_inc_tax', 1, calculate_price_inc_tax, deterministic=True)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def holds_connection(self):
+        """目前執行緒是否已借用連線（位於某個交易/函數呼叫之內）"""
+        return threading.get_ident() in self._held
+
+    def on_rollback(self, callback):
+        """目前執行緒的交易回滾時呼叫 callback（交易提交時捨棄）"""
+        hold = self._held.get(threading.get_ident())
+        if hold is not None:
+            hold.rollback_hooks.append(callback)
+
+    def _finish_transaction(self, rolled_back, hold=None):
+        hold = hold or self._held.get(threading.get_ident())
+        if hold is None:
+            return
+        hooks, hold.rollback_hooks = hold.rollback_hooks, []
+        if not rolled_back:
+            return
+        for callback in reversed(hooks):
+            try:
+                callback()
+            except sqlite3.Error:
+                # 不可蓋過造成回滾的原始例外
+                pass
+
+    def acquire(self):
+        """借出連線（同執行緒已持有時直接重用）"""
+        thread = threading.get_ident()
+        with self._cond:
+            hold = self._held.get(thread)
+            if hold is not None:
+                hold.depth += 1
+                self._stats['nested'] += 1
+                return hold.conn
+            conn = self._take()
+            self._held[thread] = _Hold(conn)
+        return conn
+
+    def checkout(self):
+        """借出不記在任何執行緒名下的連線（供跨執行緒的串流使用），以 checkin() 歸還"""
+        with self._cond:
+            return self._take()
+
+    def _take(self):
+        """取出一條閒置連線或新建（須持有 self._cond）"""
+        waited_from = None
+        while not self._idle and len(self._all) >= self.pool_size:
+            if waited_from is None:
+                waited_from = time.perf_counter()
+                self._stats['waits'] += 1
+            remaining = self.timeout - (time.perf_counter() - waited_from)
+            if remaining <= 0 or not self._cond.wait(remaining):
+                self._stats['wait_time'] += time.perf_counter() - waited_from
+                raise sqlite3.OperationalError("connection pool exhausted")
+        if waited_from is not None:
+            self._stats['wait_time'] += time.perf_counter() - waited_from
+
+        if self._idle:
+            conn = self._idle.pop()
+            self._stats['hits'] += 1
+        else:
+            conn = self._connect()
+            self._all.append(conn)
+            self._stats['misses'] += 1
+        return conn
+
+    def checkin(self, conn):
+        """放回連線（可在任何執行緒呼叫），回傳是否回滾了未提交的交易"""
+        rolled_back = conn.in_transaction
+        if rolled_back:
+            conn.rollback()
+        with self._cond:
+            if self._closed:
+                # 連線池已關閉：借出中的連線歸還時直接關閉
+                self._all.remove(conn)
+                conn.close()
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+        return rolled_back
+
+    def release(self, conn, thread=None):
+        """歸還連線；最外層歸還時未提交的交易會被回滾
+
+        thread 為借用連線的執行緒 id（預設為目前執行緒），供其他執行緒代為歸還。
+        """
+        thread = threading.get_ident() if thread is None else thread
+        with self._cond:
+            hold = self._held.get(thread)
+            if hold is None or hold.conn is not conn:
+                return
+            hold.depth -= 1
+            if hold.depth > 0:
+                return
+            del self._held[thread]
+        self._finish_transaction(self.checkin(conn), hold)
+
+    def stats(self):
+        """連線池統計"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['open'] = len(self._all)
+            stats['idle'] = len(self._idle)
+        stats['pool_size'] = self.pool_size
+        return stats
+
+    def close_all(self):
+        """關閉所有閒置連線；借出中的連線在歸還時關閉"""
+        with self._cond:
+            self._closed = True
+            for conn in self._idle:
+                self._all.remove(conn)
+                conn.close()
+            self._idle = []
+
+
+class PooledConnection:
+    """從連線池借出的連線，close() 時歸還連線池而非真正關閉（呼叫端須以 try/finally 明確歸還）
+
+    借用時連線已在交易中（外層呼叫端的工作單元）：commit() 與 with 區塊不提交也不回滾，
+    由外層持有者決定，避免內層函數提交外層尚未完成的寫入。
+    """
+
+    __slots__ = ('_pool', '_conn', '_thread', '_joined')
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self._thread = threading.get_ident()
+        self._joined = conn.in_transaction
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._joined:
+            return False
+        return self._conn.__exit__(exc_type, exc, tb)
+
+    def commit(self):
+        if not self._joined:
+            self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn, self._thread)
+            self._conn = None
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool():
+    """取得目前 DB_PATH 對應的連線池"""
+    pool = _pools.get(DB_PATH)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(DB_PATH)
+            if pool is None:
+                pool = _pools[DB_PATH] = ConnectionPool(DB_PATH)
+    return pool
+
+
+def configure_pool(pool_size=None, profile=None, pragmas=None):
+    """調整連線池大小與 PRAGMA 設定檔（會關閉並重建現有連線池）"""
+    global POOL_SIZE, DB_PROFILE, PRAGMA_OVERRIDES
+    if pool_size:
+        POOL_SIZE = int(pool_size)
+    if profile:
+        if profile not in PRAGMA_PROFILES:
+            raise ValueError(f"未知的 PRAGMA 設定檔: {profile}")
+        DB_PROFILE = profile
+    if pragmas is not None:
+        PRAGMA_OVERRIDES = dict(pragmas)
+    close_pools()
+
+
+def close_pools():
+    """關閉所有連線池的閒置連線（借出中的連線歸還時關閉）與資料版本監看連線"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close_all()
+        _pools.clear()
+    data_versions.close()
+
+
+def _reset_pools_after_fork():
+    # 子行程不可沿用父行程的 SQLite 連線
+    global _pools_lock
+    _pools.clear()
+    _pools_lock = threading.Lock()
+    data_versions.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pools_after_fork)
+
+
+def get_pool_stats():
+    """取得連線池統計（hits/misses/nested/waits/wait_time）"""
+    return get_pool().stats()
+
 
 def get_connection():
-    """建立資料庫連線"""
-    conn = sqlite3.connect(DB_PATH, timeout=30)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """建立資料庫連線（由連線池借出，close() 即歸還）"""
+    pool = get_pool()
+    return PooledConnection(pool, pool.acquire())
 
 
-def init_db():
-    """初始化資料庫"""
-    conn = get_connection()
-    cursor = conn.cursor()
+@contextmanager
+def db_connection():
+    """以 with 區塊借用連線，離開區塊自動歸還（未 commit 的變更會回滾）"""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+def is_busy_error(exc):
+    """是否為 SQLITE_BUSY / database is locked"""
+    message = str(exc).lower()
+    return 'locked' in message or 'busy' in message
 
+
+def retry_on_busy(func):
+    """遇到 SQLITE_BUSY 時以指數退避重試整個函數
+
+    只在最外層呼叫重試；巢狀呼叫（同執行緒已持有連線）直接拋出，
+    由持有交易的外層函數回滾後重來。
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if get_pool().holds_connection():
+            return func(*args, **kwargs)
+        for attempt in range(BUSY_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if attempt == BUSY_RETRIES or not is_busy_error(e):
+                    raise
+                time.sleep(BUSY_BACKOFF * (2 ** attempt) * (0.5 + random.random() / 2))
+    return wrapper
+
+
+@contextmanager
+def transaction():
+    """以 BEGIN IMMEDIATE 開始交易，離開區塊時 commit（例外時 rollback）
+
+    若目前執行緒已在交易中（巢狀呼叫），直接併入外層交易，由外層負責提交。
+    回滾時依登記的相反順序執行 on_rollback() 的 callback。
+    """
+    pool = get_pool()
+    conn = pool.acquire()
+    owner = not conn.in_transaction
+    try:
+        if owner:
+            pool._finish_transaction(False)
+            conn.execute("BEGIN IMMEDIATE")
+        yield conn
+        if owner:
+            conn.commit()
+            pool._finish_transaction(False)
+    except BaseException:
+        if owner and conn.in_transaction:
+            conn.rollback()
+            pool._finish_transaction(True)
+        raise
+    finally:
+        pool.release(conn)
+
+
+def on_rollback(callback):
+    """目前交易回滾時呼叫 callback（例如歸還交易內取得的號碼）"""
+    get_pool().on_rollback(callback)
+
+
+# ===== 資料版本與快照快取 =====
+# 受監看資料表的 INSERT / UPDATE / DELETE 觸發器在同一交易內遞增 data_versions 的範圍版本（v15），
+# 因此任何連線、行程或外部工具（manage.py、直接執行 SQL）的寫入提交後都會反映；讀取端比對版本，未變動時直接使用記憶體中的結果。
+# 讀取版本時先查監看連線的 PRAGMA data_version（其他連線提交後才會改變），有變動才重新讀取 data_versions。
+# 範圍 -> 資料表；已發佈的項目不要修改，新增範圍請另加遷移建立觸發器。
+DATA_VERSION_SCOPES = {
+    'products': ('products',),
+    'store_products': ('store_products',),
+    'stores': ('stores',),
+    'member_levels': ('member_levels',),
+    'birthday_coupons': ('birthday_coupons',),
+    'promotions': ('promotions', 'promotion_products'),
+    'members': ('members',),
+    'sales_product_daily': ('sales_product_daily',),
+}
+
+
+class DataVersionWatcher:
+    """以一條常駐的監看連線讀取已提交的資料版本（各執行緒共用）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+        self._db_path = None
+        self._mark = None
+        self._versions = {}
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = None
+        self._db_path = None
+        self._mark = None
+        self._versions = {}
+
+    def get(self):
+        """取得 {範圍: 版本}（共用物件，呼叫端不可修改）"""
+        with self._lock:
+            if self._db_path != DB_PATH:
+                self._close()
+                self._conn = sqlite3.connect(DB_PATH, timeout=CONNECT_TIMEOUT, check_same_thread=False)
+                self._db_path = DB_PATH
+            mark = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if mark != self._mark:
+                try:
+                    self._versions = dict(self._conn.execute("SELECT scope, version FROM data_versions").fetchall())
+                    self._mark = mark
+                except sqlite3.OperationalError:
+                    # 尚未遷移（沒有 data_versions）
+                    self._versions = {}
+            return self._versions
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def reset_after_fork(self):
+        # 子行程不可沿用父行程的 SQLite 連線
+        self._lock = threading.Lock()
+        self._conn = None
+        self._close()
+
+
+data_versions = DataVersionWatcher()
+
+
+def _version_of(versions, *scopes):
+    return (DB_PATH,) + tuple(versions.get(scope, 0) for scope in scopes)
+
+
+def data_version(*scopes):
+    """取得目前資料庫指定範圍已提交的版本組合（可直接比較）"""
+    return _version_of(data_versions.get(), *scopes)
+
+
+def _read_data_versions(cursor):
+    """在目前交易內讀取所有範圍的版本（含本交易尚未提交的寫入），回傳 {範圍: 版本}"""
+    cursor.execute("SELECT scope, version FROM data_versions")
+    return dict(cursor.fetchall())
+
+
+class SnapshotCache:
+    """依資料版本失效的查詢結果快取（結果為共用物件，呼叫端不可修改）"""
+
+    def __init__(self, max_entries=512):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, scopes, loader):
+        # 先取版本再載入：載入期間有寫入時，下次比對不符會重新載入
+        version = data_version(*scopes)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+        value = loader()
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                # 搜尋字串等參數組合過多時整批清掉，避免無限成長
+                self._entries.clear()
+            self._entries[key] = (version, value)
+            self.misses += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+snapshot_cache = SnapshotCache()
+
+
+def snapshot(*scopes):
+    """把讀取函數包成快取版本：同樣參數且 scopes 版本未變時不查資料庫"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (func.__name__, args, tuple(sorted(kwargs.items())))
+            return snapshot_cache.get(key, scopes, lambda: func(*args, **kwargs))
+        wrapper.uncached = func
+        return wrapper
+    return decorate
+
+
+def get_snapshot_stats():
+    """取得快照快取統計（hits/misses/entries）"""
+    return snapshot_cache.stats()
+
+
+# ===== 索引定義 =====
+# (版本, 索引名稱, 資料表, 欄位)。新增索引時加一筆新版本號，由 init_db() 補建；
+# 已發佈的項目不要修改，要調整請用新名稱新增並另行 DROP 舊索引。
+# einvoice_amount.invoice_id 已是 UNIQUE（SQLite 自動建立索引），不需重複定義。
+SCHEMA_INDEXES = [
+    (1, 'idx_store_products_store_product', 'store_products', 'store_id, product_id'),
+    (1, 'idx_sale_items_sale', 'sale_items', 'sale_id'),
+    (1, 'idx_sales_store_created', 'sales', 'store_id, created_at'),
+    (1, 'idx_sales_created', 'sales', 'created_at'),
+    (1, 'idx_promotion_products_product', 'promotion_products', 'product_id'),
+    (1, 'idx_member_points_log_member', 'member_points_log', 'member_id'),
+    (1, 'idx_einvoice_details_invoice', 'einvoice_details', 'invoice_id, sequence_number'),
+    (1, 'idx_einvoice_main_seller_date', 'einvoice_main', 'seller_identifier, invoice_date'),
+    (2, 'idx_invoices_store_created', 'invoices', 'store_id, created_at'),
+    (2, 'idx_invoices_number', 'invoices', 'invoice_number'),
+    (2, 'idx_invoice_items_invoice', 'invoice_items', 'invoice_id, sequence_number'),
+    (3, 'idx_products_barcode', 'products', 'barcode'),
+    (4, 'idx_invoices_created', 'invoices', 'created_at'),
+    (4, 'idx_members_active_created', 'members', 'is_active, created_at'),
+    (4, 'idx_inventory_transfers_created', 'inventory_transfers', 'created_at'),
+    (4, 'idx_inventory_transfers_from', 'inventory_transfers', 'from_store_id, created_at'),
+    (4, 'idx_inventory_transfers_to', 'inventory_transfers', 'to_store_id, created_at'),
+    (5, 'idx_member_points_snapshots_ledger', 'member_points_snapshots', 'ledger_id'),
+    (6, 'idx_stock_movements_store_product', 'stock_movements', 'store_id, product_id, id'),
+    (7, 'idx_inventory_transfers_order', 'inventory_transfers', 'order_id'),
+    (7, 'idx_inventory_transfers_status', 'inventory_transfers', 'status, created_at'),
+    (7, 'idx_inventory_transfer_orders_from', 'inventory_transfer_orders', 'from_store_id'),
+    (7, 'idx_inventory_transfer_orders_to', 'inventory_transfer_orders', 'to_store_id'),
+    (8, 'idx_stock_movements_store', 'stock_movements', 'store_id, id'),
+    (8, 'idx_stock_snapshots_store_created', 'stock_snapshots', 'store_id, created_at'),
+    (9, 'idx_sales_daily_rollup_day', 'sales_daily_rollup', 'day'),
+    (9, 'idx_sales_hourly_cube_day', 'sales_hourly_cube', 'day, hour'),
+    (9, 'idx_sales_product_daily_day', 'sales_product_daily', 'day'),
+]
+INDEX_VERSION = max(version for version, _, _, _ in SCHEMA_INDEXES)
+# 已由後續遷移移除的索引（資料表已刪除或另行 DROP），項目保留供舊版本遷移使用
+DROPPED_INDEXES = {
+    'idx_member_points_snapshots_ledger',   # v20 移除 member_points_snapshots
+}
+
+
+def apply_indexes(cursor, from_version=0, to_version=None):
+    """建立 (from_version, to_version] 範圍內的索引"""
+    to_version = INDEX_VERSION if to_version is None else to_version
+    for version, name, table, columns in SCHEMA_INDEXES:
+        if from_version < version <= to_version:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+
+
+def _migrate_base_schema(cursor):
+    """v1：基本資料表、預設資料、舊版 stores 欄位補齊"""
     # ===== 分店資料表 =====
     cursor.execute('''CREATE TABLE IF NOT EXISTS stores (
         id INTEGER PRIMARY KEY,
@@ -511,60 +1108,477 @@ def init_db():
             except:
                 pass
 
-    conn.commit()
-    conn.close()
-    print("資料庫初始化完成 (v2.0)")
+
+
+def _migrate_indexes_v1(cursor):
+    """v2：第一批次要索引"""
+    apply_indexes(cursor, 0, 1)
+
+
+def _migrate_invoices(cursor):
+    """v3：收銀發票主檔與明細（create_invoice / checkout 使用）"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS invoices (
+        id INTEGER PRIMARY KEY,
+        invoice_number TEXT NOT NULL,
+        sale_id INTEGER,
+        store_id INTEGER NOT NULL,
+        member_id INTEGER,
+        member_phone TEXT,
+        member_email TEXT,
+        total_amount REAL NOT NULL,
+        tax_amount REAL DEFAULT 0,
+        free_amount REAL DEFAULT 0,
+        invoice_status TEXT DEFAULT 'issued',
+        invoice_date TEXT,
+        invoice_time TEXT,
+        carrier_type TEXT,
+        carrier_number TEXT,
+        pay_time TEXT,
+        pay_type TEXT,
+        void_reason TEXT,
+        void_time TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (sale_id) REFERENCES sales(id),
+        FOREIGN KEY (store_id) REFERENCES stores(id)
+    )''')
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS invoice_items (
+        id INTEGER PRIMARY KEY,
+        invoice_id INTEGER NOT NULL,
+        product_id INTEGER,
+        product_name TEXT,
+        quantity INTEGER,
+        unit_price REAL,
+        amount REAL,
+        tax_type TEXT DEFAULT 'taxed',
+        sequence_number INTEGER,
+        FOREIGN KEY (invoice_id) REFERENCES invoices(id)
+    )''')
+    apply_indexes(cursor, 1, 2)
+
+
+def _migrate_invoice_numbering(cursor):
+    """v4：發票號碼區段預留表與收銀發票流水號"""
+    # 各行程預留中（reserved）與歸還待用（free）的字軌號碼區段
+    cursor.execute('''CREATE TABLE IF NOT EXISTS einvoice_number_blocks (
+        id INTEGER PRIMARY KEY,
+        track_id INTEGER NOT NULL,
+        start_number INTEGER NOT NULL,
+        end_number INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'free',
+        owner TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (track_id) REFERENCES einvoice_track_numbers(id)
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_einvoice_number_blocks_status "
+                   "ON einvoice_number_blocks (status, track_id, start_number)")
+
+    # 收銀發票（invoices）每店每月流水號
+    cursor.execute('''CREATE TABLE IF NOT EXISTS invoice_sequences (
+        store_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        last_serial INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (store_id, period)
+    )''')
+
+
+def _migrate_product_search(cursor):
+    """v5：商品條碼索引與名稱全文檢索（products_fts，由觸發器同步）"""
+    apply_indexes(cursor, 2, 3)
+    # 無內容（contentless）FTS5：只存詞，rowid 即 products.id
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(tokens, content='')")
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts (rowid, tokens) VALUES (new.id, pos_ngrams(new.name, new.barcode));
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, barcode ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, tokens) VALUES ('delete', old.id, pos_ngrams(old.name, old.barcode));
+        INSERT INTO products_fts (rowid, tokens) VALUES (new.id, pos_ngrams(new.name, new.barcode));
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, tokens) VALUES ('delete', old.id, pos_ngrams(old.name, old.barcode));
+    END''')
+    cursor.execute("INSERT INTO products_fts (rowid, tokens) SELECT id, pos_ngrams(name, barcode) FROM products")
+
+
+def _migrate_sales_rollup(cursor):
+    """v6：每店每日銷售彙總（由 _record_sale 累加，get_daily_sales / get_store_revenue 讀取）"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sales_daily_rollup (
+        store_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        discount REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (store_id, day)
+    )''')
+    _rebuild_rollup(cursor, 'sales_daily_rollup')
+
+
+def _migrate_sales_hourly_cube(cursor):
+    """v7：每店每日每小時銷售彙總（get_hourly_sales / get_sales_heatmap 讀取）"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sales_hourly_cube (
+        store_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        hour INTEGER NOT NULL,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        item_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (store_id, day, hour)
+    )''')
+    _rebuild_rollup(cursor, 'sales_hourly_cube')
+
+
+def _migrate_sales_product_daily(cursor):
+    """v8：每店每日商品銷售彙總（get_top_products 讀取）"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sales_product_daily (
+        store_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (store_id, day, product_id)
+    )''')
+    _rebuild_rollup(cursor, 'sales_product_daily')
+
+
+def _migrate_indexes_v4(cursor):
+    """v9：列表分頁（created_at, id）與計數用索引"""
+    apply_indexes(cursor, 3, 4)
+
+
+def _checkpoint_points(cursor):
+    """v10 遷移建立積分快照（快照表已於 v20 移除，只供 v10 使用）"""
+    cursor.execute("SELECT COALESCE(MAX(ledger_id), 0) FROM member_points_snapshots")
+    watermark = cursor.fetchone()[0]
+    cursor.execute('''INSERT INTO member_points_snapshots (member_id, ledger_id, points)
+        SELECT l.member_id, MAX(l.id), COALESCE(s.points, 0) + SUM(l.points_change)
+        FROM member_points_log l
+        LEFT JOIN member_points_snapshots s ON s.member_id = l.member_id
+        WHERE l.id > ?
+        GROUP BY l.member_id
+        ON CONFLICT(member_id) DO UPDATE SET
+            ledger_id = excluded.ledger_id, points = excluded.points, created_at = CURRENT_TIMESTAMP''',
+        (watermark,))
+
+
+def _migrate_points_ledger(cursor):
+    """v10：積分帳本快照；帳本無法解釋的既有積分補一筆期初餘額，使帳本餘額等於 members.points"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS member_points_snapshots (
+        member_id INTEGER PRIMARY KEY,
+        ledger_id INTEGER NOT NULL,
+        points INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (member_id) REFERENCES members(id)
+    )''')
+    apply_indexes(cursor, 4, 5)
+    cursor.execute('''INSERT INTO member_points_log (member_id, points_change, points_balance, reason)
+        SELECT m.id, m.points - COALESCE(l.total, 0), m.points, '期初餘額'
+        FROM members m
+        LEFT JOIN (SELECT member_id, SUM(points_change) AS total FROM member_points_log GROUP BY member_id) l
+            ON l.member_id = m.id
+        WHERE m.points IS NOT NULL AND m.points != COALESCE(l.total, 0)''')
+    _checkpoint_points(cursor)
+
+
+def _migrate_stock_movements(cursor):
+    """v11：庫存異動日誌（quantity_change 為增減量，stock_after 為異動後庫存）"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS stock_movements (
+        id INTEGER PRIMARY KEY,
+        store_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity_change INTEGER NOT NULL,
+        stock_after INTEGER,
+        movement_type TEXT NOT NULL,
+        reference TEXT,
+        created_by INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (store_id) REFERENCES stores(id),
+        FOREIGN KEY (product_id) REFERENCES products(id),
+        FOREIGN KEY (created_by) REFERENCES users(id)
+    )''')
+    apply_indexes(cursor, 5, 6)
+
+
+def _migrate_transfer_orders(cursor):
+    """v12：多品項調貨單；既有的單品項調貨 order_id 為 NULL"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS inventory_transfer_orders (
+        id INTEGER PRIMARY KEY,
+        from_store_id INTEGER NOT NULL,
+        to_store_id INTEGER NOT NULL,
+        notes TEXT,
+        created_by INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (from_store_id) REFERENCES stores(id),
+        FOREIGN KEY (to_store_id) REFERENCES stores(id),
+        FOREIGN KEY (created_by) REFERENCES users(id)
+    )''')
+    cursor.execute("SELECT name FROM pragma_table_info('inventory_transfers')")
+    if 'order_id' not in {row[0] for row in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE inventory_transfers ADD COLUMN order_id INTEGER REFERENCES inventory_transfer_orders(id)")
+    apply_indexes(cursor, 6, 7)
+
+
+def _migrate_stock_snapshots(cursor):
+    """v13：分店庫存快照；日誌無法解釋的既有庫存補一筆期初異動，使日誌重建的庫存等於 store_products.stock"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS stock_snapshots (
+        id INTEGER PRIMARY KEY,
+        store_id INTEGER NOT NULL,
+        movement_id INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (store_id) REFERENCES stores(id)
+    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS stock_snapshot_items (
+        snapshot_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        stock INTEGER NOT NULL,
+        PRIMARY KEY (snapshot_id, product_id),
+        FOREIGN KEY (snapshot_id) REFERENCES stock_snapshots(id)
+    ) WITHOUT ROWID''')
+    apply_indexes(cursor, 7, 8)
+    _reconcile_stock(cursor, 'opening')
+
+
+def _migrate_store_products_unique(cursor):
+    """v14：store_products 每店每商品只保留一列並建立唯一索引
+
+    舊版 add_store_product 以 INSERT OR REPLACE 寫入，但資料表沒有唯一鍵，重新設定會多出一列；
+    保留最後寫入的一列（即最後一次設定的價格 / 庫存），日誌與保留列不一致時補 reconcile 異動。
+    """
+    cursor.execute('''DELETE FROM store_products WHERE id NOT IN (
+        SELECT MAX(id) FROM store_products GROUP BY store_id, product_id)''')
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_store_products_unique ON store_products (store_id, product_id)")
+    _reconcile_stock(cursor, 'reconcile')
+
+
+def _migrate_data_versions(cursor):
+    """v15：資料版本表與觸發器，任何連線 / 行程的寫入都會讓快取失效"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS data_versions (
+        scope TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID''')
+    for scope, tables in DATA_VERSION_SCOPES.items():
+        cursor.execute("INSERT OR IGNORE INTO data_versions (scope) VALUES (?)", (scope,))
+        for table in tables:
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version AFTER {event} ON {table} BEGIN
+                    UPDATE data_versions SET version = version + 1 WHERE scope = '{scope}';
+                END''')
+
+
+def _migrate_rollup_day_indexes(cursor):
+    """v16：彙總表的日期索引，全部分店的報表直接依日期查詢（含已刪除分店的銷售）"""
+    apply_indexes(cursor, 8, 9)
+
+
+def _migrate_invoice_block_lease(cursor):
+    """v17：發票號碼預留區段的租約時間，其他主機遺留的區段到期後回收"""
+    cursor.execute("SELECT name FROM pragma_table_info('einvoice_number_blocks')")
+    if 'reserved_at' not in {row[0] for row in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE einvoice_number_blocks ADD COLUMN reserved_at TIMESTAMP")
+    cursor.execute("UPDATE einvoice_number_blocks SET reserved_at = created_at WHERE status = 'reserved' AND reserved_at IS NULL")
+
+
+def _migrate_product_search_tokens(cursor):
+    """v18：商品搜尋詞存入 products.search_tokens，觸發器改為純 SQL（不再需要連線上註冊的 pos_ngrams()）"""
+    cursor.execute("SELECT name FROM pragma_table_info('products')")
+    if 'search_tokens' not in {row[0] for row in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE products ADD COLUMN search_tokens TEXT")
+    for trigger in ('products_fts_insert', 'products_fts_update', 'products_fts_delete'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    refresh_product_search(cursor)
+    cursor.execute("INSERT INTO products_fts (products_fts) VALUES ('delete-all')")
+    cursor.execute("INSERT INTO products_fts (rowid, tokens) SELECT id, search_tokens FROM products WHERE search_tokens IS NOT NULL")
+    # products_fts 的內容恆等於 search_tokens（無內容 FTS5 刪除時須提供原本的詞）
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products
+        WHEN new.search_tokens IS NOT NULL BEGIN
+        INSERT INTO products_fts (rowid, tokens) VALUES (new.id, new.search_tokens);
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF search_tokens ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, tokens)
+            SELECT 'delete', old.id, old.search_tokens WHERE old.search_tokens IS NOT NULL;
+        INSERT INTO products_fts (rowid, tokens) SELECT new.id, new.search_tokens WHERE new.search_tokens IS NOT NULL;
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products
+        WHEN old.search_tokens IS NOT NULL BEGIN
+        INSERT INTO products_fts (products_fts, rowid, tokens) VALUES ('delete', old.id, old.search_tokens);
+    END''')
+    # 未帶 search_tokens 的寫入（其他程式 / sqlite3 命令列）：先以整段名稱與條碼建索引
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS products_search_tokens_insert AFTER INSERT ON products
+        WHEN new.search_tokens IS NULL BEGIN
+        UPDATE products SET search_tokens = COALESCE(new.name, '') || ' ' || COALESCE(new.barcode, '') WHERE id = new.id;
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS products_search_tokens_stale AFTER UPDATE OF name, barcode ON products
+        WHEN new.search_tokens IS old.search_tokens BEGIN
+        UPDATE products SET search_tokens = COALESCE(new.name, '') || ' ' || COALESCE(new.barcode, '') WHERE id = new.id;
+    END''')
+
+
+def _migrate_member_row_version(cursor):
+    """v19：會員資料列版本 members.row_version，會員快取只讓被修改的會員失效"""
+    cursor.execute("SELECT name FROM pragma_table_info('members')")
+    if 'row_version' not in {row[0] for row in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE members ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0")
+    # 以 data_versions 的 member_rows 計數器編號：每次寫入取得全表唯一的新版本，刪除後重用的 id 也不會與舊版本相同
+    cursor.execute("INSERT OR IGNORE INTO data_versions (scope) VALUES ('member_rows')")
+    for event, when in (('INSERT', ''), ('UPDATE', ' WHEN new.row_version IS old.row_version')):
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS members_{event.lower()}_row_version AFTER {event} ON members{when} BEGIN
+            UPDATE data_versions SET version = version + 1 WHERE scope = 'member_rows';
+            UPDATE members SET row_version = (SELECT version FROM data_versions WHERE scope = 'member_rows')
+                WHERE id = new.id;
+        END''')
+
+
+def _migrate_drop_points_snapshots(cursor):
+    """v20：移除積分快照表；餘額以 members.points（與帳本同一交易寫入）為準，check_member_points() 以帳本比對"""
+    cursor.execute("DROP TABLE IF EXISTS member_points_snapshots")
+
+
+# ===== 資料庫版本遷移 =====
+# 版本記錄於 PRAGMA user_version；只能在最後新增版本，已發佈的遷移不可修改
+MIGRATIONS = [
+    (1, _migrate_base_schema),
+    (2, _migrate_indexes_v1),
+    (3, _migrate_invoices),
+    (4, _migrate_invoice_numbering),
+    (5, _migrate_product_search),
+    (6, _migrate_sales_rollup),
+    (7, _migrate_sales_hourly_cube),
+    (8, _migrate_sales_product_daily),
+    (9, _migrate_indexes_v4),
+    (10, _migrate_points_ledger),
+    (11, _migrate_stock_movements),
+    (12, _migrate_transfer_orders),
+    (13, _migrate_stock_snapshots),
+    (14, _migrate_store_products_unique),
+    (15, _migrate_data_versions),
+    (16, _migrate_rollup_day_indexes),
+    (17, _migrate_invoice_block_lease),
+    (18, _migrate_product_search_tokens),
+    (19, _migrate_member_row_version),
+    (20, _migrate_drop_points_snapshots),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version():
+    """取得資料庫目前的結構版本"""
+    with db_connection() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def run_migrations():
+    """套用尚未執行的遷移，回傳已套用的版本清單"""
+    with db_connection() as conn:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return []
+        # 取得寫入鎖後再讀一次版本，避免多個行程同時遷移
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            cursor = conn.cursor()
+            applied = []
+            for version, migrate in MIGRATIONS:
+                if version > current:
+                    migrate(cursor)
+                    cursor.execute(f"PRAGMA user_version = {version}")
+                    applied.append(version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return applied
+
+
+def init_db():
+    """初始化資料庫（已是最新版本時只讀一次 user_version）"""
+    if run_migrations():
+        print("資料庫初始化完成 (v2.0)")
+
+
+# ===== 分頁 =====
+# 列表函數以 keyset 分頁：依 (created_at, id) 由新到舊排序，下一頁傳入上一頁最後一筆的
+# page_cursor()，不使用 OFFSET，翻到多深都只讀一頁。iter_*() 逐頁產生資料，記憶體只保留一頁。
+
+def page_cursor(row):
+    """取得一筆資料的分頁游標（傳給列表函數的 before 參數）"""
+    return (row['created_at'], row['id'])
+
+
+def _before_clause(before, alias=''):
+    """keyset 條件：排在游標之後（較舊）的資料"""
+    if before is None:
+        return "", []
+    return f" AND ({alias}created_at, {alias}id) < (?, ?)", list(before)
+
+
+def _iter_pages(fetch_page, batch_size, cursor=page_cursor):
+    """逐頁呼叫 fetch_page(limit=, before=) 並逐筆產生"""
+    before = None
+    while True:
+        rows = fetch_page(limit=batch_size, before=before)
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        before = cursor(rows[-1])
 
 
 # ===== 分店管理 =====
 
 def add_store(name, code, address="", phone="", is_hq=0, parent_id=None):
     conn = get_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute("INSERT INTO stores (name, code, address, phone, is_hq, parent_id) VALUES (?, ?, ?, ?, ?, ?)",
-            (name, code, address, phone, is_hq, parent_id))
-    except:
+        cursor = conn.cursor()
         try:
-            cursor.execute("INSERT INTO stores (name, code, address, phone, is_hq) VALUES (?, ?, ?, ?, ?)",
-                (name, code, address, phone, is_hq))
+            cursor.execute("INSERT INTO stores (name, code, address, phone, is_hq, parent_id) VALUES (?, ?, ?, ?, ?, ?)",
+                (name, code, address, phone, is_hq, parent_id))
         except:
             try:
-                cursor.execute("INSERT INTO stores (name, code, address, phone) VALUES (?, ?, ?, ?)",
-                    (name, code, address, phone))
+                cursor.execute("INSERT INTO stores (name, code, address, phone, is_hq) VALUES (?, ?, ?, ?, ?)",
+                    (name, code, address, phone, is_hq))
             except:
-                cursor.execute("INSERT INTO stores (name, address, phone) VALUES (?, ?, ?)",
-                    (name, address, phone))
-    conn.commit()
-    conn.close()
+                try:
+                    cursor.execute("INSERT INTO stores (name, code, address, phone) VALUES (?, ?, ?, ?)",
+                        (name, code, address, phone))
+                except:
+                    cursor.execute("INSERT INTO stores (name, address, phone) VALUES (?, ?, ?)",
+                        (name, address, phone))
+        conn.commit()
+    finally:
+        conn.close()
 
 
 def get_stores(is_active=None):
     conn = get_connection()
-    cursor = conn.cursor()
     try:
-        if is_active is not None:
-            cursor.execute("SELECT * FROM stores WHERE is_active = ? ORDER BY is_hq DESC, name", (is_active,))
-        else:
-            cursor.execute("SELECT * FROM stores ORDER BY is_hq DESC, name")
-    except:
-        if is_active is not None:
-            cursor.execute("SELECT * FROM stores WHERE is_active = ? ORDER BY name", (is_active,))
-        else:
-            cursor.execute("SELECT * FROM stores ORDER BY name")
-    rows = cursor.fetchall()
-    stores = [dict(row) for row in rows] if rows else []
-    conn.close()
+        cursor = conn.cursor()
+        try:
+            if is_active is not None:
+                cursor.execute("SELECT * FROM stores WHERE is_active = ? ORDER BY is_hq DESC, name", (is_active,))
+            else:
+                cursor.execute("SELECT * FROM stores ORDER BY is_hq DESC, name")
+        except:
+            if is_active is not None:
+                cursor.execute("SELECT * FROM stores WHERE is_active = ? ORDER BY name", (is_active,))
+            else:
+                cursor.execute("SELECT * FROM stores ORDER BY name")
+        rows = cursor.fetchall()
+        stores = [dict(row) for row in rows] if rows else []
+    finally:
+        conn.close()
     return stores
 
 
+cached_stores = snapshot('stores')(get_stores)
+
+
 def get_store_by_id(store_id):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM stores WHERE id = ?", (store_id,))
-    store = cursor.fetchone()
-    store = dict(store) if store else None
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM stores WHERE id = ?", (store_id,))
+        store = cursor.fetchone()
+        store = dict(store) if store else None
+    finally:
+        conn.close()
     return store
 
 
@@ -572,271 +1586,1118 @@ def get_store_by_id(store_id):
 
 def add_user(username, password, name, role, store_id=None):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO users (username, password, name, role, store_id) VALUES (?, ?, ?, ?, ?)",
-        (username, password, name, role, store_id))
-    conn.commit()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO users (username, password, name, role, store_id) VALUES (?, ?, ?, ?, ?)",
+            (username, password, name, role, store_id))
+        conn.commit()
+    finally:
+        conn.close()
 
 
 def verify_login(username, password):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE username = ? AND password = ? AND is_active = 1", (username, password))
-    user = cursor.fetchone()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM users WHERE username = ? AND password = ? AND is_active = 1", (username, password))
+        user = cursor.fetchone()
+    finally:
+        conn.close()
     return user
 
 
 def get_user_by_id(user_id):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+        user = cursor.fetchone()
+    finally:
+        conn.close()
     return user
 
 
 # ===== 商品管理 =====
 
+def calculate_price_inc_tax(price_ex_tax):
+    """未稅價換算含稅價（營業稅 5%，四捨五入至小數一位）；連線上另註冊為 SQL 函數 pos_price_inc_tax()"""
+    if not price_ex_tax:
+        return 0.0
+    try:
+        return round(float(price_ex_tax) * 1.05, 1)
+    except (TypeError, ValueError):
+        return 0.0
+
+
 def add_product(name, price_ex_tax=0, price_inc_tax=0, cost=0, barcode="", category=""):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO products (name, price_ex_tax, price_inc_tax, cost, barcode, category) VALUES (?, ?, ?, ?, ?, ?)",
-        (name, price_ex_tax, price_inc_tax, cost, barcode, category))
-    product_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO products (name, price_ex_tax, price_inc_tax, cost, barcode, category, search_tokens)
+            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            (name, price_ex_tax, price_inc_tax, cost, barcode, category, search_tokens(name, barcode)))
+        product_id = cursor.lastrowid
+        conn.commit()
+    finally:
+        conn.close()
     return product_id
 
 
+def refresh_product_search(cursor, product_ids=None):
+    """以 search_tokens() 重算商品搜尋詞（觸發器同步 products_fts），只寫入有變動的商品，回傳更新筆數
+
+    product_ids 為 None 時檢查全部商品；用於批次匯入與修正直接以 SQL 寫入的商品。
+    """
+    if product_ids is None:
+        cursor.execute("SELECT id, name, barcode, search_tokens FROM products")
+    else:
+        cursor.execute("SELECT id, name, barcode, search_tokens FROM products WHERE id IN (SELECT value FROM json_each(?))",
+                       (json.dumps(list(product_ids)),))
+    updates = []
+    for product_id, name, barcode, current in cursor.fetchall():
+        tokens = search_tokens(name, barcode)
+        if tokens != current:
+            updates.append((tokens, product_id))
+    cursor.executemany("UPDATE products SET search_tokens = ? WHERE id = ?", updates)
+    return len(updates)
+
+
+def _product_search_filter(search):
+    """商品搜尋條件：條碼完全相符，或名稱 / 條碼全文比對（products_fts），回傳 (SQL 條件, 參數)"""
+    if not search:
+        return "", []
+    match = search_match_query(search)
+    if match is None:
+        # 只有符號等無法斷詞的輸入，維持原本的模糊比對
+        return " AND (p.name LIKE ? OR p.barcode LIKE ?)", [f"%{search}%", f"%{search}%"]
+    return (" AND (p.barcode = ? OR p.id IN (SELECT rowid FROM products_fts WHERE products_fts MATCH ?))",
+            [search.strip(), match])
+
+
 def get_products(search="", store_id=None):
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
+        search_sql, search_params = _product_search_filter(search)
     
-    if store_id:
-        # 取得分店商品（含庫存）
+        if store_id:
+            # 取得分店商品（含庫存）
+            cursor.execute(f'''
+                SELECT p.*, sp.price_ex_tax as store_price, sp.price_inc_tax as store_price_inc, 
+                       sp.stock, sp.low_stock_alert
+                FROM products p
+                LEFT JOIN store_products sp ON p.id = sp.product_id AND sp.store_id = ?
+                WHERE p.is_active = 1{search_sql}
+                ORDER BY p.name
+            ''', [store_id] + search_params)
+        else:
+            cursor.execute(f"SELECT p.* FROM products p WHERE p.is_active = 1{search_sql}", search_params)
+    
+        rows = cursor.fetchall()
+        products = [dict(row) for row in rows] if rows else []
+    finally:
+        conn.close()
+    return products
+
+
+cached_products = snapshot('products', 'store_products')(get_products)
+
+
+def find_product_by_barcode(barcode, store_id=None):
+    """掃描條碼：以條碼索引精確查詢單一商品（指定分店時附分店售價與庫存）"""
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
         cursor.execute('''
-            SELECT p.*, sp.price_ex_tax as store_price, sp.price_inc_tax as store_price_inc, 
+            SELECT p.*, sp.price_ex_tax as store_price, sp.price_inc_tax as store_price_inc,
+                   COALESCE(sp.price_inc_tax, p.price_inc_tax) as price,
+                   sp.stock, sp.low_stock_alert
+            FROM products p
+            LEFT JOIN store_products sp ON p.id = sp.product_id AND sp.store_id = ?
+            WHERE p.barcode = ? AND p.is_active = 1
+            LIMIT 1
+        ''', (store_id, (barcode or '').strip()))
+        product = cursor.fetchone()
+        product = dict(product) if product else None
+    finally:
+        conn.close()
+    return product
+
+
+def get_pos_catalog(store_id, search=""):
+    """收銀前台商品清單：商品、分店售價與庫存一次查詢取得，最佳有效促銷由記憶體促銷索引計算
+
+    price 為分店含稅價（分店未設定時使用總部價）；promo_* 為以單件售價計算折扣最多的有效促銷，無促銷時為 None，
+    promo_discount 為單件結帳時所有有效促銷的合計折扣（與 price_cart 相同）。
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+
+        search_sql, search_params = _product_search_filter(search)
+        cursor.execute(f'''
+            SELECT p.*, sp.price_ex_tax as store_price, sp.price_inc_tax as store_price_inc,
+                   COALESCE(sp.price_inc_tax, p.price_inc_tax) as price,
                    sp.stock, sp.low_stock_alert
             FROM products p
             LEFT JOIN store_products sp ON p.id = sp.product_id AND sp.store_id = ?
-            WHERE p.is_active = 1 AND (p.name LIKE ? OR p.barcode LIKE ?)
+            WHERE p.is_active = 1{search_sql}
             ORDER BY p.name
-        ''', (store_id, f"%{search}%", f"%{search}%"))
-    else:
-        cursor.execute("SELECT * FROM products WHERE is_active = 1 AND (name LIKE ? OR barcode LIKE ?)", 
-            (f"%{search}%", f"%{search}%"))
-    
-    rows = cursor.fetchall()
-    products = [dict(row) for row in rows] if rows else []
-    conn.close()
+        ''', [store_id] + search_params)
+
+        rows = cursor.fetchall()
+        products = [dict(row) for row in rows] if rows else []
+    finally:
+        conn.close()
+    active_promotions = promotion_index.active_map()
+    for product in products:
+        _attach_best_promotion(product, active_promotions.get(product['id'], ()))
     return products
 
 
+def _attach_best_promotion(product, promos):
+    """以 calculate_promotion（price_cart 使用的算法）計算單件售價的各促銷折扣，標示折扣最多的一個"""
+    unit = {'quantity': 1, 'price': product['price'] or 0}
+    best, best_discount = None, 0
+    for promo in promos:
+        discount = calculate_promotion(unit, [promo])
+        if best is None or discount > best_discount:
+            best, best_discount = promo, discount
+    best = best or {}
+    product.update({
+        'promo_id': best.get('id'),
+        'promo_name': best.get('name'),
+        'promo_type': best.get('type'),
+        'promo_value': best.get('value'),
+        'promo_min_amount': best.get('min_amount'),
+        'promo_discount': calculate_promotion(unit, promos),
+    })
+
+
+
+@snapshot('products', 'store_products', 'promotions')
+def _pos_catalog_for_day(store_id, search, day):
+    return get_pos_catalog(store_id, search)
+
+
+def cached_pos_catalog(store_id, search=""):
+    """快取版 get_pos_catalog（以日期區分，跨日自動重新查詢促銷）"""
+    return _pos_catalog_for_day(store_id, search, datetime.now().strftime('%Y-%m-%d'))
+
 def get_product_by_id(product_id):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-    product = cursor.fetchone()
-    product = dict(product) if product else None
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
+        product = cursor.fetchone()
+        product = dict(product) if product else None
+    finally:
+        conn.close()
     return product
 
 
 # ===== 分店商品管理 =====
 
 def add_store_product(store_id, product_id, price_ex_tax=0, price_inc_tax=0, stock=0):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT OR REPLACE INTO store_products 
-        (store_id, product_id, price_ex_tax, price_inc_tax, stock) VALUES (?, ?, ?, ?, ?)''',
-        (store_id, product_id, price_ex_tax, price_inc_tax, stock))
-    conn.commit()
-    conn.close()
+    """設定分店商品價格與庫存（已上架則更新該列），庫存差額寫入異動日誌（set）"""
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT stock FROM store_products WHERE store_id = ? AND product_id = ?",
+                       (store_id, product_id))
+        row = cursor.fetchone()
+        before = (row[0] or 0) if row else 0
+        if row:
+            cursor.execute('''UPDATE store_products SET price_ex_tax = ?, price_inc_tax = ?, stock = ?,
+                updated_at = CURRENT_TIMESTAMP WHERE store_id = ? AND product_id = ?''',
+                (price_ex_tax, price_inc_tax, stock, store_id, product_id))
+        else:
+            cursor.execute('''INSERT INTO store_products (store_id, product_id, price_ex_tax, price_inc_tax, stock)
+                VALUES (?, ?, ?, ?, ?)''', (store_id, product_id, price_ex_tax, price_inc_tax, stock))
+        if stock != before:
+            _record_stock_movements(cursor, [(store_id, product_id, stock - before, stock, 'set', None, None)])
 
 
-def update_store_stock(store_id, product_id, quantity_change):
-    """更新庫存（增減）"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''UPDATE store_products SET stock = stock + ?, updated_at = CURRENT_TIMESTAMP 
-        WHERE store_id = ? AND product_id = ?''', (quantity_change, store_id, product_id))
-    conn.commit()
-    conn.close()
+@retry_on_busy
+def update_store_stock(store_id, product_id, quantity_change, reference=None, created_by=None):
+    """更新庫存（增減），並寫入庫存異動日誌（adjust）"""
+    with transaction() as conn:
+        _post_stock_movements(conn.cursor(), [(store_id, product_id, quantity_change, 'adjust', reference)], created_by)
 
 
 def get_store_product(store_id, product_id):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM store_products WHERE store_id = ? AND product_id = ?", 
-        (store_id, product_id))
-    sp = cursor.fetchone()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM store_products WHERE store_id = ? AND product_id = ?", 
+            (store_id, product_id))
+        sp = cursor.fetchone()
+    finally:
+        conn.close()
     return sp
 
 
+# ===== 庫存異動日誌 =====
+# 所有改變 store_products.stock 的路徑都在同一交易內寫入 stock_movements（只新增），
+# 分店庫存 = 期初 + 全部異動；stock_snapshots 定期記錄各店截至某筆異動的庫存，供歷史庫存查詢（get_inventory_as_of）。
+# movement_type：sale 銷售、receive 進貨、adjust 調整、count 盤點、transfer_out / transfer_in 調出 / 調入、
+#                set 設定分店商品、import 批次匯入、opening 期初、reconcile 比對修正；reference 為來源單據編號。
+
+def _record_stock_movements(cursor, rows):
+    """在目前交易內寫入庫存異動日誌，rows 為
+    [(store_id, product_id, quantity_change, stock_after, movement_type, reference, created_by), ...]"""
+    cursor.executemany('''INSERT INTO stock_movements
+        (store_id, product_id, quantity_change, stock_after, movement_type, reference, created_by)
+        VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+
+
+def _journal_stock_movements(cursor, movements, stock_after, created_by=None):
+    """依異動後的最終庫存回推每筆異動的 stock_after 並寫入日誌
+
+    movements 為 [(store_id, product_id, 增減量, movement_type, reference), ...]（依發生順序），
+    stock_after 為 {(store_id, product_id): 全部異動後的庫存}；沒有分店商品資料的異動不記錄。
+    """
+    stock = dict(stock_after)
+    rows = []
+    for store_id, product_id, change, movement_type, reference in reversed(movements):
+        key = (store_id, product_id)
+        if key in stock:
+            rows.append((store_id, product_id, change, stock[key], movement_type, reference, created_by))
+            stock[key] -= change
+    rows.reverse()
+    _record_stock_movements(cursor, rows)
+
+
+def _post_stock_movements(cursor, movements, created_by=None):
+    """在目前交易內套用庫存增減並寫入日誌，movements 格式同 _journal_stock_movements()
+
+    同店同商品合併為一筆，以單一 UPDATE（json_each）完成，回傳 {(store_id, product_id): 異動後庫存}。
+    """
+    deltas = {}
+    for store_id, product_id, change, _, _ in movements:
+        deltas[(store_id, product_id)] = deltas.get((store_id, product_id), 0) + change
+    if not deltas:
+        return {}
+    cursor.execute('''UPDATE store_products SET stock = stock + q.delta, updated_at = CURRENT_TIMESTAMP
+        FROM (SELECT json_extract(value, '$[0]') AS store_id, json_extract(value, '$[1]') AS product_id,
+                     json_extract(value, '$[2]') AS delta
+              FROM json_each(?)) q
+        WHERE store_products.store_id = q.store_id AND store_products.product_id = q.product_id
+        RETURNING store_products.store_id, store_products.product_id, store_products.stock''',
+        (json.dumps([[store_id, product_id, delta] for (store_id, product_id), delta in deltas.items()]),))
+    stock_after = {(row[0], row[1]): row[2] for row in cursor.fetchall()}
+    _journal_stock_movements(cursor, movements, stock_after, created_by)
+    return stock_after
+
+
+# ===== 庫存單據 =====
+# 進貨、調整、盤點等整張單據在單一交易內套用，每筆庫存異動寫入 stock_movements。
+# 單據類型：值為 True 表示明細數量是實盤數（盤點），否則為增減量。
+STOCK_DOCUMENT_TYPES = {
+    'receive': False,   # 進貨
+    'adjust': False,    # 調整（報廢、盤損等）
+    'count': True,      # 盤點
+}
+
+
+def _stock_document_lines(doc_type, lines):
+    """整理單據明細：同商品多行數量加總（如不同貨架分開盤點），回傳 ({product_id: 數量}, 退回明細)"""
+    quantities = {}
+    rejected = []
+    for product_id, quantity in lines:
+        if isinstance(quantity, float) and quantity.is_integer():
+            quantity = int(quantity)
+        if not isinstance(quantity, int) or isinstance(quantity, bool):
+            message = '數量必須為整數'
+        elif STOCK_DOCUMENT_TYPES[doc_type] and quantity < 0:
+            message = '盤點數量不可為負'
+        else:
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+            continue
+        rejected.append({'product_id': product_id, 'quantity': quantity, 'message': message})
+    return quantities, rejected
+
+
+@retry_on_busy
+def apply_stock_document(store_id, doc_type, lines, reference="", created_by=None):
+    """套用整張庫存單據（進貨 / 調整 / 盤點），lines 為 [(product_id, 數量), ...]
+
+    receive / adjust 的數量為增減量，count 為實盤數量。全部明細在同一交易內以 executemany
+    更新 store_products 並寫入 stock_movements；分店尚未上架的商品以商品主檔價格新增。
+    回傳 {'success': True, 'lines', 'changed',
+          'variances': [{'product_id', 'before', 'after', 'variance'}],
+          'rejected': [{'product_id', 'quantity', 'message'}]}
+    """
+    if doc_type not in STOCK_DOCUMENT_TYPES:
+        return {'success': False, 'message': f'不支援的單據類型: {doc_type}'}
+    quantities, rejected = _stock_document_lines(doc_type, lines)
+    is_count = STOCK_DOCUMENT_TYPES[doc_type]
+    variances = []
+    with transaction() as conn:
+        cursor = conn.cursor()
+        product_ids = json.dumps(list(quantities))
+        cursor.execute('''SELECT product_id, stock FROM store_products
+            WHERE store_id = ? AND product_id IN (SELECT value FROM json_each(?))''', (store_id, product_ids))
+        stock = {row[0]: row[1] or 0 for row in cursor.fetchall()}
+        cursor.execute("SELECT id FROM products WHERE id IN (SELECT value FROM json_each(?))", (product_ids,))
+        known = {row[0] for row in cursor.fetchall()}
+
+        updates, inserts, movements = [], [], []
+        for product_id, quantity in quantities.items():
+            if product_id not in known:
+                rejected.append({'product_id': product_id, 'quantity': quantity, 'message': '商品不存在'})
+                continue
+            before = stock.get(product_id, 0)
+            after = quantity if is_count else before + quantity
+            variances.append({'product_id': product_id, 'before': before, 'after': after, 'variance': after - before})
+            if product_id not in stock:
+                inserts.append((store_id, after, product_id))
+            elif after != before:
+                updates.append((after, store_id, product_id))
+            if after != before:
+                movements.append((store_id, product_id, after - before, after, doc_type, reference, created_by))
+
+        cursor.executemany('''UPDATE store_products SET stock = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE store_id = ? AND product_id = ?''', updates)
+        cursor.executemany('''INSERT INTO store_products (store_id, product_id, price_ex_tax, price_inc_tax, stock)
+            SELECT ?, id, price_ex_tax, price_inc_tax, ? FROM products WHERE id = ?''', inserts)
+        _record_stock_movements(cursor, movements)
+    return {'success': True, 'lines': len(variances), 'changed': len(movements),
+            'variances': variances, 'rejected': rejected}
+
+
+def get_stock_movements(store_id, product_id=None, limit=100):
+    """庫存異動日誌（由新到舊）"""
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        query = '''SELECT m.*, p.name AS product_name FROM stock_movements m
+            JOIN products p ON p.id = m.product_id WHERE m.store_id = ?'''
+        params = [store_id]
+        if product_id is not None:
+            query += " AND m.product_id = ?"
+            params.append(product_id)
+        query += " ORDER BY m.id DESC LIMIT ?"
+        params.append(limit)
+        cursor.execute(query, params)
+        movements = cursor.fetchall()
+    finally:
+        conn.close()
+    return movements
+
+
+# ===== 庫存快照與歷史庫存 =====
+
+def _stock_snapshot_base(cursor, store_id, as_of=None):
+    """分店在 as_of（None 為最新）之前最後一張快照，回傳 (snapshot_id 或 None, 已涵蓋的最後一筆異動 id)"""
+    query = "SELECT id, movement_id FROM stock_snapshots WHERE store_id = ?"
+    params = [store_id]
+    if as_of is not None:
+        query += " AND created_at <= ?"
+        params.append(as_of)
+    cursor.execute(query + " ORDER BY created_at DESC, id DESC LIMIT 1", params)
+    row = cursor.fetchone()
+    return (row[0], row[1]) if row else (None, 0)
+
+
+def _journal_stock(cursor, store_id, as_of=None):
+    """由日誌重建分店庫存：快照 + 快照之後（至 as_of 為止）的異動，回傳 {product_id: 庫存}"""
+    snapshot_id, movement_id = _stock_snapshot_base(cursor, store_id, as_of)
+    stock = {}
+    if snapshot_id is not None:
+        cursor.execute("SELECT product_id, stock FROM stock_snapshot_items WHERE snapshot_id = ?", (snapshot_id,))
+        stock = {row[0]: row[1] for row in cursor.fetchall()}
+    query = '''SELECT product_id, SUM(quantity_change) FROM stock_movements
+        WHERE store_id = ? AND id > ?'''
+    params = [store_id, movement_id]
+    if as_of is not None:
+        query += " AND created_at <= ?"
+        params.append(as_of)
+    cursor.execute(query + " GROUP BY product_id", params)
+    for product_id, change in cursor.fetchall():
+        stock[product_id] = stock.get(product_id, 0) + change
+    return stock
+
+
+def _snapshot_store_stock(cursor, store_id):
+    """在目前交易內為分店建立庫存快照（自上一張快照後沒有異動時略過），回傳是否建立"""
+    snapshot_id, movement_id = _stock_snapshot_base(cursor, store_id)
+    cursor.execute("SELECT MAX(id) FROM stock_movements WHERE store_id = ? AND id > ?", (store_id, movement_id))
+    latest = cursor.fetchone()[0]
+    if latest is None:
+        return False
+    stock = _journal_stock(cursor, store_id)
+    cursor.execute("INSERT INTO stock_snapshots (store_id, movement_id) VALUES (?, ?)", (store_id, latest))
+    new_id = cursor.lastrowid
+    cursor.executemany("INSERT INTO stock_snapshot_items (snapshot_id, product_id, stock) VALUES (?, ?, ?)",
+                       [(new_id, product_id, quantity) for product_id, quantity in stock.items()])
+    return True
+
+
+@retry_on_busy
+def snapshot_store_stock(store_id=None):
+    """建立分店（預設全部分店）的庫存快照，建議每日排程執行，回傳建立的快照數"""
+    with transaction() as conn:
+        cursor = conn.cursor()
+        if store_id is None:
+            cursor.execute("SELECT id FROM stores ORDER BY id")
+            store_ids = [row[0] for row in cursor.fetchall()]
+        else:
+            store_ids = [store_id]
+        return sum(_snapshot_store_stock(cursor, sid) for sid in store_ids)
+
+
+def get_inventory_as_of(store_id, as_of):
+    """查詢分店在某個時間點的庫存，回傳 {product_id: 庫存}
+
+    as_of 為 datetime 或與 created_at 相同格式的字串（UTC，如 '2026-10-13 23:59:59'）；
+    以 as_of 之前最後一張快照加上之後的異動計算，只讀一張快照與快照間隔內的異動。
+    升級前的庫存以升級當下的期初異動（opening）記錄，更早的時間點無法重建。
+    """
+    if isinstance(as_of, datetime):
+        as_of = as_of.strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_connection()
+    try:
+        stock = _journal_stock(conn.cursor(), store_id, as_of)
+    finally:
+        conn.close()
+    return stock
+
+
+def _stock_drift(cursor):
+    """比對 store_products.stock 與日誌重建的庫存，回傳 [{'store_id', 'product_id', 'expected', 'actual'}]"""
+    cursor.execute("SELECT id FROM stores ORDER BY id")
+    mismatches = []
+    for (store_id,) in cursor.fetchall():
+        expected = _journal_stock(cursor, store_id)
+        # v14 之前的資料庫同店同商品可能有多筆（v13 遷移時），以最早建立的一筆為準
+        cursor.execute('''SELECT product_id, stock, MIN(id) FROM store_products WHERE store_id = ?
+            GROUP BY product_id''', (store_id,))
+        actual = {row[0]: row[1] or 0 for row in cursor.fetchall()}
+        for product_id in sorted(set(expected) | set(actual)):
+            if expected.get(product_id, 0) != actual.get(product_id, 0):
+                mismatches.append({'store_id': store_id, 'product_id': product_id,
+                                   'expected': expected.get(product_id, 0), 'actual': actual.get(product_id, 0)})
+    return mismatches
+
+
+def _reconcile_stock(cursor, movement_type):
+    """以差額異動使日誌與 store_products.stock 一致，回傳修正前的不一致清單"""
+    mismatches = _stock_drift(cursor)
+    _record_stock_movements(cursor, [(m['store_id'], m['product_id'], m['actual'] - m['expected'], m['actual'],
+                                      movement_type, None, None) for m in mismatches])
+    return mismatches
+
+
+def check_stock_movements(repair=False):
+    """比對分店庫存與庫存異動日誌，回傳不一致清單 [{'store_id', 'product_id', 'expected', 'actual'}]
+
+    不一致表示有未經本模組的寫入（例如直接以 SQL 修改 store_products）；
+    repair=True 時以目前的 store_products.stock 為準寫入 reconcile 異動。
+    """
+    with transaction() as conn:
+        cursor = conn.cursor()
+        if repair:
+            return _reconcile_stock(cursor, 'reconcile')
+        return _stock_drift(cursor)
+
+
 # ===== 會員管理 =====
 
 def add_member(name, phone, email="", birthday="", address="", join_store_id=None):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO members (name, phone, email, birthday, address, join_store_id) 
-        VALUES (?, ?, ?, ?, ?, ?)''', (name, phone, email, birthday, address, join_store_id))
-    member_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO members (name, phone, email, birthday, address, join_store_id) 
+            VALUES (?, ?, ?, ?, ?, ?)''', (name, phone, email, birthday, address, join_store_id))
+        member_id = cursor.lastrowid
+        conn.commit()
+    finally:
+        conn.close()
     return member_id
 
 
-def get_members(search="", store_id=None):
+def get_members(search="", store_id=None, limit=None, before=None):
+    """會員列表（由新到舊）；limit 為 None 時取全部，before 為上一頁的 page_cursor()"""
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
     
-    if search:
-        cursor.execute("SELECT * FROM members WHERE is_active = 1 AND (name LIKE ? OR phone LIKE ?)",
-            (f"%{search}%", f"%{search}%"))
-    else:
-        cursor.execute("SELECT * FROM members WHERE is_active = 1 ORDER BY created_at DESC")
+        query = "SELECT * FROM members WHERE is_active = 1"
+        params = []
+        if search:
+            query += " AND (name LIKE ? OR phone LIKE ?)"
+            params += [f"%{search}%", f"%{search}%"]
+        clause, before_params = _before_clause(before)
+        query += clause + " ORDER BY created_at DESC, id DESC"
+        params += before_params
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        cursor.execute(query, params)
     
-    rows = cursor.fetchall()
-    members = [dict(row) for row in rows] if rows else []
-    conn.close()
+        rows = cursor.fetchall()
+        members = [dict(row) for row in rows] if rows else []
+    finally:
+        conn.close()
     return members
 
 
-def get_member_by_phone(phone):
+def iter_members(search="", batch_size=1000):
+    """逐頁讀取所有會員（記憶體只保留一頁）"""
+    return _iter_pages(lambda limit, before: get_members(search, limit=limit, before=before), batch_size)
+
+
+def count_members(search=""):
+    """會員數"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM members WHERE phone = ? AND is_active = 1", (phone,))
-    member = cursor.fetchone()
-    member = dict(member) if member else None
-    conn.close()
-    return member
+    try:
+        if search:
+            count = conn.execute("SELECT COUNT(*) FROM members WHERE is_active = 1 AND (name LIKE ? OR phone LIKE ?)",
+                                 (f"%{search}%", f"%{search}%")).fetchone()[0]
+        else:
+            count = conn.execute("SELECT COUNT(*) FROM members WHERE is_active = 1").fetchone()[0]
+    finally:
+        conn.close()
+    return count
+
+
+def get_member_by_phone(phone):
+    """以電話查詢有效會員（走會員快取，附計價欄位）"""
+    return member_cache.get_by_phone(phone)
 
 
 def get_member_by_id(member_id):
+    """以 id 查詢會員（走會員快取，附計價欄位）"""
+    return member_cache.get(member_id)
+
+
+def _load_member(where, param):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM members WHERE id = ?", (member_id,))
-    member = cursor.fetchone()
-    member = dict(member) if member else None
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT * FROM members WHERE {where}", (param,))
+        member = cursor.fetchone()
+        member = dict(member) if member else None
+    finally:
+        conn.close()
     return member
 
 
-def update_member_points(member_id, points_change, reason="", store_id=None):
-    """更新會員積分"""
+def _member_row_version(member_id):
+    """會員目前的 row_version，會員不存在時回傳 None"""
     conn = get_connection()
-    cursor = conn.cursor()
-    
-    # 更新積分
-    cursor.execute("UPDATE members SET points = points + ? WHERE id = ?", (points_change, member_id))
-    
-    # 取得新餘額
-    cursor.execute("SELECT points FROM members WHERE id = ?", (member_id,))
-    new_balance = cursor.fetchone()[0]
-    
+    try:
+        row = conn.execute("SELECT row_version FROM members WHERE id = ?", (member_id,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def _post_member_points(cursor, member_id, points_change, reason="", store_id=None):
+    """在目前交易內異動積分、寫入積分記錄並檢查升級，回傳異動後的會員資料（提交後寫回會員快取）"""
+    # 更新積分並取得新餘額
+    cursor.execute("UPDATE members SET points = points + ? WHERE id = ? RETURNING *", (points_change, member_id))
+    member = cursor.fetchone()
+    if not member:
+        return None
+    new_balance = member['points']
+
     # 記錄log
     cursor.execute('''INSERT INTO member_points_log (member_id, points_change, points_balance, reason, store_id)
         VALUES (?, ?, ?, ?, ?)''', (member_id, points_change, new_balance, reason, store_id))
-    
+
     # 檢查升級
-    check_and_update_level(member_id)
-    
-    conn.commit()
-    conn.close()
+    return _update_member_level(cursor, member_id, member)
+
+
+def evaluate_member_level(points, total_spent, ladder=None):
+    """依積分 / 消費判定會員等級，無符合的等級時回傳 None
+
+    ladder 為門檻由高到低的等級表（預設使用計價規則表中快取的 level_ladder），
+    取第一個積分或消費達到門檻的等級，與 recalculate_member_levels() 的 CASE 相同。
+    """
+    for level in pricing_rules.get()['level_ladder'] if ladder is None else ladder:
+        if (level['min_points'] is not None and level['min_points'] <= points) or \
+                (level['min_spent'] is not None and level['min_spent'] <= total_spent):
+            return level['name']
+    return None
+
+
+def _update_member_level(cursor, member_id, member=None):
+    """在目前交易內依積分/消費重新判定會員等級（記憶體中的等級表），回傳異動後的會員資料
+
+    member 為交易內已取得的最新會員資料時不再查詢；等級有變動才寫回。
+    """
+    if member is None:
+        cursor.execute("SELECT * FROM members WHERE id = ?", (member_id,))
+        member = cursor.fetchone()
+        if not member:
+            return None
+
+    member = dict(member)
+    new_level = evaluate_member_level(member['points'], member['total_spent'])
+    if new_level and new_level != member['level']:
+        cursor.execute("UPDATE members SET level = ? WHERE id = ?", (new_level, member_id))
+        member['level'] = new_level
+    # row_version 由觸發器在寫入後遞增（RETURNING 取得的是遞增前的值），寫回快取前重新讀取
+    cursor.execute("SELECT row_version FROM members WHERE id = ?", (member_id,))
+    member['row_version'] = cursor.fetchone()[0]
+    return member
+
+
+@retry_on_busy
+def update_member_points(member_id, points_change, reason="", store_id=None):
+    """更新會員積分"""
+    with transaction() as conn:
+        cursor = conn.cursor()
+        member = _post_member_points(cursor, member_id, points_change, reason, store_id)
+        versions = _read_data_versions(cursor)
+    member_cache.write_back(member, versions)
 
 
 def check_and_update_level(member_id):
     """檢查並更新會員等級"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT points, total_spent FROM members WHERE id = ?", (member_id,))
-    member = cursor.fetchone()
-    if not member:
-        conn.close()
-        return
-    
-    points, total_spent = member[0], member[1]
-    
-    cursor.execute("SELECT name FROM member_levels WHERE is_active = 1 AND (min_points <= ? OR min_spent <= ?) ORDER BY min_points DESC, min_spent DESC LIMIT 1",
-        (points, total_spent))
-    new_level = cursor.fetchone()
-    
-    if new_level:
-        cursor.execute("UPDATE members SET level = ? WHERE id = ?", (new_level[0], member_id))
-    
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cursor = conn.cursor()
+        member = _update_member_level(cursor, member_id)
+        versions = _read_data_versions(cursor)
+    member_cache.write_back(member, versions)
 
 
 # ===== 會員等級 =====
 
 def add_member_level(name, min_points=0, min_spent=0, discount_percent=0, birthday_bonus=0):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO member_levels (name, min_points, min_spent, discount_percent, birthday_bonus)
-        VALUES (?, ?, ?, ?, ?)''', (name, min_points, min_spent, discount_percent, birthday_bonus))
-    conn.commit()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO member_levels (name, min_points, min_spent, discount_percent, birthday_bonus)
+            VALUES (?, ?, ?, ?, ?)''', (name, min_points, min_spent, discount_percent, birthday_bonus))
+        conn.commit()
+    finally:
+        conn.close()
 
 
 def get_member_levels():
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM member_levels WHERE is_active = 1 ORDER BY min_points, min_spent")
-    levels = cursor.fetchall()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM member_levels WHERE is_active = 1 ORDER BY min_points, min_spent")
+        levels = cursor.fetchall()
+    finally:
+        conn.close()
     return levels
 
 
-# ===== 促銷管理 =====
+cached_member_levels = snapshot('member_levels')(get_member_levels)
 
-def add_promotion(name, promo_type, value, min_amount=0, min_quantity=1, start_date=None, end_date=None):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO promotions (name, type, value, min_amount, min_quantity, start_date, end_date)
-        VALUES (?, ?, ?, ?, ?, ?, ?)''', (name, promo_type, value, min_amount, min_quantity, start_date, end_date))
-    promo_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return promo_id
 
+def _level_ladder(cursor):
+    """門檻由高到低的有效等級表"""
+    cursor.execute("SELECT * FROM member_levels WHERE is_active = 1 ORDER BY min_points DESC, min_spent DESC")
+    return [dict(row) for row in cursor.fetchall()]
 
-def get_promotions(product_id=None, active_only=True):
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    today = datetime.now().strftime('%Y-%m-%d')
-    
-    if product_id:
-        cursor.execute('''SELECT p.* FROM promotions p
-            JOIN promotion_products pp ON p.id = pp.promotion_id
-            WHERE pp.product_id = ? AND p.is_active = 1
-            AND (p.start_date IS NULL OR p.start_date <= ?)
-            AND (p.end_date IS NULL OR p.end_date >= ?)
-            ORDER BY p.value DESC''', (product_id, today, today))
-    else:
-        if active_only:
-            cursor.execute("SELECT * FROM promotions WHERE is_active = 1 AND (start_date IS NULL OR start_date <= ?) AND (end_date IS NULL OR end_date >= ?) ORDER BY created_at DESC", (today, today))
+
+def _relevel_members(cursor, member_ids=None):
+    """在目前交易內以單一 UPDATE ... CASE 重新判定等級（member_ids 為 None 時全部會員），回傳變動數
+
+    門檻由高到低取第一個符合者，沒有符合的等級時保留原等級。
+    """
+    ladder = _level_ladder(cursor)
+    if not ladder:
+        return 0
+    case = "CASE " + " ".join(["WHEN ? <= points OR ? <= total_spent THEN ?"] * len(ladder)) + " ELSE level END"
+    params = [value for level in ladder for value in (level['min_points'], level['min_spent'], level['name'])]
+    query = f"UPDATE members SET level = {case} WHERE level IS NOT {case}"
+    params = params * 2
+    if member_ids is not None:
+        query += " AND id IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(list(member_ids)))
+    cursor.execute(query, params)
+    return cursor.rowcount
+
+
+@retry_on_busy
+def recalculate_member_levels():
+    """等級門檻變更後批次重新判定所有會員等級，回傳等級有變動的會員數"""
+    with transaction() as conn:
+        changed = _relevel_members(conn.cursor())
+    member_cache.clear()
+    return changed
+
+
+# ===== 會員快取 =====
+# 以 id 為鍵的 LRU 快取（另有電話索引），收銀前台每次重跑查會員不再查資料庫。
+# 本模組的積分 / 消費 / 等級異動在交易提交後直接寫回快取（write-through）；
+# 快取項目記錄讀取時的 members 資料版本，其他連線 / 行程修改會員後版本不符即重新載入。
+MEMBER_CACHE_SIZE = int(os.environ.get("POS_MEMBER_CACHE_SIZE", "10000"))
+
+
+class MemberCache:
+    """會員 LRU 快取；回傳的會員資料為複本，並附計價欄位：
+
+    level_discount_percent：會員等級折扣（%）
+    in_birthday_window：今天是否在生日優惠期間
+    計價欄位在會員等級 / 生日優惠設定或日期變動後重新計算（使用計價規則表，不查詢會員）；
+    members 版本變動（有會員被修改）後，命中時以主鍵比對該會員的 row_version，只有被修改的會員失效。
+    """
+
+    def __init__(self, max_entries=MEMBER_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # id -> (計價版本, 會員資料)
+        self._phones = {}               # 電話 -> id
+        self._db_path = None
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _stamp(versions=None):
+        """(會員資料版本, 計價版本)；versions 為交易內讀取的 _read_data_versions()，None 時取已提交的版本"""
+        versions = data_versions.get() if versions is None else versions
+        return (_version_of(versions, 'members'),
+                _version_of(versions, 'member_levels', 'birthday_coupons') + (datetime.now().date(),))
+
+    @staticmethod
+    def priced(member):
+        """回傳附計價欄位的會員複本（不寫入快取）"""
+        rules = pricing_rules.get()
+        member = dict(member)
+        member['level_discount_percent'] = rules['level_discounts'].get(member['level'], 0)
+        member['in_birthday_window'] = in_birthday_window(member['birthday'])
+        return member
+
+    def _check_db(self):
+        # 切換資料庫（測試、基準測試）時清空
+        if self._db_path != DB_PATH:
+            self._entries.clear()
+            self._phones.clear()
+            self._db_path = DB_PATH
+
+    def _store(self, stamp, member):
+        old = self._entries.pop(member['id'], None)
+        if old and old[1]['phone'] != member['phone']:
+            self._phones.pop(old[1]['phone'], None)
+        self._entries[member['id']] = (stamp, member)
+        if member['is_active']:
+            self._phones[member['phone']] = member['id']
+        else:
+            self._phones.pop(member['phone'], None)
+        while len(self._entries) > self.max_entries:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            if self._phones.get(evicted['phone']) == evicted['id']:
+                del self._phones[evicted['phone']]
+
+    def put(self, member, replace=True, stamp=None):
+        """寫入（或更新）一位會員，回傳附計價欄位的複本
+
+        replace=False 用於讀取載入：已有較新的寫回時保留快取中的資料。
+        stamp 為讀取 / 寫入該筆會員時的 _stamp()（應在讀取資料之前或寫入的交易內取得）。
+        """
+        if not member:
+            return None
+        stamp = stamp or self._stamp()
+        member = self.priced(member)
+        with self._lock:
+            self._check_db()
+            current = self._entries.get(member['id'])
+            if replace or current is None:
+                self._store(stamp, member)
+            elif current[0] == stamp:
+                member = current[1]
+        return dict(member)
+
+    def write_back(self, member, versions):
+        """交易提交後寫回異動後的會員，versions 為交易內最後一次寫入 members 之後讀取的 _read_data_versions()
+
+        巢狀呼叫時外層交易尚未提交（可能回滾），只移除快取，下次查詢重新載入。
+        """
+        if not member:
+            return None
+        if get_pool().holds_connection():
+            self.discard(member['id'])
+            return None
+        return self.put(member, stamp=self._stamp(versions))
+
+    def peek(self, member_id):
+        """只查快取，未快取或會員資料已被修改時回傳 None
+
+        members 版本未變時不查資料庫；有變動時只查這位會員的 row_version，相同即沿用快取。
+        """
+        stamp = self._stamp()
+        with self._lock:
+            self._check_db()
+            entry = self._entries.get(member_id)
+        if entry is None:
+            return None
+        if entry[0][0] != stamp[0] and _member_row_version(member_id) != entry[1].get('row_version'):
+            with self._lock:
+                if self._entries.get(member_id) is entry:
+                    self._discard(member_id)
+            return None
+        member = entry[1]
+        if entry[0] != stamp:
+            member = self.priced(member) if entry[0][1] != stamp[1] else member
+        with self._lock:
+            if self._entries.get(member_id) is entry:
+                self._entries[member_id] = (stamp, member)
+                self._entries.move_to_end(member_id)
+            self.hits += 1
+        return dict(member)
+
+    def get(self, member_id):
+        member = self.peek(member_id)
+        if member is None:
+            self.misses += 1
+            stamp = self._stamp()
+            member = self.put(_load_member("id = ?", member_id), replace=False, stamp=stamp)
+        return member
+
+    def get_by_phone(self, phone):
+        with self._lock:
+            self._check_db()
+            member_id = self._phones.get(phone)
+        member = self.peek(member_id) if member_id is not None else None
+        if member is None:
+            self.misses += 1
+            stamp = self._stamp()
+            member = self.put(_load_member("phone = ? AND is_active = 1", phone), replace=False, stamp=stamp)
+        return member if member and member['is_active'] else None
+
+    def _discard(self, member_id):
+        entry = self._entries.pop(member_id, None)
+        if entry and self._phones.get(entry[1]['phone']) == member_id:
+            del self._phones[entry[1]['phone']]
+
+    def discard(self, member_id):
+        with self._lock:
+            self._discard(member_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._phones.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+member_cache = MemberCache()
+
+
+def get_member_cache_stats():
+    """取得會員快取統計（hits/misses/entries）"""
+    return member_cache.stats()
+
+
+# ===== 積分帳本 =====
+# member_points_log 為只新增的積分帳本，每筆記錄異動與累計餘額（points_balance）；
+# members.points 是與帳本在同一交易寫入的物化餘額，供等級判定、會員快取與畫面讀取。
+# check_member_points() 以帳本加總比對物化餘額。
+
+def _set_member_points(cursor, balances):
+    """在目前交易內以單一 UPDATE 寫入多位會員的物化餘額，balances 為 [(member_id, points), ...]"""
+    cursor.execute('''UPDATE members SET points = b.points
+        FROM (SELECT json_extract(value, '$[0]') AS member_id, json_extract(value, '$[1]') AS points
+              FROM json_each(?)) b
+        WHERE members.id = b.member_id''', (json.dumps(list(balances)),))
+
+
+def check_member_points(repair=False):
+    """比對 members.points 與帳本餘額，回傳 [{'member_id', 'expected', 'actual'}]
+
+    repair=True 時以帳本餘額修正 members.points 並重新判定等級。
+    """
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT m.id, COALESCE(l.total, 0) AS expected, m.points
+            FROM members m
+            LEFT JOIN (SELECT member_id, SUM(points_change) AS total FROM member_points_log
+                       GROUP BY member_id) l ON l.member_id = m.id
+            WHERE m.points IS NOT COALESCE(l.total, 0)
+            ORDER BY m.id''')
+        mismatches = [{'member_id': row[0], 'expected': row[1], 'actual': row[2]} for row in cursor.fetchall()]
+        if repair and mismatches:
+            _set_member_points(cursor, [(m['member_id'], m['expected']) for m in mismatches])
+            _relevel_members(cursor, [m['member_id'] for m in mismatches])
+    if repair and mismatches:
+        member_cache.clear()
+    return mismatches
+
+
+@retry_on_busy
+def bulk_earn_points(entries, reason="", store_id=None):
+    """批次發放積分（活動加贈、生日積分），entries 為 [(member_id, points), ...]，回傳寫入的帳本筆數
+
+    同一交易內以 executemany 寫入帳本（逐筆累計餘額），再以單一 UPDATE 同步 members.points 並重新判定等級。
+    不存在的會員略過。
+    """
+    entries = [(member_id, points) for member_id, points in entries if points]
+    if not entries:
+        return 0
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, points FROM members WHERE id IN (SELECT value FROM json_each(?))",
+                       (json.dumps(sorted({member_id for member_id, _ in entries})),))
+        balances = {row[0]: row[1] for row in cursor.fetchall()}
+        rows = []
+        for member_id, points in entries:
+            if member_id in balances:
+                balances[member_id] += points
+                rows.append((member_id, points, balances[member_id], reason, store_id))
+        cursor.executemany('''INSERT INTO member_points_log (member_id, points_change, points_balance, reason, store_id)
+            VALUES (?, ?, ?, ?, ?)''', rows)
+        _set_member_points(cursor, balances.items())
+        _relevel_members(cursor, list(balances))
+    member_cache.clear()
+    return len(rows)
+
+
+@retry_on_busy
+def grant_birthday_bonus(month=None):
+    """發放生日積分：month（'YYYY-MM'，預設本月）生日的有效會員依等級的 birthday_bonus 加贈，
+
+    同月已發放過的會員略過，回傳發放人數。篩選與寫入帳本在同一交易內，同時執行也不會重複發放。
+    """
+    month = month or datetime.now().strftime('%Y-%m')
+    reason = f"生日積分 {month}"
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT m.id, (SELECT l.birthday_bonus FROM member_levels l
+                                WHERE l.name = m.level AND l.is_active = 1 ORDER BY l.id LIMIT 1) AS bonus
+            FROM members m
+            WHERE m.is_active = 1 AND substr(m.birthday, 6, 2) = ?
+            AND NOT EXISTS (SELECT 1 FROM member_points_log g WHERE g.member_id = m.id AND g.reason = ?)''',
+            (month[5:7], reason))
+        entries = [(row[0], row[1]) for row in cursor.fetchall() if row[1]]
+        # 併入本交易寫入帳本
+        return bulk_earn_points(entries, reason)
+
+
+# ===== 促銷管理 =====
+
+def add_promotion(name, promo_type, value, min_amount=0, min_quantity=1, start_date=None, end_date=None):
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO promotions (name, type, value, min_amount, min_quantity, start_date, end_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?)''', (name, promo_type, value, min_amount, min_quantity, start_date, end_date))
+        promo_id = cursor.lastrowid
+        conn.commit()
+    finally:
+        conn.close()
+    return promo_id
+
+
+def get_promotions(product_id=None, active_only=True):
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+    
+        today = datetime.now().strftime('%Y-%m-%d')
+    
+        if product_id:
+            cursor.execute('''SELECT p.* FROM promotions p
+                JOIN promotion_products pp ON p.id = pp.promotion_id
+                WHERE pp.product_id = ? AND p.is_active = 1
+                AND (p.start_date IS NULL OR p.start_date <= ?)
+                AND (p.end_date IS NULL OR p.end_date >= ?)
+                ORDER BY p.value DESC''', (product_id, today, today))
         else:
-            cursor.execute("SELECT * FROM promotions ORDER BY created_at DESC")
+            if active_only:
+                cursor.execute("SELECT * FROM promotions WHERE is_active = 1 AND (start_date IS NULL OR start_date <= ?) AND (end_date IS NULL OR end_date >= ?) ORDER BY created_at DESC", (today, today))
+            else:
+                cursor.execute("SELECT * FROM promotions ORDER BY created_at DESC")
     
-    rows = cursor.fetchall()
-    promos = [dict(row) for row in rows] if rows else []
-    conn.close()
+        rows = cursor.fetchall()
+        promos = [dict(row) for row in rows] if rows else []
+    finally:
+        conn.close()
     return promos
 
 
 def add_promotion_product(promotion_id, product_id):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO promotion_products (promotion_id, product_id) VALUES (?, ?)",
-        (promotion_id, product_id))
-    conn.commit()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO promotion_products (promotion_id, product_id) VALUES (?, ?)",
+            (promotion_id, product_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ===== 促銷索引（記憶體） =====
+
+class PromotionIndex:
+    """依商品分組的有效促銷索引
+
+    一次載入所有啟用且未結束的促銷並依折扣值排序；跨過 start_date / end_date
+    日期邊界時由已載入資料重新篩選，promotions 資料版本變動時整個重載。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = None      # product_id -> [(start_date, end_date, promo)]，依折扣值由高到低
+        self._day = None
+        self._active = {}         # product_id -> 當日有效促銷
+        self.loads = 0
+
+    def _load(self, today):
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''SELECT pp.product_id, p.* FROM promotions p
+                JOIN promotion_products pp ON p.id = pp.promotion_id
+                WHERE p.is_active = 1 AND (p.end_date IS NULL OR p.end_date >= ?)
+                ORDER BY p.value DESC''', (today,))
+            entries = {}
+            for row in cursor.fetchall():
+                promo = dict(row)
+                product_id = promo.pop('product_id')
+                entries.setdefault(product_id, []).append((promo['start_date'], promo['end_date'], promo))
+        finally:
+            conn.close()
+        self.loads += 1
+        return entries
+
+    def _refresh(self, today, version):
+        with self._lock:
+            if self._version != version:
+                self._entries = self._load(today)
+                self._version = version
+                self._day = None
+            if self._day != today:
+                self._active = {
+                    product_id: [promo for start, end, promo in promos
+                                 if (start is None or start <= today) and (end is None or end >= today)]
+                    for product_id, promos in self._entries.items()
+                }
+                self._day = today
+
+    def active_map(self):
+        """取得當日 product_id -> 有效促銷 對照表（共用物件，呼叫端不可修改）"""
+        today = datetime.now().strftime('%Y-%m-%d')
+        version = data_version('promotions')
+        if self._version != version or self._day != today:
+            self._refresh(today, version)
+        return self._active
+
+    def active(self, product_id):
+        """取得商品當日有效促銷（共用物件，呼叫端不可修改）"""
+        return self.active_map().get(product_id, ())
+
+    def lookup(self, product_id):
+        """取得商品當日有效促銷（依折扣值由高到低）"""
+        return [dict(promo) for promo in self.active(product_id)]
+
+
+promotion_index = PromotionIndex()
+
+
+def get_active_promotions(product_id):
+    """由記憶體促銷索引取得商品有效促銷（結果同 get_promotions(product_id)）"""
+    return promotion_index.lookup(product_id)
 
 
 def calculate_promotion(item, promotions):
@@ -850,7 +2711,8 @@ def calculate_promotion(item, promotions):
     subtotal = item.get('subtotal', qty * price)
     
     for p in promotions:
-        p = dict(p)
+        if not isinstance(p, dict):
+            p = dict(p)
         
         if p['type'] == 'percent':
             discount += price * qty * (p['value'] / 100)
@@ -873,226 +2735,743 @@ def calculate_promotion(item, promotions):
 
 def create_transfer(from_store_id, to_store_id, product_id, quantity, notes=""):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO inventory_transfers 
-        (from_store_id, to_store_id, product_id, quantity, notes) VALUES (?, ?, ?, ?, ?)''',
-        (from_store_id, to_store_id, product_id, quantity, notes))
-    transfer_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO inventory_transfers 
+            (from_store_id, to_store_id, product_id, quantity, notes) VALUES (?, ?, ?, ?, ?)''',
+            (from_store_id, to_store_id, product_id, quantity, notes))
+        transfer_id = cursor.lastrowid
+        conn.commit()
+    finally:
+        conn.close()
     return transfer_id
 
 
-def get_transfers(store_id=None, status=None):
+def get_transfers(store_id=None, status=None, limit=None, before=None):
+    """調貨紀錄（由新到舊）；limit 為 None 時取全部，before 為上一頁的 page_cursor()"""
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
     
-    if store_id:
-        cursor.execute('''SELECT t.*, 
+        query = '''SELECT t.*, 
             s1.name as from_store, s2.name as to_store,
             p.name as product_name
             FROM inventory_transfers t
             JOIN stores s1 ON t.from_store_id = s1.id
             JOIN stores s2 ON t.to_store_id = s2.id
             JOIN products p ON t.product_id = p.id
-            WHERE (t.from_store_id = ? OR t.to_store_id = ?)
-            ORDER BY t.created_at DESC''', (store_id, store_id))
-    else:
-        cursor.execute('''SELECT t.*, 
-            s1.name as from_store, s2.name as to_store,
-            p.name as product_name
-            FROM inventory_transfers t
-            JOIN stores s1 ON t.from_store_id = s1.id
-            JOIN stores s2 ON t.to_store_id = s2.id
-            JOIN products p ON t.product_id = p.id
-            ORDER BY t.created_at DESC''')
+            WHERE 1=1'''
+        params = []
+        if store_id:
+            query += " AND (t.from_store_id = ? OR t.to_store_id = ?)"
+            params += [store_id, store_id]
+        if status:
+            query += " AND t.status = ?"
+            params.append(status)
+        clause, before_params = _before_clause(before, 't.')
+        query += clause + " ORDER BY t.created_at DESC, t.id DESC"
+        params += before_params
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        cursor.execute(query, params)
     
-    transfers = cursor.fetchall()
-    conn.close()
+        transfers = cursor.fetchall()
+    finally:
+        conn.close()
     return transfers
 
 
-def approve_transfer(transfer_id, approved_by):
+def iter_transfers(store_id=None, status=None, batch_size=1000):
+    """逐頁讀取調貨紀錄"""
+    return _iter_pages(lambda limit, before: get_transfers(store_id, status, limit, before), batch_size)
+
+
+def count_transfers(store_id=None, status=None):
+    """調貨紀錄筆數"""
     conn = get_connection()
-    cursor = conn.cursor()
-    
-    # 取得調拨資料
-    cursor.execute("SELECT * FROM inventory_transfers WHERE id = ?", (transfer_id,))
-    transfer = cursor.fetchone()
-    
-    if transfer:
-        # 扣庫存（from_store）
-        cursor.execute('''UPDATE store_products SET stock = stock - ? 
-            WHERE store_id = ? AND product_id = ?''',
-            (transfer['quantity'], transfer['from_store_id'], transfer['product_id']))
-        
-        # 增庫存（to_store）
-        cursor.execute('''UPDATE store_products SET stock = stock + ? 
-            WHERE store_id = ? AND product_id = ?''',
-            (transfer['quantity'], transfer['to_store_id'], transfer['product_id']))
-        
-        # 更新狀態
-        cursor.execute('''UPDATE inventory_transfers 
-            SET status = 'approved', approved_by = ?, approved_at = CURRENT_TIMESTAMP
-            WHERE id = ?''', (approved_by, transfer_id))
-    
-    conn.commit()
-    conn.close()
+    try:
+        query = "SELECT COUNT(*) FROM inventory_transfers WHERE 1=1"
+        params = []
+        if store_id:
+            query += " AND (from_store_id = ? OR to_store_id = ?)"
+            params += [store_id, store_id]
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        count = conn.execute(query, params).fetchone()[0]
+    finally:
+        conn.close()
+    return count
+
+
+def create_transfer_order(from_store_id, to_store_id, lines, notes="", created_by=None):
+    """建立多品項調貨單，lines 為 [(product_id, quantity), ...]
+
+    每個品項寫入一筆 inventory_transfers（order_id 指向調貨單），可逐筆或整批核准。
+    回傳 {'success': True, 'order_id', 'transfer_ids'}；資料不正確時回傳 {'success': False, 'message'}
+    """
+    if from_store_id == to_store_id:
+        return {'success': False, 'message': '調出與調入分店相同'}
+    lines = [(product_id, quantity) for product_id, quantity in lines]
+    if not lines:
+        return {'success': False, 'message': '調貨單沒有品項'}
+    if any(not isinstance(quantity, int) or quantity <= 0 for _, quantity in lines):
+        return {'success': False, 'message': '調貨數量必須為正整數'}
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO inventory_transfer_orders (from_store_id, to_store_id, notes, created_by)
+            VALUES (?, ?, ?, ?)''', (from_store_id, to_store_id, notes, created_by))
+        order_id = cursor.lastrowid
+        cursor.executemany('''INSERT INTO inventory_transfers (order_id, from_store_id, to_store_id, product_id, quantity, notes)
+            VALUES (?, ?, ?, ?, ?, ?)''',
+            [(order_id, from_store_id, to_store_id, product_id, quantity, notes) for product_id, quantity in lines])
+        cursor.execute("SELECT id FROM inventory_transfers WHERE order_id = ? ORDER BY id", (order_id,))
+        transfer_ids = [row[0] for row in cursor.fetchall()]
+    return {'success': True, 'order_id': order_id, 'transfer_ids': transfer_ids}
+
+
+def get_transfer_orders(store_id=None, limit=100):
+    """調貨單（由新到舊），附品項數與各狀態筆數"""
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        query = '''SELECT o.*, s1.name AS from_store, s2.name AS to_store,
+            (SELECT COUNT(*) FROM inventory_transfers t WHERE t.order_id = o.id) AS lines,
+            (SELECT COUNT(*) FROM inventory_transfers t WHERE t.order_id = o.id AND t.status = 'pending') AS pending_lines,
+            (SELECT COUNT(*) FROM inventory_transfers t WHERE t.order_id = o.id AND t.status = 'approved') AS approved_lines
+            FROM inventory_transfer_orders o
+            JOIN stores s1 ON s1.id = o.from_store_id
+            JOIN stores s2 ON s2.id = o.to_store_id'''
+        params = []
+        if store_id:
+            query += " WHERE o.from_store_id = ? OR o.to_store_id = ?"
+            params += [store_id, store_id]
+        query += " ORDER BY o.id DESC LIMIT ?"
+        params.append(limit)
+        cursor.execute(query, params)
+        orders = cursor.fetchall()
+    finally:
+        conn.close()
+    return orders
+
+
+def _settle_transfers(cursor, transfer_ids, approved_by):
+    """在目前交易內核准調貨明細，回傳 (核准的 id 清單, 退回清單)
+
+    同一調出分店、同一商品的待審明細依 id 順序自調出分店庫存扣除，剩餘庫存不足的明細退回
+    （維持待審核，不佔用庫存，之後較小的明細仍可核准），其餘以整批 UPDATE 扣調出庫存、加調入庫存並寫入庫存異動日誌；
+    調入分店尚未上架的商品以商品主檔價格新增。
+    """
+    cursor.execute('''SELECT t.id, t.from_store_id, t.to_store_id, t.product_id, t.quantity, t.status,
+            (SELECT sp.stock FROM store_products sp
+             WHERE sp.store_id = t.from_store_id AND sp.product_id = t.product_id) AS available
+        FROM inventory_transfers t
+        WHERE t.id IN (SELECT value FROM json_each(?))
+        ORDER BY t.id''', (json.dumps(sorted(set(transfer_ids))),))
+    approved, rejected = [], []
+    movements = []
+    remaining = {}  # (調出分店, 商品) -> 扣除已核准明細後的庫存
+    for row in cursor.fetchall():
+        key = (row['from_store_id'], row['product_id'])
+        available = remaining.setdefault(key, row['available'])
+        if row['status'] != 'pending':
+            message = f"狀態為 {row['status']}，不需核准"
+        elif available is None:
+            message = '調出分店沒有此商品'
+        elif row['quantity'] > available:
+            message = f"調出分店庫存不足 可調數量: {available}"
+        else:
+            remaining[key] = available - row['quantity']
+            approved.append(row['id'])
+            movements.append((row['from_store_id'], row['product_id'], -row['quantity'], 'transfer_out', str(row['id'])))
+            movements.append((row['to_store_id'], row['product_id'], row['quantity'], 'transfer_in', str(row['id'])))
+            continue
+        rejected.append({'transfer_id': row['id'], 'from_store_id': row['from_store_id'],
+                         'to_store_id': row['to_store_id'], 'product_id': row['product_id'],
+                         'quantity': row['quantity'], 'available': available or 0, 'message': message})
+    if not approved:
+        return approved, rejected
+
+    cursor.execute('''INSERT INTO store_products (store_id, product_id, price_ex_tax, price_inc_tax, stock)
+        SELECT DISTINCT q.store_id, q.product_id, p.price_ex_tax, p.price_inc_tax, 0
+        FROM (SELECT json_extract(value, '$[0]') AS store_id, json_extract(value, '$[1]') AS product_id
+              FROM json_each(?)) q
+        JOIN products p ON p.id = q.product_id
+        WHERE NOT EXISTS (SELECT 1 FROM store_products sp WHERE sp.store_id = q.store_id AND sp.product_id = q.product_id)''',
+        (json.dumps([[store_id, product_id] for store_id, product_id, change, _, _ in movements if change > 0]),))
+    # 同店同商品合併為一筆增減，一個陳述式完成所有調出 / 調入，每筆明細各寫一筆日誌
+    _post_stock_movements(cursor, movements, approved_by)
+    cursor.execute('''UPDATE inventory_transfers SET status = 'approved', approved_by = ?, approved_at = CURRENT_TIMESTAMP
+        WHERE id IN (SELECT value FROM json_each(?))''', (approved_by, json.dumps(approved)))
+    return approved, rejected
+
+
+@retry_on_busy
+def approve_transfers(transfer_ids, approved_by):
+    """整批核准調貨明細（單一交易），調出分店庫存不足的明細不核准並回報
+
+    回傳 {'success': True, 'approved': [transfer_id, ...],
+          'rejected': [{'transfer_id', 'from_store_id', 'to_store_id', 'product_id', 'quantity', 'available', 'message'}]}
+    """
+    transfer_ids = list(transfer_ids)
+    if not transfer_ids:
+        return {'success': True, 'approved': [], 'rejected': []}
+    with transaction() as conn:
+        approved, rejected = _settle_transfers(conn.cursor(), transfer_ids, approved_by)
+    return {'success': True, 'approved': approved, 'rejected': rejected}
+
+
+def approve_transfer_order(order_id, approved_by):
+    """核准調貨單所有待審品項，回傳同 approve_transfers()"""
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM inventory_transfers WHERE order_id = ? AND status = 'pending'", (order_id,))
+        transfer_ids = [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+    return approve_transfers(transfer_ids, approved_by)
+
+
+def approve_transfer(transfer_id, approved_by):
+    """核准單筆調貨（調出分店庫存不足時不核准），回傳同 approve_transfers()"""
+    return approve_transfers([transfer_id], approved_by)
 
 
 # ===== 銷售 =====
 
-def create_sale(store_id, member_id, subtotal, discount, promo_discount, member_discount, total, 
-                cash, change_amount, payment_method='cash', created_by=None, items=None, invoice_number=None):
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''INSERT INTO sales 
-        (store_id, member_id, subtotal, discount, promo_discount, member_discount, total, 
+def _record_sale(cursor, store_id, member_id, subtotal, discount, promo_discount, member_discount, total,
+                 cash, change_amount, payment_method='cash', created_by=None, items=None, invoice_number=None,
+                 reserved=None):
+    """在目前交易內寫入銷售、明細、扣庫存（寫入庫存異動日誌）並累計會員消費/積分
+
+    回傳 (sale_id, 異動後的會員資料或 None)；會員資料於提交後寫回會員快取。
+    reserved 為 _reserve_stock() 已扣除的庫存 {product_id: 異動後庫存}，此時只寫日誌不再扣庫存。
+    """
+    cursor.execute('''INSERT INTO sales
+        (store_id, member_id, subtotal, discount, promo_discount, member_discount, total,
          cash, change_amount, payment_method, invoice_number, created_by)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
         (store_id, member_id, subtotal, discount, promo_discount, member_discount, total,
          cash, change_amount, payment_method, invoice_number, created_by))
     sale_id = cursor.lastrowid
-    
+    _rollup_sale(cursor, sale_id, items)
+
     if items:
-        for item in items:
-            cursor.execute('''INSERT INTO sale_items 
-                (sale_id, product_id, product_name, quantity, unit_price, discount, subtotal)
-                VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                (sale_id, item['product_id'], item['name'], item['quantity'], 
-                 item['price'], item.get('discount', 0), item['subtotal']))
-            
-            # 扣庫存
-            cursor.execute('''UPDATE store_products SET stock = stock - ? 
-                WHERE store_id = ? AND product_id = ?''',
-                (item['quantity'], store_id, item['product_id']))
-    
+        cursor.executemany('''INSERT INTO sale_items
+            (sale_id, product_id, product_name, quantity, unit_price, discount, subtotal)
+            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            [(sale_id, item['product_id'], item['name'], item['quantity'],
+              item['price'], item.get('discount', 0), item['subtotal']) for item in items])
+
+    if items:
+        # 扣庫存
+        movements = [(store_id, item['product_id'], -item['quantity'], 'sale', str(sale_id)) for item in items]
+        if reserved is None:
+            _post_stock_movements(cursor, movements, created_by)
+        else:
+            _journal_stock_movements(cursor, movements, {(store_id, product_id): stock
+                                                         for product_id, stock in reserved.items()}, created_by)
+
     # 更新會員消費
+    member = None
     if member_id:
         cursor.execute("UPDATE members SET total_spent = total_spent + ? WHERE id = ?", (total, member_id))
         # 積分 (消費1元=1點)
         points = int(total)
-        update_member_points(member_id, points, "消費積分", store_id)
-    
-    conn.commit()
-    conn.close()
+        member = _post_member_points(cursor, member_id, points, "消費積分", store_id)
+
+    return sale_id, member
+
+
+def _after_sale(store_id, items, member, before, after):
+    """銷售提交後寫回會員快取與今日排行；before / after 為交易開始與結束時的 _read_data_versions()"""
+    member_cache.write_back(member, after)
+    if not get_pool().holds_connection():
+        today_leaderboard.record(store_id, items, before.get('sales_product_daily', 0),
+                                 after.get('sales_product_daily', 0))
+
+
+@retry_on_busy
+def create_sale(store_id, member_id, subtotal, discount, promo_discount, member_discount, total,
+                cash, change_amount, payment_method='cash', created_by=None, items=None, invoice_number=None):
+    with transaction() as conn:
+        cursor = conn.cursor()
+        before = _read_data_versions(cursor)
+        sale_id, member = _record_sale(cursor, store_id, member_id, subtotal, discount, promo_discount,
+                                       member_discount, total, cash, change_amount, payment_method, created_by,
+                                       items, invoice_number)
+        after = _read_data_versions(cursor)
+    _after_sale(store_id, items, member, before, after)
     return sale_id
 
 
-def get_sales(store_id=None, limit=100):
+@retry_on_busy
+def checkout(store_id, cart, member=None, payment=None, created_by=None):
+    """結帳：計價、銷售、明細、扣庫存、會員積分/等級與發票在同一個 BEGIN IMMEDIATE 交易完成
+
+    payment: {'method': 'cash', 'cash': 收款, 'discount': 手動折扣, 'carrier_type': '', 'carrier_number': ''}
+    庫存在交易內以條件式 UPDATE 預留，不足時整筆回滾並回傳
+    {'success': False, 'message': '庫存不足', 'items': [...]}（items 格式同 check_cart_stock）；
+    收款少於應收金額時不寫入並回傳 {'success': False, 'message': '收款不足 應收: N'}。
+    任何一步失敗整筆回滾；成功回傳 {'success': True, 'sale_id', 'invoice_id', 'invoice_number', 'total', 'change', 'pricing'}
+    """
+    if not cart:
+        return {'success': False, 'message': '購物車是空的'}
+
+    payment = payment or {}
+    member = dict(member) if member else None
+    pricing = price_cart(store_id, member, cart, payment.get('discount', 0))
+    total = pricing['total']
+    cash = payment.get('cash', total)
+    if cash < total:
+        return {'success': False, 'message': f'收款不足 應收: {total}'}
+    change = cash - total
+    member_id = member['id'] if member else None
+
+    # 明細折扣記錄各行促銷折扣
+    items = [dict(item, discount=line['promo_discount']) for item, line in zip(cart, pricing['lines'])]
+
+    try:
+        with transaction() as conn:
+            cursor = conn.cursor()
+            before = _read_data_versions(cursor)
+            reserved, shortages = _reserve_stock(cursor, store_id, items)
+            if shortages:
+                raise StockShortage(shortages)
+            sale_id, updated_member = _record_sale(
+                cursor, store_id, member_id,
+                subtotal=pricing['subtotal'],
+                discount=pricing['discount'],
+                promo_discount=pricing['promo_discount'],
+                member_discount=pricing['member_discount'] + pricing['birthday_discount'],
+                total=total,
+                cash=cash,
+                change_amount=change,
+                payment_method=payment.get('method', 'cash'),
+                created_by=created_by,
+                items=items,
+                reserved=reserved,
+            )
+            invoice_id, invoice_number = _issue_invoice(
+                cursor, store_id, sale_id, member_id, total, items,
+                member_phone=member.get('phone', '') if member else '',
+                member_email=member.get('email', '') if member else '',
+                carrier_type=payment.get('carrier_type', ''),
+                carrier_number=payment.get('carrier_number', ''),
+            )
+            cursor.execute("UPDATE sales SET invoice_number = ? WHERE id = ?", (invoice_number, sale_id))
+            after = _read_data_versions(cursor)
+    except StockShortage as e:
+        return {'success': False, 'message': '庫存不足', 'items': e.items}
+    _after_sale(store_id, items, updated_member, before, after)
+
+    return {
+        'success': True,
+        'sale_id': sale_id,
+        'invoice_id': invoice_id,
+        'invoice_number': invoice_number,
+        'total': total,
+        'change': change,
+        'pricing': pricing,
+    }
+
+
+def get_sales(store_id=None, limit=100, before=None):
+    """銷售紀錄（由新到舊）；before 為上一頁最後一筆的 page_cursor()"""
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
     
-    if store_id:
-        cursor.execute('''SELECT s.*, st.name as store_name, m.name as member_name
-            FROM sales s
-            LEFT JOIN stores st ON s.store_id = st.id
-            LEFT JOIN members m ON s.member_id = m.id
-            WHERE s.store_id = ?
-            ORDER BY s.created_at DESC LIMIT ?''', (store_id, limit))
-    else:
-        cursor.execute('''SELECT s.*, st.name as store_name, m.name as member_name
-            FROM sales s
-            LEFT JOIN stores st ON s.store_id = st.id
-            LEFT JOIN members m ON s.member_id = m.id
-            ORDER BY s.created_at DESC LIMIT ?''', (limit,))
-    
-    sales = cursor.fetchall()
-    conn.close()
+        clause, before_params = _before_clause(before, 's.')
+        if store_id:
+            cursor.execute(f'''SELECT s.*, st.name as store_name, m.name as member_name
+                FROM sales s
+                LEFT JOIN stores st ON s.store_id = st.id
+                LEFT JOIN members m ON s.member_id = m.id
+                WHERE s.store_id = ?{clause}
+                ORDER BY s.created_at DESC, s.id DESC LIMIT ?''', [store_id] + before_params + [limit])
+        else:
+            cursor.execute(f'''SELECT s.*, st.name as store_name, m.name as member_name
+                FROM sales s
+                LEFT JOIN stores st ON s.store_id = st.id
+                LEFT JOIN members m ON s.member_id = m.id
+                WHERE 1=1{clause}
+                ORDER BY s.created_at DESC, s.id DESC LIMIT ?''', before_params + [limit])
+    
+        sales = cursor.fetchall()
+    finally:
+        conn.close()
     return sales
 
 
+def iter_sales(store_id=None, batch_size=1000):
+    """逐頁讀取銷售紀錄（記憶體只保留一頁）"""
+    return _iter_pages(lambda limit, before: get_sales(store_id, limit, before), batch_size)
+
+
+def count_sales(store_id=None):
+    """銷售筆數（讀 sales_daily_rollup）"""
+    conn = get_connection()
+    try:
+        if store_id:
+            count = conn.execute("SELECT SUM(orders) FROM sales_daily_rollup WHERE store_id = ?",
+                                 (store_id,)).fetchone()[0]
+        else:
+            # 全部分店（含已刪除分店）的總筆數：加總整張彙總表，列數 = 分店數 x 營業天數
+            count = conn.execute("SELECT SUM(orders) FROM sales_daily_rollup").fetchone()[0]
+    finally:
+        conn.close()
+    return count or 0
+
+
 def get_daily_sales(store_id=None):
+    """今日訂單數與營收（讀 sales_daily_rollup）"""
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
     
-    if store_id:
-        cursor.execute('''SELECT COUNT(*), SUM(total), SUM(discount) 
-            FROM sales WHERE store_id = ? AND date(created_at) = date('now')''', (store_id,))
-    else:
-        cursor.execute("SELECT COUNT(*), SUM(total), SUM(discount) FROM sales WHERE date(created_at) = date('now')")
+        if store_id:
+            cursor.execute('''SELECT SUM(orders), SUM(revenue), SUM(discount)
+                FROM sales_daily_rollup WHERE store_id = ? AND day = date('now')''', (store_id,))
+        else:
+            cursor.execute('''SELECT SUM(orders), SUM(revenue), SUM(discount)
+                FROM sales_daily_rollup WHERE day = date('now')''')
     
-    result = cursor.fetchone()
-    conn.close()
+        result = cursor.fetchone()
+    finally:
+        conn.close()
     return {'orders': result[0] or 0, 'revenue': result[1] or 0}
 
 
+DELETED_STORE_NAME = "（已刪除分店）"
+
+
 def get_store_revenue(store_id=None, days=30):
-    """取得分店營收"""
+    """取得分店營收（讀 sales_daily_rollup，筆數與天數成正比）"""
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
     
-    if store_id:
-        cursor.execute('''SELECT DATE(created_at) as date, SUM(total) as revenue, COUNT(*) as orders
-            FROM sales WHERE store_id = ? AND created_at >= date('now', '-' || ? || ' days')
-            GROUP BY DATE(created_at) ORDER BY date''', (store_id, days))
-    else:
-        cursor.execute('''SELECT store_id, st.name as store_name, SUM(total) as revenue, COUNT(*) as orders
-            FROM sales s JOIN stores st ON s.store_id = st.id
-            WHERE s.created_at >= date('now', '-' || ? || ' days')
-            GROUP BY store_id ORDER BY revenue DESC''', (days,))
+        if store_id:
+            cursor.execute('''SELECT day as date, revenue, orders
+                FROM sales_daily_rollup WHERE store_id = ? AND day >= date('now', '-' || ? || ' days')
+                ORDER BY day''', (store_id, days))
+        else:
+            # 已刪除的分店仍列出（分店名稱顯示為 DELETED_STORE_NAME），與 sales 的合計一致；
+            # GROUP BY store_id 會讓查詢計畫改走主鍵依序掃描整張表，+r.store_id 讓分組不使用主鍵，改依日期索引讀取範圍
+            cursor.execute('''SELECT r.store_id, COALESCE(st.name, ?) as store_name, SUM(r.revenue) as revenue,
+                       SUM(r.orders) as orders
+                FROM sales_daily_rollup r LEFT JOIN stores st ON st.id = r.store_id
+                WHERE r.day >= date('now', '-' || ? || ' days')
+                GROUP BY +r.store_id ORDER BY revenue DESC, r.store_id''', (DELETED_STORE_NAME, days))
     
-    results = cursor.fetchall()
-    conn.close()
+        results = cursor.fetchall()
+    finally:
+        conn.close()
     return results
 
 
+# ===== 銷售彙總 =====
+# sales_daily_rollup 以 (store_id, day)、sales_hourly_cube 以 (store_id, day, hour) 為鍵，
+# day / hour 與 sales.created_at 的日期、小時相同（UTC）。
+# _record_sale 在同一交易內累加；直接寫入 sales 的資料（匯入、修補）須以 rebuild_sales_rollup() 重建。
+
+# 彙總表 -> (鍵欄位, 值欄位, 由 sales 計算的 SELECT；{where} 代入篩選條件)
+SALES_ROLLUPS = {
+    'sales_daily_rollup': (
+        ('store_id', 'day'), ('orders', 'revenue', 'discount'),
+        '''SELECT store_id, date(created_at), COUNT(*), COALESCE(SUM(total), 0), COALESCE(SUM(discount), 0)
+        FROM sales {where}
+        GROUP BY store_id, date(created_at)'''),
+    'sales_hourly_cube': (
+        ('store_id', 'day', 'hour'), ('orders', 'revenue', 'item_count'),
+        '''SELECT store_id, date(created_at), CAST(strftime('%H', created_at) AS INTEGER), COUNT(*),
+            COALESCE(SUM(total), 0),
+            COALESCE(SUM((SELECT SUM(quantity) FROM sale_items WHERE sale_id = sales.id)), 0)
+        FROM sales {where}
+        GROUP BY store_id, date(created_at), strftime('%H', created_at)'''),
+    'sales_product_daily': (
+        ('store_id', 'day', 'product_id'), ('quantity', 'revenue'),
+        '''SELECT store_id, date(created_at), si.product_id, SUM(si.quantity), SUM(si.subtotal)
+        FROM sales JOIN sale_items si ON si.sale_id = sales.id {where}
+        GROUP BY store_id, date(created_at), si.product_id'''),
+}
+
+
+def _rollup_sale(cursor, sale_id, items=None):
+    """將一筆銷售（含明細）累加到每日、每小時與商品每日彙總"""
+    items = items or ()
+    store_id, day = cursor.execute('''INSERT INTO sales_daily_rollup (store_id, day, orders, revenue, discount)
+        SELECT store_id, date(created_at), 1, total, COALESCE(discount, 0) FROM sales WHERE id = ?
+        ON CONFLICT (store_id, day) DO UPDATE SET
+            orders = orders + 1,
+            revenue = revenue + excluded.revenue,
+            discount = discount + excluded.discount
+        RETURNING store_id, day''', (sale_id,)).fetchone()
+    item_count = sum(item['quantity'] for item in items)
+    cursor.execute('''INSERT INTO sales_hourly_cube (store_id, day, hour, orders, revenue, item_count)
+        SELECT store_id, date(created_at), CAST(strftime('%H', created_at) AS INTEGER), 1, total, ?
+        FROM sales WHERE id = ?
+        ON CONFLICT (store_id, day, hour) DO UPDATE SET
+            orders = orders + 1,
+            revenue = revenue + excluded.revenue,
+            item_count = item_count + excluded.item_count''', (item_count, sale_id))
+    cursor.executemany('''INSERT INTO sales_product_daily (store_id, day, product_id, quantity, revenue)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (store_id, day, product_id) DO UPDATE SET
+            quantity = quantity + excluded.quantity,
+            revenue = revenue + excluded.revenue''',
+        [(store_id, day, item['product_id'], item['quantity'], item['subtotal']) for item in items])
+
+
+def _rollup_filters(store_id=None, since=None):
+    """回傳 (彙總表 WHERE, sales WHERE, 參數)"""
+    rollup_where, sales_where, params = [], [], []
+    if store_id:
+        rollup_where.append("store_id = ?")
+        sales_where.append("store_id = ?")
+        params.append(store_id)
+    if since:
+        rollup_where.append("day >= ?")
+        sales_where.append("created_at >= ?")
+        params.append(since)
+    rollup_where = f"WHERE {' AND '.join(rollup_where)}" if rollup_where else ""
+    sales_where = f"WHERE {' AND '.join(sales_where)}" if sales_where else ""
+    return rollup_where, sales_where, params
+
+
+def _rebuild_rollup(cursor, table, store_id=None, since=None):
+    """由 sales 重新計算一張彙總表（可限定分店與起始日），回傳寫入筆數"""
+    keys, values, select = SALES_ROLLUPS[table]
+    rollup_where, sales_where, params = _rollup_filters(store_id, since)
+    cursor.execute(f"DELETE FROM {table} {rollup_where}", params)
+    cursor.execute(f"INSERT INTO {table} ({', '.join(keys + values)}) " + select.format(where=sales_where), params)
+    return cursor.rowcount
+
+
+@retry_on_busy
+def rebuild_sales_rollup(store_id=None, since=None):
+    """重建銷售彙總（回補歷史資料或修補直接寫入 sales 的資料），回傳 {彙總表: 筆數}
+
+    since 為 'YYYY-MM-DD'，只重建該日（含）之後的彙總。
+    """
+    with transaction() as conn:
+        cursor = conn.cursor()
+        return {table: _rebuild_rollup(cursor, table, store_id, since) for table in SALES_ROLLUPS}
+
+
+def check_sales_rollup(store_id=None, since=None):
+    """比對銷售彙總與 sales 原始資料，回傳不一致清單（空清單表示一致）
+
+    每筆：{'table', 'key': (store_id, day[, hour]), 'expected': 由 sales 計算的值, 'actual': 彙總表的值}
+    """
+    rollup_where, sales_where, params = _rollup_filters(store_id, since)
+    mismatches = []
+    with db_connection() as conn:
+        for table, (keys, values, select) in SALES_ROLLUPS.items():
+            expected = {tuple(row[:len(keys)]): tuple(row[len(keys):])
+                        for row in conn.execute(select.format(where=sales_where), params)}
+            actual = {tuple(row[:len(keys)]): tuple(row[len(keys):])
+                      for row in conn.execute(f"SELECT {', '.join(keys + values)} FROM {table} {rollup_where}", params)}
+            for key in sorted(expected.keys() | actual.keys()):
+                want, got = expected.get(key), actual.get(key)
+                if want is None or got is None or any(abs(a - b) > 0.005 for a, b in zip(want, got)):
+                    mismatches.append({'table': table, 'key': key, 'expected': want, 'actual': got})
+    return mismatches
+
+
 # ===== 庫存警示 =====
 
 def get_low_stock_products(store_id):
     """取得低庫存商品"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''SELECT sp.*, p.name as product_name, p.barcode
-        FROM store_products sp
-        JOIN products p ON sp.product_id = p.id
-        WHERE sp.store_id = ? AND sp.stock <= sp.low_stock_alert AND sp.is_active = 1
-        ORDER BY sp.stock''', (store_id,))
-    products = cursor.fetchall()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT sp.*, p.name as product_name, p.barcode
+            FROM store_products sp
+            JOIN products p ON sp.product_id = p.id
+            WHERE sp.store_id = ? AND sp.stock <= sp.low_stock_alert AND sp.is_active = 1
+            ORDER BY sp.stock''', (store_id,))
+        products = cursor.fetchall()
+    finally:
+        conn.close()
     return products
 
 
 # ===== 統計報表 =====
 
-def get_top_products(store_id=None, limit=10):
+def get_top_products(store_id=None, limit=10, start_date=None, end_date=None):
+    """熱銷商品（讀 sales_product_daily）
+
+    start_date / end_date 為 'YYYY-MM-DD'（含），未指定則不限；依銷售額由高到低取前 limit 名。
+    """
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
     
-    if store_id:
-        cursor.execute('''SELECT product_name, SUM(quantity) as total_qty, SUM(subtotal) as total_sales
-            FROM sale_items si
-            JOIN sales s ON si.sale_id = s.id
-            WHERE s.store_id = ?
-            GROUP BY product_id ORDER BY total_sales DESC LIMIT ?''', (store_id, limit))
-    else:
-        cursor.execute('''SELECT product_name, SUM(quantity) as total_qty, SUM(subtotal) as total_sales
-            FROM sale_items si
-            JOIN sales s ON si.sale_id = s.id
-            GROUP BY product_id ORDER BY total_sales DESC LIMIT ?''', (limit,))
+        if store_id:
+            cursor.execute('''SELECT p.name as product_name, t.total_qty, t.total_sales
+                FROM (SELECT product_id, SUM(quantity) as total_qty, SUM(revenue) as total_sales
+                      FROM sales_product_daily
+                      WHERE store_id = ? AND day BETWEEN COALESCE(?, '') AND COALESCE(?, '9999-12-31')
+                      GROUP BY product_id ORDER BY total_sales DESC LIMIT ?) t
+                LEFT JOIN products p ON p.id = t.product_id
+                ORDER BY t.total_sales DESC''', (store_id, start_date, end_date, limit))
+        else:
+            cursor.execute('''SELECT p.name as product_name, t.total_qty, t.total_sales
+                FROM (SELECT d.product_id, SUM(d.quantity) as total_qty, SUM(d.revenue) as total_sales
+                      FROM sales_product_daily d
+                      WHERE d.day BETWEEN COALESCE(?, '') AND COALESCE(?, '9999-12-31')
+                      GROUP BY d.product_id ORDER BY total_sales DESC LIMIT ?) t
+                LEFT JOIN products p ON p.id = t.product_id
+                ORDER BY t.total_sales DESC''', (start_date, end_date, limit))
     
-    results = cursor.fetchall()
-    conn.close()
+        results = cursor.fetchall()
+    finally:
+        conn.close()
     return results
 
 
-def get_hourly_sales(store_id=None):
-    """時段分析"""
+class TodayLeaderboard:
+    """今日熱銷排行（記憶體）
+
+    各分店首次查詢時由 sales_product_daily 載入當日資料並記下當時的資料版本；
+    之後本行程提交的銷售由 record() 累加（交易開始時的版本等於排行的版本才累加），查詢只比對版本，不讀彙總表。
+    其他連線 / 行程寫入 sales_product_daily 後版本不符，整批重新載入。換日時自動清空。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._day = None
+        self._version = None      # 各分店排行對應的 sales_product_daily 版本
+        self._stores = {}         # store_id -> {product_id: [quantity, revenue, name]}
+        self.loads = 0
+
+    @staticmethod
+    def _today():
+        return time.strftime('%Y-%m-%d', time.gmtime())
+
+    def _roll_day(self):
+        today = self._today()
+        if self._day != today:
+            self._day = today
+            self._stores = {}
+        return today
+
+    def _load(self, store_id, today):
+        with db_connection() as conn:
+            # 單一陳述式同時讀取資料版本與彙總（同一個讀取快照），不另開交易，巢狀呼叫也不影響外層交易
+            rows = conn.execute('''SELECT w.version, d.product_id, d.quantity, d.revenue, p.name
+                FROM (SELECT COALESCE(MAX(version), 0) AS version FROM data_versions
+                      WHERE scope = 'sales_product_daily') w
+                LEFT JOIN sales_product_daily d ON d.store_id = ? AND d.day = ?
+                LEFT JOIN products p ON p.id = d.product_id''', (store_id, today)).fetchall()
+        self.loads += 1
+        return rows[0][0], {row[1]: [row[2], row[3], row[4] or ''] for row in rows if row[1] is not None}
+
+    def record(self, store_id, items, before, after):
+        """累加已提交的銷售；before / after 為該交易開始與結束時的 sales_product_daily 版本
+
+        排行版本不等於 before 表示期間有其他寫入，不累加，由下次查詢重新載入。
+        """
+        with self._lock:
+            self._roll_day()
+            if self._version is None or self._version != before:
+                return
+            self._version = after
+            board = self._stores.get(store_id)
+            if board is None:
+                return
+            for item in items or ():
+                entry = board.setdefault(item['product_id'], [0, 0, item.get('name', '')])
+                entry[0] += item['quantity']
+                entry[1] += item['subtotal']
+
+    def top(self, store_id, limit=10):
+        """今日銷售額前 limit 名：[{'product_id', 'product_name', 'total_qty', 'total_sales'}]"""
+        version = data_version('sales_product_daily')[1]
+        with self._lock:
+            today = self._roll_day()
+            if version != self._version:
+                self._stores = {}
+            board = self._stores.get(store_id)
+            if board is None:
+                loaded, board = self._load(store_id, today)
+                # 在其他函數的交易內載入時可能讀到未提交（之後可能回滾）的銷售，不保留
+                if not get_pool().holds_connection():
+                    if loaded != self._version:
+                        self._stores = {}
+                        self._version = loaded
+                    self._stores[store_id] = board
+            best = heapq.nlargest(limit, board.items(), key=lambda entry: entry[1][1])
+        return [{'product_id': product_id, 'product_name': name, 'total_qty': qty, 'total_sales': revenue}
+                for product_id, (qty, revenue, name) in best]
+
+    def reset(self):
+        with self._lock:
+            self._day = None
+            self._version = None
+            self._stores = {}
+
+
+today_leaderboard = TodayLeaderboard()
+
+
+def get_today_top_products(store_id, limit=10):
+    """今日熱銷商品（記憶體排行，資料版本未變動時不讀彙總表）"""
+    return today_leaderboard.top(store_id, limit)
+
+
+def get_hourly_sales(store_id=None, days=7):
+    """時段分析（讀 sales_hourly_cube）"""
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
     
-    if store_id:
-        cursor.execute('''SELECT strftime('%H', created_at) as hour, COUNT(*) as orders, SUM(total) as revenue
-            FROM sales WHERE store_id = ? AND created_at >= date('now', '-7 days')
-            GROUP BY hour ORDER BY hour''', (store_id,))
-    else:
-        cursor.execute('''SELECT strftime('%H', created_at) as hour, COUNT(*) as orders, SUM(total) as revenue
-            FROM sales WHERE created_at >= date('now', '-7 days')
-            GROUP BY hour ORDER BY hour''')
+        if store_id:
+            cursor.execute('''SELECT printf('%02d', hour) as hour, SUM(orders) as orders, SUM(revenue) as revenue
+                FROM sales_hourly_cube WHERE store_id = ? AND day >= date('now', '-' || ? || ' days')
+                GROUP BY hour ORDER BY hour''', (store_id, days))
+        else:
+            cursor.execute('''SELECT printf('%02d', c.hour) as hour, SUM(c.orders) as orders, SUM(c.revenue) as revenue
+                FROM sales_hourly_cube c
+                WHERE c.day >= date('now', '-' || ? || ' days')
+                GROUP BY c.hour ORDER BY c.hour''', (days,))
     
-    results = cursor.fetchall()
-    conn.close()
+        results = cursor.fetchall()
+    finally:
+        conn.close()
+    return results
+
+
+def get_sales_heatmap(start_date=None, end_date=None, store_ids=None):
+    """日期 x 小時銷售熱度（讀 sales_hourly_cube）
+
+    start_date / end_date 為 'YYYY-MM-DD'（含），預設近 7 天；store_ids 為 None 時合計所有分店。
+    回傳 [{'day', 'hour', 'orders', 'revenue', 'item_count'}]，依日期、小時排序。
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+
+        if store_ids:
+            store_ids = list(store_ids)
+            placeholders = ','.join('?' * len(store_ids))
+            cursor.execute(f'''SELECT day, hour, SUM(orders) as orders, SUM(revenue) as revenue, SUM(item_count) as item_count
+                FROM sales_hourly_cube WHERE store_id IN ({placeholders}) AND day BETWEEN COALESCE(?, date('now', '-6 days')) AND COALESCE(?, date('now'))
+                GROUP BY day, hour ORDER BY day, hour''', store_ids + [start_date, end_date])
+        else:
+            cursor.execute('''SELECT c.day, c.hour, SUM(c.orders) as orders, SUM(c.revenue) as revenue,
+                    SUM(c.item_count) as item_count
+                FROM sales_hourly_cube c
+                WHERE c.day BETWEEN COALESCE(?, date('now', '-6 days')) AND COALESCE(?, date('now'))
+                GROUP BY c.day, c.hour ORDER BY c.day, c.hour''', (start_date, end_date))
+
+        results = cursor.fetchall()
+    finally:
+        conn.close()
     return results
 
 
@@ -1101,43 +3480,41 @@ def get_hourly_sales(store_id=None):
 def get_birthday_coupon():
     """取得當前有效的生日優惠券"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM birthday_coupons WHERE is_active = 1 LIMIT 1")
-    coupon = cursor.fetchone()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM birthday_coupons WHERE is_active = 1 LIMIT 1")
+        coupon = cursor.fetchone()
+    finally:
+        conn.close()
     return coupon
 
 
-def check_birthday_discount(member_id, subtotal):
-    """檢查會員是否符合生日優惠"""
-    if not member_id:
-        return 0
-    
-    member = get_member_by_id(member_id)
-    if not member or not member['birthday']:
-        return 0
-    
-    # 檢查是否在生日月份（當月或前後一個月）
-    today = datetime.now()
+cached_birthday_coupon = snapshot('birthday_coupons')(get_birthday_coupon)
+
+
+def in_birthday_window(birthday, today=None):
+    """是否在生日月份（當月或前後一個月）"""
+    if not birthday:
+        return False
+    today = today or datetime.now()
     try:
-        member_birthday = datetime.strptime(member['birthday'], '%Y-%m-%d')
-        birth_month = member_birthday.month
-        current_month = today.month
-        
-        month_diff = abs(birth_month - current_month)
-        if month_diff > 1:
-            if birth_month == 12 and current_month == 1:
-                month_diff = 1
-            elif birth_month == 1 and current_month == 12:
-                month_diff = 1
-        
-        if month_diff > 1:
-            return 0
-    except:
-        return 0
+        birth_month = datetime.strptime(birthday, '%Y-%m-%d').month
+    except (TypeError, ValueError):
+        return False
+    current_month = today.month
+    
+    month_diff = abs(birth_month - current_month)
+    if month_diff > 1:
+        if birth_month == 12 and current_month == 1:
+            month_diff = 1
+        elif birth_month == 1 and current_month == 12:
+            month_diff = 1
     
-    # 取得優惠券
-    coupon = get_birthday_coupon()
+    return month_diff <= 1
+
+
+def calculate_birthday_discount(coupon, subtotal):
+    """依生日優惠券計算折扣"""
     if not coupon:
         return 0
     
@@ -1155,15 +3532,129 @@ def check_birthday_discount(member_id, subtotal):
     return round(discount, 2)
 
 
+def check_birthday_discount(member_id, subtotal):
+    """檢查會員是否符合生日優惠"""
+    if not member_id:
+        return 0
+    
+    member = get_member_by_id(member_id)
+    if not member or not member['in_birthday_window']:
+        return 0
+    
+    return calculate_birthday_discount(get_birthday_coupon(), subtotal)
+
+
 def add_birthday_coupon(name, discount_percent=0, discount_amount=0, min_spent=0):
     """新增生日優惠券"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO birthday_coupons 
-        (name, discount_percent, discount_amount, min_spent) VALUES (?, ?, ?, ?)''',
-        (name, discount_percent, discount_amount, min_spent))
-    conn.commit()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO birthday_coupons 
+            (name, discount_percent, discount_amount, min_spent) VALUES (?, ?, ?, ?)''',
+            (name, discount_percent, discount_amount, min_spent))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ===== 結帳計價 =====
+
+class PricingRules:
+    """結帳計價規則表（會員等級折扣與升級門檻、生日優惠券），member_levels / birthday_coupons 版本變動時重載"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._rules = None
+
+    def get(self):
+        rules = self._rules
+        version = data_version('member_levels', 'birthday_coupons')
+        if self._version != version:
+            with self._lock:
+                conn = get_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT * FROM member_levels WHERE is_active = 1 ORDER BY min_points, min_spent")
+                    levels = [dict(row) for row in cursor.fetchall()]
+                    ladder = _level_ladder(cursor)
+                    cursor.execute("SELECT * FROM birthday_coupons WHERE is_active = 1 LIMIT 1")
+                    coupon = cursor.fetchone()
+                finally:
+                    conn.close()
+                # 與 pos_page 原本的線性搜尋一致：同名等級取第一筆
+                level_discounts = {}
+                for level in levels:
+                    level_discounts.setdefault(level['name'], level['discount_percent'] or 0)
+                rules = {
+                    'levels': levels,
+                    'level_ladder': ladder,
+                    'level_discounts': level_discounts,
+                    'birthday_coupon': dict(coupon) if coupon else None,
+                }
+                self._rules = rules
+                self._version = version
+        return rules
+
+
+pricing_rules = PricingRules()
+
+
+def price_cart(store_id, member, cart, discount=0):
+    """購物車計價：逐項促銷、會員等級折扣、生日折扣與總額一次算完
+
+    使用記憶體中的促銷索引與計價規則表，不查詢資料庫。
+    回傳逐項明細與各項折扣；total 與收銀前台原本算法相同（四捨五入為整數）。
+    """
+    rules = pricing_rules.get()
+    active_promotions = promotion_index.active_map()
+
+    lines = []
+    subtotal = 0
+    promo_discount = 0
+    for item in cart:
+        promos = active_promotions.get(item['product_id'], ())
+        line_subtotal = item.get('subtotal', item['quantity'] * item['price'])
+        line_discount = calculate_promotion(item, promos) if promos else 0
+        lines.append({
+            'product_id': item['product_id'],
+            'name': item.get('name', ''),
+            'quantity': item['quantity'],
+            'price': item['price'],
+            'subtotal': line_subtotal,
+            'promo_discount': line_discount,
+            'promotion_ids': [p['id'] for p in promos],
+        })
+        subtotal += line_subtotal
+        promo_discount += line_discount
+
+    member_level = None
+    member_discount_percent = 0
+    member_discount = 0
+    birthday_discount = 0
+    if member:
+        # 優先使用會員快取（結帳寫回的最新等級），未快取時由傳入的資料計算
+        member = member_cache.peek(member.get('id')) or member_cache.priced(member)
+        member_level = member['level']
+        member_discount_percent = member['level_discount_percent']
+        member_discount = subtotal * (member_discount_percent / 100)
+        if member['in_birthday_window']:
+            birthday_discount = calculate_birthday_discount(rules['birthday_coupon'], subtotal)
+
+    total = int(subtotal - discount - promo_discount - member_discount - birthday_discount + 0.5)
+
+    return {
+        'store_id': store_id,
+        'lines': lines,
+        'subtotal': subtotal,
+        'discount': discount,
+        'promo_discount': promo_discount,
+        'member_level': member_level,
+        'member_discount_percent': member_discount_percent,
+        'member_discount': member_discount,
+        'birthday_discount': birthday_discount,
+        'total': total,
+    }
 
 
 # ===== 庫存檢查 =====
@@ -1180,19 +3671,69 @@ def check_stock_available(store_id, product_id, quantity=1):
     return {'available': True, 'stock': sp['stock']}
 
 
-def check_cart_stock(store_id, cart_items):
-    """檢查購物車所有商品庫存"""
-    unavailable_items = []
-    
+def _cart_quantities(cart_items):
+    """購物車各商品需求數量（同商品多行合併）"""
+    quantities = {}
+    for item in cart_items:
+        quantities[item['product_id']] = quantities.get(item['product_id'], 0) + item['quantity']
+    return quantities
+
+
+def _cart_shortages(cursor, store_id, cart_items):
+    """一次查詢整車庫存，回傳不足的項目清單"""
+    quantities = _cart_quantities(cart_items)
+    if not quantities:
+        return []
+    placeholders = ','.join('?' * len(quantities))
+    cursor.execute(f'''SELECT product_id, COALESCE(stock, 0) FROM store_products
+        WHERE store_id = ? AND product_id IN ({placeholders})''', [store_id] + list(quantities))
+    stock = {row[0]: row[1] for row in cursor.fetchall()}
+
+    shortages = []
+    names = {}
     for item in cart_items:
-        result = check_stock_available(store_id, item['product_id'], item['quantity'])
-        if not result['available']:
-            unavailable_items.append({
-                'name': item['name'],
-                'requested': item['quantity'],
-                'available': result.get('stock', 0),
-                'message': result['message']
-            })
+        names.setdefault(item['product_id'], item.get('name', ''))
+    for product_id, requested in quantities.items():
+        if product_id not in stock:
+            message = '商品不存在'
+        elif stock[product_id] < requested:
+            message = f'庫存不足 目前庫存: {stock[product_id]}'
+        else:
+            continue
+        shortages.append({
+            'product_id': product_id,
+            'name': names[product_id],
+            'requested': requested,
+            'available': stock.get(product_id, 0),
+            'message': message
+        })
+    return shortages
+
+
+def get_stock_levels(store_id, product_ids):
+    """一次查詢多項商品的分店庫存，回傳 {product_id: stock}（分店未上架的商品不在結果中）"""
+    product_ids = list(set(product_ids))
+    if not product_ids:
+        return {}
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        placeholders = ','.join('?' * len(product_ids))
+        cursor.execute(f'''SELECT product_id, COALESCE(stock, 0) AS stock FROM store_products
+            WHERE store_id = ? AND product_id IN ({placeholders})''', [store_id] + product_ids)
+        levels = {row['product_id']: row['stock'] for row in cursor.fetchall()}
+    finally:
+        conn.close()
+    return levels
+
+
+def check_cart_stock(store_id, cart_items):
+    """檢查購物車所有商品庫存（整車一次查詢）"""
+    conn = get_connection()
+    try:
+        unavailable_items = _cart_shortages(conn.cursor(), store_id, cart_items)
+    finally:
+        conn.close()
     
     if unavailable_items:
         return {'all_available': False, 'items': unavailable_items}
@@ -1200,69 +3741,108 @@ def check_cart_stock(store_id, cart_items):
     return {'all_available': True}
 
 
+class StockShortage(Exception):
+    """結帳預留庫存不足（交易內拋出以回滾，items 為不足清單）"""
+
+    def __init__(self, items):
+        super().__init__('庫存不足')
+        self.items = items
+
+
+def _reserve_stock(cursor, store_id, cart_items):
+    """在結帳交易內以條件式 UPDATE 扣庫存（stock >= 需求量才扣），一個陳述式處理整車
+
+    回傳 ({product_id: 扣除後庫存}, 不足清單)；任何一項不足時呼叫端須回滾交易。
+    """
+    quantities = _cart_quantities(cart_items)
+    if not quantities:
+        return {}, []
+    cursor.execute('''UPDATE store_products
+        SET stock = stock - q.quantity, updated_at = CURRENT_TIMESTAMP
+        FROM (SELECT json_extract(value, '$[0]') AS product_id, json_extract(value, '$[1]') AS quantity
+              FROM json_each(?)) q
+        WHERE store_products.store_id = ? AND store_products.product_id = q.product_id
+        AND store_products.stock >= q.quantity
+        RETURNING store_products.product_id, store_products.stock''', (json.dumps(list(quantities.items())), store_id))
+    reserved = {row[0]: row[1] for row in cursor.fetchall()}
+    if len(reserved) == len(quantities):
+        return reserved, []
+    # 已扣成功的項目庫存已變動，只回報未扣到的項目
+    return reserved, [s for s in _cart_shortages(cursor, store_id, cart_items) if s['product_id'] not in reserved]
+
+
 # ===== 節慶促銷模板 =====
 
 def get_holiday_templates():
     """取得節慶促銷模板"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM holiday_promotions WHERE is_active = 1 ORDER BY name")
-    templates = cursor.fetchall()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM holiday_promotions WHERE is_active = 1 ORDER BY name")
+        templates = cursor.fetchall()
+    finally:
+        conn.close()
     return templates
 
 
 def add_holiday_template(name, promo_type, value, min_amount=0):
     """新增節慶促銷模板"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO holiday_promotions (name, type, value, min_amount)
-        VALUES (?, ?, ?, ?)''', (name, promo_type, value, min_amount))
-    conn.commit()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO holiday_promotions (name, type, value, min_amount)
+            VALUES (?, ?, ?, ?)''', (name, promo_type, value, min_amount))
+        conn.commit()
+    finally:
+        conn.close()
 
 
 def apply_holiday_template(template_id, start_date=None, end_date=None):
     """套用節慶模板建立促銷"""
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
     
-    cursor.execute("SELECT * FROM holiday_promotions WHERE id = ?", (template_id,))
-    template = cursor.fetchone()
+        cursor.execute("SELECT * FROM holiday_promotions WHERE id = ?", (template_id,))
+        template = cursor.fetchone()
     
-    if template:
-        add_promotion(
-            name=template['name'],
-            promo_type=template['type'],
-            value=template['value'],
-            min_amount=template['min_amount'],
-            start_date=start_date,
-            end_date=end_date
-        )
+        if template:
+            add_promotion(
+                name=template['name'],
+                promo_type=template['type'],
+                value=template['value'],
+                min_amount=template['min_amount'],
+                start_date=start_date,
+                end_date=end_date
+            )
     
-    conn.close()
+    finally:
+        conn.close()
 
 
 # ===== 電子發票預留 =====
 
 def generate_invoice_number(store_id):
-    """產生發票號碼（格式：AB+店家代碼+年份月份+流水號）"""
-    import random
+    """產生發票號碼（格式：AB+店家代碼+年份月份+流水號）
+
+    流水號以 UPSERT ... RETURNING 在目前交易內遞增，交易回滾時一併回滾，不會重號也不會跳號
+    """
     store = get_store_by_id(store_id)
     code = store['code'] if store else '00'
     today = datetime.now().strftime('%Y%m')
-    serial = random.randint(1000, 9999)
-    return f"AB{code}{today}{serial}"
+    with transaction() as conn:
+        serial = conn.execute('''INSERT INTO invoice_sequences (store_id, period, last_serial)
+            VALUES (?, ?, 1)
+            ON CONFLICT (store_id, period) DO UPDATE SET last_serial = last_serial + 1
+            RETURNING last_serial''', (store_id, today)).fetchone()[0]
+    return f"AB{code}{today}{serial:04d}"
 
 
 # ===== 電子發票完整功能 =====
 
-def create_invoice(store_id, sale_id, member_id, total_amount, items, 
-                  member_phone="", member_email="", carrier_type="", carrier_number=""):
-    """開立電子發票"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
+def _issue_invoice(cursor, store_id, sale_id, member_id, total_amount, items,
+                   member_phone="", member_email="", carrier_type="", carrier_number=""):
+    """在目前交易內建立發票主檔與明細，回傳 (invoice_id, invoice_number)"""
     today = datetime.now().strftime('%Y-%m-%d')
     now_time = datetime.now().strftime('%H:%M:%S')
     
@@ -1286,111 +3866,144 @@ def create_invoice(store_id, sale_id, member_id, total_amount, items,
     invoice_id = cursor.lastrowid
     
     # 建立發票明細
-    sequence = 1
-    for item in items:
-        item_amount = item['subtotal']
-        item_tax = round(item_amount * tax_rate / (1 + tax_rate), 0)
-        item_free = item_amount - item_tax
-        
-        cursor.execute('''INSERT INTO invoice_items 
-            (invoice_id, product_id, product_name, quantity, unit_price, amount, tax_type, sequence_number)
-            VALUES (?, ?, ?, ?, ?, ?, 'taxed', ?)''',
-            (invoice_id, item['product_id'], item['name'], item['quantity'], 
-             item['price'], item_amount, sequence))
-        sequence += 1
-    
-    conn.commit()
-    conn.close()
+    cursor.executemany('''INSERT INTO invoice_items 
+        (invoice_id, product_id, product_name, quantity, unit_price, amount, tax_type, sequence_number)
+        VALUES (?, ?, ?, ?, ?, ?, 'taxed', ?)''',
+        [(invoice_id, item['product_id'], item['name'], item['quantity'],
+          item['price'], item['subtotal'], sequence) for sequence, item in enumerate(items, 1)])
     
     return invoice_id, invoice_number
 
 
-def get_invoices(store_id=None, status=None, limit=100):
-    """取得發票列表"""
+@retry_on_busy
+def create_invoice(store_id, sale_id, member_id, total_amount, items, 
+                  member_phone="", member_email="", carrier_type="", carrier_number=""):
+    """開立電子發票"""
+    with transaction() as conn:
+        return _issue_invoice(conn.cursor(), store_id, sale_id, member_id, total_amount, items,
+                              member_phone, member_email, carrier_type, carrier_number)
+
+
+def get_invoices(store_id=None, status=None, limit=100, before=None):
+    """取得發票列表（由新到舊）；before 為上一頁最後一筆的 page_cursor()"""
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
     
-    query = "SELECT i.*, s.name as store_name FROM invoices i JOIN stores s ON i.store_id = s.id WHERE 1=1"
-    params = []
+        query = "SELECT i.*, s.name as store_name FROM invoices i JOIN stores s ON i.store_id = s.id WHERE 1=1"
+        params = []
     
-    if store_id:
-        query += " AND i.store_id = ?"
-        params.append(store_id)
+        if store_id:
+            query += " AND i.store_id = ?"
+            params.append(store_id)
     
-    if status:
-        query += " AND i.invoice_status = ?"
-        params.append(status)
+        if status:
+            query += " AND i.invoice_status = ?"
+            params.append(status)
     
-    query += " ORDER BY i.created_at DESC LIMIT ?"
-    params.append(limit)
+        clause, before_params = _before_clause(before, 'i.')
+        query += clause + " ORDER BY i.created_at DESC, i.id DESC LIMIT ?"
+        params += before_params + [limit]
     
-    cursor.execute(query, params)
-    invoices = cursor.fetchall()
-    conn.close()
+        cursor.execute(query, params)
+        invoices = cursor.fetchall()
+    finally:
+        conn.close()
     return invoices
 
 
+def iter_invoices(store_id=None, status=None, batch_size=1000):
+    """逐頁讀取發票"""
+    return _iter_pages(lambda limit, before: get_invoices(store_id, status, limit, before), batch_size)
+
+
+def count_invoices(store_id=None, status=None):
+    """發票張數"""
+    conn = get_connection()
+    try:
+        query = "SELECT COUNT(*) FROM invoices WHERE 1=1"
+        params = []
+        if store_id:
+            query += " AND store_id = ?"
+            params.append(store_id)
+        if status:
+            query += " AND invoice_status = ?"
+            params.append(status)
+        count = conn.execute(query, params).fetchone()[0]
+    finally:
+        conn.close()
+    return count
+
+
 def get_invoice_by_number(invoice_number):
     """依發票號碼查詢"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM invoices WHERE invoice_number = ?", (invoice_number,))
-    invoice = cursor.fetchone()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM invoices WHERE invoice_number = ?", (invoice_number,))
+        invoice = cursor.fetchone()
+    finally:
+        conn.close()
     return invoice
 
 
 def get_invoice_items(invoice_id):
     """取得發票明細"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM invoice_items WHERE invoice_id = ? ORDER BY sequence_number", (invoice_id,))
-    items = cursor.fetchall()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM invoice_items WHERE invoice_id = ? ORDER BY sequence_number", (invoice_id,))
+        items = cursor.fetchall()
+    finally:
+        conn.close()
     return items
 
 
 def void_invoice(invoice_number, void_reason):
     """作廢發票"""
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
     
-    cursor.execute('''UPDATE invoices 
-        SET invoice_status = 'voided', void_reason = ?, void_time = CURRENT_TIMESTAMP
-        WHERE invoice_number = ?''', (void_reason, invoice_number))
+        cursor.execute('''UPDATE invoices 
+            SET invoice_status = 'voided', void_reason = ?, void_time = CURRENT_TIMESTAMP
+            WHERE invoice_number = ?''', (void_reason, invoice_number))
     
-    conn.commit()
-    conn.close()
+        conn.commit()
+    finally:
+        conn.close()
 
 
 def get_invoice_statistics(store_id=None, start_date=None, end_date=None):
     """發票統計"""
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
     
-    query = '''SELECT 
-        COUNT(*) as total_count,
-        SUM(CASE WHEN invoice_status = 'issued' THEN total_amount ELSE 0 END) as issued_amount,
-        SUM(CASE WHEN invoice_status = 'voided' THEN total_amount ELSE 0 END) as voided_amount,
-        SUM(tax_amount) as total_tax
-        FROM invoices WHERE 1=1'''
-    params = []
+        query = '''SELECT 
+            COUNT(*) as total_count,
+            SUM(CASE WHEN invoice_status = 'issued' THEN total_amount ELSE 0 END) as issued_amount,
+            SUM(CASE WHEN invoice_status = 'voided' THEN total_amount ELSE 0 END) as voided_amount,
+            SUM(tax_amount) as total_tax
+            FROM invoices WHERE 1=1'''
+        params = []
     
-    if store_id:
-        query += " AND store_id = ?"
-        params.append(store_id)
+        if store_id:
+            query += " AND store_id = ?"
+            params.append(store_id)
     
-    if start_date:
-        query += " AND invoice_date >= ?"
-        params.append(start_date)
+        if start_date:
+            query += " AND invoice_date >= ?"
+            params.append(start_date)
     
-    if end_date:
-        query += " AND invoice_date <= ?"
-        params.append(end_date)
+        if end_date:
+            query += " AND invoice_date <= ?"
+            params.append(end_date)
     
-    cursor.execute(query, params)
-    result = cursor.fetchone()
-    conn.close()
+        cursor.execute(query, params)
+        result = cursor.fetchone()
+    finally:
+        conn.close()
     
     return {
         'total_count': result[0] or 0,
@@ -1439,170 +4052,506 @@ def print_invoice(invoice_number):
 def add_track_number(track_code1, track_code2, start_number, end_number, issue_date=None):
     """新增字軌號碼（政府配發）"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO einvoice_track_numbers 
-        (track_code1, track_code2, start_number, end_number, current_number, issue_date)
-        VALUES (?, ?, ?, ?, ?, ?)''',
-        (track_code1, track_code2, start_number, end_number, start_number, issue_date))
-    conn.commit()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO einvoice_track_numbers 
+            (track_code1, track_code2, start_number, end_number, current_number, issue_date)
+            VALUES (?, ?, ?, ?, ?, ?)''',
+            (track_code1, track_code2, start_number, end_number, start_number, issue_date))
+        conn.commit()
+    finally:
+        conn.close()
 
 
 def get_available_track():
     """取得可用字軌"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''SELECT * FROM einvoice_track_numbers 
-        WHERE is_active = 1 AND current_number <= end_number
-        ORDER BY issue_date LIMIT 1''')
-    track = cursor.fetchone()
-    track = dict(track) if track else None
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT * FROM einvoice_track_numbers 
+            WHERE is_active = 1 AND current_number <= end_number
+            ORDER BY issue_date LIMIT 1''')
+        track = cursor.fetchone()
+        track = dict(track) if track else None
+    finally:
+        conn.close()
     return track
 
 
 def get_all_tracks():
     """取得所有字軌"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM einvoice_track_numbers ORDER BY id DESC")
-    rows = cursor.fetchall()
-    tracks = [dict(row) for row in rows] if rows else []
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM einvoice_track_numbers ORDER BY id DESC")
+        rows = cursor.fetchall()
+        tracks = [dict(row) for row in rows] if rows else []
+    finally:
+        conn.close()
     return tracks
 
 
-def consume_track_number():
-    """使用一個字軌號碼"""
-    track = get_available_track()
-    if not track:
+# ===== 字軌號碼配號器 =====
+# 每個行程一次預留一段號碼（INVOICE_BLOCK_SIZE 個），之後由記憶體依序配發；
+# 未用完或歸還的號碼在行程結束時寫回 einvoice_number_blocks（status='free'），
+# 下次預留優先取用，因此多台收銀機 / 多行程同時開票也不會重號或跳號。
+INVOICE_BLOCK_SIZE = int(os.environ.get("POS_INVOICE_BLOCK_SIZE", "50"))
+# 其他主機的行程無法確認是否仍存在，改以租約判斷：區段超過 INVOICE_BLOCK_LEASE 秒未續約即視為遺留並回收。
+# 使用中的行程在配號前每過半個租約續約一次（各主機時鐘誤差須小於半個租約）。
+INVOICE_BLOCK_LEASE = int(os.environ.get("POS_INVOICE_BLOCK_LEASE", "86400"))
+
+
+def _process_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner_alive(owner):
+    """預留區段的行程是否仍存在；其他主機的行程無法判斷，回傳 None（由租約決定）"""
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
         return None
-    
-    invoice_number = f"{track['track_code1']}{track['track_code2']}{track['current_number']:08d}"
-    
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''UPDATE einvoice_track_numbers 
-        SET current_number = current_number + 1 WHERE id = ?''', (track['id'],))
-    conn.commit()
-    conn.close()
-    
-    return invoice_number
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _number_ranges(numbers):
+    """把號碼合併成連續區段 [(start, end), ...]"""
+    ranges = []
+    for number in sorted(numbers):
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return [tuple(r) for r in ranges]
+
+
+def _recover_number_blocks(cursor, owner, include_own=True):
+    """回收已結束行程遺留的預留區段：尚未開出發票的號碼改為 free
+
+    同主機依行程是否存在判斷，其他主機的區段在租約到期後回收；
+    include_own 為 False 時不回收 owner 自己的區段（本行程仍在使用）。
+    """
+    stale = cursor.execute('''SELECT b.id, b.track_id, b.start_number, b.end_number, b.owner,
+            t.track_code1 || t.track_code2 AS prefix,
+            b.reserved_at <= datetime('now', ?) AS expired
+        FROM einvoice_number_blocks b JOIN einvoice_track_numbers t ON t.id = b.track_id
+        WHERE b.status = 'reserved' ''', (f'-{INVOICE_BLOCK_LEASE} seconds',)).fetchall()
+    for block in stale:
+        if block['owner'] == owner:
+            if not include_own:
+                continue
+        else:
+            alive = _owner_alive(block['owner'])
+            if alive or (alive is None and not block['expired']):
+                continue
+        prefix = block['prefix']
+        used = {int(row[0][len(prefix):]) for row in cursor.execute(
+            "SELECT invoice_number FROM einvoice_main WHERE invoice_number BETWEEN ? AND ?",
+            (f"{prefix}{block['start_number']:08d}", f"{prefix}{block['end_number']:08d}"))}
+        unused = [n for n in range(block['start_number'], block['end_number'] + 1) if n not in used]
+        cursor.executemany('''INSERT INTO einvoice_number_blocks (track_id, start_number, end_number, status)
+            VALUES (?, ?, ?, 'free')''', [(block['track_id'], s, e) for s, e in _number_ranges(unused)])
+        cursor.execute("DELETE FROM einvoice_number_blocks WHERE id = ?", (block['id'],))
+
+
+def _claim_free_block(cursor, size):
+    """從歸還的號碼區段取最多 size 個"""
+    row = cursor.execute('''SELECT b.id, b.track_id, b.start_number, b.end_number,
+            t.track_code1 || t.track_code2 AS prefix
+        FROM einvoice_number_blocks b JOIN einvoice_track_numbers t ON t.id = b.track_id
+        WHERE b.status = 'free' ORDER BY b.track_id, b.start_number LIMIT 1''').fetchone()
+    if not row:
+        return None
+    end = min(row['end_number'], row['start_number'] + size - 1)
+    if end == row['end_number']:
+        cursor.execute("DELETE FROM einvoice_number_blocks WHERE id = ?", (row['id'],))
+    else:
+        cursor.execute("UPDATE einvoice_number_blocks SET start_number = ? WHERE id = ?", (end + 1, row['id']))
+    return {'track_id': row['track_id'], 'prefix': row['prefix'], 'next': row['start_number'], 'end': end}
+
+
+def _claim_track_block(cursor, size):
+    """從字軌推進 current_number 取最多 size 個（以 current_number 比對，確保沒有被其他人搶先）"""
+    while True:
+        track = cursor.execute('''SELECT id, track_code1 || track_code2 AS prefix, current_number
+            FROM einvoice_track_numbers
+            WHERE is_active = 1 AND current_number <= end_number
+            ORDER BY issue_date, id LIMIT 1''').fetchone()
+        if not track:
+            return None
+        row = cursor.execute('''UPDATE einvoice_track_numbers
+            SET current_number = MIN(current_number + ?, end_number + 1),
+                used_date = COALESCE(used_date, date('now', 'localtime'))
+            WHERE id = ? AND current_number = ?
+            RETURNING current_number''', (size, track['id'], track['current_number'])).fetchone()
+        if row:
+            return {'track_id': track['id'], 'prefix': track['prefix'],
+                    'next': track['current_number'], 'end': row['current_number'] - 1}
+
+
+class InvoiceNumberAllocator:
+    """字軌號碼配號器（執行緒安全，每個資料庫一個）"""
+
+    def __init__(self, pool, block_size=None):
+        self.pool = pool
+        self.block_size = block_size or INVOICE_BLOCK_SIZE
+        self.owner = _process_owner()
+        self._lock = threading.Lock()
+        self._block = None        # 目前預留中的區段
+        self._returned = []       # 歸還的號碼 (track_id, prefix, number)，優先配發
+        self._lost = []           # 租約過期被回收的區段 (track_id, start, end)，其中的號碼不再配發
+        self._renewed = 0.0       # 目前區段上次續約的時間（time.monotonic()）
+        self._recovered = False
+        self.issued = 0
+        self.reservations = 0
+
+    def _write(self, apply):
+        """以獨立連線執行 BEGIN IMMEDIATE 交易，不受呼叫端（可能尚未提交的）交易影響"""
+        conn = self.pool._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            result = apply(conn.cursor())
+            conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _reserve(self):
+        def apply(cursor):
+            # 首次預留時一併回收本行程先前遺留的區段，之後只回收其他行程的
+            _recover_number_blocks(cursor, self.owner, include_own=not self._recovered)
+            if self._block:
+                # 上一段已全部開出
+                cursor.execute("DELETE FROM einvoice_number_blocks WHERE id = ? AND owner = ?",
+                               (self._block['id'], self.owner))
+            block = _claim_free_block(cursor, self.block_size) or _claim_track_block(cursor, self.block_size)
+            if block:
+                cursor.execute('''INSERT INTO einvoice_number_blocks
+                    (track_id, start_number, end_number, status, owner, reserved_at)
+                    VALUES (?, ?, ?, 'reserved', ?, CURRENT_TIMESTAMP)''',
+                    (block['track_id'], block['next'], block['end'], self.owner))
+                block['id'] = cursor.lastrowid
+                block['start'] = block['next']
+            return block
+
+        block = self._write(apply)
+        self._recovered = True
+        self._block = block
+        self._renewed = time.monotonic()
+        self.reservations += 1
+        return block
+
+    def _lease_due(self):
+        """目前區段是否已過半個租約、配號前須續約（須持有 self._lock）"""
+        return self._block is not None and time.monotonic() - self._renewed > INVOICE_BLOCK_LEASE / 2
+
+    def _renew(self, cursor):
+        """續約目前區段（須持有 self._lock），回傳是否仍持有
+
+        區段已因租約過期被其他行程回收時捨棄該區段，其範圍內的號碼（含歸還的）不再配發。
+        """
+        block = self._block
+        renewed = cursor.execute('''UPDATE einvoice_number_blocks SET reserved_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND owner = ? AND status = 'reserved' ''', (block['id'], self.owner)).rowcount
+        if not renewed:
+            self._lost.append((block['track_id'], block['start'], block['end']))
+            self._returned = [r for r in self._returned if not self._is_lost(r[0], r[2])]
+            self._block = None
+        return bool(renewed)
+
+    def _is_lost(self, track_id, number):
+        return any(t == track_id and start <= number <= end for t, start, end in self._lost)
+
+    def _take(self):
+        """自記憶體取號（須持有 self._lock），沒有號碼時回傳 None"""
+        if self._returned:
+            _, prefix, number = self._returned.pop(0)
+        elif self._block and self._block['next'] <= self._block['end']:
+            prefix, number = self._block['prefix'], self._block['next']
+            self._block['next'] += 1
+        else:
+            return None
+        self.issued += 1
+        return f"{prefix}{number:08d}"
+
+    def prefetch(self):
+        """記憶體中沒有號碼時先預留一段（在交易外呼叫，交易內的 next() 就不必自字軌取號）"""
+        with self._lock:
+            if self._lease_due() and self._write(self._renew):
+                self._renewed = time.monotonic()
+            if not self._returned and (not self._block or self._block['next'] > self._block['end']):
+                self._reserve()
+
+    def next(self, cursor=None):
+        """配發下一個發票號碼，字軌用完時回傳 None
+
+        cursor 為呼叫端進行中的交易：自記憶體配發的號碼在該交易回滾時自動歸還；
+        記憶體中沒有號碼時直接在該交易內取號，不另開連線預留區段（以免等待自己持有的寫入鎖）。
+        """
+        if cursor is None:
+            with self._lock:
+                if self._lease_due() and self._write(self._renew):
+                    self._renewed = time.monotonic()
+                invoice_number = self._take()
+                if invoice_number is None and self._reserve():
+                    invoice_number = self._take()
+                return invoice_number
+
+        # 其他執行緒可能正持有鎖預留區段、等待本交易的寫入鎖，不可等待
+        invoice_number = None
+        if self._lock.acquire(blocking=False):
+            try:
+                if self._lease_due() and self._renew(cursor):
+                    # 續約隨呼叫端交易提交，回滾時維持原本的續約時間
+                    renewed, self._renewed = self._renewed, time.monotonic()
+                    self.pool.on_rollback(lambda: setattr(self, '_renewed', renewed))
+                invoice_number = self._take()
+            finally:
+                self._lock.release()
+        if invoice_number is None:
+            # 與呼叫端同一交易取號，回滾時號碼一併還原，不需歸還
+            block = _claim_free_block(cursor, 1) or _claim_track_block(cursor, 1)
+            return f"{block['prefix']}{block['next']:08d}" if block else None
+        self.pool.on_rollback(lambda: self.give_back(invoice_number))
+        return invoice_number
+
+    def give_back(self, invoice_number):
+        """歸還未開立成功的號碼，下次優先配發"""
+        with self._lock:
+            block = self._block
+            prefix, number = invoice_number[:-8], int(invoice_number[-8:])
+            self.issued -= 1
+            track_id = block['track_id'] if block and block['prefix'] == prefix else self._track_id(prefix)
+            if self._is_lost(track_id, number):
+                # 所屬區段已被回收，號碼可能已由其他行程配發
+                return
+            if block and block['prefix'] == prefix and block['next'] == number + 1:
+                block['next'] = number
+            else:
+                self._returned.append((track_id, prefix, number))
+                self._returned.sort()
+
+    def _track_id(self, prefix):
+        conn = self.pool.acquire()
+        try:
+            row = conn.execute("SELECT id FROM einvoice_track_numbers WHERE track_code1 || track_code2 = ?",
+                               (prefix,)).fetchone()
+        finally:
+            self.pool.release(conn)
+        return row[0]
+
+    def release(self):
+        """把未使用的號碼寫回資料庫（status='free'）"""
+        with self._lock:
+            block, returned = self._block, self._returned
+            if not block and not returned:
+                return
+            free = [(track_id, number) for track_id, _, number in returned]
+
+            def apply(cursor):
+                if block:
+                    held = cursor.execute("DELETE FROM einvoice_number_blocks WHERE id = ? AND owner = ?",
+                                          (block['id'], self.owner)).rowcount
+                    if held:
+                        free.extend((block['track_id'], n) for n in range(block['next'], block['end'] + 1))
+                    else:
+                        # 租約過期已被其他行程回收：區段內的號碼不重複寫回
+                        free[:] = [(t, n) for t, n in free
+                                   if not (t == block['track_id'] and block['start'] <= n <= block['end'])]
+                for track_id in {t for t, _ in free}:
+                    ranges = _number_ranges(n for t, n in free if t == track_id)
+                    cursor.executemany('''INSERT INTO einvoice_number_blocks (track_id, start_number, end_number, status)
+                        VALUES (?, ?, ?, 'free')''', [(track_id, s, e) for s, e in ranges])
+
+            self._write(apply)
+            self._block, self._returned = None, []
+
+    def stats(self):
+        with self._lock:
+            block = self._block
+            return {
+                'issued': self.issued,
+                'reservations': self.reservations,
+                'in_memory': len(self._returned) + (block['end'] - block['next'] + 1 if block else 0),
+            }
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def get_invoice_allocator():
+    """取得目前資料庫的字軌號碼配號器"""
+    with _allocators_lock:
+        allocator = _allocators.get(DB_PATH)
+        if allocator is None:
+            allocator = _allocators[DB_PATH] = InvoiceNumberAllocator(get_pool())
+        return allocator
+
+
+def release_invoice_numbers():
+    """歸還所有配號器中未使用的號碼（行程結束時自動執行）"""
+    with _allocators_lock:
+        allocators = list(_allocators.values())
+    for allocator in allocators:
+        if not os.path.exists(allocator.pool.db_path):
+            continue
+        try:
+            allocator.release()
+        except sqlite3.Error:
+            # 寫回失敗時區段仍為 reserved，下個行程預留時會回收
+            pass
+
+
+def _reset_allocators_after_fork():
+    # 子行程不可沿用父行程記憶體中的號碼
+    global _allocators_lock
+    _allocators.clear()
+    _allocators_lock = threading.Lock()
+
+
+atexit.register(release_invoice_numbers)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_allocators_after_fork)
+
+
+@retry_on_busy
+def consume_track_number():
+    """使用一個字軌號碼（由配號器自預留區段配發）
+
+    在呼叫端交易內使用時號碼隨該交易取得，交易回滾即歸還。
+    """
+    allocator = get_invoice_allocator()
+    if not get_pool().holds_connection():
+        return allocator.next()
+    with transaction() as conn:
+        return allocator.next(conn.cursor())
 
 
+@retry_on_busy
 def create_einvoice(store, buyer_info, items, tax_type='1', carrier_type='', carrier_id1='', carrier_id2='', 
                    invoice_type='07', donate_mark='0', remark='', group_mark=''):
-    """建立符合MIG 4.1 F0401的電子發票（三表結構）"""
-    import random
-    
-    conn = get_connection()
-    cursor = conn.cursor()
-    
+    """建立符合MIG 4.1 F0401的電子發票（三表結構）
+
+    可在呼叫端交易內使用（併入該交易）；交易回滾（含 retry_on_busy 重試）時號碼自動歸還。
+    """
     today_ymd = datetime.now().strftime('%Y%m%d')
     now_time = datetime.now().strftime('%H:%M:%S')
     
-    # 取得發票號碼
-    invoice_number = consume_track_number()
-    if not invoice_number:
-        return None, "無可用字軌號碼"
-    
-    # 隨機碼（4位數）
-    random_number = f"{random.randint(0, 9999):04d}"
+    allocator = get_invoice_allocator()
+    if not get_pool().holds_connection():
+        # 在交易外預留號碼區段，交易內只從記憶體配號
+        allocator.prefetch()
     
-    # 計算金額
-    total_amount = sum(item['amount'] for item in items)
-    tax_rate = 0.05
-    tax_amount = round(total_amount * tax_rate)
-    sales_amount = total_amount - tax_amount
-    free_amount = 0
-    zero_rate_amount = 0
-    discount_amount = 0
-    
-    if tax_type == '3':  # 免稅
-        free_amount = total_amount
-        sales_amount = 0
-        tax_amount = 0
-    elif tax_type == '2':  # 零稅率
-        zero_rate_amount = total_amount
-        sales_amount = 0
-        tax_amount = 0
-    
-    # 賣方資訊
-    seller_identifier = store.get('code') or '00000000'
-    seller_name = store.get('name', '')
-    seller_address = store.get('address', '')
-    seller_person = store.get('contact_person', '')
-    seller_phone = store.get('phone', '')
-    seller_email = store.get('email', '')
-    seller_fax = store.get('fax', '')
-    seller_bank_code = store.get('bank_code', '')
-    seller_bank_account = store.get('bank_account', '')
-    
-    # 買方資訊
-    buyer_identifier = buyer_info.get('identifier', '0000000000')
-    buyer_name = buyer_info.get('name', '消費者')
-    buyer_person = buyer_info.get('person', '')
-    buyer_phone = buyer_info.get('phone', '')
-    buyer_email = buyer_info.get('email', '')
-    buyer_address = buyer_info.get('address', '')
-    buyer_fax = buyer_info.get('fax', '')
-    
-    # ===== 1. 建立發票主檔 (einvoice_main) =====
-    cursor.execute('''INSERT INTO einvoice_main 
-        (invoice_number, invoice_date, invoice_time, invoice_type, random_number, group_mark, donate_mark, print_mark,
-         seller_identifier, seller_name, seller_address, seller_person, seller_phone, seller_email, seller_fax_number,
-         seller_bank_code, seller_bank_account,
-         buyer_identifier, buyer_name, buyer_person, buyer_phone, buyer_email, buyer_address, buyer_fax_number,
-         carrier_type, carrier_id1, carrier_id2, remark)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-        (invoice_number, today_ymd, now_time, invoice_type, random_number, group_mark, donate_mark, 'N',
-         seller_identifier, seller_name, seller_address, seller_person, seller_phone, seller_email, seller_fax,
-         seller_bank_code, seller_bank_account,
-         buyer_identifier, buyer_name, buyer_person, buyer_phone, buyer_email, buyer_address, buyer_fax,
-         carrier_type, carrier_id1, carrier_id2, remark))
-    
-    main_id = cursor.lastrowid
-    
-    # ===== 2. 建立發票明細 (einvoice_details) =====
-    seq = 1
-    for item in items:
-        item_amount = item.get('amount', 0)
-        item_tax = round(item_amount * tax_rate)
-        item_sales = item_amount - item_tax
-        item_free = 0
-        item_zero = 0
+    with transaction() as conn:
+        cursor = conn.cursor()
+        # 取得發票號碼（交易回滾時歸還）
+        invoice_number = allocator.next(cursor)
+        if not invoice_number:
+            return None, "無可用字軌號碼"
+        
+        # 隨機碼（4位數）
+        random_number = f"{random.randint(0, 9999):04d}"
+        
+        # 計算金額
+        total_amount = sum(item['amount'] for item in items)
+        tax_rate = 0.05
+        tax_amount = round(total_amount * tax_rate)
+        sales_amount = total_amount - tax_amount
+        free_amount = 0
+        zero_rate_amount = 0
+        discount_amount = 0
+        
+        if tax_type == '3':  # 免稅
+            free_amount = total_amount
+            sales_amount = 0
+            tax_amount = 0
+        elif tax_type == '2':  # 零稅率
+            zero_rate_amount = total_amount
+            sales_amount = 0
+            tax_amount = 0
+        
+        # 賣方資訊
+        seller_identifier = store.get('code') or '00000000'
+        seller_name = store.get('name', '')
+        seller_address = store.get('address', '')
+        seller_person = store.get('contact_person', '')
+        seller_phone = store.get('phone', '')
+        seller_email = store.get('email', '')
+        seller_fax = store.get('fax', '')
+        seller_bank_code = store.get('bank_code', '')
+        seller_bank_account = store.get('bank_account', '')
+        
+        # 買方資訊
+        buyer_identifier = buyer_info.get('identifier', '0000000000')
+        buyer_name = buyer_info.get('name', '消費者')
+        buyer_person = buyer_info.get('person', '')
+        buyer_phone = buyer_info.get('phone', '')
+        buyer_email = buyer_info.get('email', '')
+        buyer_address = buyer_info.get('address', '')
+        buyer_fax = buyer_info.get('fax', '')
         
-        if tax_type == '3':
-            item_free = item_amount
-            item_sales = 0
-            item_tax = 0
-        elif tax_type == '2':
-            item_zero = item_amount
-            item_sales = 0
-            item_tax = 0
+        # ===== 1. 建立發票主檔 (einvoice_main) =====
+        cursor.execute('''INSERT INTO einvoice_main 
+            (invoice_number, invoice_date, invoice_time, invoice_type, random_number, group_mark, donate_mark, print_mark,
+             seller_identifier, seller_name, seller_address, seller_person, seller_phone, seller_email, seller_fax_number,
+             seller_bank_code, seller_bank_account,
+             buyer_identifier, buyer_name, buyer_person, buyer_phone, buyer_email, buyer_address, buyer_fax_number,
+             carrier_type, carrier_id1, carrier_id2, remark)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (invoice_number, today_ymd, now_time, invoice_type, random_number, group_mark, donate_mark, 'N',
+             seller_identifier, seller_name, seller_address, seller_person, seller_phone, seller_email, seller_fax,
+             seller_bank_code, seller_bank_account,
+             buyer_identifier, buyer_name, buyer_person, buyer_phone, buyer_email, buyer_address, buyer_fax,
+             carrier_type, carrier_id1, carrier_id2, remark))
         
-        cursor.execute('''INSERT INTO einvoice_details 
-            (invoice_id, sequence_number, product_id, product_name, product_specification,
-             quantity, unit, unit_price, amount,
-             tax_type, tax_rate, sales_amount, tax_amount, free_amount, zero_rate_amount,
-             barcode, relate_number)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            (main_id, seq, item.get('product_id'), item.get('name', ''), item.get('spec', ''),
-             item.get('quantity', 1), item.get('unit', '件'), item.get('unit_price', 0), item_amount,
-             tax_type, tax_rate, item_sales, item_tax, item_free, item_zero,
-             item.get('barcode', ''), item.get('relate_number', '')))
-        seq += 1
-    
-    # ===== 3. 建立發票金額匯總 (einvoice_amount) =====
-    cursor.execute('''INSERT INTO einvoice_amount 
-        (invoice_id, sales_amount, tax_type, tax_rate, tax_amount, total_amount, discount_amount,
-         free_tax_sales_amount, zero_tax_sales_amount, remark)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-        (main_id, sales_amount, tax_type, tax_rate, tax_amount, total_amount, discount_amount,
-         free_amount, zero_rate_amount, remark))
-    
-    conn.commit()
-    conn.close()
+        main_id = cursor.lastrowid
+        
+        # ===== 2. 建立發票明細 (einvoice_details) =====
+        seq = 1
+        for item in items:
+            item_amount = item.get('amount', 0)
+            item_tax = round(item_amount * tax_rate)
+            item_sales = item_amount - item_tax
+            item_free = 0
+            item_zero = 0
+        
+            if tax_type == '3':
+                item_free = item_amount
+                item_sales = 0
+                item_tax = 0
+            elif tax_type == '2':
+                item_zero = item_amount
+                item_sales = 0
+                item_tax = 0
+        
+            cursor.execute('''INSERT INTO einvoice_details 
+                (invoice_id, sequence_number, product_id, product_name, product_specification,
+                 quantity, unit, unit_price, amount,
+                 tax_type, tax_rate, sales_amount, tax_amount, free_amount, zero_rate_amount,
+                 barcode, relate_number)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (main_id, seq, item.get('product_id'), item.get('name', ''), item.get('spec', ''),
+                 item.get('quantity', 1), item.get('unit', '件'), item.get('unit_price', 0), item_amount,
+                 tax_type, tax_rate, item_sales, item_tax, item_free, item_zero,
+                 item.get('barcode', ''), item.get('relate_number', '')))
+            seq += 1
+        
+        # ===== 3. 建立發票金額匯總 (einvoice_amount) =====
+        cursor.execute('''INSERT INTO einvoice_amount 
+            (invoice_id, sales_amount, tax_type, tax_rate, tax_amount, total_amount, discount_amount,
+             free_tax_sales_amount, zero_tax_sales_amount, remark)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (main_id, sales_amount, tax_type, tax_rate, tax_amount, total_amount, discount_amount,
+             free_amount, zero_rate_amount, remark))
     
     return main_id, invoice_number
 
@@ -1610,44 +4559,52 @@ def create_einvoice(store, buyer_info, items, tax_type='1', carrier_type='', car
 def get_einvoice(invoice_number):
     """查詢電子發票主檔"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM einvoice_main WHERE invoice_number = ?", (invoice_number,))
-    invoice = cursor.fetchone()
-    invoice = dict(invoice) if invoice else None
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM einvoice_main WHERE invoice_number = ?", (invoice_number,))
+        invoice = cursor.fetchone()
+        invoice = dict(invoice) if invoice else None
+    finally:
+        conn.close()
     return invoice
 
 
 def get_einvoice_details(invoice_id):
     """查詢電子發票明細"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM einvoice_details WHERE invoice_id = ? ORDER BY sequence_number", (invoice_id,))
-    rows = cursor.fetchall()
-    details = [dict(row) for row in rows] if rows else []
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM einvoice_details WHERE invoice_id = ? ORDER BY sequence_number", (invoice_id,))
+        rows = cursor.fetchall()
+        details = [dict(row) for row in rows] if rows else []
+    finally:
+        conn.close()
     return details
 
 
 def get_einvoice_amount(invoice_id):
     """查詢電子發票金額"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM einvoice_amount WHERE invoice_id = ?", (invoice_id,))
-    amount = cursor.fetchone()
-    amount = dict(amount) if amount else None
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM einvoice_amount WHERE invoice_id = ?", (invoice_id,))
+        amount = cursor.fetchone()
+        amount = dict(amount) if amount else None
+    finally:
+        conn.close()
     return amount
 
 
 def get_einvoice(invoice_number):
     """查詢電子發票"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM einvoice_main WHERE invoice_number = ?", (invoice_number,))
-    invoice = cursor.fetchone()
-    invoice = dict(invoice) if invoice else None
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM einvoice_main WHERE invoice_number = ?", (invoice_number,))
+        invoice = cursor.fetchone()
+        invoice = dict(invoice) if invoice else None
+    finally:
+        conn.close()
     return invoice
 
 
@@ -1659,58 +4616,82 @@ def get_einvoice_items(invoice_id):
 def void_einvoice(invoice_number, void_reason):
     """作廢電子發票"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''UPDATE einvoice_main 
-        SET invoice_status = 'voided', void_reason = ?, void_time = CURRENT_TIMESTAMP
-        WHERE invoice_number = ?''', (void_reason, invoice_number))
-    conn.commit()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''UPDATE einvoice_main 
+            SET invoice_status = 'voided', void_reason = ?, void_time = CURRENT_TIMESTAMP
+            WHERE invoice_number = ?''', (void_reason, invoice_number))
+        conn.commit()
+    finally:
+        conn.close()
 
 
-def get_all_einvoices(limit=100):
-    """取得所有電子發票"""
+def get_all_einvoices(limit=100, before=None):
+    """取得所有電子發票（由新到舊）；before 為上一頁最後一筆的 id"""
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM einvoice_main ORDER BY id DESC LIMIT ?", (limit,))
-    rows = cursor.fetchall()
-    einvoices = [dict(row) for row in rows] if rows else []
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        if before is None:
+            cursor.execute("SELECT * FROM einvoice_main ORDER BY id DESC LIMIT ?", (limit,))
+        else:
+            cursor.execute("SELECT * FROM einvoice_main WHERE id < ? ORDER BY id DESC LIMIT ?", (before, limit))
+        rows = cursor.fetchall()
+        einvoices = [dict(row) for row in rows] if rows else []
+    finally:
+        conn.close()
     return einvoices
 
 
+def iter_einvoices(batch_size=1000):
+    """逐頁讀取電子發票"""
+    return _iter_pages(get_all_einvoices, batch_size, cursor=lambda row: row['id'])
+
+
+def count_einvoices():
+    """電子發票張數"""
+    conn = get_connection()
+    try:
+        count = conn.execute("SELECT COUNT(*) FROM einvoice_main").fetchone()[0]
+    finally:
+        conn.close()
+    return count
+
+
 def get_einvoice_statistics(store_id=None, start_date=None, end_date=None):
     """電子發票統計（MIG 4.1 F0401三表結構）"""
     conn = get_connection()
-    cursor = conn.cursor()
-    
-    query = '''SELECT 
-        COUNT(*) as total_count,
-        SUM(CASE WHEN m.invoice_status = 'issued' THEN a.total_amount ELSE 0 END) as issued_amount,
-        SUM(CASE WHEN m.invoice_status = 'voided' THEN a.total_amount ELSE 0 END) as voided_amount,
-        SUM(a.sales_amount) as total_sales,
-        SUM(a.tax_amount) as total_tax,
-        SUM(a.free_tax_sales_amount) as total_free,
-        SUM(a.zero_tax_sales_amount) as total_zero
-        FROM einvoice_main m
-        JOIN einvoice_amount a ON m.id = a.invoice_id
-        WHERE 1=1'''
-    params = []
+    try:
+        cursor = conn.cursor()
     
-    if store_id:
-        query += " AND m.seller_identifier = ?"
-        params.append(store_id)
+        query = '''SELECT 
+            COUNT(*) as total_count,
+            SUM(CASE WHEN m.invoice_status = 'issued' THEN a.total_amount ELSE 0 END) as issued_amount,
+            SUM(CASE WHEN m.invoice_status = 'voided' THEN a.total_amount ELSE 0 END) as voided_amount,
+            SUM(a.sales_amount) as total_sales,
+            SUM(a.tax_amount) as total_tax,
+            SUM(a.free_tax_sales_amount) as total_free,
+            SUM(a.zero_tax_sales_amount) as total_zero
+            FROM einvoice_main m
+            JOIN einvoice_amount a ON m.id = a.invoice_id
+            WHERE 1=1'''
+        params = []
     
-    if start_date:
-        query += " AND m.invoice_date >= ?"
-        params.append(start_date.replace('-', ''))
+        if store_id:
+            query += " AND m.seller_identifier = ?"
+            params.append(store_id)
     
-    if end_date:
-        query += " AND m.invoice_date <= ?"
-        params.append(end_date.replace('-', ''))
+        if start_date:
+            query += " AND m.invoice_date >= ?"
+            params.append(start_date.replace('-', ''))
     
-    cursor.execute(query, params)
-    result = cursor.fetchone()
-    conn.close()
+        if end_date:
+            query += " AND m.invoice_date <= ?"
+            params.append(end_date.replace('-', ''))
+    
+        cursor.execute(query, params)
+        result = cursor.fetchone()
+    finally:
+        conn.close()
     
     return {
         'total_count': result[0] or 0,
@@ -1723,103 +4704,213 @@ def get_einvoice_statistics(store_id=None, start_date=None, end_date=None):
     }
 
 
-def generate_mig_xml(invoice_number):
-    """產生MIG 4.1 F0401 XML格式（三表結構）"""
-    invoice = get_einvoice(invoice_number)
-    if not invoice:
-        return None
-    
-    # 轉換 Row 為 dict
-    invoice = dict(invoice)
-    details = [dict(d) for d in get_einvoice_details(invoice['id'])]
-    amount = dict(get_einvoice_amount(invoice['id'])) if get_einvoice_amount(invoice['id']) else None
-    
-    # 產生F0401 XML
-    xml = f'''<?xml version="1.0" encoding="utf-8"?>
+# ===== MIG 4.1 F0401 XML =====
+# 欄位表在載入時編譯成格式字串與 SQL：一次查詢取回主檔、金額與明細，逐行寫出，
+# 文字欄位做 XML 跳脫，NULL 以預設值輸出。
+# (標籤, 欄位, 預設值, 型態)；型態：text 一般文字、number 數值、cdata 以 CDATA 包住、seq 三位數序號
+F0401_MAIN_FIELDS = [
+    ('InvoiceNumber', 'invoice_number', '', 'text'),
+    ('InvoiceDate', 'invoice_date', '', 'text'),
+    ('InvoiceTime', 'invoice_time', '', 'text'),
+    ('InvoiceType', 'invoice_type', '07', 'text'),
+    ('RandomNumber', 'random_number', '', 'text'),
+    ('GroupMark', 'group_mark', '', 'text'),
+    ('DonateMark', 'donate_mark', '0', 'text'),
+    ('Seller', [
+        ('Identifier', 'seller_identifier', '', 'text'),
+        ('Name', 'seller_name', '', 'cdata'),
+        ('Address', 'seller_address', '', 'text'),
+        ('PersonInCharge', 'seller_person_in_charge', '', 'text'),
+        ('TelephoneNumber', 'seller_phone', '', 'text'),
+        ('FacsimileNumber', 'seller_fax_number', '', 'text'),
+        ('EmailAddress', 'seller_email', '', 'text'),
+        ('CustomerNumber', 'seller_customer_number', '', 'text'),
+        ('RoleRemark', 'seller_role_remark', '', 'text'),
+        ('BankCode', 'seller_bank_code', '', 'text'),
+        ('BankAccount', 'seller_bank_account', '', 'text'),
+    ]),
+    ('Buyer', [
+        ('Identifier', 'buyer_identifier', '', 'text'),
+        ('Name', 'buyer_name', '', 'cdata'),
+        ('Address', 'buyer_address', '', 'text'),
+        ('PersonInCharge', 'buyer_person_in_charge', '', 'text'),
+        ('TelephoneNumber', 'buyer_phone', '', 'text'),
+        ('FacsimileNumber', 'buyer_fax_number', '', 'text'),
+        ('EmailAddress', 'buyer_email', '', 'text'),
+        ('CustomerNumber', 'buyer_customer_number', '', 'text'),
+        ('RoleRemark', 'buyer_role_remark', '', 'text'),
+    ]),
+    ('BuyerRemark', 'buyer_remark', '', 'text'),
+    ('MainRemark', 'main_remark', '', 'text'),
+    ('CustomsClearanceMark', 'customs_clearance_method', '', 'text'),
+    ('Category', 'category', '', 'text'),
+    ('RelateNumber', 'relate_number', '', 'text'),
+    ('CarrierType', 'carrier_type', '', 'text'),
+    ('CarrierId1', 'carrier_id1', '', 'text'),
+    ('CarrierId2', 'carrier_id2', '', 'text'),
+    ('PrintMark', 'print_mark', 'N', 'text'),
+    ('NPOBAN', 'npoaban', '', 'text'),
+    ('BondedAreaConfirm', 'bonded_area_confirm', '', 'text'),
+    ('ZeroTaxRateReason', 'zero_tax_rate_reason', '', 'text'),
+]
+
+F0401_DETAIL_FIELDS = [
+    ('SequenceNumber', 'sequence_number', 0, 'seq'),
+    ('Description', 'product_name', '', 'cdata'),
+    ('Quantity', 'quantity', '', 'number'),
+    ('Unit', 'unit', '件', 'text'),
+    ('UnitPrice', 'unit_price', '', 'number'),
+    ('TaxType', 'tax_type', '', 'text'),
+    ('Amount', 'amount', '', 'number'),
+    ('Remark', 'remark', '', 'text'),
+    ('RelateNumber', 'relate_number', '', 'text'),
+]
+
+F0401_AMOUNT_FIELDS = [
+    ('SalesAmount', 'sales_amount', '', 'number'),
+    ('FreeTaxSalesAmount', 'free_tax_sales_amount', 0, 'number'),
+    ('ZeroTaxSalesAmount', 'zero_tax_sales_amount', 0, 'number'),
+    ('TaxAmount', 'tax_amount', '', 'number'),
+    ('TaxType', 'tax_type', '', 'text'),
+    ('TaxRate', 'tax_rate', '', 'number'),
+    ('TotalAmount', 'total_amount', '', 'number'),
+    ('DiscountAmount', 'discount_amount', 0, 'number'),
+    ('OriginalCurrencyAmount', 'original_currency_amount', '', 'number'),
+    ('ExchangeRate', 'exchange_rate', '', 'number'),
+    ('Currency', 'currency', '', 'text'),
+]
+
+F0401_HEADER = '''<?xml version="1.0" encoding="utf-8"?>
 <Invoice xsi:schemaLocation="urn:GEINV:eInvoiceMessage:F0401:4.1 F0401.xsd" xmlns="urn:GEINV:eInvoiceMessage:F0401:4.1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
-  <Main>
-    <InvoiceNumber>{invoice['invoice_number']}</InvoiceNumber>
-    <InvoiceDate>{invoice['invoice_date']}</InvoiceDate>
-    <InvoiceTime>{invoice['invoice_time']}</InvoiceTime>
-    <InvoiceType>{invoice.get('invoice_type', '07')}</InvoiceType>
-    <RandomNumber>{invoice.get('random_number', '')}</RandomNumber>
-    <GroupMark>{invoice.get('group_mark', '')}</GroupMark>
-    <DonateMark>{invoice.get('donate_mark', '0')}</DonateMark>
-    <Seller>
-      <Identifier>{invoice['seller_identifier']}</Identifier>
-      <Name><![CDATA[{invoice['seller_name']}]]></Name>
-      <Address>{invoice.get('seller_address', '')}</Address>
-      <PersonInCharge>{invoice.get('seller_person_in_charge', '')}</PersonInCharge>
-      <TelephoneNumber>{invoice.get('seller_phone', '')}</TelephoneNumber>
-      <FacsimileNumber>{invoice.get('seller_fax_number', '')}</FacsimileNumber>
-      <EmailAddress>{invoice.get('seller_email', '')}</EmailAddress>
-      <CustomerNumber>{invoice.get('seller_customer_number', '')}</CustomerNumber>
-      <RoleRemark>{invoice.get('seller_role_remark', '')}</RoleRemark>
-      <BankCode>{invoice.get('seller_bank_code', '')}</BankCode>
-      <BankAccount>{invoice.get('seller_bank_account', '')}</BankAccount>
-    </Seller>
-    <Buyer>
-      <Identifier>{invoice.get('buyer_identifier', '')}</Identifier>
-      <Name><![CDATA[{invoice.get('buyer_name', '')}]]></Name>
-      <Address>{invoice.get('buyer_address', '')}</Address>
-      <PersonInCharge>{invoice.get('buyer_person_in_charge', '')}</PersonInCharge>
-      <TelephoneNumber>{invoice.get('buyer_phone', '')}</TelephoneNumber>
-      <FacsimileNumber>{invoice.get('buyer_fax_number', '')}</FacsimileNumber>
-      <EmailAddress>{invoice.get('buyer_email', '')}</EmailAddress>
-      <CustomerNumber>{invoice.get('buyer_customer_number', '')}</CustomerNumber>
-      <RoleRemark>{invoice.get('buyer_role_remark', '')}</RoleRemark>
-    </Buyer>
-    <BuyerRemark>{invoice.get('buyer_remark', '')}</BuyerRemark>
-    <MainRemark>{invoice.get('main_remark', '')}</MainRemark>
-    <CustomsClearanceMark>{invoice.get('customs_clearance_method', '')}</CustomsClearanceMark>
-    <Category>{invoice.get('category', '')}</Category>
-    <RelateNumber>{invoice.get('relate_number', '')}</RelateNumber>
-    <CarrierType>{invoice.get('carrier_type', '')}</CarrierType>
-    <CarrierId1>{invoice.get('carrier_id1', '')}</CarrierId1>
-    <CarrierId2>{invoice.get('carrier_id2', '')}</CarrierId2>
-    <PrintMark>{invoice.get('print_mark', 'N')}</PrintMark>
-    <NPOBAN>{invoice.get('npoaban', '')}</NPOBAN>
-    <BondedAreaConfirm>{invoice.get('bonded_area_confirm', '')}</BondedAreaConfirm>
-    <ZeroTaxRateReason>{invoice.get('zero_tax_rate_reason', '')}</ZeroTaxRateReason>
-  </Main>
-  <Details>
-'''
-    
-    for item in details:
-        xml += f'''    <ProductItem>
-      <SequenceNumber>{item['sequence_number']:03d}</SequenceNumber>
-      <Description><![CDATA[{item['product_name']}]]></Description>
-      <Quantity>{item['quantity']}</Quantity>
-      <Unit>{item.get('unit', '件')}</Unit>
-      <UnitPrice>{item['unit_price']}</UnitPrice>
-      <TaxType>{item['tax_type']}</TaxType>
-      <Amount>{item['amount']}</Amount>
-      <Remark>{item.get('remark', '')}</Remark>
-      <RelateNumber>{item.get('relate_number', '')}</RelateNumber>
-    </ProductItem>
 '''
-    
-    # Amount (Summary)
-    if amount:
-        xml += f'''  </Details>
-  <Amount>
-    <SalesAmount>{amount['sales_amount']}</SalesAmount>
-    <FreeTaxSalesAmount>{amount.get('free_tax_sales_amount', 0)}</FreeTaxSalesAmount>
-    <ZeroTaxSalesAmount>{amount.get('zero_tax_sales_amount', 0)}</ZeroTaxSalesAmount>
-    <TaxAmount>{amount['tax_amount']}</TaxAmount>
-    <TaxType>{amount['tax_type']}</TaxType>
-    <TaxRate>{amount['tax_rate']}</TaxRate>
-    <TotalAmount>{amount['total_amount']}</TotalAmount>
-    <DiscountAmount>{amount.get('discount_amount', 0)}</DiscountAmount>
-    <OriginalCurrencyAmount>{amount.get('original_currency_amount', '')}</OriginalCurrencyAmount>
-    <ExchangeRate>{amount.get('exchange_rate', '')}</ExchangeRate>
-    <Currency>{amount.get('currency', '')}</Currency>
-  </Amount>
-</Invoice>'''
-    
-    return xml
 
 
+def _xml_text(value, default):
+    if value is None:
+        value = default
+    text = str(value)
+    if '&' in text or '<' in text or '>' in text:
+        return xml_escape(text)
+    return text
+
+
+def _xml_number(value, default):
+    return str(value if value is not None else default)
+
+
+def _xml_cdata(value, default):
+    if value is None:
+        value = default
+    return f"<![CDATA[{str(value).replace(']]>', ']]]]><![CDATA[>')}]]>"
+
+
+def _xml_seq(value, default):
+    return f"{value if value is not None else default:03d}"
+
+
+_XML_CONVERTERS = {'text': _xml_text, 'number': _xml_number, 'cdata': _xml_cdata, 'seq': _xml_seq}
+
+
+def _compile_fields(fields, alias, indent, columns, template, values):
+    """把欄位表編譯進格式字串：columns 收集 SQL 欄位，values 收集 (欄位位置, 轉換函數, 預設值)"""
+    pad = '  ' * indent
+    for tag, column, *spec in fields:
+        if isinstance(column, list):
+            template.append(f"{pad}<{tag}>\n")
+            _compile_fields(column, alias, indent + 1, columns, template, values)
+            template.append(f"{pad}</{tag}>\n")
+            continue
+        default, kind = spec
+        template.append(f"{pad}<{tag}>{{}}</{tag}>\n")
+        values.append((len(columns), _XML_CONVERTERS[kind], default))
+        columns.append(f"{alias}.{column}")
+
+
+def _compile_f0401():
+    main, main_values, main_columns = ['  <Main>\n'], [], []
+    _compile_fields(F0401_MAIN_FIELDS, 'm', 2, main_columns, main, main_values)
+    main.append('  </Main>\n  <Details>\n')
+    amount, amount_values, amount_columns = ['  </Details>\n  <Amount>\n'], [], []
+    _compile_fields(F0401_AMOUNT_FIELDS, 'a', 2, amount_columns, amount, amount_values)
+    amount.append('  </Amount>\n')
+    detail, detail_values, detail_columns = ['    <ProductItem>\n'], [], []
+    _compile_fields(F0401_DETAIL_FIELDS, 'd', 3, detail_columns, detail, detail_values)
+    detail.append('    </ProductItem>\n')
+
+    # 一次查詢：第一列以 json_array 帶回主檔 + 金額，其後每列一筆明細
+    # 主檔列：[0, json_array(a.id, 主檔..., 金額...), NULL...]；明細列：[1, NULL, 明細...]
+    packed = ['a.id'] + main_columns + amount_columns
+    detail_at = 2
+    sql = f'''SELECT 0, json_array({", ".join(packed)}), {", ".join(["NULL"] * len(detail_columns))}
+        FROM einvoice_main m
+        LEFT JOIN einvoice_amount a ON a.invoice_id = m.id
+        WHERE m.invoice_number = ?
+        UNION ALL
+        SELECT 1, NULL, {", ".join(detail_columns)}
+        FROM einvoice_main m
+        JOIN einvoice_details d ON d.invoice_id = m.id
+        WHERE m.invoice_number = ?
+        ORDER BY 1, {detail_at + detail_columns.index('d.sequence_number') + 1}'''
+    shift = lambda values, offset: [(index + offset, convert, default) for index, convert, default in values]
+    return sql, {
+        'main': (''.join(main), shift(main_values, 1)),
+        'amount': (''.join(amount), shift(amount_values, 1 + len(main_columns))),
+        'detail': (''.join(detail), shift(detail_values, detail_at)),
+    }
+
+
+F0401_SQL, F0401_TEMPLATES = _compile_f0401()
+
+
+def _render_f0401(section, row):
+    template, values = F0401_TEMPLATES[section]
+    return template.format(*[convert(row[index], default) for index, convert, default in values])
+
+
+def iter_mig_xml(invoice_number, chunk_size=200):
+    """逐段產生 MIG 4.1 F0401 XML（每段最多 chunk_size 筆明細），發票不存在時不產生任何內容
+
+    串流期間的連線不記在本執行緒名下：產生器可在其他執行緒繼續或中途放棄，不影響本執行緒的交易與重試。
+    """
+    pool = get_pool()
+    conn = pool.checkout()
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(F0401_SQL, (invoice_number, invoice_number))
+        row = cursor.fetchone()
+        if not row:
+            return
+        first = json.loads(row[1])
+        yield F0401_HEADER + _render_f0401('main', first)
+        rows = cursor.fetchmany(chunk_size)
+        while rows:
+            yield ''.join([_render_f0401('detail', row) for row in rows])
+            rows = cursor.fetchmany(chunk_size)
+        if first[0] is not None:
+            yield _render_f0401('amount', first) + '</Invoice>'
+        else:
+            yield '  </Details>\n</Invoice>'
+    finally:
+        pool.checkin(conn)
+
+
+def write_mig_xml(invoice_number, stream):
+    """把 F0401 XML 逐段寫入檔案物件，回傳是否找到發票"""
+    found = False
+    for chunk in iter_mig_xml(invoice_number):
+        stream.write(chunk)
+        found = True
+    return found
+
+
+def generate_mig_xml(invoice_number):
+    """產生MIG 4.1 F0401 XML格式（三表結構）"""
+    buffer = io.StringIO()
+    if not write_mig_xml(invoice_number, buffer):
+        return None
+    return buffer.getvalue()
+
 # ===== Streamlit 介面所需的簡化函數 =====
 
 def create_store(name, code, address="", phone=""):
@@ -1850,24 +4941,26 @@ def use_points(member_id, points, reason=""):
 def get_inventory(store_id=None):
     """取得庫存列表"""
     conn = get_connection()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
     
-    if store_id:
-        cursor.execute('''SELECT sp.*, p.name as product_name, p.barcode, s.name as store_name
-            FROM store_products sp
-            JOIN products p ON sp.product_id = p.id
-            JOIN stores s ON sp.store_id = s.id
-            WHERE sp.store_id = ?
-            ORDER BY p.name''', (store_id,))
-    else:
-        cursor.execute('''SELECT sp.*, p.name as product_name, p.barcode, s.name as store_name
-            FROM store_products sp
-            JOIN products p ON sp.product_id = p.id
-            JOIN stores s ON sp.store_id = s.id
-            ORDER BY s.name, p.name''')
+        if store_id:
+            cursor.execute('''SELECT sp.*, p.name as product_name, p.barcode, s.name as store_name
+                FROM store_products sp
+                JOIN products p ON sp.product_id = p.id
+                JOIN stores s ON sp.store_id = s.id
+                WHERE sp.store_id = ?
+                ORDER BY p.name''', (store_id,))
+        else:
+            cursor.execute('''SELECT sp.*, p.name as product_name, p.barcode, s.name as store_name
+                FROM store_products sp
+                JOIN products p ON sp.product_id = p.id
+                JOIN stores s ON sp.store_id = s.id
+                ORDER BY s.name, p.name''')
     
-    results = cursor.fetchall()
-    conn.close()
+        results = cursor.fetchall()
+    finally:
+        conn.close()
     return results
 
 
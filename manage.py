@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+POS 連鎖店系統 - 維運指令
+
+用法：
+    python manage.py rebuild-sales-rollup                      # 重建全部銷售彙總
+    python manage.py rebuild-sales-rollup --store 2 --since 2026-01-01
+    python manage.py check-sales-rollup --since 2026-01-01 --repair
+    python manage.py export-analytics --since 2026-10            # 匯出銷售欄式分析檔（需要 pyarrow）
+    python manage.py recalculate-member-levels                   # 等級門檻變更後重新判定所有會員等級
+    python manage.py check-member-points --repair                # 比對會員積分與帳本
+    python manage.py grant-birthday-bonus --month 2026-10        # 發放生日積分
+    python manage.py import-catalog products.csv --dry-run       # 批次匯入商品主檔 / 分店價格（CSV / JSONL）
+    python manage.py import-catalog prices.jsonl --store S001
+    python manage.py snapshot-stock                              # 建立分店庫存快照（建議每日排程）
+    python manage.py check-stock --repair                        # 比對分店庫存與庫存異動日誌
+    python manage.py reindex-products                            # 補齊直接以 SQL 寫入的商品搜尋斷詞
+"""
+
+import argparse
+import sys
+
+import analytics
+import catalog_import
+import database
+
+COMMANDS = {}
+
+
+def command(name, help_text):
+    """註冊維運指令"""
+    def register(func):
+        COMMANDS[name] = (func, help_text)
+        return func
+    return register
+
+
+@command('rebuild-sales-rollup', "由 sales 回補 / 重建銷售彙總（每日、每小時）")
+def rebuild_sales_rollup(args):
+    for table, rows in database.rebuild_sales_rollup(store_id=args.store, since=args.since).items():
+        print(f"✓ {table}: 已重建 {rows:,} 筆")
+
+
+@command('check-sales-rollup', "比對銷售彙總與 sales 原始資料")
+def check_sales_rollup(args):
+    mismatches = database.check_sales_rollup(store_id=args.store, since=args.since)
+    for m in mismatches[:20]:
+        print(f"✗ {m['table']} {m['key']}: 應為 {m['expected']} 實際 {m['actual']}")
+    if len(mismatches) > 20:
+        print(f"  ... 共 {len(mismatches):,} 筆不一致")
+    if not mismatches:
+        print("✓ 銷售彙總與 sales 一致")
+        return 0
+    if args.repair:
+        rebuild_sales_rollup(args)
+        return 0
+    return 1
+
+
+@command('export-analytics', "匯出 sales / sale_items 為欄式分析檔（Parquet / Arrow IPC）")
+def export_analytics(args):
+    result = analytics.export_sales(args.path, since=args.since, fmt=args.format)
+    if not result['success']:
+        print(f"✗ {result['message']}")
+        return 1
+    print(f"✓ 已匯出 {result['rows']['sales']:,} 筆銷售、{result['rows']['sale_items']:,} 筆明細"
+          f"（{result['files']} 個檔案）至 {result['path']}")
+    return 0
+
+
+@command('recalculate-member-levels', "依目前的等級門檻重新判定所有會員等級")
+def recalculate_member_levels(args):
+    changed = database.recalculate_member_levels()
+    print(f"✓ {changed:,} 位會員等級已更新")
+    return 0
+
+
+@command('check-member-points', "比對 members.points 與積分帳本餘額")
+def check_member_points(args):
+    mismatches = database.check_member_points(repair=args.repair)
+    for m in mismatches[:20]:
+        print(f"✗ 會員 {m['member_id']}: 帳本 {m['expected']} 實際 {m['actual']}")
+    if len(mismatches) > 20:
+        print(f"  ... 共 {len(mismatches):,} 筆不一致")
+    if not mismatches:
+        print("✓ 會員積分與帳本一致")
+        return 0
+    if args.repair:
+        print(f"✓ 已依帳本修正 {len(mismatches):,} 位會員")
+        return 0
+    return 1
+
+
+@command('grant-birthday-bonus', "依會員等級發放生日積分（同月不重複）")
+def grant_birthday_bonus(args):
+    print(f"✓ 已發放 {database.grant_birthday_bonus(args.month):,} 位會員生日積分")
+    return 0
+
+
+@command('import-catalog', "由 CSV / JSONL 批次匯入商品主檔與分店價格")
+def import_catalog(args):
+    result = catalog_import.import_catalog(
+        args.path, fmt=args.format, store_code=args.store, dry_run=args.dry_run,
+        progress=lambda stage, rows: print(f"  {stage} {rows:,} 筆", flush=True))
+    if not result['success']:
+        print(f"✗ {result['message']}")
+        return 1
+    for error in result['errors'][:20]:
+        print(f"✗ 第 {error['line']} 行 {error['barcode'] or ''}: {error['message']}")
+    if result['error_count'] > 20:
+        print(f"  ... 共 {result['error_count']:,} 列有錯誤")
+    prefix = "（試算，未寫入）" if args.dry_run else ""
+    print(f"✓ {prefix}商品新增 {result['products_created']:,}、更新 {result['products_updated']:,}；"
+          f"分店商品新增 {result['store_products_created']:,}、更新 {result['store_products_updated']:,}")
+    return 1 if result['error_count'] else 0
+
+
+@command('snapshot-stock', "建立分店庫存快照（歷史庫存查詢的起點）")
+def snapshot_stock(args):
+    print(f"✓ 已建立 {database.snapshot_store_stock(args.store):,} 個分店庫存快照")
+    return 0
+
+
+@command('check-stock', "比對 store_products.stock 與庫存異動日誌")
+def check_stock(args):
+    mismatches = database.check_stock_movements(repair=args.repair)
+    for m in mismatches[:20]:
+        print(f"✗ 分店 {m['store_id']} 商品 {m['product_id']}: 日誌 {m['expected']} 實際 {m['actual']}")
+    if len(mismatches) > 20:
+        print(f"  ... 共 {len(mismatches):,} 筆不一致")
+    if not mismatches:
+        print("✓ 分店庫存與異動日誌一致")
+        return 0
+    if args.repair:
+        print(f"✓ 已寫入 {len(mismatches):,} 筆修正異動")
+        return 0
+    return 1
+
+
+@command('reindex-products', "重算商品搜尋詞（直接以 SQL 寫入的商品只以整段名稱建索引）")
+def reindex_products(args):
+    with database.transaction() as conn:
+        updated = database.refresh_product_search(conn.cursor())
+    print(f"✓ {updated:,} 筆商品搜尋詞已更新")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="POS 連鎖店系統維運指令")
+    parser.add_argument('--db', help="資料庫路徑（預設 pos_chain.db）")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    rollup = {}
+    for name in ('rebuild-sales-rollup', 'check-sales-rollup'):
+        rollup[name] = sub.add_parser(name, help=COMMANDS[name][1])
+        rollup[name].add_argument('--store', type=int, help="只處理指定分店")
+        rollup[name].add_argument('--since', help="只處理此日（YYYY-MM-DD，含）之後")
+    rollup['check-sales-rollup'].add_argument('--repair', action='store_true', help="不一致時重建")
+
+    export = sub.add_parser('export-analytics', help=COMMANDS['export-analytics'][1])
+    export.add_argument('--path', help="匯出目錄（預設為資料庫旁的 analytics/）")
+    export.add_argument('--since', help="只重新匯出此月（YYYY-MM，含）之後")
+    export.add_argument('--format', choices=sorted(analytics.FORMATS), default='parquet')
+
+    sub.add_parser('recalculate-member-levels', help=COMMANDS['recalculate-member-levels'][1])
+    points = sub.add_parser('check-member-points', help=COMMANDS['check-member-points'][1])
+    points.add_argument('--repair', action='store_true', help="不一致時以帳本修正")
+    birthday = sub.add_parser('grant-birthday-bonus', help=COMMANDS['grant-birthday-bonus'][1])
+    birthday.add_argument('--month', help="生日月份（YYYY-MM，預設本月）")
+    catalog = sub.add_parser('import-catalog', help=COMMANDS['import-catalog'][1])
+    catalog.add_argument('path', help="CSV 或 JSONL 檔案")
+    catalog.add_argument('--store', help="檔案沒有 store_code 欄位時套用的分店代碼")
+    catalog.add_argument('--format', choices=catalog_import.FORMATS, help="預設依副檔名判斷")
+    catalog.add_argument('--dry-run', action='store_true', help="只驗證與試算，不寫入")
+    snapshot = sub.add_parser('snapshot-stock', help=COMMANDS['snapshot-stock'][1])
+    snapshot.add_argument('--store', type=int, help="只處理指定分店")
+    stock = sub.add_parser('check-stock', help=COMMANDS['check-stock'][1])
+    stock.add_argument('--repair', action='store_true', help="以目前庫存寫入修正異動")
+    sub.add_parser('reindex-products', help=COMMANDS['reindex-products'][1])
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.db:
+        database.DB_PATH = args.db
+    database.init_db()
+    return COMMANDS[args.command][0](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
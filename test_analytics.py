@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+銷售分析匯出測試
+匯出的欄式檔案涵蓋全部 sales / sale_items，向量化指標與資料庫直接計算的結果一致；
+指定 since 只重新匯出該月之後的分區。未安裝 pyarrow 時回傳錯誤訊息。
+"""
+
+import sys
+import os
+import shutil
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import analytics
+import database
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+    database.add_store("第二門市", "87654321")
+    store_ids = [s['id'] for s in database.get_stores()]
+    products = database.get_products()
+    with database.transaction() as conn:
+        conn.executemany('''INSERT INTO sales (id, store_id, subtotal, discount, total, created_at)
+            VALUES (?, ?, ?, ?, ?, datetime('now', 'start of month', ? || ' months', '+1 day'))''',
+            [(i + 1, store_ids[i // 4 % 2], 100 + i, i % 5, 100 + i - i % 5, -(i % 4)) for i in range(1200)])
+        conn.executemany('''INSERT INTO sale_items (sale_id, product_id, product_name, quantity, unit_price, subtotal)
+            VALUES (?, ?, ?, ?, 50, ?)''',
+            [(i + 1, p['id'], p['name'], i % 3 + 1, 50 * (i % 3 + 1))
+             for i in range(1200) for p in products[i % 3:i % 3 + 2]])
+    return store_ids
+
+
+def expected_metrics(store_id=None):
+    with database.db_connection() as conn:
+        orders, revenue, discount = conn.execute(
+            "SELECT COUNT(*), SUM(total), SUM(discount) FROM sales WHERE ? IS NULL OR store_id = ?",
+            (store_id, store_id)).fetchone()
+    return {'success': True, 'orders': orders, 'revenue': revenue, 'discount': discount,
+            'average': revenue / orders}
+
+
+def metrics(out, **kwargs):
+    """sales_metrics() 去掉匯出時間，回傳 (指標, 匯出後即時統計的訂單數)"""
+    result = analytics.sales_metrics(out, **kwargs)
+    assert result.pop('exported_at')
+    return result, result.pop('pending')
+
+
+def test_export_and_metrics():
+    """分批匯出後指標涵蓋全部歷史"""
+    store_ids = setup_db()
+    workdir = os.path.dirname(database.DB_PATH)
+    out = os.path.join(workdir, "analytics")
+    if not analytics.available():
+        assert not analytics.export_sales(out)['success']
+        print("  （未安裝 pyarrow，略過）")
+        return
+    for fmt in analytics.FORMATS:
+        shutil.rmtree(out, ignore_errors=True)
+        result = analytics.export_sales(out, fmt=fmt, chunk_size=100)
+        assert result['success'] and result['rows'] == {'sales': 1200, 'sale_items': 2400}
+        # 4 個月 x 2 分店 x 2 張表
+        assert result['files'] == 16
+        assert metrics(out) == (expected_metrics(), 0)
+        for store_id in store_ids:
+            assert metrics(out, store_id=store_id) == (expected_metrics(store_id), 0)
+        monthly = analytics.monthly_revenue(out)
+        assert len(monthly) == 8 and sum(m['orders'] for m in monthly) == 1200
+        top = {t['product_name']: (t['total_qty'], t['total_sales']) for t in analytics.product_sales(out)}
+        with database.db_connection() as conn:
+            expected = {row[0]: (row[1], row[2]) for row in conn.execute(
+                "SELECT product_name, SUM(quantity), SUM(subtotal) FROM sale_items GROUP BY product_id")}
+        assert top == expected
+
+
+def test_incremental_export():
+    """匯出後的新銷售即時統計；since 只取代該月之後的分區，可改用另一種格式"""
+    store_ids = setup_db()
+    workdir = os.path.dirname(database.DB_PATH)
+    out = os.path.join(workdir, "analytics")
+    if not analytics.available():
+        return
+    analytics.export_sales(out)
+    months = sorted(m['month'] for m in analytics.monthly_revenue(out))
+    latest = months[-1]
+    product = database.get_products()[0]
+    database.create_sale(store_ids[0], None, 999, 0, 0, 0, 999, 999, 0, items=[
+        {'product_id': product['id'], 'name': product['name'], 'quantity': 1, 'price': 999, 'subtotal': 999}])
+    # 尚未重新匯出：新銷售由資料庫即時統計
+    assert metrics(out) == (expected_metrics(), 1)
+    assert metrics(out, store_id=store_ids[1])[1] == 0
+    assert sum(m['orders'] for m in analytics.monthly_revenue(out)) == 1201
+    top = analytics.product_sales(out, start_month=latest)
+    with database.db_connection() as conn:
+        expected = {row[0]: (row[1], row[2]) for row in conn.execute(
+            '''SELECT si.product_id, SUM(si.quantity), SUM(si.subtotal) FROM sale_items si
+            JOIN sales s ON s.id = si.sale_id WHERE strftime('%Y-%m', s.created_at) = ? GROUP BY si.product_id''',
+            (latest,))}
+    assert {t['product_id']: (t['total_qty'], t['total_sales']) for t in top} == expected
+
+    result = analytics.export_sales(out, since=latest, fmt='arrow')
+    assert result['rows']['sales'] == 1200 // 4 + 1
+    assert metrics(out) == (expected_metrics(), 0)
+    assert metrics(out, start_month=latest)[0]['orders'] == 1200 // 4 + 1
+    assert analytics.product_sales(out, start_month=latest) == top
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  銷售分析匯出測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_export_and_metrics()
+    print("✓ 匯出與向量化指標")
+    with temp_db():
+        test_incremental_export()
+    print("✓ 依月份增量匯出")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+連線 PRAGMA 與忙碌重試測試
+連線套用 PRAGMA 設定檔（預設 WAL）；另一條連線以 BEGIN IMMEDIATE 持有寫入鎖時，
+@retry_on_busy 的寫入以指數退避重試，鎖釋放後成功，重試用完則拋出 database is locked。
+"""
+
+import sys
+import os
+import sqlite3
+import threading
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+
+def pragma(name):
+    with database.db_connection() as conn:
+        return conn.execute(f"PRAGMA {name}").fetchone()[0]
+
+
+def hold_write_lock(seconds):
+    """以另一條連線持有寫入鎖 seconds 秒，回傳已取得鎖的事件與執行緒"""
+    locked = threading.Event()
+
+    def worker():
+        conn = sqlite3.connect(database.DB_PATH, isolation_level=None)
+        conn.execute("BEGIN IMMEDIATE")
+        locked.set()
+        time.sleep(seconds)
+        conn.execute("ROLLBACK")
+        conn.close()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    locked.wait(5)
+    return thread
+
+
+def test_pragma_profiles():
+    """預設設定檔為 WAL / synchronous=NORMAL，可切換 legacy 與覆寫個別值"""
+    profile, overrides = database.DB_PROFILE, dict(database.PRAGMA_OVERRIDES)
+    try:
+        database.configure_pool(profile='default', pragmas={})
+        assert (pragma('journal_mode'), pragma('synchronous')) == ('wal', 1)
+        database.configure_pool(profile='legacy', pragmas={'cache_size': -1000})
+        assert (pragma('journal_mode'), pragma('synchronous'), pragma('cache_size')) == ('delete', 2, -1000)
+    finally:
+        database.configure_pool(profile=profile, pragmas=overrides)
+
+
+def test_retry_until_lock_released():
+    """寫入鎖被占用時重試，釋放後寫入成功；不重試則立即失敗"""
+    member_id = database.add_member("王小明", "0912345678")
+    overrides, retries = dict(database.PRAGMA_OVERRIDES), database.BUSY_RETRIES
+    # 縮短 SQLite 本身的等待，讓 SQLITE_BUSY 交給 retry_on_busy 處理
+    database.configure_pool(pragmas={**overrides, 'busy_timeout': 20})
+    try:
+        database.BUSY_RETRIES = 0
+        thread = hold_write_lock(0.3)
+        try:
+            database.update_member_points(member_id, 10, "測試")
+            raise AssertionError("未重試時應拋出 database is locked")
+        except sqlite3.OperationalError as e:
+            assert database.is_busy_error(e)
+        thread.join()
+
+        database.BUSY_RETRIES = retries
+        thread = hold_write_lock(0.3)
+        database.update_member_points(member_id, 10, "測試")
+        thread.join()
+    finally:
+        database.BUSY_RETRIES = retries
+        database.configure_pool(pragmas=overrides)
+    assert database.get_member_by_id(member_id)['points'] == 10
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  連線 PRAGMA 與忙碌重試測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_pragma_profiles()
+    print("✓ PRAGMA 設定檔")
+    with temp_db():
+        test_retry_until_lock_released()
+    print("✓ 寫入鎖釋放後重試成功")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+購物車庫存測試
+整車一次查詢庫存（庫存為 NULL 視為 0）；結帳時庫存不足整筆回滾，不留下銷售與發票。
+"""
+
+import sys
+import os
+import sqlite3
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+    store_id = database.get_stores()[0]['id']
+    products = database.get_products()[:2]
+    for product in products:
+        database.add_store_product(store_id, product['id'], 100, 105, 5)
+    return store_id, products
+
+
+def line(product, quantity):
+    return {'product_id': product['id'], 'name': product['name'], 'quantity': quantity,
+            'price': 105, 'subtotal': 105 * quantity}
+
+
+def test_check_cart_stock():
+    """同商品多行合併計算；不足與未上架的商品都列出"""
+    store_id, (a, b) = setup_db()
+    assert database.check_cart_stock(store_id, [line(a, 2), line(b, 5)]) == {'all_available': True}
+    result = database.check_cart_stock(store_id, [line(a, 3), line(b, 1), line(a, 3),
+                                                  {'product_id': 999, 'name': '不存在', 'quantity': 1}])
+    assert not result['all_available']
+    shortages = {item['product_id']: item for item in result['items']}
+    assert set(shortages) == {a['id'], 999}
+    assert shortages[a['id']]['requested'] == 6 and shortages[a['id']]['available'] == 5
+    assert shortages[999]['message'] == '商品不存在'
+    assert database.get_stock_levels(store_id, [a['id'], b['id'], 999]) == {a['id']: 5, b['id']: 5}
+
+
+def test_checkout_rolls_back_on_shortage():
+    """結帳時任一項不足，庫存、銷售、發票都不變動"""
+    store_id, (a, b) = setup_db()
+    result = database.checkout(store_id, [line(a, 1), line(b, 6)])
+    assert not result['success']
+    assert [item['product_id'] for item in result['items']] == [b['id']]
+    assert database.get_stock_levels(store_id, [a['id'], b['id']]) == {a['id']: 5, b['id']: 5}
+    assert database.get_sales(store_id) == []
+
+    assert database.checkout(store_id, [line(a, 5), line(b, 1)])['success']
+    assert database.get_stock_levels(store_id, [a['id'], b['id']]) == {a['id']: 0, b['id']: 4}
+
+
+def test_null_stock_counts_as_zero():
+    """庫存欄位為 NULL（直接以 SQL 寫入的分店商品）視為 0，回報不足而不是拋出例外"""
+    store_id, (a, b) = setup_db()
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute("UPDATE store_products SET stock = NULL WHERE store_id = ? AND product_id = ?", (store_id, b['id']))
+    conn.commit()
+    conn.close()
+    result = database.check_cart_stock(store_id, [line(a, 1), line(b, 1)])
+    assert result['items'] == [{'product_id': b['id'], 'name': b['name'], 'requested': 1, 'available': 0,
+                                'message': '庫存不足 目前庫存: 0'}]
+    assert database.get_stock_levels(store_id, [a['id'], b['id']]) == {a['id']: 5, b['id']: 0}
+    assert not database.checkout(store_id, [line(b, 1)])['success']
+    assert database.get_sales(store_id) == []
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  購物車庫存測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_check_cart_stock()
+    print("✓ 整車庫存檢查")
+    with temp_db():
+        test_checkout_rolls_back_on_shortage()
+    print("✓ 庫存不足時結帳整筆回滾")
+    with temp_db():
+        test_null_stock_counts_as_zero()
+    print("✓ NULL 庫存視為 0")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+商品批次匯入測試
+CSV / JSONL 經暫存表驗證後整批 upsert 至 products / store_products；
+含稅價與 calculate_price_inc_tax() 一致；錯誤列略過並回報行號；試算不寫入。
+"""
+
+import sys
+import os
+import json
+import sqlite3
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+import catalog_import
+import manage
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("台北店", "12345678")
+    database.add_store("台中店", "87654321")
+
+
+def write_file(workdir, name, text):
+    path = os.path.join(workdir, name)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return path
+
+
+def product(barcode):
+    with database.db_connection() as conn:
+        return dict(conn.execute("SELECT * FROM products WHERE barcode = ?", (barcode,)).fetchone())
+
+
+def store_products(store_code, barcode):
+    with database.db_connection() as conn:
+        return [dict(row) for row in conn.execute('''SELECT sp.* FROM store_products sp
+            JOIN stores s ON s.id = sp.store_id JOIN products p ON p.id = sp.product_id
+            WHERE s.code = ? AND p.barcode = ?''', (store_code, barcode))]
+
+
+def test_import_csv():
+    """新增 / 更新商品主檔與分店價格，含稅價與前台計算一致"""
+    setup_db()
+    workdir = os.path.dirname(database.DB_PATH)
+    existing = database.add_product("舊名稱", 10, 10.5, 5, "4710001", "飲料")
+    store_id = next(s['id'] for s in database.get_stores() if s['code'] == "12345678")
+    database.add_store_product(store_id, existing, 12, 12.6, 30)
+    path = write_file(workdir, "catalog.csv", "\n".join([
+        "barcode,name,price_ex_tax,price_inc_tax,cost,category,store_code,stock",
+        "4710001,新名稱,20,,8,,,",
+        "4710002,新商品,33.33,,10,零食,,",
+        "4710001,,25,,,,12345678,",
+        "4710002,,40,42,,,87654321,7",
+        "4710001,,,,,,87654321,3",
+    ]) + "\n")
+    stages = []
+    result = catalog_import.import_catalog(path, progress=lambda stage, rows: stages.append((stage, rows)))
+    assert result['success'] and result['error_count'] == 0, result
+    assert (result['products_created'], result['products_updated']) == (1, 1)
+    assert (result['store_products_created'], result['store_products_updated']) == (2, 1)
+    assert ('讀取', 5) in stages
+
+    p = product("4710001")
+    assert (p['id'], p['name'], p['price_ex_tax'], p['cost'], p['category']) == (existing, "新名稱", 20, 8, "飲料")
+    assert p['price_inc_tax'] == database.calculate_price_inc_tax(20)
+    p = product("4710002")
+    assert p['price_inc_tax'] == database.calculate_price_inc_tax(33.33) and p['category'] == "零食"
+
+    [sp] = store_products("12345678", "4710001")
+    assert (sp['price_ex_tax'], sp['price_inc_tax'], sp['stock']) == (25, database.calculate_price_inc_tax(25), 30)
+    [sp] = store_products("87654321", "4710002")
+    assert (sp['price_ex_tax'], sp['price_inc_tax'], sp['stock']) == (40, 42, 7)
+    # 未提供價格的分店列沿用商品主檔價格
+    [sp] = store_products("87654321", "4710001")
+    assert (sp['price_ex_tax'], sp['price_inc_tax'], sp['stock']) == (20, database.calculate_price_inc_tax(20), 3)
+    # 匯入的庫存寫入異動日誌
+    taichung = sp['store_id']
+    assert sorted((m['quantity_change'], m['stock_after'], m['movement_type'], m['reference'])
+                  for m in database.get_stock_movements(taichung)) == [(3, 3, 'import', 'catalog.csv'),
+                                                                       (7, 7, 'import', 'catalog.csv')]
+    assert database.check_stock_movements() == []
+    # 全文索引同步更新
+    assert [row['barcode'] for row in database.get_products("新名稱")] == ["4710001"]
+
+
+def test_errors_and_dry_run():
+    """錯誤列略過並回報行號；試算回報筆數但不寫入；重複條碼以最後一列為準"""
+    setup_db()
+    workdir = os.path.dirname(database.DB_PATH)
+    rows = [
+        {"barcode": "A1", "name": "甲", "price_ex_tax": 10},
+        {"name": "沒有條碼", "price_ex_tax": 10},
+        {"barcode": "A2", "name": "乙", "price_ex_tax": "abc"},
+        {"barcode": "A3", "price_ex_tax": 10},
+        {"barcode": "A4", "name": "丁", "price_ex_tax": -1},
+        {"barcode": "A1", "name": "甲", "price_ex_tax": 11, "store_code": "NOPE"},
+        {"barcode": "A1", "name": "甲二", "price_ex_tax": 12},
+    ]
+    path = write_file(workdir, "catalog.jsonl", "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+    before = len(database.get_products())
+
+    result = catalog_import.import_catalog(path, dry_run=True)
+    assert result['success'] and result['products_created'] == 1 and result['imported'] == 0
+    assert len(database.get_products()) == before
+    assert [(e['line'], e['message']) for e in result['errors']] == [
+        (1, '檔案內條碼重複（以最後一列為準）'), (2, '缺少條碼'), (3, 'price_ex_tax 不是數字'),
+        (4, '新商品缺少名稱'), (5, '價格或成本不可為負'), (6, '分店代碼不存在')]
+
+    assert manage.main(['import-catalog', path]) == 1
+    assert (product("A1")['name'], product("A1")['price_ex_tax']) == ("甲二", 12)
+    assert len(database.get_products()) == before + 1
+
+    assert catalog_import.import_catalog(os.path.join(workdir, "missing.csv"))['success'] is False
+    assert catalog_import.import_catalog(path, fmt='xml')['success'] is False
+
+
+def test_write_lock_and_nested_dry_run():
+    """讀檔期間其他連線仍可寫入；在外層交易內試算不會回滾呼叫端的變更"""
+    setup_db()
+    workdir = os.path.dirname(database.DB_PATH)
+    path = write_file(workdir, "catalog.csv", "barcode,name,price_ex_tax\n" +
+                      "".join(f"B{i},商品{i},{i}\n" for i in range(10)))
+    writes = []
+
+    def progress(stage, rows):
+        if stage == '讀取':
+            other = sqlite3.connect(database.DB_PATH, timeout=0)
+            other.execute("UPDATE stores SET name = name")
+            other.commit()
+            other.close()
+            writes.append(rows)
+
+    result = catalog_import.import_catalog(path, progress=progress, chunk_size=4)
+    assert result['success'] and result['products_created'] == 10 and writes == [4, 8, 10]
+
+    with database.transaction() as conn:
+        conn.execute("UPDATE stores SET name = '外層交易' WHERE code = '12345678'")
+        result = catalog_import.import_catalog(write_file(workdir, "more.csv", "barcode,name\nC1,新品\n"), dry_run=True)
+        assert result['products_created'] == 1 and conn.in_transaction
+    assert [s['name'] for s in database.get_stores() if s['code'] == '12345678'] == ['外層交易']
+    assert database.find_product_by_barcode("C1") is None
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  商品批次匯入測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_import_csv()
+    print("✓ CSV 匯入商品主檔與分店價格")
+    with temp_db():
+        test_errors_and_dry_run()
+    print("✓ 錯誤列與試算")
+    with temp_db():
+        test_write_lock_and_nested_dry_run()
+    print("✓ 讀檔不鎖資料庫、巢狀試算")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+結帳測試
+checkout() 在同一交易寫入銷售、明細、扣庫存、會員積分與發票並回傳找零；
+收款不足時拒絕結帳，不留下任何寫入。
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+    store_id = database.get_stores()[0]['id']
+    products = database.get_products()[:2]
+    for product in products:
+        database.add_store_product(store_id, product['id'], 100, 105, 5)
+    member_id = database.add_member("王小明", "0912345678")
+    cart = [{'product_id': p['id'], 'name': p['name'], 'quantity': qty, 'price': 105, 'subtotal': 105 * qty}
+            for p, qty in zip(products, (2, 1))]
+    return store_id, database.get_member_by_id(member_id), cart
+
+
+def stock(store_id, cart):
+    return [database.get_store_product(store_id, item['product_id'])['stock'] for item in cart]
+
+
+def test_checkout_records_sale():
+    """銷售、明細、庫存、積分與發票一次寫入，回傳找零"""
+    store_id, member, cart = setup_db()
+    result = database.checkout(store_id, cart, member=member, payment={'cash': 500, 'discount': 15})
+    assert result['success']
+    assert (result['total'], result['change']) == (300, 200)
+
+    with database.db_connection() as conn:
+        sale = conn.execute("SELECT * FROM sales WHERE id = ?", (result['sale_id'],)).fetchone()
+        item_count = conn.execute("SELECT COUNT(*) FROM sale_items WHERE sale_id = ?",
+                                  (result['sale_id'],)).fetchone()[0]
+    assert (sale['total'], sale['cash'], sale['change_amount'], sale['member_id']) == (300, 500, 200, member['id'])
+    assert sale['invoice_number'] == result['invoice_number'] and item_count == 2
+    assert database.get_invoice_by_number(result['invoice_number']) is not None
+    assert stock(store_id, cart) == [3, 4]
+    updated = database.get_member_by_id(member['id'])
+    assert (updated['points'], updated['total_spent']) == (300, 300)
+
+
+def test_underpayment_rejected():
+    """收款少於應收時回傳錯誤，銷售、庫存、積分都不變"""
+    store_id, member, cart = setup_db()
+    result = database.checkout(store_id, cart, member=member, payment={'cash': 314})
+    assert result == {'success': False, 'message': '收款不足 應收: 315'}
+    assert database.count_sales() == 0
+    assert stock(store_id, cart) == [5, 5]
+    assert database.get_member_by_id(member['id'])['points'] == 0
+    # 未指定收款視為收足
+    assert database.checkout(store_id, cart, member=member)['change'] == 0
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  結帳測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_checkout_records_sale()
+    print("✓ 銷售、庫存、積分與發票一次寫入")
+    with temp_db():
+        test_underpayment_rejected()
+    print("✓ 收款不足拒絕結帳")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+連線池測試
+同執行緒巢狀取得連線時重用同一條、歸還時回滾未提交的交易、
+不同執行緒各自借用，連線用盡時等待逾時；
+巢狀借用的函數不提交外層未完成的交易，例外離開時明確歸還連線；
+借出的連線可由其他執行緒代為歸還；關閉連線池後，借出中的連線歸還時關閉；
+iter_mig_xml() 串流期間不佔用本執行緒的池連線。
+"""
+
+import sys
+import os
+import sqlite3
+import threading
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+
+def test_nested_reuse():
+    """同執行緒巢狀借用同一條連線，最外層歸還後才回到閒置清單"""
+    outer = database.get_connection()
+    nested = database.get_pool_stats()['nested']
+    inner = database.get_connection()
+    assert inner._conn is outer._conn
+    assert database.get_pool_stats()['nested'] == nested + 1
+    inner.close()
+    assert database.get_pool_stats()['idle'] == 0
+    outer.close()
+    stats = database.get_pool_stats()
+    assert stats['idle'] == stats['open'] == 1
+
+
+def test_release_rolls_back():
+    """最外層歸還時未提交的寫入被回滾"""
+    conn = database.get_connection()
+    conn.execute("INSERT INTO stores (name, code) VALUES ('未提交', 'X1')")
+    conn.close()
+    assert [s for s in database.get_stores() if s['code'] == 'X1'] == []
+
+
+def test_threads_and_exhaustion():
+    """不同執行緒各借一條；連線用盡時等待逾時"""
+    pool = database.ConnectionPool(database.DB_PATH, pool_size=1, timeout=0.2)
+    held, done, errors = threading.Event(), threading.Event(), []
+
+    def worker():
+        conn = pool.acquire()
+        held.set()
+        done.wait(5)
+        pool.release(conn)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    held.wait(5)
+    try:
+        pool.acquire()
+    except sqlite3.OperationalError as e:
+        errors.append(str(e))
+    done.set()
+    thread.join()
+    assert errors == ["connection pool exhausted"]
+    conn = pool.acquire()
+    pool.release(conn)
+    stats = pool.stats()
+    assert (stats['open'], stats['idle'], stats['waits']) == (1, 1, 1)
+    pool.close_all()
+
+
+def test_nested_commit_keeps_outer_unit_of_work():
+    """外層尚未提交時，內層函數的 commit() 不提交外層的寫入"""
+    outer = database.get_connection()
+    outer.execute("INSERT INTO stores (name, code) VALUES ('外層', 'X2')")
+    database.add_store("內層", "X3")
+    outer.close()
+    assert [s for s in database.get_stores() if s['code'] in ('X2', 'X3')] == []
+
+    try:
+        with database.transaction():
+            database.add_store("內層", "X4")
+            raise RuntimeError("外層失敗")
+    except RuntimeError:
+        pass
+    assert [s for s in database.get_stores() if s['code'] == 'X4'] == []
+
+    # 沒有外層交易時內層照常提交
+    database.add_store("單獨", "X5")
+    assert [s['code'] for s in database.get_stores() if s['code'] == 'X5'] == ['X5']
+
+
+def test_exception_releases_connection():
+    """函數因例外離開時連線已歸還，不依賴垃圾回收"""
+    pool = database.get_pool()
+    database.add_user("cashier", "pw", "收銀員", "staff")
+    raised = False
+    try:
+        database.add_user("cashier", "pw", "收銀員", "staff")
+    except sqlite3.IntegrityError:
+        # 例外的 traceback 仍保留函數的框架時，連線已歸還
+        raised = True
+        assert not pool.holds_connection()
+    assert raised
+    stats = pool.stats()
+    assert stats['idle'] == stats['open']
+
+
+def test_release_from_other_thread():
+    """其他執行緒關閉借出的連線時，借用的執行緒不再視為持有連線"""
+    pool = database.get_pool()
+    borrowed, ready, closed, result = [], threading.Event(), threading.Event(), {}
+
+    def worker():
+        borrowed.append(database.get_connection())
+        ready.set()
+        closed.wait(5)
+        result['holds'] = pool.holds_connection()
+        with database.transaction() as conn:
+            result['in_transaction'] = conn.in_transaction
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    ready.wait(5)
+    borrowed.pop().close()
+    closed.set()
+    thread.join()
+    assert result == {'holds': False, 'in_transaction': True}
+    stats = pool.stats()
+    assert stats['idle'] == stats['open']
+
+
+def test_close_pools_with_borrowed_connection():
+    """close_pools() 時借出中的連線在歸還時關閉，不留在舊連線池"""
+    pool = database.get_pool()
+    conn = database.get_connection()
+    database.close_pools()
+    assert pool.stats()['open'] == 1
+    conn.close()
+    assert pool.stats()['open'] == pool.stats()['idle'] == 0
+    assert not pool.holds_connection()
+    assert database.get_pool() is not pool and database.get_stores() is not None
+
+
+def test_mig_xml_stream_does_not_hold_pool_connection():
+    """XML 串流期間本執行緒未持有池連線，可在其他執行緒讀完"""
+    database.add_store("測試門市", "12345678")
+    items = [{'product_id': 1, 'name': f'商品{i}', 'quantity': 1, 'unit_price': 10, 'amount': 10} for i in range(5)]
+    _, invoice_number = database.create_einvoice({'code': '12345678', 'name': '測試門市'}, {}, items)
+    chunks = database.iter_mig_xml(invoice_number, chunk_size=2)
+    parts = [next(chunks)]
+    assert not database.get_pool().holds_connection()
+    thread = threading.Thread(target=lambda: parts.extend(chunks))
+    thread.start()
+    thread.join()
+    assert ''.join(parts) == database.generate_mig_xml(invoice_number)
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  連線池測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_nested_reuse()
+    print("✓ 同執行緒巢狀重用")
+    with temp_db():
+        test_release_rolls_back()
+    print("✓ 歸還時回滾未提交的交易")
+    with temp_db():
+        test_threads_and_exhaustion()
+    print("✓ 多執行緒借用與等待逾時")
+    with temp_db():
+        test_nested_commit_keeps_outer_unit_of_work()
+    print("✓ 內層 commit 不提交外層交易")
+    with temp_db():
+        test_exception_releases_connection()
+    print("✓ 例外離開時明確歸還")
+    with temp_db():
+        test_release_from_other_thread()
+    print("✓ 其他執行緒代為歸還")
+    with temp_db():
+        test_close_pools_with_borrowed_connection()
+    print("✓ 關閉連線池時借出中的連線")
+    with temp_db():
+        test_mig_xml_stream_does_not_hold_pool_connection()
+    print("✓ XML 串流不佔用池連線")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+字軌號碼配號器壓力測試
+多執行緒、多行程同時配號：號碼不得重複；全部歸還後，已配發 + 歸還待用的號碼必須連續不跳號。
+其他主機遺留的預留區段在租約到期後回收，被回收的一方不再配發該區段的號碼。
+"""
+
+import sys
+import os
+import multiprocessing
+import threading
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+THREADS = 8
+PROCESSES = 4
+PER_WORKER = 500
+
+
+def setup_db():
+    """停用預設字軌，改用一組足夠大的字軌"""
+    with database.transaction() as conn:
+        conn.execute("UPDATE einvoice_track_numbers SET is_active = 0")
+    database.add_track_number('ZZ', '99', 1, 1000000, '2026-01-01')
+
+
+def allocate(count):
+    numbers = []
+    for _ in range(count):
+        numbers.append(database.consume_track_number())
+    return numbers
+
+
+def process_worker(db_path, count, queue):
+    database.DB_PATH = db_path
+    numbers = allocate(count)
+    # multiprocessing 子行程以 os._exit 結束，不會執行 atexit
+    database.release_invoice_numbers()
+    queue.put(numbers)
+
+
+def check_gap_free(issued):
+    """已配發號碼與 free 區段合起來須剛好是 [1, current_number)"""
+    with database.db_connection() as conn:
+        current = conn.execute(
+            "SELECT current_number FROM einvoice_track_numbers WHERE track_code1 = 'ZZ'").fetchone()[0]
+        free = conn.execute(
+            "SELECT start_number, end_number, status FROM einvoice_number_blocks").fetchall()
+    assert all(row['status'] == 'free' for row in free), "仍有未歸還的預留區段"
+    covered = sorted([int(n[-8:]) for n in issued] +
+                     [n for row in free for n in range(row['start_number'], row['end_number'] + 1)])
+    assert covered == list(range(1, current)), "號碼有重複或跳號"
+
+
+def test_threads_unique_and_gap_free():
+    """多執行緒配號不重複、不跳號"""
+    setup_db()
+    results = [None] * THREADS
+
+    def run(index):
+        results[index] = allocate(PER_WORKER)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    issued = [n for numbers in results for n in numbers]
+    assert None not in issued
+    assert len(issued) == len(set(issued)) == THREADS * PER_WORKER
+    database.release_invoice_numbers()
+    check_gap_free(issued)
+    print(f"  {THREADS} 執行緒 x {PER_WORKER}: {len(issued) / elapsed:,.0f} 號/秒")
+
+
+def test_processes_unique_and_gap_free():
+    """多行程配號不重複、不跳號"""
+    setup_db()
+    ctx = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    queue = ctx.Queue()
+    # 父行程先預留一段，子行程不可沿用
+    parent = allocate(3)
+    start = time.perf_counter()
+    workers = [ctx.Process(target=process_worker, args=(database.DB_PATH, PER_WORKER, queue))
+               for _ in range(PROCESSES)]
+    for w in workers:
+        w.start()
+    results = [queue.get(timeout=120) for _ in workers]
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    issued = parent + [n for numbers in results for n in numbers]
+    assert None not in issued
+    assert len(issued) == len(set(issued)) == PROCESSES * PER_WORKER + 3
+    database.release_invoice_numbers()
+    check_gap_free(issued)
+    print(f"  {PROCESSES} 行程 x {PER_WORKER}: {PROCESSES * PER_WORKER / elapsed:,.0f} 號/秒")
+
+
+def test_give_back_and_reuse():
+    """開立失敗歸還的號碼與上個行程遺留的區段都會被重新配發"""
+    setup_db()
+    store = {'code': '12345678', 'name': '測試門市'}
+    items = [{'product_id': 1, 'name': '美式咖啡', 'quantity': 1, 'unit_price': 85, 'amount': 85}]
+    _, first = database.create_einvoice(store, {}, items)
+    second = database.consume_track_number()
+    database.get_invoice_allocator().give_back(second)
+    assert database.consume_track_number() == second
+
+    # 模擬行程中斷：預留區段留在資料庫，新的配號器回收尚未開立發票的號碼
+    with database.transaction() as conn:
+        conn.execute("UPDATE einvoice_number_blocks SET owner = ? WHERE status = 'reserved'",
+                     (f"{database.socket.gethostname()}:999999999",))
+    database._allocators.clear()
+    assert database.consume_track_number() == second
+    assert database.consume_track_number() != first
+
+
+def test_nested_transaction_and_rollback():
+    """在呼叫端交易內開立不會等待自己持有的寫入鎖；交易回滾時號碼歸還，下一張沿用"""
+    setup_db()
+    store = {'code': '12345678', 'name': '測試門市'}
+    items = [{'product_id': 1, 'name': '美式咖啡', 'quantity': 1, 'unit_price': 85, 'amount': 85}]
+    issued = []
+    # 第一輪記憶體中沒有號碼（在交易內自字軌取號），第二輪自預留區段配發
+    for _ in range(2):
+        try:
+            with database.transaction() as conn:
+                conn.execute("UPDATE stores SET name = name")
+                _, number = database.create_einvoice(store, {}, items)
+                assert number and conn.in_transaction
+                raise RuntimeError("結帳失敗")
+        except RuntimeError:
+            pass
+        assert database.get_einvoice(number) is None
+        _, again = database.create_einvoice(store, {}, items)
+        assert again == number
+        issued.append(again)
+
+    # 開立途中失敗同樣歸還
+    try:
+        database.create_einvoice(store, {}, [{'name': '缺少金額'}])
+        assert False, "缺少金額應失敗"
+    except KeyError:
+        pass
+    _, number = database.create_einvoice(store, {}, items)
+    issued.append(number)
+    assert issued == [f"ZZ99{n:08d}" for n in (1, 2, 3)]
+    database.release_invoice_numbers()
+    check_gap_free(issued)
+
+
+def record(numbers):
+    """模擬已開立：寫入電子發票主檔"""
+    with database.transaction() as conn:
+        conn.executemany('''INSERT INTO einvoice_main
+            (invoice_number, invoice_date, invoice_time, seller_identifier, seller_name)
+            VALUES (?, '20260101', '00:00:00', '12345678', '遠端門市')''', [(n,) for n in numbers])
+
+
+def test_remote_blocks_reclaimed_after_lease():
+    """其他主機的區段在租約內保留、到期後回收；被回收的一方續約失敗時改預留新區段，不重號"""
+    setup_db()
+    remote = database.InvoiceNumberAllocator(database.get_pool(), block_size=10)
+    remote.owner = 'remote-host:42'
+    remote_numbers = [remote.next() for _ in range(3)]
+    record(remote_numbers)
+    local = database.get_invoice_allocator()
+    local.block_size = 10
+
+    # 租約內：遠端主機的區段不回收
+    local_numbers = [local.next() for _ in range(10)]
+    assert local_numbers == [f"ZZ99{n:08d}" for n in range(11, 21)]
+
+    # 遠端主機當機、租約過期：下次預留時回收尚未開立的 4~10
+    with database.transaction() as conn:
+        conn.execute("UPDATE einvoice_number_blocks SET reserved_at = datetime('now', ?) WHERE owner = ?",
+                     (f'-{database.INVOICE_BLOCK_LEASE + 60} seconds', remote.owner))
+    local_numbers += [local.next() for _ in range(7)]
+    assert local_numbers[10:] == [f"ZZ99{n:08d}" for n in range(4, 11)]
+
+    # 遠端行程其實還在：續約時發現區段已被回收，歸還的號碼也不再配發，改預留新區段
+    remote.give_back(remote_numbers[-1])
+    remote._renewed -= database.INVOICE_BLOCK_LEASE
+    assert remote.next() == "ZZ9900000021"
+    issued = remote_numbers[:2] + local_numbers + ["ZZ9900000021"]
+    assert len(issued) == len(set(issued))
+
+    remote.release()
+    database.release_invoice_numbers()
+    with database.db_connection() as conn:
+        free = conn.execute("SELECT start_number, end_number FROM einvoice_number_blocks WHERE status = 'free'").fetchall()
+        reserved = conn.execute("SELECT COUNT(*) FROM einvoice_number_blocks WHERE status = 'reserved'").fetchone()[0]
+    assert [tuple(row) for row in free] == [(22, 30)] and reserved == 0
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  字軌號碼配號器壓力測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_threads_unique_and_gap_free()
+    print("✓ 多執行緒配號不重複、不跳號\n")
+    with temp_db():
+        test_processes_unique_and_gap_free()
+    print("✓ 多行程配號不重複、不跳號\n")
+    with temp_db():
+        test_give_back_and_reuse()
+    print("✓ 歸還與遺留區段可重新配發")
+    with temp_db():
+        test_nested_transaction_and_rollback()
+    print("✓ 交易內開立與回滾歸還")
+    with temp_db():
+        test_remote_blocks_reclaimed_after_lease()
+    print("✓ 其他主機的區段租約到期後回收")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+會員快取測試
+電話 / id 查詢命中快取不查資料庫；積分異動與結帳後快取內容與資料庫一致（write-through）；
+計價欄位隨等級設定更新；其他連線修改會員時只有被修改的會員失效；超過容量時淘汰最久未使用的會員。
+"""
+
+import sys
+import os
+import sqlite3
+from datetime import datetime
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+    store_id = database.get_stores()[0]['id']
+    product = database.get_products()[0]
+    database.add_store_product(store_id, product['id'], 100, 105, 100)
+    database.add_member_level("normal", 0, 0, 0, 0)
+    database.add_member_level("gold", 300, 100000, 5, 50)
+    birthday = datetime.now().strftime('%Y-%m-%d')
+    member_id = database.add_member("王小明", "0912345678", birthday=birthday)
+    return store_id, product, member_id
+
+
+def db_member(member_id):
+    with database.db_connection() as conn:
+        return dict(conn.execute("SELECT * FROM members WHERE id = ?", (member_id,)).fetchone())
+
+
+def count_queries(func):
+    """執行函數並回傳其送出的 SQL 數（快取命中時應為 0）"""
+    statements = []
+    with database.db_connection() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            func()
+        finally:
+            conn.set_trace_callback(None)
+    return len(statements)
+
+
+def test_lookup_hits_cache():
+    """第二次查詢由快取回傳，並附計價欄位"""
+    store_id, product, member_id = setup_db()
+    member = database.get_member_by_phone("0912345678")
+    assert member['id'] == member_id
+    assert member['level_discount_percent'] == 0 and member['in_birthday_window']
+    assert count_queries(lambda: database.get_member_by_phone("0912345678")) == 0
+    assert count_queries(lambda: database.get_member_by_id(member_id)) == 0
+    assert database.get_member_by_phone("0900000000") is None
+
+    # 回傳的是複本
+    member['name'] = "改名"
+    assert database.get_member_by_id(member_id)['name'] == "王小明"
+
+
+def test_write_through():
+    """積分異動、結帳升級後快取與資料庫一致"""
+    store_id, product, member_id = setup_db()
+    member = database.get_member_by_phone("0912345678")
+    database.update_member_points(member_id, 100, "測試")
+    cached = database.get_member_by_id(member_id)
+    assert cached['points'] == 100 == db_member(member_id)['points']
+
+    cart = [{'product_id': product['id'], 'name': product['name'], 'quantity': 2, 'price': 105, 'subtotal': 210}]
+    result = database.checkout(store_id, cart, member)
+    assert result['success']
+    cached = database.get_member_by_phone("0912345678")
+    expected = db_member(member_id)
+    assert {k: cached[k] for k in expected} == expected
+    assert cached['level'] == 'gold' and cached['level_discount_percent'] == 5
+
+    # 傳入舊的會員資料，計價仍使用快取中的最新等級
+    pricing = database.price_cart(store_id, member, cart)
+    assert pricing['member_level'] == 'gold' and pricing['member_discount'] == 210 * 0.05
+    assert count_queries(lambda: database.price_cart(store_id, member, cart)) == 0
+
+    database.create_sale(store_id, member_id, 100, 0, 0, 0, 100, 100, 0)
+    assert database.get_member_by_id(member_id)['total_spent'] == db_member(member_id)['total_spent']
+
+
+def test_pricing_fields_follow_rules():
+    """等級折扣設定變更後重新計算計價欄位"""
+    store_id, product, member_id = setup_db()
+    with database.transaction() as conn:
+        conn.execute("UPDATE members SET level = 'vip' WHERE id = ?", (member_id,))
+    assert database.get_member_by_id(member_id)['level_discount_percent'] == 0
+    database.add_member_level("vip", 0, 0, 12, 0)
+    assert database.get_member_by_id(member_id)['level_discount_percent'] == 12
+
+
+def test_write_evicts_only_touched_member():
+    """其他連線修改會員 A 後，會員 B 仍由快取回傳（只比對資料列版本）；A、刪除與重用 id 的會員重新載入"""
+    store_id, product, member_a = setup_db()
+    member_b = database.add_member("李小華", "0922222222")
+    member_c = database.add_member("張小美", "0933333333")
+    for member_id in (member_a, member_b, member_c):
+        database.get_member_by_id(member_id)
+
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute("UPDATE members SET name = '王大明' WHERE id = ?", (member_a,))
+    conn.commit()
+    stats = database.get_member_cache_stats()
+    assert count_queries(lambda: database.get_member_by_id(member_b)) == 1
+    assert count_queries(lambda: database.get_member_by_id(member_b)) == 0
+    assert database.get_member_by_id(member_a)['name'] == "王大明"
+    after = database.get_member_cache_stats()
+    assert (after['hits'] - stats['hits'], after['misses'] - stats['misses']) == (2, 1)
+
+    # 刪除後重用同一個 id 的新會員不會拿到舊資料
+    conn.execute("DELETE FROM members WHERE id = ?", (member_c,))
+    conn.execute("INSERT INTO members (id, name, phone) VALUES (?, '新會員', '0944444444')", (member_c,))
+    conn.commit()
+    conn.close()
+    assert database.get_member_by_id(member_c)['name'] == "新會員"
+    assert database.get_member_by_phone("0933333333") is None
+    assert database.get_member_by_id(member_b)['name'] == "李小華"
+
+
+def test_lru_eviction():
+    """超過容量時淘汰最久未使用的會員"""
+    store_id, product, member_id = setup_db()
+    cache = database.MemberCache(max_entries=3)
+    ids = [member_id] + [database.add_member(f"會員{i}", f"09000000{i:02d}") for i in range(4)]
+    for mid in ids[:3]:
+        cache.get(mid)
+    cache.get(ids[0])
+    cache.get(ids[3])
+    assert cache.peek(ids[1]) is None, "最久未使用的應被淘汰"
+    assert cache.peek(ids[0]) and cache.peek(ids[2]) and cache.peek(ids[3])
+    assert cache.stats()['entries'] == 3
+    assert cache.get_by_phone("0900000003")['id'] == ids[4]
+    assert cache.stats()['entries'] == 3
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  會員快取測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_lookup_hits_cache()
+    print("✓ 電話 / id 查詢命中快取")
+    with temp_db():
+        test_write_through()
+    print("✓ 積分與結帳寫回快取")
+    with temp_db():
+        test_pricing_fields_follow_rules()
+    print("✓ 計價欄位隨等級設定更新")
+    with temp_db():
+        test_write_evicts_only_touched_member()
+    print("✓ 只有被修改的會員失效")
+    with temp_db():
+        test_lru_eviction()
+    print("✓ LRU 淘汰")
+
+
+if __name__ == '__main__':
+    main()
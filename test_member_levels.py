@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+會員等級測試
+結帳時以記憶體中的等級表判定等級，結果與原本的 member_levels 查詢一致；
+recalculate_member_levels() 以單一 UPDATE 批次重新判定，結果與逐筆判定相同。
+"""
+
+import sys
+import os
+import random
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+import manage
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+    database.add_member_level("normal", 0, 0, 0, 0)
+    database.add_member_level("silver", 500, 5000, 2, 0)
+    database.add_member_level("gold", 2000, 20000, 5, 50)
+    return database.get_stores()[0]['id']
+
+
+def expected_level(conn, points, total_spent):
+    """原本的逐筆等級查詢"""
+    row = conn.execute('''SELECT name FROM member_levels WHERE is_active = 1 AND (min_points <= ? OR min_spent <= ?)
+        ORDER BY min_points DESC, min_spent DESC LIMIT 1''', (points, total_spent)).fetchone()
+    return row[0] if row else None
+
+
+def test_in_memory_level_matches_sql():
+    """記憶體判定與 SQL 查詢一致；積分異動在同一交易內升級"""
+    store_id = setup_db()
+    rng = random.Random(7)
+    with database.db_connection() as conn:
+        for _ in range(500):
+            points, spent = rng.randrange(3000), rng.randrange(30000)
+            assert database.evaluate_member_level(points, spent) == expected_level(conn, points, spent)
+
+    member_id = database.add_member("王小明", "0912345678")
+    database.update_member_points(member_id, 600, "測試", store_id)
+    assert database.get_member_by_id(member_id)['level'] == 'silver'
+    database.create_sale(store_id, member_id, 20000, 0, 0, 0, 20000, 20000, 0)
+    assert database.get_member_by_id(member_id)['level'] == 'gold'
+
+
+def test_bulk_recalculation():
+    """門檻變更後批次重新判定，結果與逐筆判定相同"""
+    store_id = setup_db()
+    rng = random.Random(11)
+    with database.transaction() as conn:
+        conn.executemany("INSERT INTO members (phone, name, points, total_spent, level) VALUES (?, ?, ?, ?, 'normal')",
+                         [(f"09{i:08d}", f"會員{i}", rng.randrange(3000), rng.randrange(30000)) for i in range(2000)])
+    member = database.get_member_by_phone("0900000001")
+    database.add_member_level("platinum", 2500, 28000, 8, 100)
+
+    assert manage.main(['recalculate-member-levels']) == 0
+    with database.db_connection() as conn:
+        rows = conn.execute("SELECT points, total_spent, level FROM members").fetchall()
+        assert all(row['level'] == expected_level(conn, row['points'], row['total_spent']) for row in rows)
+    assert {row['level'] for row in rows} == {'normal', 'silver', 'gold', 'platinum'}
+    # 快取已清除，查詢取得新等級
+    with database.db_connection() as conn:
+        level = conn.execute("SELECT level FROM members WHERE id = ?", (member['id'],)).fetchone()[0]
+    assert database.get_member_by_phone("0900000001")['level'] == level
+    assert database.recalculate_member_levels() == 0, "再次執行不應有變動"
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  會員等級測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_in_memory_level_matches_sql()
+    print("✓ 記憶體等級判定")
+    with temp_db():
+        test_bulk_recalculation()
+    print("✓ 批次重新判定等級")
+
+
+if __name__ == '__main__':
+    main()
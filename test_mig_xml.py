@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+MIG F0401 XML 黃金樣本測試
+串流產生的 F0401 XML 與固定樣本逐字相同：NULL 欄位輸出預設值（文字為空字串），
+文字欄位做 XML 跳脫，CDATA 內的 "]]>" 拆段；分段大小不影響輸出，缺金額檔時仍正確收尾。
+"""
+
+import sys
+import os
+import xml.etree.ElementTree as ET
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+NS = '{urn:GEINV:eInvoiceMessage:F0401:4.1}'
+
+GOLDEN = '''<?xml version="1.0" encoding="utf-8"?>
+<Invoice xsi:schemaLocation="urn:GEINV:eInvoiceMessage:F0401:4.1 F0401.xsd" xmlns="urn:GEINV:eInvoiceMessage:F0401:4.1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <Main>
+    <InvoiceNumber>AB12345678</InvoiceNumber>
+    <InvoiceDate>20260101</InvoiceDate>
+    <InvoiceTime>09:30:00</InvoiceTime>
+    <InvoiceType>07</InvoiceType>
+    <RandomNumber>0420</RandomNumber>
+    <GroupMark></GroupMark>
+    <DonateMark>0</DonateMark>
+    <Seller>
+      <Identifier>12345678</Identifier>
+      <Name><![CDATA[好食<商行> ]]]]><![CDATA[> 分店]]></Name>
+      <Address>台北市 A&amp;B 路 1 號</Address>
+      <PersonInCharge></PersonInCharge>
+      <TelephoneNumber></TelephoneNumber>
+      <FacsimileNumber></FacsimileNumber>
+      <EmailAddress></EmailAddress>
+      <CustomerNumber></CustomerNumber>
+      <RoleRemark></RoleRemark>
+      <BankCode></BankCode>
+      <BankAccount></BankAccount>
+    </Seller>
+    <Buyer>
+      <Identifier>0000000000</Identifier>
+      <Name><![CDATA[]]></Name>
+      <Address></Address>
+      <PersonInCharge></PersonInCharge>
+      <TelephoneNumber></TelephoneNumber>
+      <FacsimileNumber></FacsimileNumber>
+      <EmailAddress></EmailAddress>
+      <CustomerNumber></CustomerNumber>
+      <RoleRemark></RoleRemark>
+    </Buyer>
+    <BuyerRemark></BuyerRemark>
+    <MainRemark></MainRemark>
+    <CustomsClearanceMark></CustomsClearanceMark>
+    <Category></Category>
+    <RelateNumber></RelateNumber>
+    <CarrierType></CarrierType>
+    <CarrierId1></CarrierId1>
+    <CarrierId2></CarrierId2>
+    <PrintMark>N</PrintMark>
+    <NPOBAN></NPOBAN>
+    <BondedAreaConfirm></BondedAreaConfirm>
+    <ZeroTaxRateReason></ZeroTaxRateReason>
+  </Main>
+  <Details>
+    <ProductItem>
+      <SequenceNumber>001</SequenceNumber>
+      <Description><![CDATA[拿鐵 ]]]]><![CDATA[> 大杯]]></Description>
+      <Quantity>2.0</Quantity>
+      <Unit>杯</Unit>
+      <UnitPrice>65.0</UnitPrice>
+      <TaxType>1</TaxType>
+      <Amount>130.0</Amount>
+      <Remark>R&amp;D</Remark>
+      <RelateNumber></RelateNumber>
+    </ProductItem>
+    <ProductItem>
+      <SequenceNumber>002</SequenceNumber>
+      <Description><![CDATA[吸管]]></Description>
+      <Quantity>1.0</Quantity>
+      <Unit>件</Unit>
+      <UnitPrice>0.0</UnitPrice>
+      <TaxType>1</TaxType>
+      <Amount>0.0</Amount>
+      <Remark></Remark>
+      <RelateNumber></RelateNumber>
+    </ProductItem>
+  </Details>
+  <Amount>
+    <SalesAmount>124.0</SalesAmount>
+    <FreeTaxSalesAmount>0.0</FreeTaxSalesAmount>
+    <ZeroTaxSalesAmount>0.0</ZeroTaxSalesAmount>
+    <TaxAmount>6.0</TaxAmount>
+    <TaxType>1</TaxType>
+    <TaxRate>0.05</TaxRate>
+    <TotalAmount>130.0</TotalAmount>
+    <DiscountAmount>0.0</DiscountAmount>
+    <OriginalCurrencyAmount></OriginalCurrencyAmount>
+    <ExchangeRate></ExchangeRate>
+    <Currency></Currency>
+  </Amount>
+</Invoice>'''
+
+
+def setup_db(with_amount=True):
+    """寫入固定內容的發票：含 NULL 欄位、需跳脫的文字與含 "]]>" 的 CDATA 欄位"""
+    with database.transaction() as conn:
+        invoice_id = conn.execute('''INSERT INTO einvoice_main (invoice_number, invoice_date, invoice_time,
+            random_number, print_mark, seller_identifier, seller_name, seller_address, buyer_identifier, buyer_name,
+            main_remark)
+            VALUES ('AB12345678', '20260101', '09:30:00', '0420', NULL, '12345678', '好食<商行> ]]> 分店',
+                    '台北市 A&B 路 1 號', '0000000000', NULL, NULL)''').lastrowid
+        conn.execute('''INSERT INTO einvoice_details
+            (invoice_id, sequence_number, product_name, quantity, unit, unit_price, amount, remark)
+            VALUES (?, 2, '吸管', 1, NULL, 0, 0, NULL), (?, 1, '拿鐵 ]]> 大杯', 2, '杯', 65, 130, 'R&D')''',
+                     (invoice_id, invoice_id))
+        if with_amount:
+            conn.execute('''INSERT INTO einvoice_amount (invoice_id, sales_amount, tax_amount, total_amount)
+                VALUES (?, 124, 6, 130)''', (invoice_id,))
+
+
+def test_matches_golden():
+    """輸出與黃金樣本逐字相同，解析後還原原始文字"""
+    setup_db()
+    xml = database.generate_mig_xml('AB12345678')
+    assert xml == GOLDEN
+    root = ET.fromstring(xml)
+    assert root.find(f'{NS}Main/{NS}Seller/{NS}Name').text == '好食<商行> ]]> 分店'
+    assert root.find(f'{NS}Main/{NS}Seller/{NS}Address').text == '台北市 A&B 路 1 號'
+    assert root.find(f'{NS}Main/{NS}Buyer/{NS}Name').text is None
+    assert [item.find(f'{NS}Description').text for item in root.iter(f'{NS}ProductItem')] == ['拿鐵 ]]> 大杯', '吸管']
+    assert database.generate_mig_xml('ZZ00000000') is None
+
+
+def test_chunks_and_missing_amount():
+    """逐筆分段的串流與整份輸出相同；沒有金額檔時省略 Amount 並關閉 Details"""
+    setup_db(with_amount=False)
+    chunks = list(database.iter_mig_xml('AB12345678', chunk_size=1))
+    assert len(chunks) == 4
+    expected = GOLDEN[:GOLDEN.index('  </Details>')] + '  </Details>\n</Invoice>'
+    assert ''.join(chunks) == expected
+    ET.fromstring(expected)
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  MIG F0401 XML 黃金樣本測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_matches_golden()
+    print("✓ 與黃金樣本相同")
+    with temp_db():
+        test_chunks_and_missing_amount()
+    print("✓ 分段串流與缺金額檔")
+
+
+if __name__ == '__main__':
+    main()
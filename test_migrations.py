@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+版本遷移測試
+已是最新版本時 init_db() 只讀一次 PRAGMA user_version；舊版本資料庫只套用較新的遷移；
+benchmark.py startup 輸出冷啟動與重跑耗時。
+"""
+
+import sys
+import os
+import io
+import re
+from contextlib import redirect_stdout
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+import benchmark
+from conftest import temp_db
+
+
+def traced_init():
+    """執行 init_db()，回傳執行的 SQL"""
+    statements = []
+    with database.db_connection() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            database.init_db()
+        finally:
+            conn.set_trace_callback(None)
+    return statements
+
+
+def test_warm_init_reads_version_only():
+    """最新版本的資料庫重跑 init_db() 只讀 user_version"""
+    assert database.get_schema_version() == database.SCHEMA_VERSION
+    assert traced_init() == ["PRAGMA user_version"]
+    assert database.run_migrations() == []
+
+
+def test_upgrade_applies_newer_versions():
+    """較舊的版本只套用之後的遷移，資料保留"""
+    database.add_store("測試門市", "12345678")
+    with database.db_connection() as conn:
+        conn.execute(f"PRAGMA user_version = {database.SCHEMA_VERSION - 2}")
+    assert database.run_migrations() == [database.SCHEMA_VERSION - 1, database.SCHEMA_VERSION]
+    assert database.get_schema_version() == database.SCHEMA_VERSION
+    assert [s['code'] for s in database.get_stores() if s['code'] == '12345678'] == ['12345678']
+
+
+def test_startup_harness_output():
+    """benchmark.py startup 印出兩種初始化方式的冷啟動與重跑耗時"""
+    out = io.StringIO()
+    with redirect_stdout(out):
+        benchmark.bench_startup(reruns=3)
+    lines = out.getvalue().splitlines()
+    timing = re.compile(r'^  (冷啟動（新資料庫）|重跑 x3（平均）)\s+\d+\.\d{2} ms$')
+    assert [line.strip() for line in lines if line.startswith('  [')] == ["[舊版（每次全量 DDL）]", "[版本遷移]"]
+    assert [timing.match(line).group(1) for line in lines if timing.match(line)] == \
+        ["冷啟動（新資料庫）", "重跑 x3（平均）"] * 2
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  版本遷移測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_warm_init_reads_version_only()
+    print("✓ 重跑只讀 user_version")
+    with temp_db():
+        test_upgrade_applies_newer_versions()
+    print("✓ 舊版本只套用較新的遷移")
+    with temp_db():
+        test_startup_harness_output()
+    print("✓ startup 基準輸出")
+
+
+if __name__ == '__main__':
+    main()
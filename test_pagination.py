@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+分頁測試
+keyset 分頁（before=page_cursor(上一頁最後一筆)）逐頁讀完不重複、不遺漏，
+同一秒建立的資料也依 id 排序；iter_*() 與 count_*() 與全表結果一致。
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+    database.add_store("第二門市", "87654321")
+    store_ids = [s['id'] for s in database.get_stores()]
+    product_id = database.get_products()[0]['id']
+    with database.transaction() as conn:
+        # 每 7 筆共用同一個 created_at，驗證同時間的資料以 id 區分
+        conn.executemany('''INSERT INTO members (phone, name, created_at)
+            VALUES (?, ?, datetime('2026-01-01', ? || ' seconds'))''',
+            [(f"09{i:08d}", f"會員{i}", i // 7) for i in range(250)])
+        conn.executemany('''INSERT INTO sales (store_id, subtotal, total, created_at)
+            VALUES (?, 100, 100, datetime('2026-01-01', ? || ' seconds'))''',
+            [(store_ids[i % 2], i // 7) for i in range(230)])
+        conn.executemany('''INSERT INTO invoices (invoice_number, store_id, total_amount, invoice_status, created_at)
+            VALUES (?, ?, 100, ?, datetime('2026-01-01', ? || ' seconds'))''',
+            [(f"AB{i:08d}", store_ids[i % 2], 'void' if i % 5 == 0 else 'issued', i // 7) for i in range(120)])
+        conn.executemany('''INSERT INTO inventory_transfers (from_store_id, to_store_id, product_id, quantity,
+            status, created_at) VALUES (?, ?, ?, 1, ?, datetime('2026-01-01', ? || ' seconds'))''',
+            [(store_ids[i % 2], store_ids[1 - i % 2], product_id, 'approved' if i % 3 == 0 else 'pending', i // 7)
+             for i in range(90)])
+    database.rebuild_sales_rollup()
+    return store_ids
+
+
+def read_pages(fetch, page_size):
+    """以 before 逐頁讀取，回傳所有 id"""
+    ids, before = [], None
+    while True:
+        page = fetch(limit=page_size, before=before)
+        ids += [row['id'] for row in page]
+        if len(page) < page_size:
+            return ids
+        before = database.page_cursor(page[-1])
+
+
+def test_pages_cover_all_rows():
+    """逐頁讀取等於一次讀取全部，順序為 created_at、id 由新到舊"""
+    store_ids = setup_db()
+    members = [m['id'] for m in database.get_members()]
+    assert len(members) == 250 == database.count_members()
+    assert read_pages(lambda **kw: database.get_members(**kw), 40) == members
+    assert [m['id'] for m in database.iter_members(batch_size=30)] == members
+    assert database.count_members("會員1") == len(database.get_members("會員1"))
+
+    for store_id in store_ids + [None]:
+        sales = [s['id'] for s in database.get_sales(store_id, limit=1000)]
+        assert database.count_sales(store_id) == len(sales)
+        assert read_pages(lambda **kw: database.get_sales(store_id, **kw), 25) == sales
+        assert [s['id'] for s in database.iter_sales(store_id, batch_size=50)] == sales
+
+        for status in (None, 'void'):
+            invoices = [i['id'] for i in database.get_invoices(store_id, status, limit=1000)]
+            assert database.count_invoices(store_id, status) == len(invoices)
+            assert read_pages(lambda **kw: database.get_invoices(store_id, status, **kw), 16) == invoices
+            assert [i['id'] for i in database.iter_invoices(store_id, status, batch_size=16)] == invoices
+
+        for status in (None, 'pending'):
+            transfers = [t['id'] for t in database.get_transfers(store_id, status)]
+            assert database.count_transfers(store_id, status) == len(transfers)
+            assert all(t['status'] == status for t in database.get_transfers(store_id, status) if status)
+            assert read_pages(lambda **kw: database.get_transfers(store_id, status, **kw), 11) == transfers
+            assert [t['id'] for t in database.iter_transfers(store_id, status, batch_size=11)] == transfers
+
+    assert len(database.get_sales()) == 100, "get_sales 預設仍為 100 筆"
+    ordered = [(s['created_at'], s['id']) for s in database.get_sales(limit=1000)]
+    assert ordered == sorted(ordered, reverse=True)
+
+
+def test_einvoice_pages():
+    """電子發票依 id 分頁"""
+    store_ids = setup_db()
+    with database.transaction() as conn:
+        conn.executemany('''INSERT INTO einvoice_main (invoice_number, invoice_date, invoice_time,
+            seller_identifier, seller_name) VALUES (?, '20260101', '12:00:00', '12345678', '測試門市')''',
+            [(f"CD{i:08d}",) for i in range(75)])
+    einvoices = [e['id'] for e in database.get_all_einvoices(limit=1000)]
+    assert len(einvoices) == 75 == database.count_einvoices()
+    assert [e['id'] for e in database.iter_einvoices(batch_size=10)] == einvoices
+    assert [e['id'] for e in database.get_all_einvoices(10, before=einvoices[9])] == einvoices[10:20]
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  分頁測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_pages_cover_all_rows()
+    print("✓ keyset 分頁涵蓋全部資料")
+    with temp_db():
+        test_einvoice_pages()
+    print("✓ 電子發票分頁")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+積分帳本測試
+積分異動寫入帳本並同步 members.points（帳本加總與累計餘額一致）；批次發放逐筆累計餘額並重新判定等級；
+生日積分同月不重複發放；舊資料庫升級時補期初餘額並移除積分快照表。
+"""
+
+import sys
+import os
+import sqlite3
+import threading
+from datetime import datetime
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+import manage
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+    database.add_member_level("normal", 0, 0, 0, 10)
+    database.add_member_level("gold", 1000, 100000, 5, 50)
+    return database.get_stores()[0]['id']
+
+
+def ledger(member_id):
+    with database.db_connection() as conn:
+        return [tuple(row) for row in conn.execute(
+            "SELECT points_change, points_balance, reason FROM member_points_log WHERE member_id = ? ORDER BY id",
+            (member_id,))]
+
+
+def test_ledger_matches_balance():
+    """每筆異動記錄累計餘額，最後一筆餘額與帳本加總都等於 members.points"""
+    store_id = setup_db()
+    member_id = database.add_member("王小明", "0912345678")
+    database.update_member_points(member_id, 300, "測試", store_id)
+    database.create_sale(store_id, member_id, 200, 0, 0, 0, 200, 200, 0)
+    database.update_member_points(member_id, -120, "兌換", store_id)
+    assert ledger(member_id) == [(300, 300, "測試"), (200, 500, "消費積分"), (-120, 380, "兌換")]
+    assert database.get_member_by_id(member_id)['points'] == 380
+    assert database.check_member_points() == []
+
+
+def test_bulk_earn():
+    """批次發放：同一會員多筆依序累計餘額、同步 members.points 並升級"""
+    store_id = setup_db()
+    a = database.add_member("甲", "0911111111")
+    b = database.add_member("乙", "0922222222")
+    database.update_member_points(a, 100, "消費積分", store_id)
+    database.get_member_by_id(a)
+    written = database.bulk_earn_points([(a, 500), (b, 50), (a, 600), (999, 10), (b, 0)], "週年加贈", store_id)
+    assert written == 3
+    assert ledger(a)[-2:] == [(500, 600, "週年加贈"), (600, 1200, "週年加贈")]
+    member = database.get_member_by_id(a)
+    assert member['points'] == 1200 == ledger(a)[-1][1]
+    assert member['level'] == 'gold'
+    assert database.get_member_by_id(b)['points'] == 50
+    assert database.check_member_points() == []
+
+
+def test_birthday_bonus():
+    """生日積分依等級 birthday_bonus 發放，同月不重複"""
+    store_id = setup_db()
+    month = datetime.now().strftime('%Y-%m')
+    a = database.add_member("甲", "0911111111", birthday=f"1990-{month[5:]}-15")
+    b = database.add_member("乙", "0922222222", birthday=f"1985-{month[5:]}-01")
+    database.add_member("丙", "0933333333", birthday="1990-13-01")
+    database.bulk_earn_points([(b, 1000)], "測試")
+    assert database.grant_birthday_bonus() == 2
+    assert database.get_member_by_id(a)['points'] == 10
+    assert database.get_member_by_id(b)['points'] == 1050
+    assert database.grant_birthday_bonus(month) == 0
+
+    # 多個行程 / 執行緒同時發放，每位會員只發一次
+    c = database.add_member("丁", "0944444444", birthday=f"2000-{month[5:]}-20")
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(database.grant_birthday_bonus())) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results) == [0, 0, 0, 1]
+    assert database.get_member_by_id(c)['points'] == 10
+
+
+def test_drift_and_upgrade():
+    """直接修改 members.points 時 check-member-points 偵測並以帳本修正；升級時補期初餘額"""
+    store_id = setup_db()
+    member_id = database.add_member("王小明", "0912345678")
+    database.update_member_points(member_id, 200, "測試", store_id)
+    with database.transaction() as conn:
+        conn.execute("UPDATE members SET points = 999 WHERE id = ?", (member_id,))
+    assert manage.main(['check-member-points']) == 1
+    assert manage.main(['check-member-points', '--repair']) == 0
+    assert database.get_member_by_id(member_id)['points'] == 200
+
+    # 模擬 v9 資料庫：帳本不足以解釋 members.points
+    database.close_pools()
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute("UPDATE members SET points = 750 WHERE id = ?", (member_id,))
+    conn.execute("PRAGMA user_version = 9")
+    conn.commit()
+    conn.close()
+    database.member_cache.clear()
+    database.init_db()
+    assert ledger(member_id)[-1] == (550, 750, '期初餘額')
+    assert database.get_member_by_id(member_id)['points'] == 750
+    assert database.check_member_points() == []
+    with database.db_connection() as conn:
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'member_points_snapshots'").fetchone() is None
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  積分帳本測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_ledger_matches_balance()
+    print("✓ 帳本與積分餘額一致")
+    with temp_db():
+        test_bulk_earn()
+    print("✓ 批次發放積分")
+    with temp_db():
+        test_birthday_bonus()
+    print("✓ 生日積分")
+    with temp_db():
+        test_drift_and_upgrade()
+    print("✓ 餘額比對修正與升級")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+收銀前台商品清單測試
+get_pos_catalog() 的分店售價、庫存與最佳促銷；最佳促銷以分店售價計算實際折扣排序，
+promo_discount 與 price_cart() 單件結帳的促銷折扣一致。
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+    store_id = database.get_stores()[0]['id']
+    cheap = database.add_product("小杯紅茶", 19, 20, barcode="4710000000011")
+    pricey = database.add_product("禮盒", 95.2, 100, barcode="4710000000028")
+    plain = database.add_product("吸管", 1, 1, barcode="4710000000035")
+    database.add_store_product(store_id, cheap, 19, 20, 10)
+    # 分店售價高於總部價
+    database.add_store_product(store_id, pricey, 114.3, 120, 10)
+    percent = database.add_promotion("全館9折", "percent", 10)
+    fixed = database.add_promotion("現折5元", "fixed", 5)
+    expired = database.add_promotion("過期促銷", "fixed", 50, start_date="2000-01-01", end_date="2000-01-31")
+    for product_id in (cheap, pricey):
+        database.add_promotion_product(percent, product_id)
+        database.add_promotion_product(fixed, product_id)
+        database.add_promotion_product(expired, product_id)
+    return store_id, {'cheap': cheap, 'pricey': pricey, 'plain': plain}, {'percent': percent, 'fixed': fixed}
+
+
+def test_best_promotion_by_discount():
+    """低價商品的現折 5 元勝過 9 折；高價商品 9 折勝過現折；過期促銷不列入"""
+    store_id, products, promos = setup_db()
+    catalog = {p['id']: p for p in database.get_pos_catalog(store_id)}
+
+    cheap = catalog[products['cheap']]
+    assert (cheap['price'], cheap['stock'], cheap['promo_id'], cheap['promo_type']) == (20, 10, promos['fixed'], 'fixed')
+    pricey = catalog[products['pricey']]
+    assert (pricey['price'], pricey['promo_id'], pricey['promo_value']) == (120, promos['percent'], 10)
+    plain = catalog[products['plain']]
+    assert (plain['stock'], plain['promo_id'], plain['promo_type'], plain['promo_discount']) == (None, None, None, 0)
+
+
+def test_tile_discount_matches_price_cart():
+    """商品卡片的促銷折扣與 price_cart() 單件結帳相同"""
+    store_id, products, _ = setup_db()
+    for product in database.get_pos_catalog(store_id):
+        cart = [{'product_id': product['id'], 'name': product['name'], 'quantity': 1, 'price': product['price']}]
+        assert product['promo_discount'] == database.price_cart(store_id, None, cart)['promo_discount']
+    found = database.get_pos_catalog(store_id, "紅茶")
+    assert [(p['id'], p['promo_discount']) for p in found] == [(products['cheap'], 7)]
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  收銀前台商品清單測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_best_promotion_by_discount()
+    print("✓ 最佳促銷依實際折扣")
+    with temp_db():
+        test_tile_discount_matches_price_cart()
+    print("✓ 卡片折扣與結帳一致")
+
+
+if __name__ == '__main__':
+    main()
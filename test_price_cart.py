@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+購物車計價測試
+price_cart() 的逐項促銷、會員等級折扣、生日折扣與總額與收銀前台原本的逐項算法相同；
+調整等級折扣或生日優惠券後，計價規則表重新載入。
+"""
+
+import sys
+import os
+import sqlite3
+from datetime import datetime
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+    store_id = database.get_stores()[0]['id']
+    database.add_member_level("gold", 100, 1000, 5, 50)
+    birthday = f"1990-{datetime.now().month:02d}-15"
+    member_id = database.add_member("王小明", "0912345678", birthday=birthday)
+    with database.transaction() as conn:
+        conn.execute("UPDATE members SET level = 'gold' WHERE id = ?", (member_id,))
+    database.add_birthday_coupon("生日9折", discount_percent=10)
+
+    products = database.get_products()[:3]
+    for promo_type, value, product in (("percent", 10, products[0]), ("bogo", 0, products[1]), ("fixed", 5, products[1])):
+        promo_id = database.add_promotion(f"{promo_type}促銷", promo_type, value)
+        database.add_promotion_product(promo_id, product['id'])
+    cart = [{'product_id': p['id'], 'name': p['name'], 'quantity': qty, 'price': p['price_inc_tax'],
+             'subtotal': qty * p['price_inc_tax']} for p, qty in zip(products, (1, 3, 2))]
+    return store_id, database.get_member_by_id(member_id), cart
+
+
+def legacy_pricing(member, cart, discount=0):
+    """收銀前台原本的算法：逐項查促銷、線性搜尋會員等級、另查生日優惠"""
+    subtotal = sum(item['subtotal'] for item in cart)
+    member_discount = 0
+    birthday_discount = 0
+    if member:
+        for level in database.get_member_levels():
+            if level['name'] == member['level']:
+                member_discount = subtotal * (level['discount_percent'] / 100)
+                break
+        birthday_discount = database.check_birthday_discount(member['id'], subtotal)
+    promo_discount = 0
+    for item in cart:
+        promos = database.get_promotions(item['product_id'])
+        if promos:
+            promo_discount += database.calculate_promotion(item, promos)
+    total = int(subtotal - discount - promo_discount - member_discount - birthday_discount + 0.5)
+    return {'subtotal': subtotal, 'promo_discount': promo_discount, 'member_discount': member_discount,
+            'birthday_discount': birthday_discount, 'total': total}
+
+
+def pricing(store_id, member, cart, discount=0):
+    result = database.price_cart(store_id, member, cart, discount)
+    return {key: result[key] for key in ('subtotal', 'promo_discount', 'member_discount', 'birthday_discount', 'total')}
+
+
+def test_matches_legacy_pricing():
+    """有無會員、有無額外折扣都與原本的算法相同，並附逐項明細"""
+    store_id, member, cart = setup_db()
+    for who in (member, None):
+        for discount in (0, 7):
+            assert pricing(store_id, who, cart, discount) == legacy_pricing(who, cart, discount)
+    result = database.price_cart(store_id, member, cart)
+    assert result['member_level'] == 'gold' and result['member_discount_percent'] == 5
+    assert [line['promo_discount'] for line in result['lines']] == \
+        [database.calculate_promotion(item, database.get_promotions(item['product_id'])) for item in cart]
+    assert result['birthday_discount'] > 0 and result['promo_discount'] > 0
+
+
+def test_rule_changes_reload():
+    """其他連線調整等級折扣、停用生日優惠券後，計價使用新規則"""
+    store_id, member, cart = setup_db()
+    before = pricing(store_id, member, cart)
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute("UPDATE member_levels SET discount_percent = 15 WHERE name = 'gold'")
+    conn.execute("UPDATE birthday_coupons SET is_active = 0")
+    conn.commit()
+    conn.close()
+    after = pricing(store_id, member, cart)
+    assert after == legacy_pricing(member, cart)
+    assert after['member_discount'] == before['member_discount'] * 3
+    assert after['birthday_discount'] == 0
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  購物車計價測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_matches_legacy_pricing()
+    print("✓ 與原本算法相同")
+    with temp_db():
+        test_rule_changes_reload()
+    print("✓ 規則異動後重新載入")
+
+
+if __name__ == '__main__':
+    main()
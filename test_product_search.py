@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+商品搜尋測試
+條碼完全相符走條碼索引；中文名稱以單字 + 兩字詞比對（「拿鐵」找到「冰拿鐵」）；
+新增、改名、刪除商品後 products_fts 同步，觸發器不依賴連線上註冊的函數，其他連線可直接寫入 products。
+"""
+
+import sys
+import os
+import sqlite3
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+import catalog_import
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+    store_id = database.get_stores()[0]['id']
+    products = {
+        'iced': database.add_product("冰拿鐵", 76, 80, 30, "4719990000011", "飲料"),
+        'hot': database.add_product("熱拿鐵 Latte", 71, 75, 28, "4719990000028", "飲料"),
+        'pie': database.add_product("拿破崙派", 85, 90, 35, "4719990000035", "點心"),
+    }
+    database.add_store_product(store_id, products['iced'], 80, 84, 12)
+    return store_id, products
+
+
+def found(search):
+    """搜尋結果中本測試建立的商品（條碼 471999 開頭，不含範例商品）"""
+    return sorted(p['id'] for p in database.get_products(search) if (p['barcode'] or '').startswith('471999'))
+
+
+def test_barcode_lookup():
+    """條碼完全相符：掃描查詢附分店售價與庫存，搜尋框輸入條碼也找得到"""
+    store_id, products = setup_db()
+    product = database.find_product_by_barcode("4719990000011", store_id)
+    assert (product['id'], product['name'], product['price'], product['stock']) == (products['iced'], "冰拿鐵", 84, 12)
+    assert database.find_product_by_barcode("4719990000028")['id'] == products['hot']
+    assert database.find_product_by_barcode("4719990000099") is None
+    assert found("4719990000035") == [products['pie']]
+
+
+def test_cjk_substring():
+    """中文子字串與英文前綴比對"""
+    _, products = setup_db()
+    assert found("拿鐵") == sorted([products['iced'], products['hot']])
+    assert found("冰拿鐵") == [products['iced']]
+    assert found("拿") == sorted(products.values())
+    assert found("拿破崙") == [products['pie']]
+    assert found("lat") == [products['hot']]
+    assert found("紅茶") == []
+
+
+def test_sync_after_update_and_delete():
+    """其他連線直接寫入不會失敗；改名、刪除後索引同步，斷詞由匯入或 refresh_product_search() 補齊"""
+    _, products = setup_db()
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute("UPDATE products SET name = '熱美式' WHERE id = ?", (products['hot'],))
+    conn.execute("DELETE FROM products WHERE id = ?", (products['pie'],))
+    raw = conn.execute("INSERT INTO products (name, barcode) VALUES ('焦糖拿鐵', '4719990000042')").lastrowid
+    conn.commit()
+    conn.close()
+    assert found("拿鐵") == [products['iced']]
+    assert found("熱美式") == [products['hot']] and found("拿破崙") == []
+    assert found("焦糖拿鐵") == [raw] and found("4719990000042") == [raw]
+
+    with database.transaction() as conn:
+        assert database.refresh_product_search(conn.cursor()) == 2
+    assert found("美式") == [products['hot']]
+    assert found("拿鐵") == sorted([products['iced'], raw])
+
+    path = os.path.join(os.path.dirname(database.DB_PATH), "rename.csv")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("barcode,name\n4719990000011,冰燕麥拿鐵\n4719990000059,抹茶拿鐵\n")
+    assert catalog_import.import_catalog(path)['success']
+    assert found("燕麥") == [products['iced']]
+    assert found("抹茶") == [database.find_product_by_barcode("4719990000059")['id']]
+    assert len(found("拿鐵")) == 3
+    with database.transaction() as conn:
+        assert database.refresh_product_search(conn.cursor()) == 0
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  商品搜尋測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_barcode_lookup()
+    print("✓ 條碼完全相符")
+    with temp_db():
+        test_cjk_substring()
+    print("✓ 中文子字串比對")
+    with temp_db():
+        test_sync_after_update_and_delete()
+    print("✓ 改名、刪除後索引同步")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+促銷索引測試
+promotion_index 的查詢結果與 get_promotions(product_id) 相同，重複查詢不重新載入；
+start_date / end_date 日期邊界由已載入資料重新篩選；新增促銷、適用商品、套用節慶模板
+或其他連線直接修改 promotions 後重新載入。
+"""
+
+import sys
+import os
+import sqlite3
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+
+def setup_db():
+    product_ids = [p['id'] for p in database.get_products()][:3]
+    small = database.add_promotion("小折扣", "fixed", 3)
+    large = database.add_promotion("大折扣", "percent", 20)
+    later = database.add_promotion("下月促銷", "fixed", 9, start_date="2099-01-01", end_date="2099-01-31")
+    for promo_id in (small, large, later):
+        database.add_promotion_product(promo_id, product_ids[0])
+    database.add_promotion_product(small, product_ids[1])
+    return product_ids, {'small': small, 'large': large, 'later': later}
+
+
+def ids(promos):
+    return [p['id'] for p in promos]
+
+
+def test_lookup_matches_query():
+    """索引查詢與 SQL 查詢相同（依折扣值由高到低），重複查詢不重新載入"""
+    product_ids, promos = setup_db()
+    for product_id in product_ids:
+        assert database.get_active_promotions(product_id) == database.get_promotions(product_id)
+    assert ids(database.get_active_promotions(product_ids[0])) == [promos['large'], promos['small']]
+    loads = database.promotion_index.loads
+    for _ in range(100):
+        database.get_active_promotions(product_ids[0])
+    assert database.promotion_index.loads == loads
+
+
+def test_date_boundaries():
+    """跨過開始 / 結束日期時由已載入的資料重新篩選，不重新查詢"""
+    product_ids, promos = setup_db()
+    index = database.PromotionIndex()
+    version = database.data_version('promotions')
+    index._refresh('2099-01-01', version)
+    assert ids(index._active[product_ids[0]]) == [promos['large'], promos['later'], promos['small']]
+    index._refresh('2099-02-01', version)
+    assert ids(index._active[product_ids[0]]) == [promos['large'], promos['small']]
+    assert index.loads == 1
+
+
+def test_writes_invalidate():
+    """新增適用商品、套用節慶模板與其他連線的修改都會重新載入"""
+    product_ids, promos = setup_db()
+    database.get_active_promotions(product_ids[2])
+    loads = database.promotion_index.loads
+
+    database.add_promotion_product(promos['large'], product_ids[2])
+    assert ids(database.get_active_promotions(product_ids[2])) == [promos['large']]
+    assert database.promotion_index.loads == loads + 1
+
+    database.add_holiday_template("週年慶", "percent", 15)
+    with database.db_connection() as conn:
+        template_id = conn.execute("SELECT MAX(id) FROM holiday_promotions").fetchone()[0]
+    database.apply_holiday_template(template_id)
+    database.get_active_promotions(product_ids[2])
+    assert database.promotion_index.loads == loads + 2
+
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute("UPDATE promotions SET is_active = 0 WHERE id = ?", (promos['large'],))
+    conn.commit()
+    conn.close()
+    assert database.get_active_promotions(product_ids[2]) == []
+    assert ids(database.get_active_promotions(product_ids[0])) == [promos['small']]
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  促銷索引測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_lookup_matches_query()
+    print("✓ 索引查詢與 SQL 相同")
+    with temp_db():
+        test_date_boundaries()
+    print("✓ 日期邊界重新篩選")
+    with temp_db():
+        test_writes_invalidate()
+    print("✓ 寫入後重新載入")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+查詢計畫回歸測試
+對熱門路徑（收銀、會員、報表、電子發票）實際執行的每一條 SQL 跑 EXPLAIN QUERY PLAN，
+大表出現全表掃描（SCAN）或臨時自動索引時即判定失敗。
+"""
+
+import sys
+import os
+import re
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+# 資料量小、全表掃描可接受的設定表
+SMALL_TABLES = {
+    'stores', 'member_levels', 'birthday_coupons', 'holiday_promotions',
+    'einvoice_track_numbers', 'promotions',
+    # 整車預留庫存時逐項走訪綁定的 JSON 參數
+    'json_each',
+    # FTS5 在連線首次使用（或結構變更後）讀取的設定影子表，只有數列
+    'products_fts_config',
+    # 資料版本表，每個範圍一列
+    'data_versions',
+}
+
+# 依定義須讀取整張表的呼叫：(說明) -> 可全表掃描的資料表
+WHOLE_TABLE_CALLS = {
+    # 全部分店（含已刪除分店）的總筆數加總整張每日彙總，列數 = 分店數 x 營業天數
+    "count_sales()": {'sales_daily_rollup'},
+}
+
+TABLE_ALIAS = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(?!WHERE|ON|SET|JOIN|LEFT|ORDER|GROUP|LIMIT|VALUES)(\w+))?', re.I)
+# SCAN CONSTANT ROW 為沒有 FROM 的純量查詢，不是資料表；影子表的計畫帶 main. 前綴
+SCAN = re.compile(r'^SCAN (?!CONSTANT ROW)(?:\w+\.)?(\w+)')
+# FTS5 以 MATCH 查詢時計畫顯示為 SCAN ... VIRTUAL TABLE INDEX n:M...，屬於索引查詢
+FTS_MATCH = re.compile(r'VIRTUAL TABLE INDEX \d+:\S*M')
+# 以 LIMIT 限制筆數的子查詢（如排行前 N 名）再掃描一次不算全表掃描
+LIMITED_SUBQUERY = re.compile(r'LIMIT \d+\)\s*(?:AS\s+)?(\w+)', re.I)
+
+
+def setup_db():
+    """建立測試資料"""
+    database.add_store("測試門市", "12345678")
+    store_id = database.get_stores()[0]['id']
+    database.add_store("第二門市", "87654321")
+    other_id = [s['id'] for s in database.get_stores() if s['id'] != store_id][0]
+    for p in database.get_products():
+        database.add_store_product(store_id, p['id'], p['price_ex_tax'], p['price_inc_tax'], 100)
+        database.add_store_product(other_id, p['id'], p['price_ex_tax'], p['price_inc_tax'], 100)
+    database.add_member_level("gold", 100, 1000, 5, 50)
+    member_id = database.add_member("王小明", "0912345678", birthday="2000-01-01")
+    promo_id = database.add_promotion("拿鐵9折", "percent", 10)
+    database.add_promotion_product(promo_id, 2)
+
+
+def hot_calls():
+    """熱門路徑呼叫清單：(說明, 呼叫函數)"""
+    store_id = database.get_stores()[0]['id']
+    member = database.get_member_by_phone("0912345678")
+    items = [{'product_id': 2, 'name': '拿鐵', 'quantity': 2, 'price': 95, 'subtotal': 190}]
+    store = {'code': '12345678', 'name': '測試門市'}
+    invoice = {}
+    transfer = {}
+    other_id = [s['id'] for s in database.get_stores() if s['id'] != store_id][0]
+    # 促銷索引/計價規則是整批載入的快取，先載入，只檢查結帳本身的查詢
+    database.price_cart(store_id, member, items)
+
+    def issue_einvoice():
+        invoice['id'], invoice['number'] = database.create_einvoice(
+            store, {}, [{'product_id': 2, 'name': '拿鐵', 'quantity': 1, 'unit_price': 95, 'amount': 95}])
+
+    return [
+        ("get_products(search)", lambda: database.get_products("拿鐵")),
+        ("get_pos_catalog(search)", lambda: database.get_pos_catalog(store_id, "拿鐵")),
+        ("get_pos_catalog(barcode)", lambda: database.get_pos_catalog(store_id, "A002")),
+        ("find_product_by_barcode", lambda: database.find_product_by_barcode("A002", store_id)),
+        ("get_store_product", lambda: database.get_store_product(store_id, 2)),
+        ("check_stock_available", lambda: database.check_stock_available(store_id, 2, 1)),
+        ("check_cart_stock", lambda: database.check_cart_stock(store_id, items)),
+        ("get_stock_levels", lambda: database.get_stock_levels(store_id, [1, 2, 3])),
+        ("get_promotions(product_id)", lambda: database.get_promotions(2)),
+        # 會員快取未命中時的查詢
+        ("get_member_by_phone", lambda: (database.member_cache.clear(), database.get_member_by_phone("0912345678"))),
+        ("get_member_by_id", lambda: (database.member_cache.clear(), database.get_member_by_id(member['id']))),
+        ("create_sale", lambda: database.create_sale(
+            store_id, member['id'], 190, 0, 0, 0, 190, 200, 10, items=items)),
+        ("checkout", lambda: database.checkout(store_id, items, member, {'cash': 200})),
+        ("checkout(庫存不足)", lambda: database.checkout(
+            store_id, [dict(items[0], quantity=10 ** 6, subtotal=95 * 10 ** 6)], member)),
+        ("update_member_points", lambda: database.update_member_points(member['id'], 10, "測試", store_id)),
+        ("bulk_earn_points", lambda: database.bulk_earn_points([(member['id'], 10), (member['id'], 5)], "加贈")),
+        ("update_store_stock", lambda: database.update_store_stock(store_id, 2, 5)),
+        ("apply_stock_document(receive)", lambda: database.apply_stock_document(store_id, 'receive', [(1, 5), (2, 3)])),
+        ("apply_stock_document(count)", lambda: database.apply_stock_document(store_id, 'count', [(1, 100), (3, 50)])),
+        ("get_stock_movements", lambda: database.get_stock_movements(store_id)),
+        ("get_stock_movements(product_id)", lambda: database.get_stock_movements(store_id, 2)),
+        ("snapshot_store_stock", lambda: database.snapshot_store_stock(store_id)),
+        ("get_inventory_as_of", lambda: database.get_inventory_as_of(store_id, '9999-12-31')),
+        ("get_inventory_as_of(快照前)", lambda: database.get_inventory_as_of(store_id, '2020-01-01')),
+        ("get_sales(store_id)", lambda: database.get_sales(store_id)),
+        ("get_sales(before)", lambda: database.get_sales(store_id, 50, ('9999-12-31', 0))),
+        ("get_sales(before, 全部)", lambda: database.get_sales(None, 50, ('9999-12-31', 0))),
+        ("count_sales(store_id)", lambda: database.count_sales(store_id)),
+        ("count_sales()", lambda: database.count_sales()),
+        ("get_members(page)", lambda: database.get_members(limit=100, before=('9999-12-31', 0))),
+        ("count_members", lambda: database.count_members()),
+        ("get_invoices(before)", lambda: database.get_invoices(store_id, before=('9999-12-31', 0))),
+        ("get_invoices(before, 全部)", lambda: database.get_invoices(before=('9999-12-31', 0))),
+        ("count_invoices(store_id)", lambda: database.count_invoices(store_id)),
+        ("get_all_einvoices(before)", lambda: database.get_all_einvoices(before=10 ** 9)),
+        ("get_transfers(store_id)", lambda: database.get_transfers(store_id, limit=100)),
+        ("get_transfers(before)", lambda: database.get_transfers(limit=100, before=('9999-12-31', 0))),
+        ("count_transfers(store_id)", lambda: database.count_transfers(store_id)),
+        ("get_transfers(pending)", lambda: database.get_transfers(status='pending', limit=100)),
+        ("create_transfer_order", lambda: transfer.update(database.create_transfer_order(store_id, other_id, [(1, 1), (2, 1)]))),
+        ("approve_transfers", lambda: database.approve_transfers(transfer['transfer_ids'], 1)),
+        ("approve_transfer_order", lambda: database.approve_transfer_order(transfer['order_id'], 1)),
+        ("get_transfer_orders(store_id)", lambda: database.get_transfer_orders(store_id)),
+        ("get_daily_sales(store_id)", lambda: database.get_daily_sales(store_id)),
+        ("get_daily_sales()", lambda: database.get_daily_sales()),
+        ("get_store_revenue(store_id)", lambda: database.get_store_revenue(store_id)),
+        ("get_store_revenue()", lambda: database.get_store_revenue(days=1)),
+        ("get_hourly_sales(store_id)", lambda: database.get_hourly_sales(store_id)),
+        ("get_hourly_sales()", lambda: database.get_hourly_sales()),
+        ("get_sales_heatmap(store_ids)", lambda: database.get_sales_heatmap(store_ids=[store_id])),
+        ("get_sales_heatmap()", lambda: database.get_sales_heatmap()),
+        ("get_top_products(store_id)", lambda: database.get_top_products(store_id, 10, '2020-01-01')),
+        ("get_top_products()", lambda: database.get_top_products()),
+        ("get_low_stock_products", lambda: database.get_low_stock_products(store_id)),
+        ("create_einvoice", issue_einvoice),
+        ("get_einvoice", lambda: database.get_einvoice(invoice['number'])),
+        ("get_einvoice_details", lambda: database.get_einvoice_details(invoice['id'])),
+        ("get_einvoice_amount", lambda: database.get_einvoice_amount(invoice['id'])),
+        ("generate_mig_xml", lambda: database.generate_mig_xml(invoice['number'])),
+        ("get_einvoice_statistics(seller)", lambda: database.get_einvoice_statistics('12345678', '2020-01-01')),
+    ]
+
+
+def capture_statements(func):
+    """執行函數並擷取其送出的 SQL（已代入參數）"""
+    statements = []
+    with database.db_connection() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            func()
+        finally:
+            conn.set_trace_callback(None)
+    return [s for s in statements if s.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'WITH'))]
+
+
+def full_scans(sql, allowed=()):
+    """回傳此 SQL 查詢計畫中大表的全表掃描 / 自動索引（allowed 內的資料表除外）"""
+    aliases = {}
+    for table, alias in TABLE_ALIAS.findall(sql):
+        aliases[table] = table
+        if alias:
+            aliases[alias] = table
+    limited = set(LIMITED_SUBQUERY.findall(sql))
+    problems = []
+    with database.db_connection() as conn:
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+    for detail in plan:
+        match = SCAN.match(detail)
+        if match and (FTS_MATCH.search(detail) or match.group(1) in limited):
+            continue
+        table = aliases.get(match.group(1), match.group(1)) if match else None
+        if match and table not in SMALL_TABLES and table not in allowed:
+            problems.append(detail)
+        elif 'AUTOMATIC' in detail:
+            problems.append(detail)
+    return problems
+
+
+def test_indexes_created():
+    """索引定義都已建立（已移除的除外）"""
+    setup_db()
+    with database.db_connection() as conn:
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    missing = [name for _, name, _, _ in database.SCHEMA_INDEXES
+               if name not in existing and name not in database.DROPPED_INDEXES]
+    assert not missing, f"缺少索引: {missing}"
+
+
+def test_hot_queries_use_indexes():
+    """熱門查詢不得全表掃描"""
+    setup_db()
+    failures = []
+    for label, call in hot_calls():
+        for sql in capture_statements(call):
+            problems = full_scans(sql, WHOLE_TABLE_CALLS.get(label, ()))
+            if problems:
+                failures.append((label, ' '.join(sql.split()), problems))
+                print(f"  ✗ {label}: {problems}")
+        if not any(f[0] == label for f in failures):
+            print(f"  ✓ {label}")
+    assert not failures, "\n".join(f"{label}: {problems}\n    {sql}" for label, sql, problems in failures)
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  查詢計畫回歸測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_indexes_created()
+    print("✓ 索引定義都已建立\n")
+    with temp_db():
+        test_hot_queries_use_indexes()
+    print("\n✓ 熱門查詢皆有使用索引")
+
+
+if __name__ == '__main__':
+    main()
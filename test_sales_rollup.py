@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+銷售彙總測試
+create_sale / checkout 累加的 sales_daily_rollup / sales_hourly_cube / sales_product_daily
+必須與直接由 sales 計算的結果一致；
+直接寫入 sales 的歷史資料以 rebuild_sales_rollup() 回補。
+"""
+
+import sys
+import os
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+import manage
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+    database.add_store("第二門市", "87654321")
+
+
+def rows(results):
+    return [tuple(row) for row in results]
+
+
+def expected_revenue(store_id=None, days=30):
+    """直接由 sales 計算的分店營收（舊版查詢）"""
+    with database.db_connection() as conn:
+        if store_id:
+            return rows(conn.execute('''SELECT DATE(created_at), SUM(total), COUNT(*)
+                FROM sales WHERE store_id = ? AND created_at >= date('now', '-' || ? || ' days')
+                GROUP BY DATE(created_at) ORDER BY 1''', (store_id, days)))
+        return rows(conn.execute('''SELECT store_id, COALESCE(st.name, ?), SUM(total), COUNT(*)
+            FROM sales s LEFT JOIN stores st ON s.store_id = st.id
+            WHERE s.created_at >= date('now', '-' || ? || ' days')
+            GROUP BY store_id ORDER BY 3 DESC, 1''', (database.DELETED_STORE_NAME, days)))
+
+
+def expected_hourly(store_id=None, days=7):
+    """直接由 sales 計算的時段分析（舊版查詢）"""
+    with database.db_connection() as conn:
+        if store_id:
+            return rows(conn.execute('''SELECT strftime('%H', created_at) as hour, COUNT(*), SUM(total)
+                FROM sales WHERE store_id = ? AND created_at >= date('now', '-' || ? || ' days')
+                GROUP BY hour ORDER BY hour''', (store_id, days)))
+        return rows(conn.execute('''SELECT strftime('%H', created_at) as hour, COUNT(*), SUM(total)
+            FROM sales WHERE created_at >= date('now', '-' || ? || ' days')
+            GROUP BY hour ORDER BY hour''', (days,)))
+
+
+def expected_top(store_id=None, start_date='', end_date='9999-12-31', limit=10):
+    """直接由 sale_items 計算的熱銷商品"""
+    with database.db_connection() as conn:
+        return rows(conn.execute('''SELECT p.name, SUM(si.quantity) as qty, SUM(si.subtotal) as revenue
+            FROM sale_items si JOIN sales s ON si.sale_id = s.id JOIN products p ON p.id = si.product_id
+            WHERE (? IS NULL OR s.store_id = ?) AND date(s.created_at) BETWEEN ? AND ?
+            GROUP BY si.product_id ORDER BY revenue DESC LIMIT ?''',
+            (store_id, store_id, start_date, end_date, limit)))
+
+
+def test_rollup_matches_sales():
+    """結帳累加的彙總與 sales 一致"""
+    setup_db()
+    store_ids = [s['id'] for s in database.get_stores()]
+    product = database.get_products()[0]
+    for store_id in store_ids:
+        database.add_store_product(store_id, product['id'], 100, 105, 100)
+    cart = [{'product_id': product['id'], 'name': product['name'], 'quantity': 1, 'price': 105, 'subtotal': 105}]
+    # 今日排行先載入，之後的結帳由記憶體累加
+    assert database.get_today_top_products(store_ids[0]) == []
+    database.checkout(store_ids[0], cart)
+    database.checkout(store_ids[0], cart, payment={'discount': 5})
+    database.create_sale(store_ids[1], None, 210, 10, 0, 0, 200, 200, 0, items=cart)
+
+    assert database.get_daily_sales(store_ids[0]) == {'orders': 2, 'revenue': 205}
+    assert database.get_daily_sales() == {'orders': 3, 'revenue': 405}
+    for store_id in store_ids + [None]:
+        assert rows(database.get_store_revenue(store_id)) == expected_revenue(store_id)
+        assert rows(database.get_hourly_sales(store_id)) == expected_hourly(store_id)
+
+    heatmap = database.get_sales_heatmap(store_ids=[store_ids[0]])
+    assert [(h['orders'], h['revenue'], h['item_count']) for h in heatmap] == [(2, 205, 2)]
+    assert sum(h['orders'] for h in database.get_sales_heatmap()) == 3
+    assert database.get_sales_heatmap('2000-01-01', '2000-01-31') == []
+    for store_id in store_ids + [None]:
+        assert rows(database.get_top_products(store_id)) == expected_top(store_id)
+    assert rows(database.get_top_products(start_date='2000-01-01', end_date='2000-01-31')) == []
+
+    loads = database.today_leaderboard.loads
+    today = database.get_today_top_products(store_ids[0])
+    assert database.today_leaderboard.loads == loads, "今日排行不應重新載入"
+    assert [(t['product_name'], t['total_qty'], t['total_sales']) for t in today] == expected_top(store_ids[0])
+    # 在外層交易內首次查詢：不另開交易、不影響外層，也不保留可能含未提交資料的排行
+    database.today_leaderboard.reset()
+    with database.transaction() as conn:
+        assert database.get_today_top_products(store_ids[0]) == today
+        assert conn.in_transaction
+    assert database.get_today_top_products(store_ids[0]) == today
+    assert database.check_sales_rollup() == []
+
+
+def test_rebuild_backfills_history():
+    """直接寫入的歷史銷售由 manage.py check-sales-rollup 偵測並 --repair 回補"""
+    setup_db()
+    store_ids = [s['id'] for s in database.get_stores()]
+    products = database.get_products()
+    with database.transaction() as conn:
+        conn.executemany('''INSERT INTO sales (id, store_id, subtotal, total, created_at)
+            VALUES (?, ?, 100, 100, datetime('now', ? || ' days'))''',
+            [(i + 1, store_ids[i % 2], -(i % 40)) for i in range(200)])
+        conn.executemany('''INSERT INTO sale_items (sale_id, product_id, product_name, quantity, unit_price, subtotal)
+            VALUES (?, ?, ?, ?, 50, ?)''',
+            [(i + 1, p['id'], p['name'], i % 3 + 1, 50 * (i % 3 + 1))
+             for i in range(200) for p in products[i % 3:i % 3 + 2]])
+    assert rows(database.get_store_revenue(days=60)) == []
+    mismatches = database.check_sales_rollup()
+    assert {m['table'] for m in mismatches} == set(database.SALES_ROLLUPS)
+    assert manage.main(['check-sales-rollup']) == 1
+
+    assert manage.main(['check-sales-rollup', '--repair']) == 0
+    assert database.check_sales_rollup() == []
+    for store_id in store_ids + [None]:
+        assert rows(database.get_store_revenue(store_id, days=60)) == expected_revenue(store_id, 60)
+        assert rows(database.get_hourly_sales(store_id, days=60)) == expected_hourly(store_id, 60)
+        assert rows(database.get_top_products(store_id)) == expected_top(store_id)
+        week = (time.strftime('%Y-%m-%d', time.gmtime(time.time() - 7 * 86400)), '9999-12-31')
+        assert rows(database.get_top_products(store_id, 3, *week)) == expected_top(store_id, *week, limit=3)
+
+    # 只重建單一分店近期資料不影響其他彙總
+    rebuilt = database.rebuild_sales_rollup(store_id=store_ids[0], since='2000-01-01')
+    assert rebuilt['sales_daily_rollup'] > 0
+    assert database.check_sales_rollup() == []
+def test_deleted_store_stays_in_totals():
+    """直接刪除的分店，其銷售仍計入全部分店的合計（與 sales 一致）"""
+    setup_db()
+    store_ids = [s['id'] for s in database.get_stores()]
+    product = database.get_products()[0]
+    cart = [{'product_id': product['id'], 'name': product['name'], 'quantity': 1, 'price': 105, 'subtotal': 105}]
+    for store_id in store_ids:
+        database.add_store_product(store_id, product['id'], 100, 105, 100)
+        database.checkout(store_id, cart)
+    with database.transaction() as conn:
+        conn.execute("DELETE FROM stores WHERE id = ?", (store_ids[1],))
+
+    assert database.count_sales() == 2
+    assert database.get_daily_sales() == {'orders': 2, 'revenue': 210}
+    revenue = rows(database.get_store_revenue())
+    assert revenue == expected_revenue()
+    assert (store_ids[1], database.DELETED_STORE_NAME, 105, 1) in revenue
+    assert rows(database.get_hourly_sales()) == expected_hourly()
+    assert sum(h['orders'] for h in database.get_sales_heatmap()) == 2
+    assert rows(database.get_top_products()) == expected_top()
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  銷售彙總測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_rollup_matches_sales()
+    print("✓ 結帳累加的彙總與 sales 一致")
+    with temp_db():
+        test_rebuild_backfills_history()
+    print("✓ 歷史資料回補")
+    with temp_db():
+        test_deleted_store_stays_in_totals()
+    print("✓ 已刪除分店仍計入合計")
+
+
+if __name__ == '__main__':
+    main()
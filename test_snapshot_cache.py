@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+快照快取測試
+資料未異動時重複讀取不查資料庫；任何連線 / 行程寫入後資料版本遞增，下次讀取取得新資料。
+"""
+
+import sys
+import os
+import sqlite3
+import subprocess
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+
+
+def count_queries(func):
+    """執行函數並回傳送出的 SELECT 數"""
+    statements = []
+    with database.db_connection() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            func()
+        finally:
+            conn.set_trace_callback(None)
+    return sum(1 for s in statements if s.lstrip().upper().startswith('SELECT'))
+
+
+def test_reads_hit_cache_until_write():
+    """未異動時命中快取，寫入後重新載入"""
+    setup_db()
+    store_id = database.get_stores()[0]['id']
+    product_id = database.get_products()[0]['id']
+    database.add_store_product(store_id, product_id, 100, 105, 10)
+
+    def reads():
+        database.cached_stores(is_active=1)
+        database.cached_products(store_id=store_id)
+        database.cached_pos_catalog(store_id)
+        database.cached_member_levels()
+        database.cached_birthday_coupon()
+
+    assert count_queries(reads) > 0
+    before = database.get_snapshot_stats()
+    assert count_queries(reads) == 0, "資料未異動時不應查詢資料庫"
+    after = database.get_snapshot_stats()
+    assert after['hits'] - before['hits'] == 5
+
+    database.update_store_stock(store_id, product_id, -3)
+    catalog = database.cached_pos_catalog(store_id)
+    assert [p['stock'] for p in catalog if p['id'] == product_id] == [7]
+
+    database.add_member_level("gold", 100, 1000, 5, 50)
+    assert [lv['name'] for lv in database.cached_member_levels()] == ["gold"]
+
+    database.add_store("第二門市", "87654321")
+    assert len(database.cached_stores()) == 2
+
+
+def test_checkout_invalidates_stock():
+    """結帳扣庫存後，快取的分店商品反映新庫存"""
+    setup_db()
+    store_id = database.get_stores()[0]['id']
+    product = database.get_products()[0]
+    database.add_store_product(store_id, product['id'], 100, 105, 10)
+    stock = {p['id']: p['stock'] for p in database.cached_products(store_id=store_id)}
+    assert stock[product['id']] == 10
+    cart = [{'product_id': product['id'], 'name': product['name'], 'quantity': 2, 'price': 105, 'subtotal': 210}]
+    assert database.checkout(store_id, cart)['success']
+    stock = {p['id']: p['stock'] for p in database.cached_products(store_id=store_id)}
+    assert stock[product['id']] == 8
+
+
+def test_other_process_writes():
+    """其他行程（manage.py、直接執行 SQL）寫入後，快照快取、會員快取與今日排行都重新載入"""
+    setup_db()
+    workdir = os.path.dirname(database.DB_PATH)
+    store_id = database.get_stores()[0]['id']
+    product = database.get_products()[0]
+    database.add_store_product(store_id, product['id'], 100, 105, 10)
+    member_id = database.add_member("王小明", "0912345678")
+    cart = [{'product_id': product['id'], 'name': product['name'], 'quantity': 2, 'price': 105, 'subtotal': 210}]
+    assert database.checkout(store_id, cart)['success']
+
+    assert [p['stock'] for p in database.cached_pos_catalog(store_id) if p['id'] == product['id']] == [8]
+    assert database.get_member_by_id(member_id)['points'] == 0
+    assert [t['total_qty'] for t in database.get_today_top_products(store_id)] == [2]
+    # 本行程的結帳直接累加，不重新載入
+    loads = database.today_leaderboard.loads
+    assert database.checkout(store_id, cart)['success']
+    assert [t['total_qty'] for t in database.get_today_top_products(store_id)] == [4]
+    assert database.today_leaderboard.loads == loads
+
+    path = os.path.join(workdir, "prices.csv")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"barcode,price_ex_tax,stock\n{product['barcode']},200,50\n")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "manage.py")
+    subprocess.run([sys.executable, script, '--db', database.DB_PATH, 'import-catalog', path, '--store', '12345678'],
+                   check=True, capture_output=True)
+    other = sqlite3.connect(database.DB_PATH)
+    other.execute("UPDATE members SET points = 500 WHERE id = ?", (member_id,))
+    other.execute("UPDATE sales_product_daily SET quantity = quantity + 10 WHERE store_id = ?", (store_id,))
+    other.commit()
+    other.close()
+
+    catalog = database.cached_pos_catalog(store_id)
+    assert [(p['store_price'], p['stock']) for p in catalog if p['id'] == product['id']] == [(200, 50)]
+    assert database.get_member_by_id(member_id)['points'] == 500
+    assert database.get_member_by_phone("0912345678")['points'] == 500
+    assert [t['total_qty'] for t in database.get_today_top_products(store_id)] == [14]
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  快照快取測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_reads_hit_cache_until_write()
+    print("✓ 未異動時命中快取，寫入後重新載入")
+    with temp_db():
+        test_checkout_invalidates_stock()
+    print("✓ 結帳後庫存快取失效")
+    with temp_db():
+        test_other_process_writes()
+    print("✓ 其他行程寫入後快取失效")
+
+
+if __name__ == '__main__':
+    main()
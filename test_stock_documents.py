@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+庫存單據測試
+進貨 / 調整為增減量、盤點為實盤數量；整張單據在同一交易內套用，回傳差異並寫入 stock_movements；
+無效明細退回，不影響其他明細。
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("測試門市", "12345678")
+    store_id = database.get_stores()[0]['id']
+    products = [p['id'] for p in database.get_products()]
+    for product_id in products[:3]:
+        database.add_store_product(store_id, product_id, 100, 105, 10)
+    return store_id, products
+
+
+def stock(store_id, product_id):
+    return database.get_store_product(store_id, product_id)['stock']
+
+
+def test_receive_and_adjust():
+    """增減量單據：同商品多行加總，未上架商品自動新增，日誌記錄異動後庫存"""
+    store_id, products = setup_db()
+    a, b, c, new = products[:4]
+    result = database.apply_stock_document(store_id, 'receive', [(a, 5), (b, 3), (a, 2), (new, 7), (c, 0)],
+                                           reference="GR-001")
+    assert result['success'] and result['rejected'] == []
+    assert (result['lines'], result['changed']) == (4, 3)
+    assert stock(store_id, a) == 17 and stock(store_id, b) == 13 and stock(store_id, new) == 7
+    assert database.get_store_product(store_id, new)['price_inc_tax'] == database.get_product_by_id(new)['price_inc_tax']
+
+    result = database.apply_stock_document(store_id, 'adjust', [(a, -4), (b, 1.5), (999999, 1)], reference="ADJ-1")
+    assert stock(store_id, a) == 13
+    assert [(r['product_id'], r['message']) for r in result['rejected']] == [(b, '數量必須為整數'), (999999, '商品不存在')]
+
+    movements = database.get_stock_movements(store_id, a)
+    assert [(m['quantity_change'], m['stock_after'], m['movement_type'], m['reference']) for m in movements] == [
+        (-4, 13, 'adjust', 'ADJ-1'), (7, 17, 'receive', 'GR-001'), (10, 10, 'set', None)]
+    assert database.apply_stock_document(store_id, 'transfer', [(a, 1)])['success'] is False
+
+
+def test_stocktake_variances():
+    """盤點：以實盤數量覆蓋庫存，回傳差異；沒有差異的商品不寫日誌"""
+    store_id, products = setup_db()
+    a, b, c = products[:3]
+    result = database.apply_stock_document(store_id, 'count', [(a, 8), (b, 10), (c, 4), (c, 1), (a, -1)],
+                                           reference="ST-2026-10")
+    assert [(v['product_id'], v['before'], v['after'], v['variance']) for v in result['variances']] == [
+        (a, 10, 8, -2), (b, 10, 10, 0), (c, 10, 5, -5)]
+    assert result['rejected'][0]['message'] == '盤點數量不可為負'
+    assert result['changed'] == 2
+    assert (stock(store_id, a), stock(store_id, b), stock(store_id, c)) == (8, 10, 5)
+    assert [m['movement_type'] for m in database.get_stock_movements(store_id, b)] == ['set']
+    # 重複套用同一張盤點單不再產生異動
+    assert database.apply_stock_document(store_id, 'count', [(a, 8), (c, 5)])['changed'] == 0
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  庫存單據測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_receive_and_adjust()
+    print("✓ 進貨 / 調整單據")
+    with temp_db():
+        test_stocktake_variances()
+    print("✓ 盤點差異")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+庫存異動日誌與歷史庫存測試
+銷售、結帳、調整、調貨、單據與匯入都寫入 stock_movements，日誌重建的庫存等於 store_products.stock；
+get_inventory_as_of() 以快照 + 異動重建任一時間點的庫存；舊資料庫升級時補期初異動。
+"""
+
+import sys
+import os
+import sqlite3
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+import manage
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("台北店", "12345678")
+    database.add_store("台中店", "87654321")
+    stores = {s['code']: s['id'] for s in database.get_stores()}
+    products = [p['id'] for p in database.get_products()]
+    for product_id in products[:3]:
+        database.add_store_product(stores["12345678"], product_id, 100, 105, 20)
+    return stores["12345678"], stores["87654321"], products
+
+
+def backdate(timestamp, table='stock_movements'):
+    """把尚未設定日期的異動 / 快照改到指定時間（測試時間點都在 2026-10-01 ~ 10-03）"""
+    with database.transaction() as conn:
+        conn.execute(f"UPDATE {table} SET created_at = ? WHERE created_at NOT LIKE '2026-10-0_ %'", (timestamp,))
+
+
+def replay(store_id, as_of):
+    """不使用快照，直接加總全部異動"""
+    with database.db_connection() as conn:
+        rows = conn.execute('''SELECT product_id, SUM(quantity_change) FROM stock_movements
+            WHERE store_id = ? AND created_at <= ? GROUP BY product_id''', (store_id, as_of)).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def test_all_paths_write_movements():
+    """各種庫存異動路徑都寫日誌，stock_after 為異動後庫存"""
+    taipei, taichung, products = setup_db()
+    a, b, c = products[:3]
+    items = [{'product_id': a, 'name': '甲', 'quantity': 2, 'price': 105, 'subtotal': 210},
+             {'product_id': a, 'name': '甲', 'quantity': 1, 'price': 105, 'subtotal': 105}]
+    sale_id = database.create_sale(taipei, None, 315, 0, 0, 0, 315, 315, 0, items=items)
+    result = database.checkout(taipei, [dict(items[0], product_id=b)])
+    database.update_store_stock(taipei, c, -4)
+    transfer = database.create_transfer_order(taipei, taichung, [(a, 5), (b, 1)])
+    database.approve_transfers(transfer['transfer_ids'], 1)
+    database.apply_stock_document(taichung, 'count', [(a, 4)], "ST-1")
+
+    movements = [(m['product_id'], m['quantity_change'], m['stock_after'], m['movement_type'], m['reference'])
+                 for m in reversed(database.get_stock_movements(taipei))]
+    assert movements[3:] == [
+        (a, -2, 18, 'sale', str(sale_id)), (a, -1, 17, 'sale', str(sale_id)),
+        (b, -2, 18, 'sale', str(result['sale_id'])), (c, -4, 16, 'adjust', None),
+        (a, -5, 12, 'transfer_out', str(transfer['transfer_ids'][0])),
+        (b, -1, 17, 'transfer_out', str(transfer['transfer_ids'][1]))]
+    assert [m['movement_type'] for m in reversed(database.get_stock_movements(taichung, a))] == ['transfer_in', 'count']
+    assert database.get_inventory_as_of(taichung, '9999-12-31') == {a: 4, b: 1}
+    assert database.check_stock_movements() == []
+
+
+def test_inventory_as_of():
+    """快照 + 異動重建的歷史庫存與全部異動加總一致"""
+    taipei, taichung, products = setup_db()
+    a, b = products[:2]
+    backdate('2026-10-01 09:00:00')
+    database.update_store_stock(taipei, a, -3)
+    backdate('2026-10-01 15:00:00')
+    assert database.snapshot_store_stock() == 1
+    backdate('2026-10-01 23:59:59', 'stock_snapshots')
+
+    database.apply_stock_document(taipei, 'receive', [(a, 5), (b, 2)], "GR-1")
+    backdate('2026-10-02 10:00:00')
+    assert manage.main(['snapshot-stock']) == 0
+    backdate('2026-10-02 23:59:59', 'stock_snapshots')
+    assert database.snapshot_store_stock() == 0, "沒有新異動時不建立快照"
+
+    database.update_store_stock(taipei, b, -7)
+    backdate('2026-10-03 12:00:00')
+
+    expected = {
+        '2026-09-30 23:59:59': {},
+        '2026-10-01 12:00:00': {a: 20, b: 20, products[2]: 20},
+        '2026-10-01 18:00:00': {a: 17, b: 20, products[2]: 20},
+        '2026-10-02 12:00:00': {a: 22, b: 22, products[2]: 20},
+        '2026-10-03 23:00:00': {a: 22, b: 15, products[2]: 20},
+    }
+    for as_of, stock in expected.items():
+        assert database.get_inventory_as_of(taipei, as_of) == stock == replay(taipei, as_of), as_of
+    assert database.get_inventory_as_of(taipei, '9999-12-31') == database.get_stock_levels(taipei, products[:3])
+
+
+def test_drift_and_upgrade():
+    """直接修改 store_products 時 check-stock 偵測並補修正異動；升級時補期初異動"""
+    taipei, taichung, products = setup_db()
+    with database.transaction() as conn:
+        conn.execute("UPDATE store_products SET stock = 50 WHERE store_id = ? AND product_id = ?",
+                     (taipei, products[0]))
+    assert manage.main(['check-stock']) == 1
+    assert manage.main(['check-stock', '--repair']) == 0
+    assert database.check_stock_movements() == []
+    assert database.get_stock_movements(taipei, products[0])[0]['movement_type'] == 'reconcile'
+
+    # 模擬 v12 資料庫：沒有快照表，日誌不完整
+    database.close_pools()
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute("DROP TABLE stock_snapshot_items")
+    conn.execute("DROP TABLE stock_snapshots")
+    conn.execute("DELETE FROM stock_movements")
+    conn.execute("PRAGMA user_version = 12")
+    conn.commit()
+    conn.close()
+    database.init_db()
+    assert database.check_stock_movements() == []
+    assert database.get_inventory_as_of(taipei, '9999-12-31')[products[0]] == 50
+    assert {m['movement_type'] for m in database.get_stock_movements(taipei)} == {'opening'}
+
+
+def test_readd_store_product():
+    """重新設定分店商品時更新原本那一列；v14 遷移合併重複列並建立唯一索引"""
+    taipei, taichung, products = setup_db()
+    a, b = products[:2]
+    database.add_store_product(taichung, a, 100, 105, 5)
+    database.add_store_product(taichung, a, 120, 126, 9)
+    assert database.get_store_product(taichung, a)['stock'] == 9
+    assert database.get_store_product(taichung, a)['price_ex_tax'] == 120
+    assert [(m['quantity_change'], m['stock_after']) for m in database.get_stock_movements(taichung, a)] == [
+        (4, 9), (5, 5)]
+    assert database.check_stock_movements() == []
+    assert database.get_inventory_as_of(taichung, '9999-12-31') == {a: 9}
+
+    # 模擬 v13 資料庫：舊版 INSERT OR REPLACE 留下的重複列
+    database.close_pools()
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute("DROP INDEX idx_store_products_unique")
+    conn.execute('''INSERT INTO store_products (store_id, product_id, price_ex_tax, price_inc_tax, stock)
+        VALUES (?, ?, 130, 136, 12)''', (taichung, a))
+    conn.execute("PRAGMA user_version = 13")
+    conn.commit()
+    conn.close()
+    database.init_db()
+    with database.db_connection() as conn:
+        rows = conn.execute("SELECT price_ex_tax, stock FROM store_products WHERE store_id = ? AND product_id = ?",
+                            (taichung, a)).fetchall()
+    assert [tuple(row) for row in rows] == [(130, 12)]
+    assert database.check_stock_movements() == []
+    assert database.get_stock_movements(taichung, a)[0]['movement_type'] == 'reconcile'
+    try:
+        with database.transaction() as conn:
+            conn.execute("INSERT INTO store_products (store_id, product_id, stock) VALUES (?, ?, 1)", (taichung, a))
+        assert False, "重複列應被唯一索引擋下"
+    except sqlite3.IntegrityError:
+        pass
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  庫存異動日誌與歷史庫存測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_all_paths_write_movements()
+    print("✓ 各路徑寫入庫存異動")
+    with temp_db():
+        test_inventory_as_of()
+    print("✓ 歷史庫存查詢")
+    with temp_db():
+        test_drift_and_upgrade()
+    print("✓ 比對修正與升級")
+    with temp_db():
+        test_readd_store_product()
+    print("✓ 重新設定分店商品")
+
+
+if __name__ == '__main__':
+    main()
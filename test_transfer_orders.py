@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+調貨單測試
+多品項調貨單整批核准：同店同商品依序扣除調出庫存，剩餘庫存不足的明細退回（維持待審核），
+其餘在同一交易內扣調出、加調入庫存；庫存不會被扣成負數。
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from conftest import temp_db
+
+
+def setup_db():
+    database.add_store("台北店", "12345678")
+    database.add_store("台中店", "87654321")
+    stores = {s['code']: s['id'] for s in database.get_stores()}
+    products = [p['id'] for p in database.get_products()]
+    for product_id in products[:3]:
+        database.add_store_product(stores["12345678"], product_id, 100, 105, 10)
+        database.add_store_product(stores["87654321"], product_id, 100, 105, 0)
+    return stores["12345678"], stores["87654321"], products
+
+
+def stock(store_id, product_id):
+    sp = database.get_store_product(store_id, product_id)
+    return sp['stock'] if sp else None
+
+
+def status(transfer_id):
+    with database.db_connection() as conn:
+        return conn.execute("SELECT status FROM inventory_transfers WHERE id = ?", (transfer_id,)).fetchone()[0]
+
+
+def test_bulk_approve_with_availability():
+    """剩餘庫存不足的明細退回，其餘整批核准"""
+    taipei, taichung, products = setup_db()
+    a, b, c, unstocked = products[:4]
+    first = database.create_transfer_order(taipei, taichung, [(a, 6), (b, 4), (unstocked, 1)], "補貨")
+    second = database.create_transfer_order(taipei, taichung, [(a, 5), (c, 10)])
+    assert first['success'] and len(first['transfer_ids']) == 3
+
+    ids = first['transfer_ids'] + second['transfer_ids']
+    result = database.approve_transfers(ids, approved_by=1)
+    rejected = {r['transfer_id']: r['message'] for r in result['rejected']}
+    assert rejected == {first['transfer_ids'][2]: '調出分店沒有此商品',
+                        second['transfer_ids'][0]: '調出分店庫存不足 可調數量: 4'}
+    assert sorted(result['approved']) == sorted([first['transfer_ids'][0], first['transfer_ids'][1],
+                                                 second['transfer_ids'][1]])
+    assert (stock(taipei, a), stock(taipei, b), stock(taipei, c)) == (4, 6, 0)
+    assert (stock(taichung, a), stock(taichung, b), stock(taichung, c)) == (6, 4, 10)
+    assert status(second['transfer_ids'][0]) == 'pending'
+
+    # 已核准的明細不重複扣庫存；補貨後可再核准
+    again = database.approve_transfers(ids, approved_by=1)
+    assert again['approved'] == [] and stock(taipei, a) == 4
+    database.update_store_stock(taipei, a, 1)
+    assert database.approve_transfer_order(second['order_id'], 1)['approved'] == [second['transfer_ids'][0]]
+    assert stock(taipei, a) == 0 and stock(taichung, a) == 11
+
+    orders = {o['id']: o for o in database.get_transfer_orders(taipei)}
+    assert (orders[first['order_id']]['lines'], orders[first['order_id']]['pending_lines']) == (3, 1)
+    assert orders[second['order_id']]['approved_lines'] == 2
+
+
+def test_single_transfer_and_validation():
+    """單筆調貨同樣檢查庫存；調入分店未上架的商品自動新增"""
+    taipei, taichung, products = setup_db()
+    a = products[0]
+    database.add_store("高雄店", "11112222")
+    kaohsiung = [s['id'] for s in database.get_stores() if s['code'] == "11112222"][0]
+    too_many = database.create_transfer(taipei, taichung, a, 11)
+    assert database.approve_transfer(too_many, 1)['rejected'][0]['available'] == 10
+    assert stock(taipei, a) == 10
+
+    ok = database.create_transfer(taipei, kaohsiung, a, 3)
+    assert database.approve_transfer(ok, 1)['approved'] == [ok]
+    assert stock(taipei, a) == 7 and stock(kaohsiung, a) == 3
+
+    # 退回的大量明細不佔用庫存，之後較小的明細仍可核准
+    b = products[1]
+    order = database.create_transfer_order(taipei, taichung, [(b, 11), (b, 3), (b, 4), (b, 5)])
+    result = database.approve_transfers(order['transfer_ids'], 1)
+    assert result['approved'] == order['transfer_ids'][1:3]
+    assert [(r['quantity'], r['available']) for r in result['rejected']] == [(11, 10), (5, 3)]
+    assert stock(taipei, b) == 3 and stock(taichung, b) == 7
+
+    assert not database.create_transfer_order(taipei, taipei, [(a, 1)])['success']
+    assert not database.create_transfer_order(taipei, taichung, [])['success']
+    assert not database.create_transfer_order(taipei, taichung, [(a, 0)])['success']
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("  調貨單測試")
+    print("=" * 60 + "\n")
+    with temp_db():
+        test_bulk_approve_with_availability()
+    print("✓ 整批核准與庫存檢查")
+    with temp_db():
+        test_single_transfer_and_validation()
+    print("✓ 單筆調貨與資料檢查")
+
+
+if __name__ == '__main__':
+    main()